@@ -44,8 +44,10 @@ from fastapi import FastAPI, HTTPException, Request, Depends, Header
 from pydantic import BaseModel, Field
 from starlette.datastructures import UploadFile as StarletteUploadFile
 
+from acestep.audio_codes import parse_audio_codes
 from acestep.handler import AceStepHandler
 from acestep.llm_inference import LLMHandler
+from acestep.pipeline_executor import StagedPipelineExecutor, set_active_pipeline
 from acestep.constants import (
     DEFAULT_DIT_INSTRUCTION,
     DEFAULT_LM_INSTRUCTION,
@@ -366,6 +368,8 @@ PARAM_ALIASES = {
     "src_audio_path": ["src_audio_path", "ctx_audio_path", "sourceAudioPath", "srcAudioPath", "ctxAudioPath"],
     "task_type": ["task_type", "taskType"],
     "infer_method": ["infer_method", "inferMethod"],
+    "lora_name": ["lora_name", "loraName", "lora"],
+    "audio_codes": ["audio_codes", "audioCodes", "audio_code_string"],
     "use_tiled_decode": ["use_tiled_decode", "useTiledDecode"],
     "constrained_decoding": ["constrained_decoding", "constrainedDecoding", "constrained"],
     "constrained_decoding_debug": ["constrained_decoding_debug", "constrainedDecodingDebug"],
@@ -504,6 +508,14 @@ class GenerateMusicRequest(BaseModel):
         default=None,
         description="Custom timesteps (comma-separated, e.g., '0.97,0.76,0.615,0.5,0.395,0.28,0.18,0.085,0'). Overrides inference_steps and shift."
     )
+    audio_codes: Optional[Union[List[int], str]] = Field(
+        default=None,
+        description="Audio semantic codes to condition on instead of LM-generated ones: a JSON array of code ints (compact form) or the '<|audio_code_N|>...' string."
+    )
+    lora_name: Optional[str] = Field(
+        default=None,
+        description="LoRA adapter to use for this request (a directory name under ACESTEP_LORA_DIR or an adapter already loaded on the server). Empty string forces the base model."
+    )
 
     audio_format: str = "mp3"
     use_tiled_decode: bool = True
@@ -814,6 +826,23 @@ def _map_status(status: str) -> int:
     return STATUS_MAP.get(status, 2)
 
 
+def _parse_audio_codes_param(v: Any) -> Optional[Union[List[int], str]]:
+    """Audio codes from a request: JSON array (also as a form string) or code string."""
+    if v is None:
+        return None
+    if isinstance(v, str):
+        v = v.strip()
+        if v.startswith("["):
+            try:
+                return [int(x) for x in json.loads(v)]
+            except (ValueError, TypeError):
+                return None
+        return v or None
+    if isinstance(v, (list, tuple)):
+        return [int(x) for x in v]
+    return None
+
+
 def _parse_timesteps(s: Optional[str]) -> Optional[List[float]]:
     """Parse comma-separated timesteps string to list of floats."""
     if not s or not s.strip():
@@ -970,7 +999,14 @@ def create_app() -> FastAPI:
     set_api_key(api_key)
 
     QUEUE_MAXSIZE = int(os.getenv("ACESTEP_QUEUE_MAXSIZE", "200"))
-    WORKER_COUNT = int(os.getenv("ACESTEP_QUEUE_WORKERS", "1"))  # Single GPU recommended
+    # Single GPU recommended. With the vllm LM backend, more than one worker lets the
+    # LM phases of concurrent jobs join the same continuously batched decode loop,
+    # while DiT generation stays serialized by the handler's generation_lock.
+    WORKER_COUNT = int(os.getenv("ACESTEP_QUEUE_WORKERS", "1"))
+    # Staged pipeline (LM -> DiT -> VAE -> save): with several workers, jobs overlap
+    # stage by stage instead of only in the LM phase. Each stage admits a bounded
+    # number of jobs; DiT and VAE always run one job at a time.
+    PIPELINE_ENABLED = os.getenv("ACESTEP_PIPELINE_EXECUTOR", "").lower() in ("1", "true", "yes")
 
     INITIAL_AVG_JOB_SECONDS = float(os.getenv("ACESTEP_AVG_JOB_SECONDS", "5.0"))
     AVG_WINDOW = int(os.getenv("ACESTEP_AVG_WINDOW", "50"))
@@ -1050,9 +1086,27 @@ def create_app() -> FastAPI:
         app.state._config_path2 = config_path2
         app.state._config_path3 = config_path3
 
-        max_workers = int(os.getenv("ACESTEP_API_WORKERS", "1"))
+        # Each queue worker blocks one executor thread for the whole job, so the pool
+        # must be at least as large as the worker count for jobs to actually overlap
+        max_workers = max(int(os.getenv("ACESTEP_API_WORKERS", "1")), WORKER_COUNT)
         executor = ThreadPoolExecutor(max_workers=max_workers)
 
+        pipeline = None
+        if PIPELINE_ENABLED:
+            # The vllm engine batches concurrent LM requests; the PyTorch backend is not re-entrant
+            lm_backend = os.getenv("ACESTEP_LM_BACKEND", "vllm").strip().lower()
+            default_lm_slots = max(1, WORKER_COUNT) if lm_backend == "vllm" else 1
+            pipeline = StagedPipelineExecutor(
+                stage_slots={
+                    "lm": int(os.getenv("ACESTEP_PIPELINE_LM_SLOTS", str(default_lm_slots))),
+                    "dit": 1,
+                    "vae": 1,
+                    "save": int(os.getenv("ACESTEP_PIPELINE_SAVE_SLOTS", "2")),
+                },
+                max_in_flight=max(1, WORKER_COUNT),
+            )
+            set_active_pipeline(pipeline)
+
         # Queue & observability
         app.state.job_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)  # (job_id, req)
         app.state.pending_ids = deque()  # queued job_ids
@@ -1069,6 +1123,7 @@ def create_app() -> FastAPI:
 
         app.state.handler = handler
         app.state.executor = executor
+        app.state.pipeline = pipeline
         app.state.job_store = store
         app.state._python_executable = sys.executable
         
@@ -1500,7 +1555,7 @@ def create_app() -> FastAPI:
                     instruction=instruction_to_use,
                     reference_audio=req.reference_audio_path,
                     src_audio=req.src_audio_path,
-                    audio_codes="",
+                    audio_codes=parse_audio_codes(req.audio_codes) if req.audio_codes else "",
                     caption=caption,
                     lyrics=lyrics,
                     instrumental=_is_instrumental(lyrics),
@@ -1518,6 +1573,7 @@ def create_app() -> FastAPI:
                     shift=req.shift,
                     infer_method=req.infer_method,
                     timesteps=parsed_timesteps,
+                    lora_name=req.lora_name,
                     repainting_start=req.repainting_start,
                     repainting_end=req.repainting_end if req.repainting_end else -1,
                     audio_cover_strength=req.audio_cover_strength,
@@ -1800,7 +1856,15 @@ def create_app() -> FastAPI:
             t0 = time.time()
             try:
                 loop = asyncio.get_running_loop()
-                result = await loop.run_in_executor(executor, _blocking_generate)
+                pipeline: Optional[StagedPipelineExecutor] = app.state.pipeline
+                if pipeline is not None:
+                    def _pipelined_generate() -> Dict[str, Any]:
+                        with pipeline.job():
+                            return _blocking_generate()
+
+                    result = await loop.run_in_executor(executor, _pipelined_generate)
+                else:
+                    result = await loop.run_in_executor(executor, _blocking_generate)
                 job_store.mark_succeeded(job_id, result)
 
                 # Update local cache
@@ -1980,6 +2044,12 @@ def create_app() -> FastAPI:
             app.state._initialized = True
             print(f"[API Server] Primary model loaded: {_get_model_name(config_path)}")
 
+            # Optionally serve one LoRA adapter merged into the primary DiT weights
+            merge_lora_path = os.getenv("ACESTEP_LORA_MERGE", "").strip()
+            if merge_lora_path:
+                merge_scale = float(os.getenv("ACESTEP_LORA_MERGE_SCALE", "1.0"))
+                print(f"[API Server] {handler.merge_lora(merge_lora_path, merge_scale)}")
+
             # Initialize secondary model if configured
             if handler2 and config_path2:
                 model2_name = _get_model_name(config_path2)
@@ -2151,6 +2221,8 @@ def create_app() -> FastAPI:
             for t in workers:
                 t.cancel()
             executor.shutdown(wait=False, cancel_futures=True)
+            if pipeline is not None:
+                set_active_pipeline(None)
 
     app = FastAPI(title="ACE-Step API", version="1.0", lifespan=lifespan)
 
@@ -2216,6 +2288,8 @@ def create_app() -> FastAPI:
                 cfg_interval_end=p.float("cfg_interval_end", 1.0),
                 infer_method=p.str("infer_method", "ode"),
                 shift=p.float("shift", 3.0),
+                lora_name=p.str("lora_name", None),
+                audio_codes=_parse_audio_codes_param(p.get("audio_codes")),
                 audio_format=p.str("audio_format", "mp3"),
                 use_tiled_decode=p.bool("use_tiled_decode", True),
                 lm_model_path=p.str("lm_model_path") or None,
@@ -2331,6 +2405,27 @@ def create_app() -> FastAPI:
                     ),
                 )
 
+        # Reject adapter selections the target DiT cannot serve (e.g. the base model while a
+        # LoRA is merged) here, instead of failing the job inside generation
+        if req.lora_name is not None:
+            secondary_models = {
+                _get_model_name(getattr(app.state, config_attr))
+                for handler_attr, ready_attr, config_attr in (
+                    ("handler2", "_initialized2", "_config_path2"),
+                    ("handler3", "_initialized3", "_config_path3"),
+                )
+                if getattr(app.state, handler_attr, None) and getattr(app.state, ready_attr, False)
+            }
+            if not req.model or req.model not in secondary_models:
+                lora_error = app.state.handler.lora_request_error(req.lora_name)
+                if lora_error:
+                    for p in temp_files:
+                        try:
+                            os.remove(p)
+                        except Exception:
+                            pass
+                    raise HTTPException(status_code=400, detail=lora_error)
+
         rec = store.create()
 
         q: asyncio.Queue = app.state.job_queue
@@ -2493,6 +2588,7 @@ def create_app() -> FastAPI:
             "queue_size": app.state.job_queue.qsize(),
             "queue_maxsize": QUEUE_MAXSIZE,
             "avg_job_seconds": avg_job_seconds,
+            "pipeline": app.state.pipeline.get_stats() if app.state.pipeline is not None else None,
         })
 
     @app.get("/v1/models")
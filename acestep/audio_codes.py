@@ -0,0 +1,121 @@
+"""
+Compact audio-code representation
+
+Audio codes (5Hz semantic tokens, codebook size 64000) are carried between the LM,
+acestep.inference and AceStepHandler as 1D uint16 numpy arrays. The
+``<|audio_code_N|>`` string form is only produced at the edges: LM prompts, the
+Gradio textbox and JSON results. Every function here also accepts the string form,
+so callers can pass whatever they received.
+"""
+
+import re
+from typing import Any, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from loguru import logger
+
+MAX_AUDIO_CODE = 63999  # Maximum valid audio code value (codebook size = 64000)
+AUDIO_CODE_DTYPE = np.uint16
+
+AudioCodesLike = Union[str, np.ndarray, torch.Tensor, Sequence[int]]
+
+_AUDIO_CODE_PATTERN = re.compile(r"<\|audio_code_(\d+)\|>")
+_EMPTY_CODES = np.zeros(0, dtype=AUDIO_CODE_DTYPE)
+_EMPTY_CODES.flags.writeable = False
+
+
+def _is_int_sequence(value: Any) -> bool:
+    return isinstance(value, (list, tuple)) and len(value) > 0 and all(
+        isinstance(x, (int, np.integer)) for x in value
+    )
+
+
+def is_audio_codes_batch(value: Any) -> bool:
+    """
+    True for a per-item list (of strings / arrays / None); a plain list of ints is one item.
+    """
+    return isinstance(value, (list, tuple)) and not _is_int_sequence(value)
+
+
+def parse_audio_codes(value: Optional[AudioCodesLike]) -> np.ndarray:
+    """
+    Convert audio codes in any supported form to a 1D uint16 array.
+
+    Values outside [0, MAX_AUDIO_CODE] are clamped (with a warning) so they always
+    index into the quantizer's codebook.
+    """
+    if value is None:
+        return _EMPTY_CODES
+    if isinstance(value, np.ndarray) and value.dtype == AUDIO_CODE_DTYPE:
+        return value.reshape(-1)
+    if isinstance(value, torch.Tensor):
+        value = value.detach().to("cpu").numpy()
+    if isinstance(value, str):
+        digits = _AUDIO_CODE_PATTERN.findall(value)
+        if not digits:
+            return _EMPTY_CODES
+        try:
+            codes = np.array(digits, dtype=np.int64)
+        except OverflowError:
+            codes = np.array([min(int(x), MAX_AUDIO_CODE) for x in digits], dtype=np.int64)
+    else:
+        codes = np.asarray(value, dtype=np.int64).reshape(-1)
+
+    out_of_range = (codes < 0) | (codes > MAX_AUDIO_CODE)
+    if out_of_range.any():
+        logger.warning(f"[parse_audio_codes] Clamped {int(out_of_range.sum())} audio code value(s) to valid range [0, {MAX_AUDIO_CODE}]")
+        codes = np.clip(codes, 0, MAX_AUDIO_CODE)
+    return codes.astype(AUDIO_CODE_DTYPE)
+
+
+def format_audio_codes(value: Optional[AudioCodesLike]) -> str:
+    """String form ``<|audio_code_N|>...`` of audio codes (strings pass through unchanged)."""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return "".join([f"<|audio_code_{code}|>" for code in parse_audio_codes(value).tolist()])
+
+
+def count_audio_codes(value: Optional[AudioCodesLike]) -> int:
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return value.count("<|audio_code_")
+    if isinstance(value, (np.ndarray, torch.Tensor)):
+        return int(value.numel() if isinstance(value, torch.Tensor) else value.size)
+    return len(value)
+
+
+def has_audio_codes(value: Any) -> bool:
+    """Whether ``value`` (one item or a per-item list) contains any audio codes."""
+    if value is None:
+        return False
+    if isinstance(value, str):
+        return bool(value.strip())
+    if is_audio_codes_batch(value):
+        return any(has_audio_codes(item) for item in value)
+    return count_audio_codes(value) > 0
+
+
+def audio_codes_to_json(value: Any) -> Any:
+    """String form of one item or a per-item list, for JSON results and UUID hashing."""
+    if is_audio_codes_batch(value):
+        return [audio_codes_to_json(item) for item in value]
+    if value is None or isinstance(value, str):
+        return value
+    return format_audio_codes(value)
+
+
+def audio_codes_list(value: Any, batch_size: int) -> List[Optional[np.ndarray]]:
+    """Per-item uint16 arrays for a batch (None where an item has no codes)."""
+    items = list(value) if is_audio_codes_batch(value) else [value] * batch_size
+    if len(items) == 1 and batch_size > 1:
+        items = items * batch_size
+    items = (items + [None] * batch_size)[:batch_size]
+    result = []
+    for item in items:
+        codes = parse_audio_codes(item)
+        result.append(codes if codes.size > 0 else None)
+    return result
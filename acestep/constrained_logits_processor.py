@@ -20,6 +20,11 @@ Usage:
     outputs = model.generate(inputs, logits_processor=[processor])
 """
 
+import copy
+import hashlib
+import json
+import threading
+from collections import OrderedDict
 from enum import Enum, auto
 from typing import Optional, Dict, Any, Tuple, List, Callable, Set
 from loguru import logger
@@ -47,6 +52,15 @@ from acestep.constants import (
 MAX_AUDIO_CODE = 63999  # Maximum valid audio code value (codebook size = 64000)
 
 
+# ==============================================================================
+# Precompiled Token Tables
+# ==============================================================================
+# Bump when the layout of the on-disk token tables changes
+TOKEN_TABLES_CACHE_VERSION = 1
+# Max number of whitelist masks kept per processor (one [vocab_size] bool tensor each)
+WHITELIST_MASK_CACHE_SIZE = 256
+
+
 # ==============================================================================
 # FSM States for Constrained Decoding
 # ==============================================================================
@@ -99,6 +113,23 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
     the previous token was a period and newline has the highest probability.
     """
     
+    # Mutable FSM fields that make up the state of one generated sequence.
+    # Single-sequence decoding uses them directly as attributes; batched decoding
+    # keeps one column per sequence in a struct-of-arrays (see process_batch).
+    FSM_STATE_FIELDS = (
+        "state",
+        "position_in_state",
+        "accumulated_value",
+        "accumulated_token_ids",
+        "codes_count",
+        "user_field_token_queue",
+        "current_user_field",
+        "caption_after_newline",
+        "caption_token_count",
+        "caption_ending",
+        "pending_field_name",
+    )
+    
     def __init__(
         self,
         tokenizer: AutoTokenizer,
@@ -107,6 +138,7 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         genres_vocab_path: Optional[str] = None,
         skip_genres: bool = True,
         max_duration: Optional[int] = None,
+        cache_dir: Optional[str] = None,
     ):
         """
         Initialize the constrained logits processor.
@@ -120,6 +152,9 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
             genres_vocab_path: Path to genres vocabulary file
             skip_genres: Whether to skip genres field generation
             max_duration: Maximum duration in seconds (default: DURATION_MAX from constants)
+            cache_dir: Directory for the precompiled token tables. When set, the
+                vocabulary scans and prefix trees are loaded from (or saved to) a
+                file keyed by the tokenizer fingerprint, so startup skips them.
         """
         self.tokenizer = tokenizer
         self.enabled = enabled
@@ -180,6 +215,23 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         self.user_field_token_queue: List[int] = []
         self.current_user_field: Optional[str] = None  # Current field being injected
         
+        # Per-sequence FSM state for batched decoding (struct-of-arrays):
+        # _seq_state[field][slot] holds FSM_STATE_FIELDS for each sequence,
+        # _seq_slots maps a caller-provided sequence id to its slot
+        self._seq_slots: Dict[int, int] = {}
+        self._seq_state: Dict[str, list] = {name: [] for name in self.FSM_STATE_FIELDS}
+        
+        # Whitelist masks compiled on first use, keyed by the allowed token set.
+        # Shared between forks (read-only once built), hence the lock.
+        self._whitelist_masks: "OrderedDict[Tuple, torch.Tensor]" = OrderedDict()
+        self._whitelist_masks_lock = threading.Lock()
+        
+        # Load precompiled token tables (vocab scans + prefix trees) if available
+        self.cache_dir = cache_dir
+        self._token_tables_path: Optional[str] = None
+        self._token_tables_key: Optional[str] = None
+        self._cached_token_tables: Optional[Dict[str, Any]] = self._load_token_tables()
+        
         # Pre-compute token IDs for efficiency
         self._precompute_tokens()
 
@@ -212,30 +264,50 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         self.valid_duration_values = [str(v) for v in range(self.field_specs["duration"]["min"], self.field_specs["duration"]["max"] + 1)]
         self.valid_timesig_values = [str(v) for v in self.field_specs["timesignature"]["valid_values"]]
         
-        # Build keyscale prefix tree (requires _char_to_tokens to be initialized)
-        self.keyscale_prefix_tree = self._build_keyscale_prefix_tree()
-        
-        # Build numeric prefix trees (BPM, Duration, Timesignature) with context
-        # IMPORTANT: State machine generates "bpm:" (no space), but tokenizer sees "bpm: " (with space)
-        # Use same logic as keyscale: context_prefix_for_matching (no space) and context_prefix_for_tokenization (with space)
-        self.bpm_prefix_tree = self._build_numeric_prefix_tree(
-            self.valid_bpm_values, 
-            context_prefix_for_matching="bpm:",
-            context_prefix_for_tokenization="bpm: "
-        )
-        self.duration_prefix_tree = self._build_numeric_prefix_tree(
-            self.valid_duration_values,
-            context_prefix_for_matching="duration:",
-            context_prefix_for_tokenization="duration: "
-        )
-        self.timesig_prefix_tree = self._build_numeric_prefix_tree(
-            self.valid_timesig_values,
-            context_prefix_for_matching="timesignature:",
-            context_prefix_for_tokenization="timesignature: "
-        )
-        
-        # Build language prefix tree (similar to keyscale but for language codes)
-        self.language_prefix_tree = self._build_language_prefix_tree()
+        cached = self._cached_token_tables
+        if cached is not None:
+            # Prefix trees only depend on the tokenizer and constants, except the
+            # duration tree which also depends on max_duration
+            self.keyscale_prefix_tree = cached["keyscale_prefix_tree"]
+            self.bpm_prefix_tree = cached["bpm_prefix_tree"]
+            self.timesig_prefix_tree = cached["timesig_prefix_tree"]
+            self.language_prefix_tree = cached["language_prefix_tree"]
+            if cached["max_duration"] == self.max_duration:
+                self.duration_prefix_tree = cached["duration_prefix_tree"]
+            else:
+                self.duration_prefix_tree = self._build_numeric_prefix_tree(
+                    self.valid_duration_values,
+                    context_prefix_for_matching="duration:",
+                    context_prefix_for_tokenization="duration: "
+                )
+        else:
+            # Build keyscale prefix tree (requires _char_to_tokens to be initialized)
+            self.keyscale_prefix_tree = self._build_keyscale_prefix_tree()
+        
+            # Build numeric prefix trees (BPM, Duration, Timesignature) with context
+            # IMPORTANT: State machine generates "bpm:" (no space), but tokenizer sees "bpm: " (with space)
+            # Use same logic as keyscale: context_prefix_for_matching (no space) and context_prefix_for_tokenization (with space)
+            self.bpm_prefix_tree = self._build_numeric_prefix_tree(
+                self.valid_bpm_values, 
+                context_prefix_for_matching="bpm:",
+                context_prefix_for_tokenization="bpm: "
+            )
+            self.duration_prefix_tree = self._build_numeric_prefix_tree(
+                self.valid_duration_values,
+                context_prefix_for_matching="duration:",
+                context_prefix_for_tokenization="duration: "
+            )
+            self.timesig_prefix_tree = self._build_numeric_prefix_tree(
+                self.valid_timesig_values,
+                context_prefix_for_matching="timesignature:",
+                context_prefix_for_tokenization="timesignature: "
+            )
+        
+            # Build language prefix tree (similar to keyscale but for language codes)
+            self.language_prefix_tree = self._build_language_prefix_tree()
+            
+            self._save_token_tables()
+        self._cached_token_tables = None  # Only needed during __init__
 
         self._load_genres_vocab()
         
@@ -551,6 +623,10 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         These tokens should be blocked during caption generation.
         Only tokens with code values in range [0, MAX_AUDIO_CODE] are included.
         """
+        if self._cached_token_tables is not None:
+            self.audio_code_token_ids = set(self._cached_token_tables["audio_code_token_ids"])
+            return
+        
         import re
         audio_code_pattern = re.compile(r'^<\|audio_code_(\d+)\|>$')
         invalid_tokens_count = 0
@@ -650,9 +726,10 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         """
         Apply whitelist constraint inplace: only allow specified tokens, block all others.
         
-        This is more efficient than creating a mask tensor because:
-        1. No memory allocation for mask
-        2. No tensor addition operation
+        A single allowed token is handled with plain indexing. Larger whitelists
+        (prefix-tree nodes, digit sets, genre continuations) use a precompiled
+        blocking mask, so each step is one masked_fill_ with no host-to-device
+        copy of the token list.
         
         Args:
             scores: [1, vocab_size] scores tensor to modify inplace
@@ -663,15 +740,143 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
             scores.fill_(float('-inf'))
             return
         
-        # Save the original values of allowed tokens
-        allowed_indices = torch.tensor(allowed_tokens, device=scores.device, dtype=torch.long)
-        saved_values = scores[0, allowed_indices].clone()
+        if len(allowed_tokens) == 1:
+            token_id = allowed_tokens[0]
+            saved_value = scores[:, token_id].clone()
+            scores.fill_(float('-inf'))
+            scores[:, token_id] = saved_value
+            return
+        
+        blocked = self._get_whitelist_mask(allowed_tokens, scores.shape[-1], scores.device)
+        scores.masked_fill_(blocked, float('-inf'))
+    
+    def _get_whitelist_mask(self, allowed_tokens: List[int], width: int, device: torch.device) -> torch.Tensor:
+        """
+        Get the compiled blocking mask for a whitelist.
+        
+        Masks are built once per distinct allowed set and device, and kept in a
+        bounded LRU shared by all forks of this processor.
+        
+        Args:
+            allowed_tokens: Token IDs to allow
+            width: Size of the logits' last dimension (may exceed len(tokenizer))
+            device: Device of the logits
+            
+        Returns:
+            [width] bool tensor, True for tokens that must be blocked
+        """
+        key = (str(device), width, tuple(sorted(set(allowed_tokens))))
+        with self._whitelist_masks_lock:
+            mask = self._whitelist_masks.get(key)
+            if mask is not None:
+                self._whitelist_masks.move_to_end(key)
+                return mask
+        
+        mask = torch.ones(width, dtype=torch.bool)
+        mask[list(key[2])] = False
+        mask = mask.to(device)
+        
+        with self._whitelist_masks_lock:
+            self._whitelist_masks[key] = mask
+            while len(self._whitelist_masks) > WHITELIST_MASK_CACHE_SIZE:
+                self._whitelist_masks.popitem(last=False)
+        return mask
+    
+    def _token_tables_fingerprint(self) -> str:
+        """
+        Hash everything the precompiled token tables depend on: the tokenizer
+        vocabulary (including added tokens) and the constants the prefix trees
+        are built from.
+        """
+        h = hashlib.sha256()
+        h.update(f"v{TOKEN_TABLES_CACHE_VERSION}|{type(self.tokenizer).__name__}|{len(self.tokenizer)}\n".encode("utf-8"))
+        for token, token_id in sorted(self.tokenizer.get_vocab().items(), key=lambda item: item[1]):
+            h.update(f"{token_id}\t{token}\n".encode("utf-8"))
+        constants = (
+            MAX_AUDIO_CODE, sorted(VALID_KEYSCALES), sorted(VALID_LANGUAGES),
+            BPM_MIN, BPM_MAX, DURATION_MIN, list(VALID_TIME_SIGNATURES),
+        )
+        h.update(repr(constants).encode("utf-8"))
+        return h.hexdigest()
+    
+    @staticmethod
+    def _encode_prefix_tree(tree: Dict[Tuple[int, ...], Set[int]]) -> List[List[List[int]]]:
+        return [[list(prefix), sorted(allowed)] for prefix, allowed in tree.items()]
+    
+    @staticmethod
+    def _decode_prefix_tree(entries: List[List[List[int]]]) -> Dict[Tuple[int, ...], Set[int]]:
+        return {tuple(prefix): set(allowed) for prefix, allowed in entries}
+    
+    def _load_token_tables(self) -> Optional[Dict[str, Any]]:
+        """
+        Load the precompiled token tables for this tokenizer from cache_dir.
+        
+        Returns:
+            Decoded tables, or None if caching is disabled or no valid file exists
+        """
+        if not self.cache_dir:
+            return None
+        try:
+            fingerprint = self._token_tables_fingerprint()
+        except Exception as e:
+            logger.warning(f"Could not fingerprint tokenizer, token table cache disabled: {e}")
+            return None
+        self._token_tables_key = fingerprint
+        self._token_tables_path = os.path.join(self.cache_dir, f"token_tables_{fingerprint[:32]}.json")
+        if not os.path.exists(self._token_tables_path):
+            return None
         
-        # Set all scores to -inf
-        scores.fill_(float('-inf'))
+        try:
+            with open(self._token_tables_path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            if payload.get("version") != TOKEN_TABLES_CACHE_VERSION or payload.get("fingerprint") != fingerprint:
+                return None
+            tables = {
+                "audio_code_token_ids": payload["audio_code_token_ids"],
+                "char_to_tokens": {char: set(ids) for char, ids in payload["char_to_tokens"].items()},
+                "token_to_text": {int(token_id): text for token_id, text in payload["token_to_text"].items()},
+                "max_duration": payload["max_duration"],
+            }
+            for name in ("keyscale", "bpm", "duration", "timesig", "language"):
+                tables[f"{name}_prefix_tree"] = self._decode_prefix_tree(payload[f"{name}_prefix_tree"])
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable token table cache {self._token_tables_path}: {e}")
+            return None
         
-        # Restore allowed token values
-        scores[0, allowed_indices] = saved_values
+        logger.info(f"Loaded precompiled token tables from {self._token_tables_path}")
+        return tables
+    
+    def _save_token_tables(self):
+        """Persist the vocab scans and prefix trees so the next startup can skip them."""
+        if not self._token_tables_path:
+            return
+        payload = {
+            "version": TOKEN_TABLES_CACHE_VERSION,
+            "fingerprint": self._token_tables_key,
+            "audio_code_token_ids": sorted(self.audio_code_token_ids),
+            "char_to_tokens": {char: sorted(ids) for char, ids in self._char_to_tokens.items()},
+            "token_to_text": {str(token_id): text for token_id, text in self._token_to_text.items()},
+            "max_duration": self.max_duration,
+            "keyscale_prefix_tree": self._encode_prefix_tree(self.keyscale_prefix_tree),
+            "bpm_prefix_tree": self._encode_prefix_tree(self.bpm_prefix_tree),
+            "duration_prefix_tree": self._encode_prefix_tree(self.duration_prefix_tree),
+            "timesig_prefix_tree": self._encode_prefix_tree(self.timesig_prefix_tree),
+            "language_prefix_tree": self._encode_prefix_tree(self.language_prefix_tree),
+        }
+        tmp_path = f"{self._token_tables_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(payload, f, ensure_ascii=False)
+            # Atomic rename so concurrent processes never read a partial file
+            os.replace(tmp_path, self._token_tables_path)
+            logger.info(f"Saved precompiled token tables to {self._token_tables_path}")
+        except OSError as e:
+            logger.warning(f"Could not save token table cache to {self.cache_dir}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def _build_keyscale_prefix_tree(self) -> Dict[Tuple[int, ...], Set[int]]:
         """
@@ -1086,6 +1291,11 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         Note: Many subword tokenizers (like Qwen) add space prefixes to tokens.
         We need to handle both the raw first char and the first non-space char.
         """
+        if self._cached_token_tables is not None:
+            self._char_to_tokens = self._cached_token_tables["char_to_tokens"]
+            self._token_to_text = self._cached_token_tables["token_to_text"]
+            return
+        
         self._char_to_tokens: Dict[str, set] = {}
         self._token_to_text: Dict[int, str] = {}  # Precomputed decoded text for each token
         
@@ -1268,6 +1478,24 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         
         return list(allowed)
     
+    def fork(self) -> "MetadataConstrainedLogitsProcessor":
+        """
+        Create an independent processor for one generation request.
+        
+        The precomputed token tables, prefix trees and masks are shared with this
+        instance (they are read-only after __init__), while the FSM state and the
+        per-generation settings are private to the fork. This lets concurrent
+        requests that share one running batch each drive their own FSM.
+        
+        Returns:
+            A reset processor that can be configured without affecting this one
+        """
+        forked = copy.copy(self)
+        # set_user_metadata() mutates this dict in place, so it must not be shared
+        forked.user_provided_metadata = dict(self.user_provided_metadata)
+        forked.reset()
+        return forked
+    
     def reset(self):
         """Reset the processor state for a new generation."""
         self.state = FSMState.THINK_TAG
@@ -1281,6 +1509,41 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         self.caption_token_count = 0  # Reset caption token count
         self.caption_ending = False  # Reset caption ending tracking
         self.pending_field_name = ""  # Reset pending field name
+        self._seq_slots = {}  # Drop per-sequence batch state
+        self._seq_state = {name: [] for name in self.FSM_STATE_FIELDS}
+    
+    def _get_slot(self, seq_id: int) -> int:
+        """Return the state slot of a sequence, creating a fresh FSM state on first use."""
+        slot = self._seq_slots.get(seq_id)
+        if slot is None:
+            slot = len(self._seq_state["state"])
+            self._seq_slots[seq_id] = slot
+            defaults = {
+                "state": FSMState.THINK_TAG,
+                "position_in_state": 0,
+                "accumulated_value": "",
+                "accumulated_token_ids": [],
+                "codes_count": 0,
+                "user_field_token_queue": [],
+                "current_user_field": None,
+                "caption_after_newline": False,
+                "caption_token_count": 0,
+                "caption_ending": False,
+                "pending_field_name": "",
+            }
+            for name in self.FSM_STATE_FIELDS:
+                self._seq_state[name].append(defaults[name])
+        return slot
+    
+    def _load_slot(self, slot: int):
+        """Load a sequence's FSM state into the scalar attributes used by the FSM logic."""
+        for name in self.FSM_STATE_FIELDS:
+            setattr(self, name, self._seq_state[name][slot])
+    
+    def _store_slot(self, slot: int):
+        """Write the scalar FSM attributes back into a sequence's slot."""
+        for name in self.FSM_STATE_FIELDS:
+            self._seq_state[name][slot] = getattr(self, name)
     
     def set_target_duration(self, duration: Optional[float]):
         """
@@ -1580,6 +1843,10 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         Returns:
             Modified scores with invalid tokens masked to -inf and temperature scaling applied
         """
+        if scores.shape[0] > 1:
+            # Each row follows its own FSM; rows are identified by batch index
+            return self.process_batch(list(range(scores.shape[0])), input_ids, scores)
+        
         if not self.enabled:
             return self._apply_temperature_scaling(scores)
         
@@ -1643,7 +1910,7 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         Check if input contains the </think> closing tag.
         
         Args:
-            input_ids: [batch_size, seq_len] input token IDs
+            input_ids: [batch_size, seq_len] input token IDs (tensor or list of token id lists)
             
         Returns:
             True if </think> is found in the input (any sequence in batch)
@@ -1654,8 +1921,8 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
             return False
         
         # Check each sequence in batch
-        for b in range(input_ids.shape[0]):
-            seq = input_ids[b].tolist()
+        for row in input_ids:
+            seq = row.tolist() if hasattr(row, "tolist") else list(row)
             # Search for the token sequence in the input
             for i in range(len(seq) - len(think_end_tokens) + 1):
                 if seq[i:i+len(think_end_tokens)] == think_end_tokens:
@@ -1694,6 +1961,200 @@ class MetadataConstrainedLogitsProcessor(LogitsProcessor):
         # Apply temperature scaling
         return scores / temperature
     
+    def process_batch(
+        self,
+        seq_ids: List[int],
+        input_ids: Any,
+        scores: torch.FloatTensor,
+    ) -> torch.FloatTensor:
+        """
+        Apply constrained decoding to a batch in which every sequence follows its own FSM.
+        
+        Rows in CODES_GENERATION (the bulk of decoding steps) are masked together with
+        one vectorized op, including the per-row duration (EOS) constraint. Rows still
+        generating metadata go through the single-sequence FSM logic on their own state
+        slot, since their constraints depend on the row's logits.
+        
+        Args:
+            seq_ids: Stable id per row (e.g. nano-vllm seq_id or batch row index)
+            input_ids: Per-row token IDs ([batch_size, seq_len] tensor or list of lists);
+                       only used to detect a prompt that already contains </think>
+            scores: [batch_size, vocab_size] logits for next token
+            
+        Returns:
+            Modified scores with per-row masks and temperature scaling applied
+        """
+        slots = [self._get_slot(seq_id) for seq_id in seq_ids]
+        states = self._seq_state["state"]
+        
+        if self.enabled:
+            # For codes phase, rows whose input already contains </think> skip to CODES_GENERATION
+            if self.generation_phase == "codes":
+                for b, slot in enumerate(slots):
+                    if states[slot] == FSMState.THINK_TAG and self._input_contains_think_end_tag(input_ids[b:b+1]):
+                        states[slot] = FSMState.CODES_GENERATION
+                        self._seq_state["codes_count"][slot] = 0
+            
+            codes_rows = [b for b, slot in enumerate(slots) if states[slot] == FSMState.CODES_GENERATION]
+            completed_rows = [b for b, slot in enumerate(slots) if states[slot] == FSMState.COMPLETED]
+            metadata_rows = [b for b, slot in enumerate(slots)
+                             if states[slot] not in (FSMState.CODES_GENERATION, FSMState.COMPLETED)]
+            
+            if codes_rows:
+                scores = self._apply_codes_constraints_batch(scores, codes_rows, [slots[b] for b in codes_rows])
+            
+            # In understanding phase, block audio codes during lyrics generation (COMPLETED state)
+            if completed_rows and self.generation_phase == "understand" and self.audio_code_mask is not None:
+                if self.audio_code_mask.device != scores.device or self.audio_code_mask.dtype != scores.dtype:
+                    self.audio_code_mask = self.audio_code_mask.to(device=scores.device, dtype=scores.dtype)
+                scores = self._add_mask_to_rows(scores, completed_rows, self.audio_code_mask)
+            
+            for b in metadata_rows:
+                self._load_slot(slots[b])
+                result = self._process_single_sequence(input_ids[b], scores[b:b+1])
+                scores[b] = result[0]
+                self._store_slot(slots[b])
+        
+        return self._apply_temperature_scaling_batch(scores, slots)
+    
+    def update_state_batch(self, seq_ids: List[int], token_ids: List[int]):
+        """
+        Update the FSM state of each sequence after one batched sampling step.
+        
+        Args:
+            seq_ids: Stable id per row, matching the ids passed to process_batch()
+            token_ids: Token sampled for each row
+        """
+        if not self.enabled:
+            return
+        
+        states = self._seq_state["state"]
+        codes_counts = self._seq_state["codes_count"]
+        for seq_id, token_id in zip(seq_ids, token_ids):
+            slot = self._get_slot(seq_id)
+            state = states[slot]
+            if state == FSMState.COMPLETED:
+                continue
+            if state == FSMState.CODES_GENERATION:
+                # Fast path: only the codes counter changes during codes generation
+                codes_counts[slot] += 1
+                continue
+            self._load_slot(slot)
+            self.update_state(int(token_id))
+            self._store_slot(slot)
+    
+    def speculation_ready(self, seq_id: int) -> bool:
+        """
+        Whether the sequence's constraints for the next few tokens are known without
+        running the FSM, so speculative decoding can verify draft tokens for it
+        (see process_batch_lookahead). True in CODES_GENERATION and COMPLETED.
+        """
+        if not self.enabled:
+            return True
+        state = self._seq_state["state"][self._get_slot(seq_id)]
+        return state == FSMState.CODES_GENERATION or state == FSMState.COMPLETED
+    
+    def process_batch_lookahead(
+        self,
+        seq_ids: List[int],
+        scores: torch.FloatTensor,
+        offsets: List[int],
+    ) -> torch.FloatTensor:
+        """
+        process_batch() for speculative positions: row b gets the constraints that
+        apply after offsets[b] more tokens have been accepted for its sequence.
+        
+        Only valid while speculation_ready(seq_id): in CODES_GENERATION each accepted
+        token is an audio code (anything else is masked) and advances the codes count
+        by one, so the duration (EOS) constraint is evaluated at codes_count + offset.
+        Does not change any FSM state; update_state_batch() is still called once per
+        accepted token.
+        """
+        slots = [self._get_slot(seq_id) for seq_id in seq_ids]
+        states = self._seq_state["state"]
+        
+        if self.enabled:
+            codes_rows = [b for b, slot in enumerate(slots) if states[slot] == FSMState.CODES_GENERATION]
+            completed_rows = [b for b, slot in enumerate(slots) if states[slot] == FSMState.COMPLETED]
+            if codes_rows:
+                scores = self._apply_codes_constraints_batch(
+                    scores, codes_rows, [slots[b] for b in codes_rows], [offsets[b] for b in codes_rows]
+                )
+            if completed_rows and self.generation_phase == "understand" and self.audio_code_mask is not None:
+                if self.audio_code_mask.device != scores.device or self.audio_code_mask.dtype != scores.dtype:
+                    self.audio_code_mask = self.audio_code_mask.to(device=scores.device, dtype=scores.dtype)
+                scores = self._add_mask_to_rows(scores, completed_rows, self.audio_code_mask)
+        
+        return self._apply_temperature_scaling_batch(scores, slots)
+    
+    @staticmethod
+    def _add_mask_to_rows(scores: torch.FloatTensor, rows: List[int], mask: torch.Tensor) -> torch.FloatTensor:
+        """Add a [1, vocab_size] mask to the given rows (whole batch in one op when possible)."""
+        if len(rows) == scores.shape[0]:
+            return scores + mask
+        row_index = torch.tensor(rows, device=scores.device, dtype=torch.long)
+        scores[row_index] = scores[row_index] + mask
+        return scores
+    
+    def _apply_codes_constraints_batch(
+        self,
+        scores: torch.FloatTensor,
+        rows: List[int],
+        slots: List[int],
+        count_offsets: Optional[List[int]] = None,
+    ) -> torch.FloatTensor:
+        """Vectorized CODES_GENERATION masking: audio codes only, EOS gated per row by its codes count
+        (plus count_offsets[n] for speculative lookahead rows)."""
+        if self.non_audio_code_mask is not None:
+            if self.non_audio_code_mask.device != scores.device or self.non_audio_code_mask.dtype != scores.dtype:
+                self.non_audio_code_mask = self.non_audio_code_mask.to(device=scores.device, dtype=scores.dtype)
+            scores = self._add_mask_to_rows(scores, rows, self.non_audio_code_mask)
+        
+        if self.target_codes is not None and self.eos_token_id is not None:
+            codes_counts = self._seq_state["codes_count"]
+            counts = [codes_counts[slot] for slot in slots]
+            if count_offsets is not None:
+                counts = [count + offset for count, offset in zip(counts, count_offsets)]
+            below_target = [b for b, count in zip(rows, counts) if count < self.target_codes]
+            reached_target = [b for b, count in zip(rows, counts) if count >= self.target_codes]
+            if below_target:
+                # Block EOS token until target codes count is reached
+                below_index = torch.tensor(below_target, device=scores.device, dtype=torch.long)
+                scores[below_index, self.eos_token_id] = float('-inf')
+            if reached_target:
+                # Force EOS token when target codes count is reached
+                reached_index = torch.tensor(reached_target, device=scores.device, dtype=torch.long)
+                eos_scores = scores[reached_index, self.eos_token_id].clone()
+                scores[reached_index] = float('-inf')
+                scores[reached_index, self.eos_token_id] = eos_scores
+            if self.debug:
+                logger.debug(f"Codes generation (batch): {len(below_target)} rows below target, {len(reached_target)} rows forced to EOS")
+        return scores
+    
+    def _apply_temperature_scaling_batch(self, scores: torch.FloatTensor, slots: List[int]) -> torch.FloatTensor:
+        """Per-row phase temperature scaling (codes vs metadata temperature), applied in one op."""
+        if self.codes_temperature is None and self.metadata_temperature is None:
+            return scores
+        
+        states = self._seq_state["state"]
+        temperatures = []
+        for slot in slots:
+            if states[slot] == FSMState.CODES_GENERATION or states[slot] == FSMState.COMPLETED:
+                temperature = self.codes_temperature
+            else:
+                temperature = self.metadata_temperature
+            if temperature is None:
+                temperature = 1.0
+            elif temperature <= 0:
+                # Avoid division by zero
+                temperature = 1e-6
+            temperatures.append(temperature)
+        
+        if all(t == temperatures[0] for t in temperatures):
+            return scores / temperatures[0] if temperatures[0] != 1.0 else scores
+        temperature_tensor = torch.tensor(temperatures, device=scores.device, dtype=scores.dtype).unsqueeze(1)
+        return scores / temperature_tensor
+    
     def _get_user_provided_field_tokens(self, field_name: str) -> Optional[List[int]]:
         """
         Get token sequence for a user-provided field (field_name + value + newline).
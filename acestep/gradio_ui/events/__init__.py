@@ -965,11 +965,12 @@ def setup_training_event_handlers(demo, dit_handler, llm_handler, training_secti
     
     # ========== Dataset Builder Handlers ==========
     
-    # Scan directory for audio files
+    # Scan directory for audio files (streams partial results for large directories)
+    def scan_wrapper(dir, name, tag, pos, instr, state):
+        yield from train_h.scan_directory(dir, name, tag, pos, instr, state)
+    
     training_section["scan_btn"].click(
-        fn=lambda dir, name, tag, pos, instr, state: train_h.scan_directory(
-            dir, name, tag, pos, instr, state
-        ),
+        fn=scan_wrapper,
         inputs=[
             training_section["audio_directory"],
             training_section["dataset_name"],
@@ -988,8 +989,8 @@ def setup_training_event_handlers(demo, dit_handler, llm_handler, training_secti
     
     # Auto-label all samples
     training_section["auto_label_btn"].click(
-        fn=lambda state, skip, fmt_lyrics, trans_lyrics, only_unlab: train_h.auto_label_all(
-            dit_handler, llm_handler, state, skip, fmt_lyrics, trans_lyrics, only_unlab
+        fn=lambda state, skip, fmt_lyrics, trans_lyrics, only_unlab, save_path: train_h.auto_label_all(
+            dit_handler, llm_handler, state, skip, fmt_lyrics, trans_lyrics, only_unlab, save_path=save_path
         ),
         inputs=[
             training_section["dataset_builder_state"],
@@ -997,6 +998,7 @@ def setup_training_event_handlers(demo, dit_handler, llm_handler, training_secti
             training_section["format_lyrics"],
             training_section["transcribe_lyrics"],
             training_section["only_unlabeled"],
+            training_section["save_path"],
         ],
         outputs=[
             training_section["audio_files_table"],
@@ -35,14 +35,18 @@ def scan_directory(
     tag_position: str,
     all_instrumental: bool,
     builder_state: Optional[DatasetBuilder],
-) -> Tuple[Any, str, Any, DatasetBuilder]:
+):
     """Scan a directory for audio files.
-    
-    Returns:
+
+    Generator: partial tables are yielded while large directories are still being
+    scanned, followed by the final result.
+
+    Yields:
         Tuple of (table_data, status, slider_update, builder_state)
     """
     if not audio_dir or not audio_dir.strip():
-        return [], "� Please enter a directory path", _safe_slider(0, value=0, visible=False), builder_state
+        yield [], "� Please enter a directory path", _safe_slider(0, value=0, visible=False), builder_state
+        return
     
     # Create or use existing builder
     builder = builder_state if builder_state else DatasetBuilder()
@@ -53,11 +57,15 @@ def scan_directory(
     builder.metadata.tag_position = tag_position
     builder.metadata.all_instrumental = all_instrumental
     
-    # Scan directory
-    samples, status = builder.scan_directory(audio_dir.strip())
+    # Scan directory, streaming partial results to the table
+    samples, status = [], ""
+    for samples, status in builder.iter_scan_directory(audio_dir.strip()):
+        if status.startswith("🔍"):
+            yield builder.get_samples_dataframe_data(), status, gr.update(), builder
     
     if not samples:
-        return [], status, _safe_slider(0, value=0, visible=False), builder
+        yield [], status, _safe_slider(0, value=0, visible=False), builder
+        return
     
     # Set instrumental and tag for all samples
     builder.set_all_instrumental(all_instrumental)
@@ -70,7 +78,7 @@ def scan_directory(
     # Calculate slider max and return as Slider update
     slider_max = max(0, len(samples) - 1)
     
-    return table_data, status, _safe_slider(slider_max, value=0, visible=len(samples) > 1), builder
+    yield table_data, status, _safe_slider(slider_max, value=0, visible=len(samples) > 1), builder
 
 
 def auto_label_all(
@@ -82,6 +90,7 @@ def auto_label_all(
     transcribe_lyrics: bool = False,
     only_unlabeled: bool = False,
     progress=None,
+    save_path: Optional[str] = None,
 ) -> Tuple[List[List[Any]], str, DatasetBuilder]:
     """Auto-label all samples in the dataset.
 
@@ -94,6 +103,8 @@ def auto_label_all(
         transcribe_lyrics: If True, use LLM to transcribe lyrics from audio (ignores .txt files)
         only_unlabeled: If True, only label samples without caption
         progress: Progress callback
+        save_path: Dataset JSON path; progress is saved there after every batch so an
+            interrupted run can resume
 
     Returns:
         Tuple of (table_data, status, builder_state)
@@ -127,6 +138,7 @@ def auto_label_all(
         skip_metas=skip_metas,
         only_unlabeled=only_unlabeled,
         progress_callback=progress_callback,
+        save_path=save_path.strip() if save_path and save_path.strip() else None,
     )
 
     # Get updated table data
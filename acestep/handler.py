@@ -18,9 +18,10 @@ import uuid
 import hashlib
 import json
 import threading
-from contextlib import contextmanager
-from typing import Optional, Dict, Any, Tuple, List, Union
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Dict, Any, Tuple, List, Union, Callable
 
+import numpy as np
 import torch
 import torchaudio
 import soundfile as sf
@@ -46,6 +47,16 @@ from acestep.constants import (
 )
 from acestep.dit_alignment_score import MusicStampsAligner, MusicLyricScorer
 from acestep.gpu_config import get_gpu_memory_gb, get_global_gpu_config
+from acestep.audio_codes import (
+    AudioCodesLike,
+    audio_codes_list,
+    format_audio_codes,
+    has_audio_codes,
+    parse_audio_codes,
+)
+from acestep.latent_cache import TensorLRUCache, audio_content_hash, token_ids_hash
+from acestep.lora_registry import LoRARegistry, MergedLoRA, adapter_fingerprint, load_lora_deltas
+from acestep.pipeline_executor import pipeline_stage
 
 
 warnings.filterwarnings("ignore")
@@ -84,11 +95,18 @@ class AceStepHandler:
         self.offload_to_cpu = False
         self.offload_dit_to_cpu = False
         self.compiled = False
-        self.current_offload_cost = 0.0
+        # Per-call offload time and ref-latent cache counters (see _call_stats_scope).
+        # Thread-local because staged pipeline jobs overlap on their own worker threads.
+        self._call_stats = threading.local()
         self.disable_tqdm = os.environ.get("ACESTEP_DISABLE_TQDM", "").lower() in ("1", "true", "yes") or not getattr(sys.stderr, 'isatty', lambda: False)()
         self.debug_stats = os.environ.get("ACESTEP_DEBUG_STATS", "").lower() in ("1", "true", "yes")
         self._last_diffusion_per_step_sec: Optional[float] = None
+        # Schedule of the most recent VAE decode (mode, windows, calls, ...) for time_costs
+        self._vae_copy_stream = None
         self._progress_estimates_lock = threading.Lock()
+        # Serializes generate_music() calls from concurrent jobs (e.g. API queue workers);
+        # model weights, offload state and CUDA buffers are shared and not thread-safe
+        self.generation_lock = threading.Lock()
         self._progress_estimates = {"records": []}
         self._progress_estimates_path = os.path.join(
             self._get_project_root(),
@@ -99,15 +117,37 @@ class AceStepHandler:
         self._load_progress_estimates()
         self.last_init_params = None
         
+        # Reference-audio VAE latents keyed by content hash (memory LRU + optional disk tier)
+        self.ref_latent_cache = TensorLRUCache(
+            max_entries=int(os.environ.get("ACESTEP_REF_LATENT_CACHE_SIZE", "32")),
+            disk_dir=os.environ.get("ACESTEP_REF_LATENT_CACHE_DIR") or None,
+        )
+        # Text encoder outputs (caption hidden states, lyric embeddings) keyed by token ids
+        self.text_embedding_cache = TensorLRUCache(
+            max_entries=int(os.environ.get("ACESTEP_TEXT_EMBED_CACHE_SIZE", "64")),
+        )
+        self._vae_cache_id = ""
+        # Packed silence reference latents per batch size (see _get_packed_silence_reference)
+        self._silence_reference_cache: Dict[Tuple, Tuple[torch.Tensor, torch.Tensor]] = {}
+        
         # Quantization state - tracks if model is quantized (int8_weight_only, fp8_weight_only, or w8a8_dynamic)
         # Populated during initialize_service, remains None if quantization is disabled
         self.quantization = None
         
-        # LoRA state
+        # LoRA state: adapters live side by side in one PEFT wrapper, see acestep/lora_registry.py
+        self.lora_registry = LoRARegistry(
+            max_resident=int(os.environ.get("ACESTEP_LORA_MAX_RESIDENT", "4")),
+            max_adapters=int(os.environ.get("ACESTEP_LORA_MAX_ADAPTERS", "16")),
+            search_dir=os.environ.get("ACESTEP_LORA_DIR") or None,
+        )
         self.lora_loaded = False
         self.use_lora = False
-        self.lora_scale = 1.0  # LoRA influence scale (0-1)
-        self._base_decoder = None  # Backup of original decoder
+        self.lora_scale = 1.0  # LoRA influence scale (0-1) of the active adapter
+        self.active_lora: Optional[str] = None  # Adapter used when a request names none
+        # Adapter folded into the decoder weights by merge_lora (None = not merged)
+        self.merged_lora: Optional[MergedLoRA] = None
+        self.merged_lora_cache_dir = os.environ.get("ACESTEP_LORA_MERGE_CACHE_DIR") or None
+        self._dit_cache_id = ""
     
     def get_available_checkpoints(self) -> str:
         """Return project root directory path"""
@@ -160,11 +200,34 @@ class AceStepHandler:
             return False
         return getattr(self.config, 'is_turbo', False)
     
-    def load_lora(self, lora_path: str) -> str:
-        """Load LoRA adapter into the decoder.
+    def _get_dit_quant_config(self):
+        """torchao config for self.quantization (used for the DiT and merged LoRA weights)."""
+        if self.quantization == "int8_weight_only":
+            from torchao.quantization import Int8WeightOnlyConfig
+            return Int8WeightOnlyConfig()
+        elif self.quantization == "fp8_weight_only":
+            from torchao.quantization import Float8WeightOnlyConfig
+            return Float8WeightOnlyConfig()
+        elif self.quantization == "w8a8_dynamic":
+            from torchao.quantization import Int8DynamicActivationInt8WeightConfig, MappingType
+            return Int8DynamicActivationInt8WeightConfig(act_mapping_type=MappingType.ASYMMETRIC)
+        raise ValueError(f"Unsupported quantization type: {self.quantization}")
+
+    def _lora_target_device(self):
+        # Adapter weights follow the decoder: on self.device unless the DiT is offloaded
+        if self.offload_to_cpu and self.offload_dit_to_cpu:
+            return "cpu"
+        return self.device
+
+    def load_lora(self, lora_path: str, adapter_name: Optional[str] = None) -> str:
+        """Load a LoRA adapter into the decoder and make it the active adapter.
+        
+        Adapters are kept side by side in the registry, so loading another one
+        (or re-activating one loaded earlier) does not copy the base decoder.
         
         Args:
             lora_path: Path to the LoRA adapter directory (containing adapter_config.json)
+            adapter_name: Name to register the adapter under (default: directory name)
             
         Returns:
             Status message
@@ -196,64 +259,57 @@ class AceStepHandler:
             return f"❌ Invalid LoRA adapter: adapter_config.json not found in {lora_path}"
         
         try:
-            from peft import PeftModel, PeftConfig
+            import peft  # noqa: F401
         except ImportError:
             return "❌ PEFT library not installed. Please install with: pip install peft"
         
+        adapter_name = (adapter_name or "").strip() or os.path.basename(os.path.normpath(lora_path))
+        
         try:
-            import copy
-            # Backup base decoder if not already backed up
-            if self._base_decoder is None:
-                self._base_decoder = copy.deepcopy(self.model.decoder)
-                logger.info("Base decoder backed up")
-            else:
-                # Restore base decoder before loading new LoRA
-                self.model.decoder = copy.deepcopy(self._base_decoder)
-                logger.info("Restored base decoder before loading new LoRA")
-            
-            # Load PEFT adapter
-            logger.info(f"Loading LoRA adapter from {lora_path}")
-            self.model.decoder = PeftModel.from_pretrained(
-                self.model.decoder,
-                lora_path,
-                is_trainable=False,
-            )
-            self.model.decoder = self.model.decoder.to(self.device).to(self.dtype)
-            self.model.decoder.eval()
+            self.lora_registry.register(self.model, adapter_name, lora_path, self._lora_target_device(), self.dtype)
+            # Enable the new adapter by default after loading
+            self.lora_registry.set_default(self.model, adapter_name, True)
             
+            self.active_lora = adapter_name
             self.lora_loaded = True
-            self.use_lora = True  # Enable LoRA by default after loading
+            self.use_lora = True
+            self.lora_scale = self.lora_registry.get_scale(adapter_name)
             
-            logger.info(f"LoRA adapter loaded successfully from {lora_path}")
-            return f"✅ LoRA loaded from {lora_path}"
+            logger.info(f"LoRA adapter '{adapter_name}' loaded successfully from {lora_path}")
+            return f"✅ LoRA '{adapter_name}' loaded from {lora_path}"
             
         except Exception as e:
             logger.exception("Failed to load LoRA adapter")
             return f"❌ Failed to load LoRA: {str(e)}"
     
-    def unload_lora(self) -> str:
-        """Unload LoRA adapter and restore base decoder.
+    def unload_lora(self, adapter_name: Optional[str] = None) -> str:
+        """Unload LoRA adapters and restore base decoder.
+        
+        Args:
+            adapter_name: Adapter to remove; None removes every adapter
         
         Returns:
             Status message
         """
-        if not self.lora_loaded:
+        if not self.lora_registry.names:
             return "⚠️ No LoRA adapter loaded."
         
-        if self._base_decoder is None:
-            return "❌ Base decoder backup not found. Cannot restore."
+        if adapter_name is not None and adapter_name not in self.lora_registry:
+            return f"❌ LoRA adapter not loaded: {adapter_name}"
         
         try:
-            import copy
-            # Restore base decoder
-            self.model.decoder = copy.deepcopy(self._base_decoder)
-            self.model.decoder = self.model.decoder.to(self.device).to(self.dtype)
-            self.model.decoder.eval()
-            
-            self.lora_loaded = False
-            self.use_lora = False
-            self.lora_scale = 1.0  # Reset scale to default
-            
+            self.lora_registry.unregister(self.model, adapter_name)
+            
+            remaining = self.lora_registry.names
+            if self.active_lora not in remaining:
+                self.active_lora = None
+                self.use_lora = False
+                self.lora_scale = 1.0  # Reset scale to default
+            self.lora_loaded = bool(remaining)
+            
+            if adapter_name is not None and remaining:
+                logger.info(f"LoRA adapter '{adapter_name}' unloaded")
+                return f"✅ LoRA '{adapter_name}' unloaded"
             logger.info("LoRA unloaded, base decoder restored")
             return "✅ LoRA unloaded, using base model"
             
@@ -261,11 +317,12 @@ class AceStepHandler:
             logger.exception("Failed to unload LoRA")
             return f"❌ Failed to unload LoRA: {str(e)}"
     
-    def set_use_lora(self, use_lora: bool) -> str:
+    def set_use_lora(self, use_lora: bool, adapter_name: Optional[str] = None) -> str:
         """Toggle LoRA usage for inference.
         
         Args:
             use_lora: Whether to use LoRA adapter
+            adapter_name: Adapter to switch to (default: the active adapter)
             
         Returns:
             Status message
@@ -273,79 +330,246 @@ class AceStepHandler:
         if use_lora and not self.lora_loaded:
             return "❌ No LoRA adapter loaded. Please load a LoRA first."
         
+        if use_lora and self.merged_lora is not None:
+            return f"❌ LoRA '{self.merged_lora.name}' is merged into the decoder. Unmerge it first."
+        
+        if adapter_name is not None:
+            if adapter_name not in self.lora_registry:
+                return f"❌ LoRA adapter not loaded: {adapter_name}"
+            self.active_lora = adapter_name
+            self.lora_scale = self.lora_registry.get_scale(adapter_name)
+        
         self.use_lora = use_lora
         
-        # Use PEFT's enable/disable methods if available
-        if self.lora_loaded and hasattr(self.model.decoder, 'disable_adapter_layers'):
+        if self.lora_loaded:
             try:
-                if use_lora:
-                    self.model.decoder.enable_adapter_layers()
-                    logger.info("LoRA adapter enabled")
-                    # Apply current scale when enabling LoRA
-                    if self.lora_scale != 1.0:
-                        self.set_lora_scale(self.lora_scale)
-                else:
-                    self.model.decoder.disable_adapter_layers()
-                    logger.info("LoRA adapter disabled")
+                self.lora_registry.set_default(self.model, self.active_lora, use_lora)
+                logger.info(f"LoRA adapter {'enabled' if use_lora else 'disabled'} (active: {self.active_lora})")
             except Exception as e:
                 logger.warning(f"Could not toggle adapter layers: {e}")
         
         status = "enabled" if use_lora else "disabled"
         return f"✅ LoRA {status}"
     
-    def set_lora_scale(self, scale: float) -> str:
+    def set_lora_scale(self, scale: float, adapter_name: Optional[str] = None) -> str:
         """Set LoRA adapter scale/weight (0-1 range).
         
         Args:
             scale: LoRA influence scale (0=disabled, 1=full effect)
+            adapter_name: Adapter to scale (default: the active adapter)
             
         Returns:
             Status message
         """
+        if self.merged_lora is not None and (adapter_name or self.active_lora or self.merged_lora.name) == self.merged_lora.name:
+            # Merged weights are baked at one scale: re-merge (served from disk cache when available)
+            name = self.merged_lora.name
+            if name == self.active_lora:
+                self.lora_scale = max(0.0, min(1.0, scale))
+            if name in self.lora_registry:
+                self.lora_registry.set_scale(self.model, name, max(0.0, min(1.0, scale)))
+                return self.merge_lora(name, scale)
+            return self.merge_lora(self.merged_lora.path, scale)
+        
         if not self.lora_loaded:
             return "⚠️ No LoRA loaded"
         
-        # Clamp scale to 0-1 range
-        self.lora_scale = max(0.0, min(1.0, scale))
+        adapter_name = adapter_name or self.active_lora
+        if adapter_name not in self.lora_registry:
+            return f"❌ LoRA adapter not loaded: {adapter_name}"
         
-        # Only apply scaling if LoRA is enabled
-        if not self.use_lora:
-            logger.info(f"LoRA scale set to {self.lora_scale:.2f} (will apply when LoRA is enabled)")
-            return f"✅ LoRA scale: {self.lora_scale:.2f} (LoRA disabled)"
+        # Clamp scale to 0-1 range
+        scale = max(0.0, min(1.0, scale))
+        if adapter_name == self.active_lora:
+            self.lora_scale = scale
         
-        # Iterate through LoRA layers only and set their scaling
+        # Scales are per adapter, so they also apply to requests that select the adapter by name
         try:
-            modified_count = 0
-            for name, module in self.model.decoder.named_modules():
-                # Only modify LoRA modules - they have 'lora_' in their name
-                # This prevents modifying attention scaling and other non-LoRA modules
-                if 'lora_' in name and hasattr(module, 'scaling'):
-                    scaling = module.scaling
-                    # Handle dict-style scaling (adapter_name -> value)
-                    if isinstance(scaling, dict):
-                        # Save original scaling on first call
-                        if not hasattr(module, '_original_scaling'):
-                            module._original_scaling = {k: v for k, v in scaling.items()}
-                        # Apply new scale
-                        for adapter_name in scaling:
-                            module.scaling[adapter_name] = module._original_scaling[adapter_name] * self.lora_scale
-                        modified_count += 1
-                    # Handle float-style scaling (single value)
-                    elif isinstance(scaling, (int, float)):
-                        if not hasattr(module, '_original_scaling'):
-                            module._original_scaling = scaling
-                        module.scaling = module._original_scaling * self.lora_scale
-                        modified_count += 1
+            modified_count = self.lora_registry.set_scale(self.model, adapter_name, scale)
             
             if modified_count > 0:
-                logger.info(f"LoRA scale set to {self.lora_scale:.2f} (modified {modified_count} modules)")
-                return f"✅ LoRA scale: {self.lora_scale:.2f}"
+                logger.info(f"LoRA '{adapter_name}' scale set to {scale:.2f} (modified {modified_count} modules)")
+                if not self.use_lora and adapter_name == self.active_lora:
+                    return f"✅ LoRA scale: {scale:.2f} (LoRA disabled)"
+                return f"✅ LoRA scale: {scale:.2f}"
             else:
                 logger.warning("No LoRA scaling attributes found to modify")
-                return f"⚠️ Scale set to {self.lora_scale:.2f} (no modules found)"
+                return f"⚠️ Scale set to {scale:.2f} (no modules found)"
         except Exception as e:
             logger.warning(f"Could not set LoRA scale: {e}")
-            return f"⚠️ Scale set to {self.lora_scale:.2f} (partial)"
+            return f"⚠️ Scale set to {scale:.2f} (partial)"
+    
+    def merge_lora(self, lora: Optional[str] = None, scale: Optional[float] = None) -> str:
+        """Fold a LoRA adapter into the decoder weights (merge mode).
+        
+        Removes the extra low-rank matmuls of the PEFT layers from every DiT step and,
+        unlike load_lora, also works on quantized models: merged weights are
+        re-quantized with the service's quantization. The original weights are kept,
+        so unmerge_lora reverts instantly. With ACESTEP_LORA_MERGE_CACHE_DIR set, merged
+        weights are cached on disk per (base checkpoint, adapter, scale, quantization).
+        
+        Args:
+            lora: Loaded adapter name or adapter directory (default: the active adapter)
+            scale: LoRA influence scale 0-1 (default: the adapter's current scale)
+            
+        Returns:
+            Status message
+        """
+        if self.model is None:
+            return "❌ Model not initialized. Please initialize service first."
+        
+        lora = (lora or "").strip() or self.active_lora
+        if not lora:
+            return "❌ No LoRA adapter selected. Please load a LoRA or provide its path."
+        
+        if lora in self.lora_registry:
+            name, path = lora, self.lora_registry.get_path(lora)
+        else:
+            name, path = os.path.basename(os.path.normpath(lora)), lora
+            if not os.path.exists(os.path.join(path, "adapter_config.json")):
+                return f"❌ Invalid LoRA adapter: adapter_config.json not found in {path}"
+        
+        if scale is None:
+            scale = self.lora_registry.get_scale(name)
+        scale = max(0.0, min(1.0, scale))
+        
+        try:
+            key = hashlib.sha1(
+                f"{self._dit_cache_id}|{adapter_fingerprint(path)}|{scale:.4f}|{self.quantization}|{self.dtype}".encode("utf-8")
+            ).hexdigest()
+            if self.merged_lora is not None:
+                if self.merged_lora.key == key:
+                    return f"✅ LoRA '{name}' already merged (scale {scale:.2f})"
+                self.unmerge_lora()
+            
+            start = time.time()
+            with torch.no_grad(), self._load_model_context("model"):
+                merged = self._load_merged_lora_weights(key)
+                cached = merged is not None
+                if merged is None:
+                    quantize_fn = self._quantize_merged_weight if self.quantization is not None else None
+                    merged = MergedLoRA.build(self.model.decoder, load_lora_deltas(path, scale), quantize_fn)
+                    self._save_merged_lora_weights(key, merged)
+                state = MergedLoRA(name, path, key)
+                state.apply(self.model.decoder, merged)
+            self.merged_lora = state
+            
+            # The PEFT layers would apply the adapter a second time on top of the merged weights
+            if self.lora_loaded and self.use_lora:
+                self.lora_registry.set_default(self.model, self.active_lora, False)
+                self.use_lora = False
+            
+            source = "disk cache" if cached else "adapter"
+            logger.info(f"LoRA '{name}' merged at scale {scale:.2f} into {len(merged)} layers from {source} in {time.time() - start:.2f}s")
+            return f"✅ LoRA '{name}' merged (scale {scale:.2f})"
+        
+        except Exception as e:
+            logger.exception("Failed to merge LoRA adapter")
+            return f"❌ Failed to merge LoRA: {str(e)}"
+    
+    def unmerge_lora(self) -> str:
+        """Restore the decoder weights saved by merge_lora.
+        
+        Returns:
+            Status message
+        """
+        if self.merged_lora is None:
+            return "⚠️ No merged LoRA."
+        
+        name = self.merged_lora.name
+        try:
+            with torch.no_grad():
+                self.merged_lora.revert(self.model.decoder)
+            self.merged_lora = None
+            logger.info(f"LoRA '{name}' unmerged, base weights restored")
+            return f"✅ LoRA '{name}' unmerged"
+        except Exception as e:
+            logger.exception("Failed to unmerge LoRA")
+            return f"❌ Failed to unmerge LoRA: {str(e)}"
+    
+    def _quantize_merged_weight(self, weight: torch.Tensor) -> torch.Tensor:
+        """Quantize one merged linear weight the same way initialize_service quantized the DiT."""
+        from torchao.quantization import quantize_
+        
+        linear = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=False, device=weight.device, dtype=weight.dtype)
+        linear.weight = torch.nn.Parameter(weight, requires_grad=False)
+        quantize_(linear, self._get_dit_quant_config())
+        return linear.weight.data
+    
+    def _merged_lora_cache_path(self, key: str) -> Optional[str]:
+        if not self.merged_lora_cache_dir:
+            return None
+        return os.path.join(self.merged_lora_cache_dir, f"{key}.pt")
+    
+    def _load_merged_lora_weights(self, key: str) -> Optional[Dict[str, torch.Tensor]]:
+        path = self._merged_lora_cache_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            # Quantized weights are tensor subclasses, which the weights_only unpickler rejects
+            return torch.load(path, map_location=self.device, weights_only=self.quantization is None)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable merged LoRA cache file {path}: {e}")
+            return None
+    
+    def _save_merged_lora_weights(self, key: str, merged: Dict[str, torch.Tensor]):
+        path = self._merged_lora_cache_path(key)
+        if path is None:
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.merged_lora_cache_dir, exist_ok=True)
+            torch.save(merged, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning(f"Could not write merged LoRA cache file {path}: {e}")
+    
+    def lora_request_error(self, lora_name: Optional[str]) -> Optional[str]:
+        """Why a per-request LoRA selection cannot be served, or None if it can.
+        
+        Lets callers reject a request before it is queued rather than failing inside
+        generation.
+        
+        Args:
+            lora_name: Requested adapter ("" = base model, None = the active adapter)
+            
+        Returns:
+            Error message, or None
+        """
+        if lora_name is None:
+            return None
+        name = lora_name.strip() or None
+        if self.merged_lora is not None:
+            # The merged adapter is part of the weights: the base model is not available,
+            # and other adapters would stack on top of it
+            if name == self.merged_lora.name:
+                return None
+            if name is None:
+                return f"LoRA '{self.merged_lora.name}' is merged into the decoder, so the base model is unavailable; unmerge it first"
+            return f"LoRA '{self.merged_lora.name}' is merged into the decoder; unmerge it to select '{name}'"
+        if name is not None and self.quantization is not None:
+            return f"LoRA adapters are not supported on quantized models (quantization: {self.quantization})"
+        return None
+    
+    def _lora_context(self, lora_names: Optional[Union[str, List[Optional[str]]]], batch_size: int):
+        """Select per-request LoRA adapters for the DiT forward passes (no-op when None)."""
+        if lora_names is None:
+            return nullcontext()
+        if isinstance(lora_names, str):
+            lora_names = [lora_names] * batch_size
+        elif len(lora_names) != batch_size:
+            raise ValueError(f"Got {len(lora_names)} LoRA adapter names for a batch of {batch_size}")
+        names = [name.strip() if name and name.strip() else None for name in lora_names]
+        for name in set(names):
+            error = self.lora_request_error(name or "")
+            if error:
+                raise ValueError(error)
+        if self.merged_lora is not None:
+            return nullcontext()
+        if all(name is None for name in names) and not self.lora_loaded:
+            return nullcontext()
+        # Called inside _load_model_context("model"), so the decoder is on self.device
+        return self.lora_registry.activate(self.model, names, self.device, self.dtype)
     
     def get_lora_status(self) -> Dict[str, Any]:
         """Get current LoRA status.
@@ -357,6 +581,9 @@ class AceStepHandler:
             "loaded": self.lora_loaded,
             "active": self.use_lora,
             "scale": self.lora_scale,
+            "active_adapter": self.active_lora,
+            "adapters": self.lora_registry.names,
+            "merged_adapter": self.merged_lora.name if self.merged_lora is not None else None,
         }
     
     def initialize_service(
@@ -529,6 +756,14 @@ class AceStepHandler:
 
                 self.model.config._attn_implementation = attn_implementation
                 self.config = self.model.config
+                # Adapters were attached to (or merged into) the previous decoder
+                self.lora_registry.reset()
+                self.merged_lora = None
+                self._dit_cache_id = self._fingerprint_checkpoint_dir(acestep_v15_checkpoint_path)
+                self.lora_loaded = False
+                self.use_lora = False
+                self.lora_scale = 1.0
+                self.active_lora = None
                 # Move model to device and set dtype
                 if not self.offload_to_cpu:
                     self.model = self.model.to(device).to(self.dtype)
@@ -556,17 +791,7 @@ class AceStepHandler:
                     if self.quantization is not None:
                         from torchao.quantization import quantize_
                         from torchao.quantization.quant_api import _is_linear
-                        if self.quantization == "int8_weight_only":
-                            from torchao.quantization import Int8WeightOnlyConfig
-                            quant_config = Int8WeightOnlyConfig()
-                        elif self.quantization == "fp8_weight_only":
-                            from torchao.quantization import Float8WeightOnlyConfig
-                            quant_config = Float8WeightOnlyConfig()
-                        elif self.quantization == "w8a8_dynamic":
-                            from torchao.quantization import Int8DynamicActivationInt8WeightConfig, MappingType
-                            quant_config = Int8DynamicActivationInt8WeightConfig(act_mapping_type=MappingType.ASYMMETRIC)
-                        else:
-                            raise ValueError(f"Unsupported quantization type: {self.quantization}")
+                        quant_config = self._get_dit_quant_config()
                         
                         # Only quantize DiT layers; exclude tokenizer and detokenizer submodules.
                         # The tokenizer (ResidualFSQ) and detokenizer contain small Linear layers
@@ -602,6 +827,9 @@ class AceStepHandler:
             vae_checkpoint_path = os.path.join(checkpoint_dir, "vae")
             if os.path.exists(vae_checkpoint_path):
                 self.vae = AutoencoderOobleck.from_pretrained(vae_checkpoint_path)
+                # Cached reference latents belong to the previous VAE
+                self.ref_latent_cache.clear()
+                self._vae_cache_id = self._fingerprint_checkpoint_dir(vae_checkpoint_path)
                 if not self.offload_to_cpu:
                     # Keep VAE in GPU precision when resident on accelerator.
                     vae_dtype = self._get_vae_dtype(device)
@@ -635,6 +863,8 @@ class AceStepHandler:
                 else:
                     self.text_encoder = self.text_encoder.to("cpu").to(self.dtype)
                 self.text_encoder.eval()
+                # Cached embeddings belong to the previous text encoder
+                self.text_embedding_cache.clear()
             else:
                 raise FileNotFoundError(f"Text encoder not found at {text_encoder_path}")
 
@@ -941,6 +1171,50 @@ class AceStepHandler:
             if still_wrong:
                 logger.error(f"[_recursive_to_device] CRITICAL: {len(still_wrong)} parameters still on wrong device: {still_wrong[:10]}")
     
+    def supports_stage_overlap(self) -> bool:
+        """
+        Whether DiT and VAE-decode stages of different jobs may run concurrently.
+
+        CPU offload swaps models on and off the device inside _load_model_context,
+        and ACESTEP_VAE_ON_CPU moves the shared VAE during decode; both would pull
+        weights out from under the other stage, so those setups keep the whole
+        generate_music() call under generation_lock.
+        """
+        if self.offload_to_cpu:
+            return False
+        return os.environ.get("ACESTEP_VAE_ON_CPU", "0").lower() not in ("1", "true", "yes")
+
+    @contextmanager
+    def _call_stats_scope(self):
+        """
+        Collect offload time and ref-latent cache hits/misses for the enclosed phase.
+
+        Counters only see work done on the calling thread, so a job's numbers do not
+        include other jobs overlapping with it in the staged pipeline.
+
+        Yields:
+            Dict with offload_time_cost, ref_latent_cache_hits and ref_latent_cache_misses,
+            plus vae_decode_schedule once a tiled VAE decode has run
+        """
+        stats = {"offload_time_cost": 0.0, "ref_latent_cache_hits": 0, "ref_latent_cache_misses": 0}
+        previous = getattr(self._call_stats, "current", None)
+        self._call_stats.current = stats
+        try:
+            yield stats
+        finally:
+            self._call_stats.current = previous
+
+    def _record_call_stat(self, key: str, value: float):
+        stats = getattr(self._call_stats, "current", None)
+        if stats is not None:
+            stats[key] += value
+
+    def _record_vae_decode_schedule(self, schedule: Dict[str, float]):
+        """Keep the schedule (mode, windows, calls, ...) of this call's VAE decode for time_costs."""
+        stats = getattr(self._call_stats, "current", None)
+        if stats is not None:
+            stats["vae_decode_schedule"] = schedule
+
     @contextmanager
     def _load_model_context(self, model_name: str):
         """
@@ -990,7 +1264,7 @@ class AceStepHandler:
              self.silence_latent = self.silence_latent.to(self.device).to(self.dtype)
         
         load_time = time.time() - start_time
-        self.current_offload_cost += load_time
+        self._record_call_stat("offload_time_cost", load_time)
         logger.info(f"[_load_model_context] Loaded {model_name} to {self.device} in {load_time:.4f}s")
 
         try:
@@ -1010,7 +1284,7 @@ class AceStepHandler:
             
             self._empty_cache()
             offload_time = time.time() - start_time
-            self.current_offload_cost += offload_time
+            self._record_call_stat("offload_time_cost", offload_time)
             logger.info(f"[_load_model_context] Offloaded {model_name} to CPU in {offload_time:.4f}s")
 
     def process_target_audio(self, audio_file) -> Optional[torch.Tensor]:
@@ -1035,43 +1309,19 @@ class AceStepHandler:
             logger.exception("[process_target_audio] Error processing target audio")
             return None
     
-    def _parse_audio_code_string(self, code_str: str) -> List[int]:
-        """Extract integer audio codes from prompt tokens like <|audio_code_123|>.
-        Code values are clamped to valid range [0, 63999] (codebook size = 64000).
-        """
-        if not code_str:
-            return []
-        try:
-            MAX_AUDIO_CODE = 63999  # Maximum valid audio code value (codebook size = 64000)
-            codes = []
-            clamped_count = 0
-            for x in re.findall(r"<\|audio_code_(\d+)\|>", code_str):
-                code_value = int(x)
-                # Clamp code value to valid range [0, MAX_AUDIO_CODE]
-                clamped_value = max(0, min(code_value, MAX_AUDIO_CODE))
-                if clamped_value != code_value:
-                    clamped_count += 1
-                    logger.warning(f"[_parse_audio_code_string] Clamped audio code value from {code_value} to {clamped_value}")
-                codes.append(clamped_value)
-            if clamped_count > 0:
-                logger.warning(f"[_parse_audio_code_string] Clamped {clamped_count} audio code value(s) to valid range [0, {MAX_AUDIO_CODE}]")
-            return codes
-        except Exception as e:
-            logger.debug(f"[_parse_audio_code_string] Failed to parse audio code string: {e}")
-            return []
-    
-    def _decode_audio_codes_to_latents(self, code_str: str) -> Optional[torch.Tensor]:
+    def _decode_audio_codes_to_latents(self, codes: AudioCodesLike) -> Optional[torch.Tensor]:
         """
-        Convert serialized audio code string into 25Hz latents using model quantizer/detokenizer.
+        Convert audio codes (uint16 array, or the serialized string form) into 25Hz latents
+        using model quantizer/detokenizer.
         
-        Note: Code values are already clamped to valid range [0, 63999] by _parse_audio_code_string(),
+        Note: Code values are already clamped to valid range [0, 63999] by parse_audio_codes(),
         ensuring indices are within the quantizer's codebook size (64000).
         """
         if self.model is None or not hasattr(self.model, 'tokenizer') or not hasattr(self.model, 'detokenizer'):
             return None
         
-        code_ids = self._parse_audio_code_string(code_str)
-        if len(code_ids) == 0:
+        code_ids = parse_audio_codes(codes)
+        if code_ids.size == 0:
             return None
         
         with self._load_model_context("model"):
@@ -1080,8 +1330,8 @@ class AceStepHandler:
             
             num_quantizers = getattr(quantizer, "num_quantizers", 1)
             # Create indices tensor: [T_5Hz]
-            # Note: code_ids are already clamped to [0, 63999] by _parse_audio_code_string()
-            indices = torch.tensor(code_ids, device=self.device, dtype=torch.long)  # [T_5Hz]
+            # Note: code_ids are already clamped to [0, 63999] by parse_audio_codes()
+            indices = torch.from_numpy(code_ids.astype(np.int64)).to(self.device)  # [T_5Hz]
             
             indices = indices.unsqueeze(0).unsqueeze(-1)  # [1, T_5Hz, 1]
             
@@ -1504,6 +1754,17 @@ class AceStepHandler:
                     return 1024
         return 512
 
+    def _get_auto_encode_chunk_size(self) -> int:
+        """VAE encode window in samples (48kHz), adaptive to GPU memory."""
+        gpu_memory = get_gpu_memory_gb()
+        if gpu_memory <= 0 and self.device == "mps":
+            mem_gb = self._get_effective_mps_memory_gb()
+            if mem_gb is not None:
+                gpu_memory = mem_gb
+        if gpu_memory <= 8:
+            return 48000 * 15  # 15 seconds for low VRAM
+        return 48000 * 30  # 30 seconds for normal VRAM
+
     def _should_offload_wav_to_cpu(self) -> bool:
         """Decide whether to offload decoded wavs to CPU for memory safety."""
         override = os.environ.get("ACESTEP_MPS_DECODE_OFFLOAD")
@@ -1602,25 +1863,9 @@ class AceStepHandler:
         
         return audio
     
-    def _normalize_audio_code_hints(self, audio_code_hints: Optional[Union[str, List[str]]], batch_size: int) -> List[Optional[str]]:
-        """Normalize audio_code_hints to list of correct length."""
-        if audio_code_hints is None:
-            normalized = [None] * batch_size
-        elif isinstance(audio_code_hints, str):
-            normalized = [audio_code_hints] * batch_size
-        elif len(audio_code_hints) == 1 and batch_size > 1:
-            normalized = audio_code_hints * batch_size
-        elif len(audio_code_hints) != batch_size:
-            # Pad or truncate to match batch_size
-            normalized = list(audio_code_hints[:batch_size])
-            while len(normalized) < batch_size:
-                normalized.append(None)
-        else:
-            normalized = list(audio_code_hints)
-        
-        # Clean up: convert empty strings to None
-        normalized = [hint if isinstance(hint, str) and hint.strip() else None for hint in normalized]
-        return normalized
+    def _normalize_audio_code_hints(self, audio_code_hints: Optional[Union[AudioCodesLike, List[Optional[AudioCodesLike]]]], batch_size: int) -> List[Optional[np.ndarray]]:
+        """Normalize audio_code_hints to a list of uint16 code arrays (None = no codes) of correct length."""
+        return audio_codes_list(audio_code_hints, batch_size)
     
     def _normalize_instructions(self, instructions: Optional[Union[str, List[str]]], batch_size: int, default: Optional[str] = None) -> List[str]:
         """Normalize instructions to list of correct length."""
@@ -1813,20 +2058,23 @@ class AceStepHandler:
             # If audio is greater than or equal to 30 seconds, no operation needed
             
             # For all cases, select random 10-second segments from front, middle, and back
-            # then concatenate them to form 30 seconds
+            # then concatenate them to form 30 seconds.
+            # The RNG is seeded from the audio content so the same track always yields the
+            # same segments, which lets its VAE latent be reused (see ref_latent_cache).
             total_frames = audio.shape[-1]
             segment_size = total_frames // 3
+            rng = random.Random(audio_content_hash(audio))
             
             # Front segment: [0, segment_size]
-            front_start = random.randint(0, max(0, segment_size - segment_frames))
+            front_start = rng.randint(0, max(0, segment_size - segment_frames))
             front_audio = audio[:, front_start:front_start + segment_frames]
             
             # Middle segment: [segment_size, 2*segment_size]
-            middle_start = segment_size + random.randint(0, max(0, segment_size - segment_frames))
+            middle_start = segment_size + rng.randint(0, max(0, segment_size - segment_frames))
             middle_audio = audio[:, middle_start:middle_start + segment_frames]
             
             # Back segment: [2*segment_size, total_frames]
-            back_start = 2 * segment_size + random.randint(0, max(0, (total_frames - 2 * segment_size) - segment_frames))
+            back_start = 2 * segment_size + rng.randint(0, max(0, (total_frames - 2 * segment_size) - segment_frames))
             back_audio = audio[:, back_start:back_start + segment_frames]
             
             # Concatenate three segments to form 30 seconds
@@ -1865,6 +2113,21 @@ class AceStepHandler:
         Returns:
             Formatted codes string like '<|audio_code_123|><|audio_code_456|>...' or error message
         """
+        codes = self.convert_src_audio_to_code_ids(audio_file)
+        if isinstance(codes, str):
+            return codes
+        return format_audio_codes(codes)
+    
+    def convert_src_audio_to_code_ids(self, audio_file) -> Union[np.ndarray, str]:
+        """
+        Convert uploaded source audio to audio codes.
+        
+        Args:
+            audio_file: Path to audio file or None
+            
+        Returns:
+            1D uint16 array of code indices, or an error message string
+        """
         if audio_file is None:
             return "❌ Please upload source audio first"
         
@@ -1877,41 +2140,82 @@ class AceStepHandler:
             if processed_audio is None:
                 return "❌ Failed to process audio file"
             
-            # Encode audio to latents using VAE
-            with torch.inference_mode():
-                with self._load_model_context("vae"):
-                    # Check if audio is silence
-                    if self.is_silence(processed_audio.unsqueeze(0)):
-                        return "❌ Audio file appears to be silent"
+            codes = self.encode_audios_to_code_ids([processed_audio])[0]
+            if not isinstance(codes, str):
+                logger.info(f"[convert_src_audio_to_codes] Generated {codes.size} audio codes")
+            return codes
                     
-                    # Encode to latents using helper method
-                    latents = self._encode_audio_to_latents(processed_audio)  # [T, d]
+        except Exception as e:
+            error_msg = f"❌ Error converting audio to codes: {str(e)}\n{traceback.format_exc()}"
+            logger.exception("[convert_src_audio_to_codes] Error converting audio to codes")
+            return error_msg
+    
+    # Upper bound on encode-window-sized rows (see tiled_encode) in one batched VAE encode
+    _VAE_ENCODE_BATCH_MAX_WINDOWS = 4
+    
+    def encode_audios_to_code_ids(self, audios: List[torch.Tensor]) -> List[Union[np.ndarray, str]]:
+        """
+        VAE-encode and tokenize several processed audios (see process_src_audio).
+        
+        Audios with exactly the same number of samples share batched VAE encodes, so
+        no item is ever padded and its codes are those of encoding it on its own.
+        Each batch is capped at _VAE_ENCODE_BATCH_MAX_WINDOWS encode windows' worth
+        of samples; a batch that still runs out of memory is retried one audio at a
+        time. Callers get the most batching by grouping audios of equal length.
+        
+        Args:
+            audios: [channels, samples] tensors at 48kHz
+            
+        Returns:
+            Per input, a 1D uint16 array of code indices or an error message string
+        """
+        results: List[Union[np.ndarray, str]] = ["❌ Audio file appears to be silent"] * len(audios)
+        with torch.inference_mode():
+            with self._load_model_context("vae"):
+                # Check if audio is silence
+                keep = [i for i, audio in enumerate(audios) if not self.is_silence(audio.unsqueeze(0))]
+                if not keep:
+                    return results
                 
-                # Create attention mask for latents
-                attention_mask = torch.ones(latents.shape[0], dtype=torch.bool, device=self.device)
+                by_length: Dict[int, List[int]] = {}
+                for i in keep:
+                    by_length.setdefault(audios[i].shape[-1], []).append(i)
+                window_samples = self._get_auto_encode_chunk_size()
+                groups = []
+                for length, indices in by_length.items():
+                    rows_per_call = max(1, self._VAE_ENCODE_BATCH_MAX_WINDOWS * window_samples // min(length, window_samples))
+                    groups.extend(indices[k:k + rows_per_call] for k in range(0, len(indices), rows_per_call))
                 
-                # Tokenize latents to get code indices
-                with self._load_model_context("model"):
-                    # Prepare latents for tokenize: [T, d] -> [1, T, d]
-                    hidden_states = latents.unsqueeze(0)  # [1, T, d]
+                latents_by_index: Dict[int, torch.Tensor] = {}
+                for group in groups:
+                    out_of_memory = False
+                    try:
+                        # Encode to latents using helper method
+                        latents = self._encode_audio_to_latents(torch.stack([audios[i] for i in group]))  # [B, T, d]
+                        latents_by_index.update((i, latents[row:row + 1]) for row, i in enumerate(group))
+                    except RuntimeError as e:
+                        if len(group) == 1 or "out of memory" not in str(e).lower():
+                            raise
+                        out_of_memory = True
+                    if out_of_memory:
+                        # Retried outside the except block so the failed call's tensors are freed first
+                        logger.warning(f"[encode_audios_to_code_ids] Out of memory encoding {len(group)} audios together, retrying one at a time")
+                        self._empty_cache()
+                        for i in group:
+                            latents_by_index[i] = self._encode_audio_to_latents(audios[i].unsqueeze(0))
+            
+            # Tokenize latents to get code indices
+            with self._load_model_context("model"):
+                for i in keep:
+                    hidden_states = latents_by_index[i]  # [1, T, d]
+                    attention_mask = torch.ones(1, hidden_states.shape[1], dtype=torch.bool, device=self.device)
                     
-                    # Call tokenize method
                     # tokenize returns: (quantized, indices, attention_mask)
-                    _, indices, _ = self.model.tokenize(hidden_states, self.silence_latent, attention_mask.unsqueeze(0))
+                    _, indices, _ = self.model.tokenize(hidden_states, self.silence_latent, attention_mask)
                     
-                    # Format indices as code string
                     # indices shape: [1, T_5Hz] or [1, T_5Hz, num_quantizers]
-                    # Flatten and convert to list
-                    indices_flat = indices.flatten().cpu().tolist()
-                    codes_string = "".join([f"<|audio_code_{idx}|>" for idx in indices_flat])
-                    
-                    logger.info(f"[convert_src_audio_to_codes] Generated {len(indices_flat)} audio codes")
-                    return codes_string
-                    
-        except Exception as e:
-            error_msg = f"❌ Error converting audio to codes: {str(e)}\n{traceback.format_exc()}"
-            logger.exception("[convert_src_audio_to_codes] Error converting audio to codes")
-            return error_msg
+                    results[i] = parse_audio_codes(indices.flatten())
+        return results
         
     def prepare_batch_data(
         self,
@@ -1953,11 +2257,7 @@ class AceStepHandler:
         is_lego_task = (task_type == "lego")
         is_cover_task = (task_type == "cover")
 
-        has_codes = False
-        if isinstance(audio_code_string, list):
-            has_codes = any((c or "").strip() for c in audio_code_string)
-        else:
-            has_codes = bool(audio_code_string and str(audio_code_string).strip())
+        has_codes = has_audio_codes(audio_code_string)
 
         if has_codes:
             is_cover_task = True
@@ -2136,7 +2436,7 @@ class AceStepHandler:
         repainting_start: Optional[List[float]] = None,
         repainting_end: Optional[List[float]] = None,
         instructions: Optional[List[str]] = None,
-        audio_code_hints: Optional[List[Optional[str]]] = None,
+        audio_code_hints: Optional[List[Optional[AudioCodesLike]]] = None,
         audio_cover_strength: float = 1.0,
     ) -> Dict[str, Any]:
         """
@@ -2147,7 +2447,9 @@ class AceStepHandler:
             lyrics: List of lyrics (optional, can be empty strings)
             keys: List of unique identifiers (optional)
             target_wavs: Target audio tensors (optional, will use silence if not provided)
-            refer_audios: Reference audio tensors (optional, will use silence if not provided)
+            refer_audios: Reference audio tensors (optional, will use silence if not provided).
+                An empty list for a batch item means "no reference" (silence) without
+                allocating any audio.
             metas: Metadata (optional, will use defaults if not provided)
             vocal_languages: Vocal languages (optional, will default to 'en')
             
@@ -2162,14 +2464,21 @@ class AceStepHandler:
         # Normalize audio_code_hints to batch list
         audio_code_hints = self._normalize_audio_code_hints(audio_code_hints, batch_size)
 
-        # Guard: refer_audios can be None when reference audio UI path didn't populate it (e.g. TEXT2MUSIC)
+        # Guard: refer_audios can be None when reference audio UI path didn't populate it (e.g. TEXT2MUSIC).
+        # An empty list is the "no reference" sentinel: infer_refer_latent uses the
+        # precomputed silence latent directly, so nothing is allocated or transferred
         if refer_audios is None:
-            refer_audios = [[torch.zeros(2, 30 * self.sample_rate)] for _ in range(batch_size)]
+            refer_audios = [[] for _ in range(batch_size)]
 
+        # The same reference tensor is usually repeated for every batch item; move it
+        # once so infer_refer_latent can also recognise the duplicates
+        moved_refer_audios = {}
         for ii, refer_audio_list in enumerate(refer_audios):
             if isinstance(refer_audio_list, list):
                 for idx, refer_audio in enumerate(refer_audio_list):
-                    refer_audio_list[idx] = refer_audio_list[idx].to(self.device).to(self._get_vae_dtype())
+                    if id(refer_audio) not in moved_refer_audios:
+                        moved_refer_audios[id(refer_audio)] = refer_audio.to(self.device).to(self._get_vae_dtype())
+                    refer_audio_list[idx] = moved_refer_audios[id(refer_audio)]
             elif isinstance(refer_audio_list, torch.Tensor):
                 refer_audios[ii] = refer_audios[ii].to(self.device)
         
@@ -2192,7 +2501,7 @@ class AceStepHandler:
                 for i in range(batch_size):
                     code_hint = audio_code_hints[i]
                     # Prefer decoding from provided audio codes
-                    if code_hint:
+                    if code_hint is not None:
                         logger.info(f"[generate_music] Decoding audio codes for item {i}...")
                         decoded_latents = self._decode_audio_codes_to_latents(code_hint)
                         if decoded_latents is not None:
@@ -2536,6 +2845,35 @@ class AceStepHandler:
                     batch[k] = v.to(self.dtype)
         return batch
     
+    @staticmethod
+    def _fingerprint_checkpoint_dir(path: str) -> str:
+        """Cheap identity of a checkpoint directory (file names, sizes and mtimes)."""
+        h = hashlib.sha1()
+        for name in sorted(os.listdir(path)):
+            stat = os.stat(os.path.join(path, name))
+            h.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)};".encode("utf-8"))
+        return h.hexdigest()[:16]
+
+    def _get_packed_silence_reference(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Packed reference latents and order mask for a batch without any reference audio.
+        
+        Built once per batch size and reused across requests; rebuilt when
+        silence_latent moves to another device or dtype.
+        """
+        key = (batch_size, self.silence_latent.device, self.silence_latent.dtype, self.dtype)
+        cached = self._silence_reference_cache.get(key)
+        if cached is None:
+            silence = self.silence_latent[:, :750, :]
+            if silence.dim() == 2:
+                silence = silence.unsqueeze(0)
+            latents = silence.to(self.dtype).repeat(batch_size, 1, 1)
+            order_mask = torch.arange(batch_size, device=self.device, dtype=torch.long)
+            # Only the latest device/dtype combination is worth keeping
+            self._silence_reference_cache = {k: v for k, v in self._silence_reference_cache.items() if k[1:] == key[1:]}
+            cached = self._silence_reference_cache[key] = (latents, order_mask)
+        return cached
+
     def infer_refer_latent(self, refer_audioss):
         refer_audio_order_mask = []
         refer_audio_latents = []
@@ -2543,6 +2881,10 @@ class AceStepHandler:
         # Ensure silence_latent is on the correct device
         self._ensure_silence_latent_on_device()
 
+        # Fast path: no item has reference audio (the common text2music case)
+        if all(len(refer_audios) == 0 for refer_audios in refer_audioss):
+            return self._get_packed_silence_reference(len(refer_audioss))
+
         def _normalize_audio_2d(a: torch.Tensor) -> torch.Tensor:
             """Normalize audio tensor to [2, T] on current device."""
             if not isinstance(a, torch.Tensor):
@@ -2567,23 +2909,45 @@ class AceStepHandler:
                 z = z.unsqueeze(0)
             return z
 
+        # Latents depend on the VAE weights and the precision they run in
+        vae_tag = f"{self._vae_cache_id}|{self._get_vae_dtype()}"
+        keys_by_tensor = {}
+        batch_latents = {}
+
         for batch_idx, refer_audios in enumerate(refer_audioss):
-            if len(refer_audios) == 1 and torch.all(refer_audios[0] == 0.0):
+            # Empty list = no reference; an all-zero tensor is still accepted from older callers
+            if len(refer_audios) == 0 or (len(refer_audios) == 1 and torch.all(refer_audios[0] == 0.0)):
                 refer_audio_latent = _ensure_latent_3d(self.silence_latent[:, :750, :])
                 refer_audio_latents.append(refer_audio_latent)
                 refer_audio_order_mask.append(batch_idx)
             else:
                 for refer_audio in refer_audios:
-                    refer_audio = _normalize_audio_2d(refer_audio)
-                    # Use tiled_encode for memory-efficient encoding of long audio
-                    with torch.inference_mode():
-                        refer_audio_latent = self.tiled_encode(refer_audio, offload_latent_to_cpu=True)
-                    # Move to device and cast to model dtype
-                    refer_audio_latent = refer_audio_latent.to(self.device).to(self.dtype)
-                    # Ensure 3D before transpose: [C, T] -> [1, C, T] -> [1, T, C]
-                    if refer_audio_latent.dim() == 2:
-                        refer_audio_latent = refer_audio_latent.unsqueeze(0)
-                    refer_audio_latents.append(_ensure_latent_3d(refer_audio_latent.transpose(1, 2)))
+                    # Batch items normally share one reference tensor: key it once
+                    if id(refer_audio) not in keys_by_tensor:
+                        keys_by_tensor[id(refer_audio)] = f"{audio_content_hash(refer_audio)}|{vae_tag}"
+                    cache_key = keys_by_tensor[id(refer_audio)]
+                    refer_audio_latent = batch_latents.get(cache_key)
+                    if refer_audio_latent is None:
+                        cached_latent = self.ref_latent_cache.get(cache_key)
+                        self._record_call_stat(
+                            "ref_latent_cache_hits" if cached_latent is not None else "ref_latent_cache_misses", 1
+                        )
+                        if cached_latent is not None:
+                            refer_audio_latent = cached_latent.to(self.device).to(self.dtype)
+                        else:
+                            refer_audio_2d = _normalize_audio_2d(refer_audio)
+                            # Use tiled_encode for memory-efficient encoding of long audio
+                            with torch.inference_mode():
+                                refer_audio_latent = self.tiled_encode(refer_audio_2d, offload_latent_to_cpu=True)
+                            # Move to device and cast to model dtype
+                            refer_audio_latent = refer_audio_latent.to(self.device).to(self.dtype)
+                            # Ensure 3D before transpose: [C, T] -> [1, C, T] -> [1, T, C]
+                            if refer_audio_latent.dim() == 2:
+                                refer_audio_latent = refer_audio_latent.unsqueeze(0)
+                            refer_audio_latent = _ensure_latent_3d(refer_audio_latent.transpose(1, 2))
+                            self.ref_latent_cache.put(cache_key, refer_audio_latent)
+                        batch_latents[cache_key] = refer_audio_latent
+                    refer_audio_latents.append(refer_audio_latent)
                     refer_audio_order_mask.append(batch_idx)
 
         refer_audio_latents = torch.cat(refer_audio_latents, dim=0)
@@ -2600,6 +2964,53 @@ class AceStepHandler:
             lyric_embeddings = self.text_encoder.embed_tokens(lyric_token_ids)
         return lyric_embeddings
 
+    def _infer_embeddings_cached(
+        self,
+        requests: List[Tuple[str, torch.Tensor, Callable[[torch.Tensor], torch.Tensor]]],
+    ) -> List[torch.Tensor]:
+        """
+        Run text-encoder inference with deduplication and a cross-request cache.
+        
+        Identical rows within a batch are encoded once and gathered back, and rows
+        seen in earlier requests come from text_embedding_cache. The text encoder is
+        only loaded (_load_model_context) if some row actually has to be encoded.
+        
+        Args:
+            requests: (kind, token_idss [B, L], encode_fn) tuples; kind namespaces
+                the cache (e.g. "text", "lyric")
+            
+        Returns:
+            One [B, L, D] tensor per request, as encode_fn would have returned
+        """
+        plans = []
+        needs_encoder = False
+        for kind, token_idss, encode_fn in requests:
+            # Padded rows are keyed as-is, so cached outputs are exactly what the
+            # encoder produced for that input (including the padding positions)
+            keys = [f"{kind}|{token_ids_hash(row)}" for row in token_idss.cpu()]
+            unique_keys = list(dict.fromkeys(keys))
+            embeddings = {key: self.text_embedding_cache.get(key) for key in unique_keys}
+            missing = [key for key in unique_keys if embeddings[key] is None]
+            needs_encoder = needs_encoder or bool(missing)
+            plans.append((token_idss, keys, unique_keys, embeddings, missing, encode_fn))
+
+        results = []
+        with self._load_model_context("text_encoder") if needs_encoder else nullcontext():
+            for token_idss, keys, unique_keys, embeddings, missing, encode_fn in plans:
+                if missing:
+                    rows = [keys.index(key) for key in missing]
+                    encoded = encode_fn(token_idss[rows])
+                    for key, embedding in zip(missing, encoded):
+                        embeddings[key] = embedding
+                        self.text_embedding_cache.put(key, embedding)
+                unique = torch.stack([embeddings[key].to(token_idss.device) for key in unique_keys])
+                if len(unique_keys) == len(keys):
+                    results.append(unique)
+                else:
+                    gather_index = torch.tensor([unique_keys.index(key) for key in keys], device=unique.device)
+                    results.append(unique.index_select(0, gather_index))
+        return results
+
     def preprocess_batch(self, batch):
 
         # step 1: VAE encode latents, target_latents: N x T x d
@@ -2616,8 +3027,11 @@ class AceStepHandler:
 
         # step 2: refer_audio timbre
         keys = batch["keys"]
-        with self._load_model_context("vae"):
-            refer_audio_acoustic_hidden_states_packed, refer_audio_order_mask = self.infer_refer_latent(batch["refer_audioss"])
+        refer_audioss = batch["refer_audioss"]
+        # Without reference audio only the silence latent is used; don't load the VAE for it
+        needs_vae = any(len(refer_audios) > 0 for refer_audios in refer_audioss)
+        with self._load_model_context("vae") if needs_vae else nullcontext():
+            refer_audio_acoustic_hidden_states_packed, refer_audio_order_mask = self.infer_refer_latent(refer_audioss)
         if refer_audio_acoustic_hidden_states_packed.dtype != dtype:
             refer_audio_acoustic_hidden_states_packed = refer_audio_acoustic_hidden_states_packed.to(dtype)
 
@@ -2633,24 +3047,26 @@ class AceStepHandler:
         lyric_attention_mask = batch["lyric_attention_masks"]
         text_inputs = batch["text_inputs"]
 
-        logger.info("[preprocess_batch] Inferring prompt embeddings...")
-        with self._load_model_context("text_encoder"):
-            text_hidden_states = self.infer_text_embeddings(text_token_idss)
-            logger.info("[preprocess_batch] Inferring lyric embeddings...")
-            lyric_hidden_states = self.infer_lyric_embeddings(lyric_token_idss)
-
-            is_covers = batch["is_covers"]
-            
-            # Get precomputed hints from batch if available
-            precomputed_lm_hints_25Hz = batch.get("precomputed_lm_hints_25Hz", None)
-            
-            # Get non-cover text input ids and attention masks from batch if available
-            non_cover_text_input_ids = batch.get("non_cover_text_input_ids", None)
-            non_cover_text_attention_masks = batch.get("non_cover_text_attention_masks", None)
-            non_cover_text_hidden_states = None
-            if non_cover_text_input_ids is not None:
-                logger.info("[preprocess_batch] Inferring non-cover text embeddings...")
-                non_cover_text_hidden_states = self.infer_text_embeddings(non_cover_text_input_ids)
+        is_covers = batch["is_covers"]
+        
+        # Get precomputed hints from batch if available
+        precomputed_lm_hints_25Hz = batch.get("precomputed_lm_hints_25Hz", None)
+        
+        # Get non-cover text input ids and attention masks from batch if available
+        non_cover_text_input_ids = batch.get("non_cover_text_input_ids", None)
+        non_cover_text_attention_masks = batch.get("non_cover_text_attention_masks", None)
+        
+        logger.info("[preprocess_batch] Inferring prompt and lyric embeddings...")
+        embedding_requests = [
+            ("text", text_token_idss, self.infer_text_embeddings),
+            ("lyric", lyric_token_idss, self.infer_lyric_embeddings),
+        ]
+        if non_cover_text_input_ids is not None:
+            logger.info("[preprocess_batch] Inferring non-cover text embeddings...")
+            embedding_requests.append(("text", non_cover_text_input_ids, self.infer_text_embeddings))
+        embeddings = self._infer_embeddings_cached(embedding_requests)
+        text_hidden_states, lyric_hidden_states = embeddings[0], embeddings[1]
+        non_cover_text_hidden_states = embeddings[2] if non_cover_text_input_ids is not None else None
 
         return (
             keys,
@@ -2697,9 +3113,10 @@ class AceStepHandler:
         cfg_interval_start: float = 0.0,
         cfg_interval_end: float = 1.0,
         shift: float = 1.0,
-        audio_code_hints: Optional[Union[str, List[str]]] = None,
+        audio_code_hints: Optional[Union[AudioCodesLike, List[Optional[AudioCodesLike]]]] = None,
         infer_method: str = "ode",
         timesteps: Optional[List[float]] = None,
+        lora_names: Optional[Union[str, List[Optional[str]]]] = None,
     ) -> Dict[str, Any]:
 
         """
@@ -2724,6 +3141,9 @@ class AceStepHandler:
             use_adg: Whether to use ADG (Adaptive Diffusion Guidance) (default: False)
             cfg_interval_start: Start of CFG interval (0.0-1.0, default: 0.0)
             cfg_interval_end: End of CFG interval (0.0-1.0, default: 1.0)
+            lora_names: LoRA adapter for the whole batch, or one per item (None / "" = base
+                model); items with different adapters still share one forward pass.
+                None keeps the adapter selected via load_lora / set_use_lora.
             
         Returns:
             Dictionary containing:
@@ -2889,7 +3309,8 @@ class AceStepHandler:
                     precomputed_lm_hints_25Hz=precomputed_lm_hints_25Hz,
                 )
                 
-                outputs = self.model.generate_audio(**generate_kwargs)
+                with self._lora_context(lora_names, batch_size):
+                    outputs = self.model.generate_audio(**generate_kwargs)
         
         # Add intermediate information to outputs for extra_outputs
         outputs["src_latents"] = src_latents
@@ -2909,6 +3330,11 @@ class AceStepHandler:
     # MPS-safe chunk parameters (class-level for testability)
     _MPS_DECODE_CHUNK_SIZE = 32
     _MPS_DECODE_OVERLAP = 8
+    # Upper bound on windows stacked into a single VAE call by the overlapped decode
+    _OVERLAPPED_DECODE_MAX_WINDOWS = 4
+    # Live copies of the last decoder block's activation during a VAE decode
+    # (block input, snake output, conv output, residual sum)
+    _VAE_DECODE_ACTIVATION_COPIES = 4
 
     def tiled_decode(self, latents, chunk_size: Optional[int] = None, overlap: int = 64, offload_wav_to_cpu: Optional[bool] = None):
         """
@@ -2977,6 +3403,7 @@ class AceStepHandler:
     def _tiled_decode_inner(self, latents, chunk_size, overlap, offload_wav_to_cpu):
         """Core tiled decode logic (extracted for fallback wrapping)."""
         B, C, T = latents.shape
+        self._record_vae_decode_schedule({"windows": 1, "calls": 1, "overlapped": 0})
         
         # If short enough, decode directly
         if T <= chunk_size:
@@ -2992,8 +3419,12 @@ class AceStepHandler:
             raise ValueError(f"chunk_size {chunk_size} must be > 2 * overlap {overlap}")
         
         num_steps = math.ceil(T / stride)
+        self._record_vae_decode_schedule({"windows": num_steps, "calls": num_steps, "overlapped": 0})
         
         if offload_wav_to_cpu:
+            if self._use_overlapped_decode(latents):
+                # CUDA: batched windows, async D2H on a side stream into pinned memory
+                return self._tiled_decode_offload_cpu_overlapped(latents, B, T, stride, overlap, num_steps)
             # Optimized path: offload wav to CPU immediately to save VRAM
             return self._tiled_decode_offload_cpu(latents, B, T, stride, overlap, num_steps)
         else:
@@ -3125,6 +3556,151 @@ class AceStepHandler:
         final_audio = final_audio[:, :, :audio_write_pos]
         
         return final_audio
+
+    def _use_overlapped_decode(self, latents) -> bool:
+        """Overlapped decode needs CUDA streams; CPU/MPS keep the synchronous path."""
+        if latents.device.type != "cuda" or not torch.cuda.is_available():
+            return False
+        return os.environ.get("ACESTEP_VAE_OVERLAP_DECODE", "1").lower() not in ("0", "false", "no")
+
+    def _estimate_vae_decode_window_bytes(self, batch_size: int, audio_len: int, element_size: int) -> int:
+        """
+        Peak activation memory of decoding one window, from its shape.
+
+        The Oobleck decoder's largest activations are in its last block (fewest
+        channels, but at the full audio rate). Estimated rather than measured: the
+        device-wide peak counter is shared with other code and, in the staged
+        pipeline, with another job's DiT running at the same time.
+        """
+        config = getattr(self.vae, "config", None)
+        decoder_channels = getattr(config, "decoder_channels", 128)
+        channel_multiples = getattr(config, "channel_multiples", None) or [1]
+        hidden = decoder_channels * channel_multiples[0]
+        return self._VAE_DECODE_ACTIVATION_COPIES * batch_size * hidden * audio_len * element_size
+
+    def _overlapped_decode_windows_per_call(self, window_bytes: int) -> int:
+        """How many full-size windows fit in one VAE call given the estimated per-window cost."""
+        override = os.environ.get("ACESTEP_VAE_DECODE_WINDOWS_PER_CALL")
+        if override:
+            try:
+                return max(1, int(override))
+            except ValueError:
+                pass
+        if window_bytes <= 0:
+            return 1
+        try:
+            free_bytes, _ = torch.cuda.mem_get_info()
+        except RuntimeError:
+            return 1
+        # Keep a safety margin: activations fragment and other jobs may share the device
+        fits = int((free_bytes * 0.5) // window_bytes)
+        return max(1, min(self._OVERLAPPED_DECODE_MAX_WINDOWS, fits))
+
+    def _tiled_decode_offload_cpu_overlapped(self, latents, B, T, stride, overlap, num_steps):
+        """
+        Tiled decode to CPU with decode/copy overlap.
+
+        Same windows and trimming as _tiled_decode_offload_cpu, but equal-sized
+        windows are stacked along the batch dimension into one VAE call when memory
+        allows, and each decoded group is copied into pinned host memory with a
+        non_blocking copy on a side stream. The host-side write of group i happens
+        while group i+1 is decoding.
+        """
+        compute_stream = torch.cuda.current_stream(latents.device)
+        if self._vae_copy_stream is None or self._vae_copy_stream.device != latents.device:
+            self._vae_copy_stream = torch.cuda.Stream(device=latents.device)
+        copy_stream = self._vae_copy_stream
+
+        # (win_start, win_end, added_start, added_end) in latent frames
+        windows = []
+        for i in range(num_steps):
+            core_start = i * stride
+            core_end = min(core_start + stride, T)
+            win_start = max(0, core_start - overlap)
+            win_end = min(T, core_end + overlap)
+            windows.append((win_start, win_end, core_start - win_start, win_end - core_end))
+
+        # First window on its own: gives upsample factor, channels and per-window memory cost
+        first = windows[0]
+        first_audio = self.vae.decode(latents[:, :, first[0]:first[1]]).sample
+        upsample_factor = first_audio.shape[-1] / (first[1] - first[0])
+        window_bytes = self._estimate_vae_decode_window_bytes(
+            B, int(round((2 * overlap + stride) * upsample_factor)), first_audio.element_size()
+        )
+        windows_per_call = self._overlapped_decode_windows_per_call(window_bytes)
+
+        audio_channels = first_audio.shape[1]
+        total_audio_length = int(round(T * upsample_factor))
+        final_audio = torch.empty(B, audio_channels, total_audio_length, dtype=first_audio.dtype, device="cpu")
+
+        # Consecutive windows with identical geometry can share one VAE call
+        groups = [[windows[0]]]
+        for window in windows[1:]:
+            last = groups[-1]
+            same_shape = (window[1] - window[0], window[2], window[3]) == (last[0][1] - last[0][0], last[0][2], last[0][3])
+            if last is not groups[0] and same_shape and len(last) < windows_per_call:
+                last.append(window)
+            else:
+                groups.append([window])
+
+        pending = []  # (copy_done_event, pinned_staging, write_pos)
+        audio_write_pos = 0
+        writeback_wait = 0.0
+
+        def _flush_oldest():
+            nonlocal writeback_wait
+            event, staging, pos = pending.pop(0)
+            wait_start = time.time()
+            event.synchronize()
+            writeback_wait += time.time() - wait_start
+            # staging: [k, B, channels, core_len] in window order
+            core_len = staging.shape[-1]
+            for j in range(staging.shape[0]):
+                final_audio[:, :, pos + j * core_len:pos + (j + 1) * core_len] = staging[j]
+
+        for group_idx, group in enumerate(tqdm(groups, desc="Decoding audio chunks", disable=self.disable_tqdm)):
+            if group_idx == 0:
+                audio, first_audio = first_audio, None
+            else:
+                latent_chunk = torch.cat([latents[:, :, w[0]:w[1]] for w in group], dim=0)
+                audio = self.vae.decode(latent_chunk).sample
+                del latent_chunk
+
+            _, _, added_start, added_end = group[0]
+            trim_start = int(round(added_start * upsample_factor))
+            trim_end = int(round(added_end * upsample_factor))
+            audio_len = audio.shape[-1]
+            end_idx = audio_len - trim_end if trim_end > 0 else audio_len
+            cores = audio.reshape(len(group), B, audio_channels, audio_len)[..., trim_start:end_idx].contiguous()
+            del audio
+
+            copy_stream.wait_stream(compute_stream)
+            with torch.cuda.stream(copy_stream):
+                staging = torch.empty(cores.shape, dtype=cores.dtype, pin_memory=True)
+                staging.copy_(cores, non_blocking=True)
+                copy_done = torch.cuda.Event()
+                copy_done.record(copy_stream)
+            # Keep the GPU block alive until the side-stream copy has consumed it
+            cores.record_stream(copy_stream)
+            pending.append((copy_done, staging, audio_write_pos))
+            audio_write_pos += len(group) * cores.shape[-1]
+            del cores
+
+            # Write back the previous group while this one is still copying/decoding
+            while len(pending) > 1:
+                _flush_oldest()
+
+        while pending:
+            _flush_oldest()
+
+        self._record_vae_decode_schedule({
+            "windows": num_steps,
+            "calls": len(groups),
+            "windows_per_call": windows_per_call,
+            "overlapped": 1,
+            "writeback_wait_time_cost": writeback_wait,
+        })
+        return final_audio[:, :, :audio_write_pos]
     
     def tiled_encode(self, audio, chunk_size=None, overlap=None, offload_latent_to_cpu=True):
         """
@@ -3143,15 +3719,7 @@ class AceStepHandler:
         """
         # Default values for 48kHz audio, adaptive to GPU memory
         if chunk_size is None:
-            gpu_memory = get_gpu_memory_gb()
-            if gpu_memory <= 0 and self.device == "mps":
-                mem_gb = self._get_effective_mps_memory_gb()
-                if mem_gb is not None:
-                    gpu_memory = mem_gb
-            if gpu_memory <= 8:
-                chunk_size = 48000 * 15  # 15 seconds for low VRAM
-            else:
-                chunk_size = 48000 * 30  # 30 seconds for normal VRAM
+            chunk_size = self._get_auto_encode_chunk_size()
         if overlap is None:
             overlap = 48000 * 2  # 2 seconds overlap
         
@@ -3325,7 +3893,7 @@ class AceStepHandler:
         audio_duration: Optional[float] = None,
         batch_size: Optional[int] = None,
         src_audio=None,
-        audio_code_string: Union[str, List[str]] = "",
+        audio_code_string: Union[AudioCodesLike, List[Optional[AudioCodesLike]]] = "",
         repainting_start: float = 0.0,
         repainting_end: Optional[float] = None,
         instruction: str = DEFAULT_DIT_INSTRUCTION,
@@ -3338,11 +3906,17 @@ class AceStepHandler:
         infer_method: str = "ode",
         use_tiled_decode: bool = True,
         timesteps: Optional[List[float]] = None,
+        lora_name: Optional[Union[str, List[Optional[str]]]] = None,
         progress=None
     ) -> Dict[str, Any]:
         """
         Main interface for music generation
         
+        lora_name selects a registered LoRA adapter (or one per batch item) for this
+        call only; None uses the adapter enabled through load_lora / set_use_lora.
+        audio_code_string takes uint16 code arrays (see acestep.audio_codes) as well as
+        the ``<|audio_code_N|>`` string form, for one item or as a per-item list.
+        
         Returns:
             Dictionary containing:
             - audios: List of audio dictionaries with path, key, params
@@ -3365,16 +3939,11 @@ class AceStepHandler:
                 "error": "Model not fully initialized",
             }
 
-        def _has_audio_codes(v: Union[str, List[str]]) -> bool:
-            if isinstance(v, list):
-                return any((x or "").strip() for x in v)
-            return bool(v and str(v).strip())
-
         # Auto-detect task type based on audio_code_string
         # If audio_code_string is provided and not empty, use cover task
         # Otherwise, use text2music task (or keep current task_type if not text2music)
         if task_type == "text2music":
-            if _has_audio_codes(audio_code_string):
+            if has_audio_codes(audio_code_string):
                 # User has provided audio codes, switch to cover task
                 task_type = "cover"
                 # Update instruction for cover task
@@ -3384,9 +3953,7 @@ class AceStepHandler:
         if progress:
             progress(0.51, desc="Preparing inputs...")
         logger.info("[generate_music] Preparing inputs...")
-        
-        # Reset offload cost
-        self.current_offload_cost = 0.0
+
 
         # Caption and lyrics are optional - can be empty
         # Use provided batch_size or default
@@ -3414,14 +3981,15 @@ class AceStepHandler:
                     # Each batch item has a list of reference audios
                     refer_audios = [[processed_ref_audio] for _ in range(actual_batch_size)]
             else:
-                refer_audios = [[torch.zeros(2, 30*self.sample_rate)] for _ in range(actual_batch_size)]
+                # No reference: empty per-item lists select the precomputed silence latent
+                refer_audios = [[] for _ in range(actual_batch_size)]
             
             # 2. Process source audio
             # If audio_code_string is provided, ignore src_audio and use codes instead
             processed_src_audio = None
             if src_audio is not None:
                 # Check if audio codes are provided - if so, ignore src_audio
-                if _has_audio_codes(audio_code_string):
+                if has_audio_codes(audio_code_string):
                     logger.info("[generate_music] Audio codes provided, ignoring src_audio and using codes instead")
                 else:
                     logger.info("[generate_music] Processing source audio...")
@@ -3458,11 +4026,8 @@ class AceStepHandler:
             # Prepare audio_code_hints - use if audio_code_string is provided
             # This works for both text2music (auto-switched to cover) and cover tasks
             audio_code_hints_batch = None
-            if _has_audio_codes(audio_code_string):
-                if isinstance(audio_code_string, list):
-                    audio_code_hints_batch = audio_code_string
-                else:
-                    audio_code_hints_batch = [audio_code_string] * actual_batch_size
+            if has_audio_codes(audio_code_string):
+                audio_code_hints_batch = audio_codes_list(audio_code_string, actual_batch_size)
 
             should_return_intermediate = (task_type == "text2music")
             progress_desc = f"Generating music (batch size: {actual_batch_size})..."
@@ -3480,29 +4045,31 @@ class AceStepHandler:
                     duration_sec=audio_duration if audio_duration and audio_duration > 0 else None,
                     desc=progress_desc,
                 )
-                outputs = self.service_generate(
-                    captions=captions_batch,
-                    lyrics=lyrics_batch,
-                    metas=metas_batch,  # Pass as dict, service will convert to string
-                    vocal_languages=vocal_languages_batch,
-                    refer_audios=refer_audios,  # Already in List[List[torch.Tensor]] format
-                    target_wavs=target_wavs_tensor,  # Shape: [batch_size, 2, frames]
-                    infer_steps=inference_steps,
-                    guidance_scale=guidance_scale,
-                    seed=actual_seed_list,  # Pass list of seeds, one per batch item
-                    repainting_start=repainting_start_batch,
-                    repainting_end=repainting_end_batch,
-                    instructions=instructions_batch,  # Pass instructions to service
-                    audio_cover_strength=audio_cover_strength,  # Pass audio cover strength
-                    use_adg=use_adg,  # Pass use_adg parameter
-                    cfg_interval_start=cfg_interval_start,  # Pass CFG interval start
-                    cfg_interval_end=cfg_interval_end,  # Pass CFG interval end
-                    shift=shift,  # Pass shift parameter
-                    infer_method=infer_method,  # Pass infer method (ode or sde)
-                    audio_code_hints=audio_code_hints_batch,  # Pass audio code hints as list
-                    return_intermediate=should_return_intermediate,
-                    timesteps=timesteps,  # Pass custom timesteps if provided
-                )
+                with pipeline_stage("dit"), self._call_stats_scope() as dit_stats:
+                    outputs = self.service_generate(
+                        captions=captions_batch,
+                        lyrics=lyrics_batch,
+                        metas=metas_batch,  # Pass as dict, service will convert to string
+                        vocal_languages=vocal_languages_batch,
+                        refer_audios=refer_audios,  # Already in List[List[torch.Tensor]] format
+                        target_wavs=target_wavs_tensor,  # Shape: [batch_size, 2, frames]
+                        infer_steps=inference_steps,
+                        guidance_scale=guidance_scale,
+                        seed=actual_seed_list,  # Pass list of seeds, one per batch item
+                        repainting_start=repainting_start_batch,
+                        repainting_end=repainting_end_batch,
+                        instructions=instructions_batch,  # Pass instructions to service
+                        audio_cover_strength=audio_cover_strength,  # Pass audio cover strength
+                        use_adg=use_adg,  # Pass use_adg parameter
+                        cfg_interval_start=cfg_interval_start,  # Pass CFG interval start
+                        cfg_interval_end=cfg_interval_end,  # Pass CFG interval end
+                        shift=shift,  # Pass shift parameter
+                        infer_method=infer_method,  # Pass infer method (ode or sde)
+                        audio_code_hints=audio_code_hints_batch,  # Pass audio code hints as list
+                        return_intermediate=should_return_intermediate,
+                        timesteps=timesteps,  # Pass custom timesteps if provided
+                        lora_names=lora_name,
+                    )
             finally:
                 if stop_event is not None:
                     stop_event.set()
@@ -3512,7 +4079,7 @@ class AceStepHandler:
             logger.info("[generate_music] Model generation completed. Decoding latents...")
             pred_latents = outputs["target_latents"]  # [batch, latent_length, latent_dim]
             time_costs = outputs["time_costs"]
-            time_costs["offload_time_cost"] = self.current_offload_cost
+            time_costs.update(dit_stats)
             per_step = time_costs.get("diffusion_per_step_time_cost")
             if isinstance(per_step, (int, float)) and per_step > 0:
                 self._last_diffusion_per_step_sec = float(per_step)
@@ -3548,9 +4115,10 @@ class AceStepHandler:
                 progress(0.8, desc="Decoding audio...")
             logger.info("[generate_music] Decoding latents with VAE...")
             
-            # Decode latents to audio
-            start_time = time.time()
-            with torch.inference_mode():
+            # Decode latents to audio (the "vae" pipeline stage lets this overlap with
+            # another job's diffusion when a staged pipeline executor is active)
+            with pipeline_stage("vae"), torch.inference_mode(), self._call_stats_scope() as vae_stats:
+                start_time = time.time()
                 with self._load_model_context("vae"):
                     # Move pred_latents to CPU early to save VRAM (will be used in extra_outputs later)
                     pred_latents_cpu = pred_latents.detach().cpu()
@@ -3608,10 +4176,12 @@ class AceStepHandler:
                     self._empty_cache()
             end_time = time.time()
             time_costs["vae_decode_time_cost"] = end_time - start_time
+            for key, value in vae_stats.get("vae_decode_schedule", {}).items():
+                time_costs[f"vae_decode_{key}"] = value
             time_costs["total_time_cost"] = time_costs["total_time_cost"] + time_costs["vae_decode_time_cost"]
             
-            # Update offload cost one last time to include VAE offloading
-            time_costs["offload_time_cost"] = self.current_offload_cost
+            # Include the VAE load/offload of this call
+            time_costs["offload_time_cost"] += vae_stats["offload_time_cost"]
             
             logger.info("[generate_music] VAE decode completed. Preparing audio tensors...")
             if progress:
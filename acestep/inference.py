@@ -12,13 +12,16 @@ import tempfile
 import shutil
 import subprocess
 import sys
+from contextlib import nullcontext
 from typing import Optional, Union, List, Dict, Any, Tuple
 from dataclasses import dataclass, field, asdict
 from loguru import logger
 
+from acestep.audio_codes import AudioCodesLike, audio_codes_to_json, format_audio_codes, has_audio_codes, parse_audio_codes
 from acestep.audio_utils import AudioSaver, generate_uuid_from_params, is_audio_silent
 from acestep.constants import TASK_INSTRUCTIONS
 from acestep.gpu_config import get_gpu_config
+from acestep.pipeline_executor import get_active_pipeline, pipeline_stage
 
 # HuggingFace Space environment detection
 IS_HUGGINGFACE_SPACE = os.environ.get("SPACE_ID") is not None
@@ -65,12 +68,14 @@ class GenerationParams:
         cfg_interval_start: Start ratio (0.0–1.0) to apply CFG.
         cfg_interval_end: End ratio (0.0–1.0) to apply CFG.
         shift: Timestep shift factor (default 1.0). When != 1.0, applies t = shift * t / (1 + (shift - 1) * t) to timesteps.
+        lora_name: Name of a loaded LoRA adapter to use for this generation only ("" = base model, None = the handler's active adapter).
         
         # Task-Specific Parameters
         task_type: Type of generation task. One of: "text2music", "cover", "repaint", "lego", "extract", "complete".
         reference_audio: Path to a reference audio file for style transfer or cover tasks.
         src_audio: Path to a source audio file for audio-to-audio tasks.
-        audio_codes: Audio semantic codes as a string (advanced use, for code-control generation).
+        audio_codes: Audio semantic codes (advanced use, for code-control generation): a uint16 array /
+            list of code ints (see acestep.audio_codes) or the "<|audio_code_N|>..." string form.
         repainting_start: For repaint/lego tasks: start time in seconds for region to repaint.
         repainting_end: For repaint/lego tasks: end time in seconds for region to repaint (-1 for until end).
         audio_cover_strength: Strength of reference audio/codes influence (range 0.0–1.0). set smaller (0.2) for style transfer tasks.
@@ -95,8 +100,8 @@ class GenerationParams:
     reference_audio: Optional[str] = None
     src_audio: Optional[str] = None
 
-    # LM Codes Hints
-    audio_codes: str = ""
+    # LM Codes Hints (uint16 array, list of ints or "<|audio_code_N|>" string)
+    audio_codes: AudioCodesLike = ""
 
     # Text Inputs
     caption: str = ""
@@ -122,6 +127,8 @@ class GenerationParams:
     # Custom timesteps (parsed from string like "0.97,0.76,0.615,0.5,0.395,0.28,0.18,0.085,0")
     # If provided, overrides inference_steps and shift
     timesteps: Optional[List[float]] = None
+    # Per-request LoRA adapter (see AceStepHandler.lora_registry)
+    lora_name: Optional[str] = None
 
     repainting_start: float = 0.0
     repainting_end: float = -1
@@ -150,7 +157,10 @@ class GenerationParams:
 
     def to_dict(self) -> Dict[str, Any]:
         """Convert config to dictionary for JSON serialization."""
-        return asdict(self)
+        data = asdict(self)
+        # Code arrays are serialized in their string form
+        data["audio_codes"] = audio_codes_to_json(self.audio_codes)
+        return data
 
 
 @dataclass
@@ -322,6 +332,7 @@ def generate_music(
         lm_total_time_costs = {
             "phase1_time": 0.0,
             "phase2_time": 0.0,
+            "phase2_prefix_saved_time": 0.0,
             "total_time": 0.0,
         }
 
@@ -336,7 +347,7 @@ def generate_music(
         # Determine if we need to generate audio codes
         # If user has provided audio_codes, we don't need to generate them
         # Otherwise, check if we need audio codes (lm_dit mode) or just metas (dit mode)
-        user_provided_audio_codes = bool(params.audio_codes and str(params.audio_codes).strip())
+        user_provided_audio_codes = has_audio_codes(params.audio_codes)
 
         # Safety: cover task without any source audio or codes produces silence.
         if params.task_type == "cover":
@@ -347,6 +358,17 @@ def generate_music(
                 if params.instruction == TASK_INSTRUCTIONS.get("cover"):
                     params.instruction = TASK_INSTRUCTIONS.get("text2music", params.instruction)
 
+        # Reject an adapter selection the DiT cannot serve before spending time on the LM
+        lora_error = dit_handler.lora_request_error(params.lora_name)
+        if lora_error:
+            return GenerationResult(
+                audios=[],
+                status_message=f"❌ {lora_error}",
+                extra_outputs={},
+                success=False,
+                error=lora_error,
+            )
+
         # Determine infer_type: use "llm_dit" if we need audio codes, "dit" if only metas needed
         # For now, we use "llm_dit" if batch mode or if user hasn't provided codes
         # Use "dit" if user has provided codes (only need metas) or if explicitly only need metas
@@ -561,6 +583,7 @@ def generate_music(
 
             all_metadata_list = []
             all_audio_codes_list = []
+            all_audio_code_ids_list = []
 
             for chunk_idx in range(num_chunks):
                 chunk_start = chunk_idx * max_inference_batch_size
@@ -574,26 +597,27 @@ def generate_music(
                 # Use the determined infer_type
                 # - "llm_dit" will internally run two phases (metas + codes)
                 # - "dit" will only run phase 1 (metas only)
-                result = llm_handler.generate_with_stop_condition(
-                    caption=params.caption or "",
-                    lyrics=params.lyrics or "",
-                    infer_type=infer_type,
-                    temperature=params.lm_temperature,
-                    cfg_scale=params.lm_cfg_scale,
-                    negative_prompt=params.lm_negative_prompt,
-                    top_k=top_k_value,
-                    top_p=top_p_value,
-                    target_duration=audio_duration,  # Pass duration to limit audio codes generation
-                    user_metadata=user_metadata_to_pass,
-                    use_cot_caption=params.use_cot_caption,
-                    use_cot_language=params.use_cot_language,
-                    use_cot_metas=params.use_cot_metas,
-                    use_constrained_decoding=params.use_constrained_decoding,
-                    constrained_decoding_debug=config.constrained_decoding_debug,
-                    batch_size=chunk_size,
-                    seeds=chunk_seeds,
-                    progress=progress,
-                )
+                with pipeline_stage("lm"):
+                    result = llm_handler.generate_with_stop_condition(
+                        caption=params.caption or "",
+                        lyrics=params.lyrics or "",
+                        infer_type=infer_type,
+                        temperature=params.lm_temperature,
+                        cfg_scale=params.lm_cfg_scale,
+                        negative_prompt=params.lm_negative_prompt,
+                        top_k=top_k_value,
+                        top_p=top_p_value,
+                        target_duration=audio_duration,  # Pass duration to limit audio codes generation
+                        user_metadata=user_metadata_to_pass,
+                        use_cot_caption=params.use_cot_caption,
+                        use_cot_language=params.use_cot_language,
+                        use_cot_metas=params.use_cot_metas,
+                        use_constrained_decoding=params.use_constrained_decoding,
+                        constrained_decoding_debug=config.constrained_decoding_debug,
+                        batch_size=chunk_size,
+                        seeds=chunk_seeds,
+                        progress=progress,
+                    )
 
                 # Check if LM generation failed
                 if not result.get("success", False):
@@ -614,18 +638,23 @@ def generate_music(
                     audio_codes_list = result.get("audio_codes", [])
                     all_metadata_list.extend(metadata_list)
                     all_audio_codes_list.extend(audio_codes_list)
+                    all_audio_code_ids_list.extend(
+                        result.get("audio_code_ids") or [parse_audio_codes(codes) for codes in audio_codes_list]
+                    )
                 else:
                     metadata = result.get("metadata", {})
                     audio_codes = result.get("audio_codes", "")
+                    audio_code_ids = result.get("audio_code_ids")
                     all_metadata_list.append(metadata)
                     all_audio_codes_list.append(audio_codes)
+                    all_audio_code_ids_list.append(audio_code_ids if audio_code_ids is not None else parse_audio_codes(audio_codes))
 
                 # Collect time costs from LM extra_outputs
                 lm_extra = result.get("extra_outputs", {})
                 lm_chunk_time_costs = lm_extra.get("time_costs", {})
                 if lm_chunk_time_costs:
                     # Accumulate time costs from all chunks
-                    for key in ["phase1_time", "phase2_time", "total_time"]:
+                    for key in ["phase1_time", "phase2_time", "phase2_prefix_saved_time", "total_time"]:
                         if key in lm_chunk_time_costs:
                             lm_total_time_costs[key] += lm_chunk_time_costs[key]
 
@@ -635,13 +664,14 @@ def generate_music(
             lm_generated_metadata = all_metadata_list[0] if all_metadata_list else None
             lm_generated_audio_codes_list = all_audio_codes_list
 
-            # Set audio_code_string_to_use based on infer_type
+            # Set audio_code_string_to_use based on infer_type. The DiT gets the code
+            # arrays; the strings are only kept for the per-audio params (JSON / UI).
             if infer_type == "llm_dit":
-                # If batch mode, use list; otherwise use single string
+                # If batch mode, use list; otherwise use single array
                 if actual_batch_size > 1:
-                    audio_code_string_to_use = all_audio_codes_list
+                    audio_code_string_to_use = all_audio_code_ids_list
                 else:
-                    audio_code_string_to_use = all_audio_codes_list[0] if all_audio_codes_list else ""
+                    audio_code_string_to_use = all_audio_code_ids_list[0] if all_audio_code_ids_list else ""
             else:
                 # For "dit" mode, keep user-provided codes or empty
                 audio_code_string_to_use = params.audio_codes
@@ -681,35 +711,44 @@ def generate_music(
 
         # Phase 2: DiT music generation
         # Use seed_for_generation (from config.seed or params.seed) instead of params.seed for actual generation
-        result = dit_handler.generate_music(
-            captions=dit_input_caption,
-            lyrics=dit_input_lyrics,
-            bpm=bpm,
-            key_scale=key_scale,
-            time_signature=time_signature,
-            vocal_language=dit_input_vocal_language,
-            inference_steps=params.inference_steps,
-            guidance_scale=params.guidance_scale,
-            use_random_seed=config.use_random_seed,
-            seed=seed_for_generation,  # Use config.seed (or params.seed fallback) instead of params.seed directly
-            reference_audio=params.reference_audio,
-            audio_duration=audio_duration,
-            batch_size=config.batch_size if config.batch_size is not None else 1,
-            src_audio=params.src_audio,
-            audio_code_string=audio_code_string_to_use,
-            repainting_start=params.repainting_start,
-            repainting_end=params.repainting_end,
-            instruction=params.instruction,
-            audio_cover_strength=params.audio_cover_strength,
-            task_type=params.task_type,
-            use_adg=params.use_adg,
-            cfg_interval_start=params.cfg_interval_start,
-            cfg_interval_end=params.cfg_interval_end,
-            shift=params.shift,
-            infer_method=params.infer_method,
-            timesteps=params.timesteps,
-            progress=progress,
-        )
+        # The DiT handler is not re-entrant: concurrent jobs serialize here while their
+        # LM phases keep sharing the continuously batched nano-vllm engine. Under a
+        # staged pipeline executor the handler's "dit"/"vae" stage gates serialize each
+        # phase instead, so one job can decode while the next one diffuses.
+        dit_guard = getattr(dit_handler, "generation_lock", None)
+        if get_active_pipeline() is not None and getattr(dit_handler, "supports_stage_overlap", lambda: False)():
+            dit_guard = None
+        with dit_guard or nullcontext():
+            result = dit_handler.generate_music(
+                captions=dit_input_caption,
+                lyrics=dit_input_lyrics,
+                bpm=bpm,
+                key_scale=key_scale,
+                time_signature=time_signature,
+                vocal_language=dit_input_vocal_language,
+                inference_steps=params.inference_steps,
+                guidance_scale=params.guidance_scale,
+                use_random_seed=config.use_random_seed,
+                seed=seed_for_generation,  # Use config.seed (or params.seed fallback) instead of params.seed directly
+                reference_audio=params.reference_audio,
+                audio_duration=audio_duration,
+                batch_size=config.batch_size if config.batch_size is not None else 1,
+                src_audio=params.src_audio,
+                audio_code_string=audio_code_string_to_use,
+                repainting_start=params.repainting_start,
+                repainting_end=params.repainting_end,
+                instruction=params.instruction,
+                audio_cover_strength=params.audio_cover_strength,
+                task_type=params.task_type,
+                use_adg=params.use_adg,
+                cfg_interval_start=params.cfg_interval_start,
+                cfg_interval_end=params.cfg_interval_end,
+                shift=params.shift,
+                infer_method=params.infer_method,
+                timesteps=params.timesteps,
+                lora_name=params.lora_name,
+                progress=progress,
+            )
 
         # Check if generation failed
         if not result.get("success", False):
@@ -788,11 +827,12 @@ def generate_music(
             if audio_tensor is not None and save_dir is not None and not silent_check:
                 try:
                     audio_file = os.path.join(save_dir, f"{audio_key}.{audio_format}")
-                    audio_path = audio_saver.save_audio(audio_tensor,
-                                                        audio_file,
-                                                        sample_rate=sample_rate,
-                                                        format=audio_format,
-                                                        channels_first=True)
+                    with pipeline_stage("save"):
+                        audio_path = audio_saver.save_audio(audio_tensor,
+                                                            audio_file,
+                                                            sample_rate=sample_rate,
+                                                            format=audio_format,
+                                                            channels_first=True)
                 except Exception as e:
                     logger.error(f"[generate_music] Failed to save audio file: {e}")
                     audio_path = ""
@@ -863,7 +903,7 @@ def generate_music(
 
 def understand_music(
     llm_handler,
-    audio_codes: str,
+    audio_codes: AudioCodesLike,
     temperature: float = 0.85,
     top_k: Optional[int] = None,
     top_p: Optional[float] = None,
@@ -911,6 +951,7 @@ def understand_music(
         )
     
     # If codes are empty, use "NO USER INPUT" to generate a sample example
+    audio_codes = format_audio_codes(audio_codes)
     if not audio_codes or not audio_codes.strip():
         audio_codes = "NO USER INPUT"
     
@@ -0,0 +1,118 @@
+"""Tensor caches for expensive encoder outputs
+
+Caches VAE latents of reference audio keyed by audio content hash, and text
+encoder outputs keyed by token ids, so repeated inputs are encoded once.
+Memory tier is a bounded LRU; an optional disk tier persists entries between
+restarts.
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+import torch
+from loguru import logger
+
+
+def audio_content_hash(audio: torch.Tensor) -> str:
+    """
+    Hash the samples of an audio tensor.
+
+    Args:
+        audio: Audio tensor on any device (copied to CPU for hashing)
+
+    Returns:
+        Hex digest that identifies the audio content
+    """
+    data = audio.detach().to("cpu", torch.float32).contiguous()
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(tuple(data.shape)).encode("utf-8"))
+    h.update(data.numpy().tobytes())
+    return h.hexdigest()
+
+
+def token_ids_hash(token_ids: torch.Tensor) -> str:
+    """Hash a 1D tensor of token ids."""
+    data = token_ids.detach().to("cpu", torch.int64).contiguous()
+    return hashlib.blake2b(data.numpy().tobytes(), digest_size=16).hexdigest()
+
+
+class TensorLRUCache:
+    """
+    LRU cache of tensors (e.g. reference-audio VAE latents, text embeddings).
+
+    Keys are built by the caller (content hash + model identity/dtype), values are
+    stored on CPU and moved to the requested device by the caller.
+    """
+
+    def __init__(self, max_entries: int = 32, disk_dir: Optional[str] = None):
+        self.max_entries = max(0, max_entries)
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key: str) -> str:
+        safe_key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{safe_key}.pt")
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """Return the cached tensor (CPU) or None, counting hits/misses."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                try:
+                    value = torch.load(path, map_location="cpu", weights_only=True)
+                except Exception as e:
+                    logger.warning(f"[TensorLRUCache] Ignoring unreadable cache file {path}: {e}")
+                    value = None
+                if value is not None:
+                    self._put_memory(key, value)
+                    with self._lock:
+                        self.hits += 1
+                    return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, value: torch.Tensor):
+        """Store a tensor in the memory tier and, if enabled, the disk tier."""
+        if self.max_entries == 0 and not self.disk_dir:
+            return
+        value = value.detach().to("cpu").contiguous()
+        self._put_memory(key, value)
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                torch.save(value, tmp_path)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.warning(f"[TensorLRUCache] Could not write {path}: {e}")
+
+    def _put_memory(self, key: str, value: torch.Tensor):
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop the memory tier (e.g. after the encoder is reloaded)."""
+        with self._lock:
+            self._entries.clear()
@@ -21,6 +21,7 @@ from transformers.generation.logits_process import (
     LogitsProcessorList,
     RepetitionPenaltyLogitsProcessor,
 )
+from acestep.audio_codes import AudioCodesLike, format_audio_codes, parse_audio_codes
 from acestep.constrained_logits_processor import MetadataConstrainedLogitsProcessor
 from acestep.constants import DEFAULT_LM_INSTRUCTION, DEFAULT_LM_UNDERSTAND_INSTRUCTION, DEFAULT_LM_INSPIRED_INSTRUCTION, DEFAULT_LM_REWRITE_INSTRUCTION
 from acestep.gpu_config import get_lm_gpu_memory_ratio, get_gpu_memory_gb, get_lm_model_size, get_global_gpu_config
@@ -38,6 +39,143 @@ def _warn_if_prerelease_python():
         )
 
 
+class _DecodeBuffer:
+    """
+    Preallocated token ids and attention mask for the custom PyTorch decode loops.
+
+    Appending a token writes one column at the write cursor instead of rebuilding
+    the whole sequence with torch.cat, so per-token overhead stays constant
+    instead of growing with the sequence length.
+    """
+
+    def __init__(self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor], max_new_tokens: int):
+        batch_size, prompt_len = input_ids.shape
+        capacity = prompt_len + max_new_tokens
+        self.ids = input_ids.new_zeros((batch_size, capacity))
+        self.ids[:, :prompt_len] = input_ids
+        mask_dtype = attention_mask.dtype if attention_mask is not None else input_ids.dtype
+        self.mask = torch.zeros((batch_size, capacity), dtype=mask_dtype, device=input_ids.device)
+        if attention_mask is not None:
+            self.mask[:, :prompt_len] = attention_mask
+        else:
+            self.mask[:, :prompt_len] = 1
+        # Cache positions for a static KV cache; sliced per step, never reallocated
+        self.positions = torch.arange(capacity, device=input_ids.device)
+        self.prompt_len = prompt_len
+        self.length = prompt_len
+        # Unmasked tokens per row, for position ids that skip padding columns
+        self.num_valid = self.mask[:, :prompt_len].long().sum(-1)
+
+    @property
+    def input_ids(self) -> torch.Tensor:
+        """[batch, length] view of the prompt plus generated tokens"""
+        return self.ids[:, :self.length]
+
+    @property
+    def attention_mask(self) -> torch.Tensor:
+        """[batch, length] view of the attention mask"""
+        return self.mask[:, :self.length]
+
+    def cache_position(self, prefill: bool) -> torch.Tensor:
+        """Positions of the tokens fed to the next forward pass"""
+        if prefill:
+            return self.positions[:self.length]
+        return self.positions[self.length - 1:self.length]
+
+    def position_ids(self, prefill_start: Optional[int] = None) -> torch.Tensor:
+        """Per-row positions of the tokens fed to the next forward pass, not counting
+        masked columns (needed when padding sits between a reused prefix and the prompt).
+        
+        prefill_start: first column fed by the prefill step; None for a decode step.
+        """
+        if prefill_start is not None:
+            positions = (self.attention_mask.long().cumsum(-1) - 1).clamp_(min=0)
+            return positions[:, prefill_start:]
+        return (self.num_valid - 1).clamp(min=0).unsqueeze(1)
+
+    def append(self, tokens: torch.Tensor, alive: Optional[torch.Tensor] = None):
+        """Write one token per row at the cursor. tokens: [batch] or [batch, 1]
+        
+        alive ([batch] bool) masks out rows that had already finished, so the
+        padding appended to them is never attended to.
+        """
+        self.ids[:, self.length] = tokens.view(-1)
+        if alive is None:
+            self.mask[:, self.length] = 1
+            self.num_valid += 1
+        else:
+            self.mask[:, self.length] = alive.to(self.mask.dtype)
+            self.num_valid += alive.long()
+        self.length += 1
+
+
+class _PhasePrefix:
+    """
+    CoT-phase sequence that the codes phase of generate_with_stop_condition forks from.
+
+    Phase 1 records its conditional prompt and the generated tokens up to
+    </think> (on the PyTorch backend also its final KV cache). Phase 2 builds each
+    prompt, conditional and CFG unconditional, as a continuation of those token ids
+    wherever its text starts with them, so the shared prefix is not prefilled again:
+    the PyTorch backend slices the recorded KV cache, nano-vllm gets identical
+    token ids and serves them from its paged prefix cache.
+    """
+
+    def __init__(self):
+        self.prompt_text: Optional[str] = None
+        self.prompt_ids: List[int] = []
+        self.completion_text = ""
+        self.completion_ids: List[int] = []
+        # PyTorch backend: final cache of the phase-1 decode loop (conditional row first)
+        self.kv_cache: Optional[Any] = None
+        # Left padding of the conditional row inside kv_cache
+        self.kv_offset = 0
+        # Last measured prefill throughput, used to estimate the time saved
+        self.prefill_tokens_per_second = 0.0
+        # Phase-2 accounting
+        self.reused_tokens = 0
+        self.saved_seconds = 0.0
+
+    def record(self, tokenizer, prompt_text: str, prompt_ids: List[int], completion_ids: List[int], kv_offset: int = 0):
+        """Remember the phase-1 sequence, cut right after the </think> token."""
+        completion_ids = list(completion_ids)
+        stop_token_id = tokenizer.convert_tokens_to_ids(LLMHandler.STOP_REASONING_TAG)
+        cut = completion_ids.index(stop_token_id) + 1 if stop_token_id in completion_ids else 0
+        self.prompt_text = prompt_text
+        self.prompt_ids = list(prompt_ids)
+        self.completion_ids = completion_ids[:cut]
+        self.completion_text = tokenizer.decode(self.completion_ids, skip_special_tokens=False)
+        self.kv_offset = kv_offset
+
+    def note_prefill(self, num_tokens: int, seconds: float):
+        if num_tokens > 0 and seconds > 0:
+            self.prefill_tokens_per_second = num_tokens / seconds
+
+    def note_reuse(self, num_tokens: int):
+        """Count prefix tokens phase 2 did not prefill and the estimated time saved."""
+        self.reused_tokens += num_tokens
+        if self.prefill_tokens_per_second > 0:
+            self.saved_seconds += num_tokens / self.prefill_tokens_per_second
+
+    def fork(self, tokenizer, text: str) -> Tuple[List[int], int]:
+        """
+        Token ids for a phase-2 prompt, continuing the longest phase-1 sequence it starts with.
+
+        Returns:
+            (token_ids, number of leading token ids shared with phase 1)
+        """
+        if self.prompt_text is not None:
+            candidates = (
+                (self.prompt_text + self.completion_text, self.prompt_ids + self.completion_ids),
+                (self.prompt_text, self.prompt_ids),
+            )
+            for prefix_text, prefix_ids in candidates:
+                if prefix_ids and text.startswith(prefix_text):
+                    suffix_ids = tokenizer.encode(text[len(prefix_text):], add_special_tokens=False)
+                    return prefix_ids + suffix_ids, len(prefix_ids)
+        return tokenizer.encode(text), 0
+
+
 class LLMHandler:
     """5Hz LM Handler for audio code generation"""
 
@@ -57,6 +195,26 @@ class LLMHandler:
         self.dtype = torch.float32
         self.offload_to_cpu = False
         self.disable_tqdm = os.environ.get("ACESTEP_DISABLE_TQDM", "").lower() in ("1", "true", "yes") or not (hasattr(sys.stderr, 'isatty') and sys.stderr.isatty())
+        # PyTorch backend: use a preallocated (static) KV cache in the custom decode loops
+        # instead of the dynamically growing one. Avoids per-token cache reallocation and
+        # gives fixed shapes (torch.compile friendly), at the cost of reserving the full
+        # prompt + max_new_tokens cache up front.
+        self.use_static_kv_cache = os.environ.get("ACESTEP_LM_STATIC_KV_CACHE", "").lower() in ("1", "true", "yes")
+        # Codes phase continues from the CoT phase's prompt + generated tokens (and KV cache)
+        # instead of prefilling caption, lyrics and CoT again
+        self.share_cot_prefix = os.environ.get("ACESTEP_LM_COT_PREFIX_SHARING", "1").lower() not in ("0", "false", "no")
+        # vllm backend: speculative decoding with n-gram self-drafting, verifying this many
+        # draft tokens per decode step (0 = off). Mostly helps the long audio-code phase;
+        # the output distribution is unchanged.
+        self.num_speculative_tokens = int(os.environ.get("ACESTEP_LM_SPECULATIVE_TOKENS", "0") or 0)
+        # vllm backend: weight-only quantization of the LM's linear layers ("int8" or "int4").
+        # Pre-quantized checkpoints (nanovllm.utils.quantize) are detected automatically.
+        self.lm_quantization = os.environ.get("ACESTEP_LM_QUANTIZATION", "").lower() or None
+        if self.lm_quantization in ("none", "0", "false", "no"):
+            self.lm_quantization = None
+        # vllm backend: paged KV cache storage, "auto" (model dtype), "int8" or "fp8".
+        # Quantized caches hold about twice the tokens (CFG pairs, minutes of codes).
+        self.lm_kv_cache_dtype = os.environ.get("ACESTEP_LM_KV_CACHE_DTYPE", "auto").lower() or "auto"
 
         # HuggingFace Space persistent storage support
         if persistent_storage_path is None and self.IS_HUGGINGFACE_SPACE:
@@ -202,52 +360,47 @@ class LLMHandler:
         skip_caption: bool,
         skip_language: bool,
         generation_phase: str,
-        is_batch: bool = False,
         metadata_temperature: Optional[float] = None,
         codes_temperature: Optional[float] = None,
     ) -> Optional[MetadataConstrainedLogitsProcessor]:
-        """Setup and configure constrained processor for generation"""
-        use_phase_temperatures = not is_batch and (metadata_temperature is not None or codes_temperature is not None)
+        """
+        Setup and configure constrained processor for generation.
+        
+        The processor tracks FSM state per sequence, so batch generation supports the
+        same options (phase temperatures, user metadata, skip flags) as single mode.
+        """
+        use_phase_temperatures = metadata_temperature is not None or codes_temperature is not None
         
         if not use_constrained_decoding and not use_phase_temperatures:
             return None
         
-        # Reset processor state for new generation
-        self.constrained_processor.reset()
+        # Fork the shared processor: precomputed tables are reused, but FSM state and
+        # settings are private to this generation so that concurrent requests running
+        # in the same nano-vllm batch don't clobber each other
+        processor = self.constrained_processor.fork()
         
-        # Use shared processor, just update settings
-        self.constrained_processor.enabled = use_constrained_decoding
-        self.constrained_processor.debug = constrained_decoding_debug
+        processor.enabled = use_constrained_decoding
+        processor.debug = constrained_decoding_debug
         
-        # Phase temperatures only supported in single mode
         if use_phase_temperatures:
-            self.constrained_processor.metadata_temperature = metadata_temperature
-            self.constrained_processor.codes_temperature = codes_temperature
+            processor.metadata_temperature = metadata_temperature
+            processor.codes_temperature = codes_temperature
         else:
-            self.constrained_processor.metadata_temperature = None
-            self.constrained_processor.codes_temperature = None
+            processor.metadata_temperature = None
+            processor.codes_temperature = None
         
-        self.constrained_processor.set_target_duration(target_duration)
+        processor.set_target_duration(target_duration)
         
-        # Batch mode uses default/disabled settings for these options
-        if is_batch:
-            self.constrained_processor.set_user_metadata(None)
-            self.constrained_processor.set_stop_at_reasoning(False)
-            self.constrained_processor.set_skip_genres(True)
-            self.constrained_processor.set_skip_caption(True)
-            self.constrained_processor.set_skip_language(True)
-        else:
-            # Single mode uses provided settings
-            self.constrained_processor.set_user_metadata(user_metadata)
-            self.constrained_processor.set_stop_at_reasoning(stop_at_reasoning)
-            self.constrained_processor.set_skip_genres(skip_genres)
-            self.constrained_processor.set_skip_caption(skip_caption)
-            self.constrained_processor.set_skip_language(skip_language)
+        processor.set_user_metadata(user_metadata)
+        processor.set_stop_at_reasoning(stop_at_reasoning)
+        processor.set_skip_genres(skip_genres)
+        processor.set_skip_caption(skip_caption)
+        processor.set_skip_language(skip_language)
         
         # Set generation phase for phase-aware processing
-        self.constrained_processor.set_generation_phase(generation_phase)
+        processor.set_generation_phase(generation_phase)
         
-        return self.constrained_processor
+        return processor
     
     def _build_unconditional_prompt(
         self,
@@ -308,34 +461,52 @@ class LLMHandler:
             logits[indices_to_remove] = float('-inf')
         return logits
     
-    def _sample_tokens(self, logits: torch.Tensor, temperature: float) -> torch.Tensor:
+    def _sample_tokens(
+        self,
+        logits: torch.Tensor,
+        temperature: float,
+        generators: Optional[List[torch.Generator]] = None,
+    ) -> torch.Tensor:
         """Sample tokens from logits with temperature.
         
         Upcasts to float32 for numerical stability (float16 logits can overflow
         during softmax, especially after CFG scaling).
+        
+        If generators is given (one per row), each row is sampled with its own
+        generator so batched rows reproduce their per-seed single-run results.
         """
         if temperature > 0:
             # Upcast to float32 for stable softmax (critical for float16/MPS)
             logits = logits.float() / temperature
             probs = torch.softmax(logits, dim=-1)
+            if generators is not None:
+                return torch.cat([
+                    torch.multinomial(probs[i:i + 1], num_samples=1, generator=generators[i])
+                    for i in range(probs.shape[0])
+                ]).squeeze(1)
             return torch.multinomial(probs, num_samples=1).squeeze(1)
         else:
             return torch.argmax(logits, dim=-1)
     
     def _check_eos_token(self, tokens: torch.Tensor, eos_token_id: int, pad_token_id: Optional[int]) -> bool:
         """Check if any token in the batch is EOS or pad token"""
-        if torch.any(tokens == eos_token_id):
-            return True
+        return bool(self._eos_token_mask(tokens, eos_token_id, pad_token_id).any())
+    
+    def _eos_token_mask(self, tokens: torch.Tensor, eos_token_id: int, pad_token_id: Optional[int]) -> torch.Tensor:
+        """Per-row bool mask of tokens that end a sequence (EOS or pad token)"""
+        is_end = tokens == eos_token_id
         if pad_token_id is not None and pad_token_id != eos_token_id:
-            if torch.any(tokens == pad_token_id):
-                return True
-        return False
+            is_end = is_end | (tokens == pad_token_id)
+        return is_end
     
     def _update_constrained_processor_state(self, constrained_processor: Optional[MetadataConstrainedLogitsProcessor], tokens: torch.Tensor):
         """Update constrained processor state with generated tokens"""
         if constrained_processor is not None:
-            for b in range(tokens.shape[0]):
-                constrained_processor.update_state(tokens[b].item())
+            if tokens.shape[0] > 1:
+                # Each batch row advances its own FSM (rows are identified by batch index)
+                constrained_processor.update_state_batch(list(range(tokens.shape[0])), tokens.tolist())
+            else:
+                constrained_processor.update_state(tokens[0].item())
     
     def _forward_pass(
         self,
@@ -344,11 +515,21 @@ class LLMHandler:
         model_kwargs: Dict[str, Any],
         past_key_values: Optional[Any],
         use_cache: bool,
+        prefill: Optional[bool] = None,
+        prefill_start: int = 0,
     ) -> Any:
-        """Perform forward pass with KV cache support"""
-        if past_key_values is None:
+        """Perform forward pass with KV cache support.
+        
+        prefill defaults to "no cache yet"; a static cache exists before the
+        first step, so its callers pass it explicitly. prefill_start skips the
+        leading columns already held by a reused prefix cache.
+        """
+        if prefill is None:
+            prefill = past_key_values is None
+        if prefill:
             outputs = model(
-                input_ids=generated_ids,
+                input_ids=generated_ids[:, prefill_start:],
+                past_key_values=past_key_values,
                 **model_kwargs,
                 use_cache=use_cache,
             )
@@ -361,6 +542,27 @@ class LLMHandler:
             )
         return outputs
     
+    def _make_static_kv_cache(self, model: Any, batch_size: int, max_cache_len: int) -> Optional[Any]:
+        """Create a transformers StaticCache sized for one decode loop, or None if unsupported."""
+        try:
+            from transformers import StaticCache
+        except ImportError:
+            logger.warning("[static_kv_cache] transformers.StaticCache unavailable, using dynamic cache")
+            return None
+        
+        # The constructor signature changed across transformers releases
+        base_kwargs = {"config": model.config, "max_cache_len": max_cache_len}
+        device_kwargs = {"device": model.device, "dtype": model.dtype}
+        for extra in ({"max_batch_size": batch_size, **device_kwargs},
+                      {"batch_size": batch_size, **device_kwargs},
+                      {}):
+            try:
+                return StaticCache(**base_kwargs, **extra)
+            except TypeError:
+                continue
+        logger.warning("[static_kv_cache] Could not construct StaticCache, using dynamic cache")
+        return None
+    
     def _normalize_batch_input(self, formatted_prompts: Union[str, List[str]]) -> Tuple[List[str], bool]:
         """Normalize batch input: convert single string to list and return (list, is_batch)"""
         is_batch = isinstance(formatted_prompts, list)
@@ -486,6 +688,9 @@ class LLMHandler:
                 enabled=True,
                 debug=False,
                 max_duration=max_duration_for_constraint,
+                # Vocab scans and prefix trees are cached next to the checkpoints,
+                # keyed by the tokenizer fingerprint
+                cache_dir=os.path.join(checkpoint_dir, ".cache", "constrained_decoding"),
             )
             logger.info(f"Constrained processor initialized in {time.time() - processor_start:.2f} seconds")
             
@@ -521,9 +726,9 @@ class LLMHandler:
                     status_msg = f"✅ 5Hz LM initialized (PyTorch fallback, MLX not available)\nModel: {full_lm_model_path}\nBackend: PyTorch"
                     return status_msg, True
 
-            if backend == "vllm" and device != "cuda":
+            if backend == "vllm" and device not in ("cuda", "cpu"):
                 logger.warning(
-                    f"[initialize] vllm backend requires CUDA. Falling back to PyTorch backend for device={device}."
+                    f"[initialize] vllm backend requires CUDA or CPU. Falling back to PyTorch backend for device={device}."
                 )
                 backend = "pt"
 
@@ -533,6 +738,7 @@ class LLMHandler:
                 status_msg = self._initialize_5hz_lm_vllm(
                     full_lm_model_path,
                     enforce_eager=enforce_eager_for_vllm,
+                    device=device,
                 )
                 logger.info(f"5Hz LM status message: {status_msg}")
                 # Check if initialization failed (status_msg starts with ❌)
@@ -563,9 +769,12 @@ class LLMHandler:
         except Exception as e:
             return f"❌ Error initializing 5Hz LM: {str(e)}\n\nTraceback:\n{traceback.format_exc()}", False
     
-    def _initialize_5hz_lm_vllm(self, model_path: str, enforce_eager: bool = False) -> str:
+    def _initialize_5hz_lm_vllm(self, model_path: str, enforce_eager: bool = False, device: str = "cuda") -> str:
         """Initialize 5Hz LM model using vllm backend. When enforce_eager is True, CUDA graph
-        capture is disabled (required when LoRA training may run in the same process)."""
+        capture is disabled (required when LoRA training may run in the same process).
+        device="cpu" runs the same engine (paged KV, prefix cache, CFG pairing) on the CPU."""
+        if device == "cpu":
+            return self._initialize_5hz_lm_vllm_cpu(model_path)
         if not torch.cuda.is_available():
             self.llm_initialized = False
             logger.error("CUDA/ROCm is not available. Please check your GPU setup.")
@@ -604,6 +813,9 @@ class LLMHandler:
                 tensor_parallel_size=1,
                 max_model_len=self.max_model_len,
                 gpu_memory_utilization=gpu_memory_utilization,
+                num_speculative_tokens=self.num_speculative_tokens,
+                quantization=self.lm_quantization,
+                kv_cache_dtype=self.lm_kv_cache_dtype,
                 tokenizer=self.llm_tokenizer,
             )
             logger.info(f"5Hz LM initialized successfully in {time.time() - start_time:.2f} seconds")
@@ -614,6 +826,42 @@ class LLMHandler:
             self.llm_initialized = False
             return f"❌ Error initializing 5Hz LM: {str(e)}\n\nTraceback:\n{traceback.format_exc()}"
 
+    def _initialize_5hz_lm_vllm_cpu(self, model_path: str) -> str:
+        """Initialize the nano-vllm engine on CPU (eager mode, host-memory KV cache)."""
+        try:
+            from nanovllm import LLM
+        except ImportError:
+            self.llm_initialized = False
+            logger.error("nano-vllm is not installed. Please install it using 'cd acestep/third_parts/nano-vllm && pip install .")
+            return "❌ nano-vllm is not installed. Please install it using 'cd acestep/third_parts/nano-vllm && pip install ."
+
+        try:
+            self.max_model_len = 4096
+            kv_cache_gb = float(os.environ.get("ACESTEP_LM_CPU_KV_CACHE_GB", "4"))
+            logger.info(f"Initializing 5Hz LM on CPU with model: {model_path}, max_model_len: {self.max_model_len}, kv_cache: {kv_cache_gb:.1f} GB")
+            start_time = time.time()
+            self.llm = LLM(
+                model=model_path,
+                device="cpu",
+                enforce_eager=True,
+                tensor_parallel_size=1,
+                max_model_len=self.max_model_len,
+                # Warmup prefills max_num_batched_tokens tokens; keep it to one sequence on CPU
+                max_num_batched_tokens=self.max_model_len,
+                cpu_kvcache_gb=kv_cache_gb,
+                num_speculative_tokens=self.num_speculative_tokens,
+                quantization=self.lm_quantization,
+                kv_cache_dtype=self.lm_kv_cache_dtype,
+                tokenizer=self.llm_tokenizer,
+            )
+            logger.info(f"5Hz LM initialized successfully on CPU in {time.time() - start_time:.2f} seconds")
+            self.llm_initialized = True
+            self.llm_backend = "vllm"
+            return f"✅ 5Hz LM initialized successfully\nModel: {model_path}\nDevice: CPU\nKV Cache: {kv_cache_gb:.1f} GB"
+        except Exception as e:
+            self.llm_initialized = False
+            return f"❌ Error initializing 5Hz LM: {str(e)}\n\nTraceback:\n{traceback.format_exc()}"
+
     def _run_vllm(
         self,
         formatted_prompts: Union[str, List[str]],
@@ -638,11 +886,16 @@ class LLMHandler:
         lyrics: str = "",
         cot_text: str = "",
         seeds: Optional[List[int]] = None,
+        phase_prefix: Optional[_PhasePrefix] = None,
     ) -> Union[str, List[str]]:
         """
         Unified vllm generation function supporting both single and batch modes.
         Accepts either a single formatted prompt (str) or a list of formatted prompts (List[str]).
         Returns a single string for single mode, or a list of strings for batch mode.
+        
+        With phase_prefix, the CoT phase records its prompt + generated token ids and
+        the codes phase submits token ids that continue them, so the shared prefix
+        is served from the engine's prefix cache instead of being prefilled again.
         """
         from nanovllm import SamplingParams
 
@@ -651,9 +904,8 @@ class LLMHandler:
         batch_size = len(formatted_prompt_list)
 
         # Determine effective temperature for sampler
-        # Batch mode doesn't support phase temperatures, so use simple temperature
-        # Single mode supports phase temperatures
-        use_phase_temperatures = not is_batch and (metadata_temperature is not None or codes_temperature is not None)
+        # Phase temperatures are applied by the constrained processor (per sequence)
+        use_phase_temperatures = metadata_temperature is not None or codes_temperature is not None
         effective_sampler_temp = 1.0 if use_phase_temperatures else temperature
 
         # Setup constrained processor
@@ -667,7 +919,6 @@ class LLMHandler:
             skip_caption=skip_caption,
             skip_language=skip_language,
             generation_phase=generation_phase,
-            is_batch=is_batch,
             metadata_temperature=metadata_temperature,
             codes_temperature=codes_temperature,
         )
@@ -706,14 +957,43 @@ class LLMHandler:
                 is_batch=is_batch,
             )
             unconditional_prompts = [formatted_unconditional_prompt] * batch_size
-            
-            outputs = self.llm.generate(
-                formatted_prompt_list,
-                sampling_params,
-                unconditional_prompts=unconditional_prompts,
-            )
         else:
-            outputs = self.llm.generate(formatted_prompt_list, sampling_params)
+            unconditional_prompts = [None] * batch_size
+
+        # Token ids instead of text when forking from / recording for the CoT phase
+        request_prompts = formatted_prompt_list
+        if phase_prefix is not None:
+            tokenizer = self.llm.tokenizer
+            if generation_phase == "codes":
+                request_prompts = [phase_prefix.fork(tokenizer, prompt)[0] for prompt in formatted_prompt_list]
+                unconditional_prompts = [
+                    phase_prefix.fork(tokenizer, prompt)[0] if prompt is not None else None
+                    for prompt in unconditional_prompts
+                ]
+            else:
+                request_prompts = [tokenizer.encode(prompt) for prompt in formatted_prompt_list]
+
+        # Submit to the nano-vllm engine loop: the prompts join the running decode batch
+        # (shared with any concurrent requests) and leave it as soon as they finish
+        handles = [
+            self.llm.add_request(prompt, sampling_params, unconditional_prompt)
+            for prompt, unconditional_prompt in zip(request_prompts, unconditional_prompts)
+        ]
+        try:
+            outputs = [handle.result() for handle in handles]
+        except BaseException:
+            for handle in handles:
+                if not handle.done():
+                    handle.abort()
+            raise
+
+        if phase_prefix is not None:
+            if generation_phase == "codes":
+                # Prompt tokens (cond + uncond) the engine took from its prefix cache
+                phase_prefix.prefill_tokens_per_second = self.llm.prefill_throughput
+                phase_prefix.note_reuse(sum(output.get("num_cached_tokens", 0) for output in outputs))
+            else:
+                phase_prefix.record(self.llm.tokenizer, formatted_prompt_list[0], request_prompts[0], outputs[0]["token_ids"])
 
         # Extract text from outputs
         output_texts = []
@@ -751,8 +1031,13 @@ class LLMHandler:
         caption: str,
         lyrics: str,
         cot_text: str,
+        phase_prefix: Optional[_PhasePrefix] = None,
     ) -> str:
-        """Internal helper function for single-item PyTorch generation."""
+        """Internal helper function for single-item PyTorch generation.
+        
+        phase_prefix (CoT phase) records the conditional sequence and its KV cache
+        for the codes phase to fork from.
+        """
         inputs = self.llm_tokenizer(
             formatted_prompt,
             return_tensors="pt",
@@ -771,24 +1056,12 @@ class LLMHandler:
             skip_caption=skip_caption,
             skip_language=skip_language,
             generation_phase=generation_phase,
-            is_batch=False,
         )
 
         with self._load_model_context():
             inputs = {k: v.to(self.device) for k, v in inputs.items()}
             
-            # Calculate max_new_tokens based on target_duration if specified
-            # 5 audio codes = 1 second, plus ~500 tokens for CoT metadata and safety margin
-            if target_duration is not None and target_duration > 0:
-                # Ensure duration is within valid range (10-600 seconds)
-                effective_duration = max(10, min(600, target_duration))
-                max_new_tokens = int(effective_duration * 5) + 500
-            else:
-                max_new_tokens = getattr(self.llm.config, "max_new_tokens", 4096)
-            
-            # Cap at model's max length
-            if hasattr(self, "max_model_len"):
-                max_new_tokens = min(max_new_tokens, self.max_model_len - 64)
+            max_new_tokens = self._get_pt_max_new_tokens(target_duration)
 
             # Build logits processor list (only for CFG and repetition penalty)
             logits_processor = self._build_logits_processor(repetition_penalty)
@@ -835,6 +1108,7 @@ class LLMHandler:
                     pad_token_id=self.llm_tokenizer.pad_token_id or self.llm_tokenizer.eos_token_id,
                     streamer=None,
                     constrained_processor=constrained_processor,
+                    phase_prefix=phase_prefix,
                 )
                 
                 # Extract only the conditional output (first in batch)
@@ -852,6 +1126,7 @@ class LLMHandler:
                     pad_token_id=self.llm_tokenizer.pad_token_id or self.llm_tokenizer.eos_token_id,
                     streamer=None,
                     constrained_processor=constrained_processor,
+                    phase_prefix=phase_prefix,
                 )
             else:
                 # Generate without CFG using native generate() parameters
@@ -883,9 +1158,10 @@ class LLMHandler:
         if cfg_scale > 1.0:
             # In CFG case, we need to use the conditional input length from batch_inputs_tokenized
             # Both sequences have the same length due to padding
-            input_length = batch_inputs_tokenized['input_ids'].shape[1]
+            prompt_inputs = batch_inputs_tokenized
         else:
-            input_length = inputs["input_ids"].shape[1]
+            prompt_inputs = inputs
+        input_length = prompt_inputs["input_ids"].shape[1]
         
         generated_ids = generated_ids[input_length:]
         
@@ -893,9 +1169,202 @@ class LLMHandler:
         if generated_ids.device.type != "cpu":
             generated_ids = generated_ids.cpu()
         
+        if phase_prefix is not None:
+            # Conditional row without its left padding
+            prompt_mask = prompt_inputs.get("attention_mask")
+            offset = int((prompt_mask[0] == 0).sum()) if prompt_mask is not None else 0
+            phase_prefix.record(
+                self.llm_tokenizer,
+                formatted_prompt,
+                prompt_inputs["input_ids"][0, offset:].tolist(),
+                generated_ids.tolist(),
+                kv_offset=offset,
+            )
+        
         output_text = self.llm_tokenizer.decode(generated_ids, skip_special_tokens=False)
         return output_text
 
+    def _get_pt_max_new_tokens(self, target_duration: Optional[float]) -> int:
+        """Token budget for one PyTorch-backend generation."""
+        # Calculate max_new_tokens based on target_duration if specified
+        # 5 audio codes = 1 second, plus ~500 tokens for CoT metadata and safety margin
+        if target_duration is not None and target_duration > 0:
+            # Ensure duration is within valid range (10-600 seconds)
+            effective_duration = max(10, min(600, target_duration))
+            max_new_tokens = int(effective_duration * 5) + 500
+        else:
+            max_new_tokens = getattr(self.llm.config, "max_new_tokens", 4096)
+        
+        # Cap at model's max length
+        if hasattr(self, "max_model_len"):
+            max_new_tokens = min(max_new_tokens, self.max_model_len - 64)
+        return max_new_tokens
+
+    def _make_row_generators(self, seeds: Optional[List[int]], batch_size: int) -> Optional[List[torch.Generator]]:
+        """One seeded torch.Generator per batch row, or None to use the global RNG."""
+        if not seeds:
+            return None
+        try:
+            generators = []
+            for i in range(batch_size):
+                generator = torch.Generator(device=self.device)
+                # Rows without an explicit seed derive one from the last provided seed
+                generator.manual_seed(seeds[i] if i < len(seeds) else seeds[-1] + i)
+                generators.append(generator)
+            return generators
+        except RuntimeError as e:
+            # Some backends can't create device generators; fall back to a global seed
+            logger.warning(f"[_run_pt_batch] Per-row generators unavailable on {self.device} ({e}), seeding globally")
+            torch.manual_seed(seeds[0])
+            return None
+
+    def _run_pt_batch(
+        self,
+        formatted_prompts: List[str],
+        temperature: float,
+        cfg_scale: float,
+        negative_prompt: str,
+        top_k: Optional[int],
+        top_p: Optional[float],
+        repetition_penalty: float,
+        use_constrained_decoding: bool,
+        constrained_decoding_debug: bool,
+        target_duration: Optional[float],
+        user_metadata: Optional[Dict[str, Optional[str]]],
+        stop_at_reasoning: bool,
+        skip_genres: bool,
+        skip_caption: bool,
+        skip_language: bool,
+        generation_phase: str,
+        caption: str,
+        lyrics: str,
+        cot_text: str,
+        seeds: Optional[List[int]],
+        phase_prefix: Optional[_PhasePrefix] = None,
+    ) -> List[str]:
+        """
+        Batched PyTorch generation: all prompts run left-padded through one forward
+        pass per step.
+        
+        Each row samples with its own seeded generator and finishes on its own EOS.
+        With CFG the batch is laid out as [cond..., uncond...], like the nano-vllm
+        runner, and every conditional row is paired with the same unconditional prompt.
+        In the codes phase, phase_prefix lets every row start from the CoT phase's
+        KV cache (see _fork_pt_inputs).
+        """
+        batch_size = len(formatted_prompts)
+        
+        # One processor drives all rows; it keeps an FSM state per row
+        constrained_processor = self._setup_constrained_processor(
+            use_constrained_decoding=use_constrained_decoding,
+            constrained_decoding_debug=constrained_decoding_debug,
+            target_duration=target_duration,
+            user_metadata=user_metadata,
+            stop_at_reasoning=stop_at_reasoning,
+            skip_genres=skip_genres,
+            skip_caption=skip_caption,
+            skip_language=skip_language,
+            generation_phase=generation_phase,
+        )
+        
+        batch_texts = list(formatted_prompts)
+        if cfg_scale > 1.0:
+            # Same unconditional prompt as the single-item path, once per row
+            formatted_unconditional_prompt = self._build_unconditional_prompt(
+                caption=caption,
+                lyrics=lyrics,
+                cot_text=cot_text,
+                negative_prompt=negative_prompt,
+                generation_phase=generation_phase,
+                is_batch=False,
+            )
+            batch_texts += [formatted_unconditional_prompt] * batch_size
+        
+        pad_token_id = self.llm_tokenizer.pad_token_id or self.llm_tokenizer.eos_token_id
+        eos_token_id = self.llm_tokenizer.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = pad_token_id
+        
+        fork = None
+        if phase_prefix is not None and generation_phase == "codes":
+            fork = self._fork_pt_inputs(batch_texts, phase_prefix, pad_token_id)
+        if fork is not None:
+            batch_inputs = {'input_ids': fork['input_ids'], 'attention_mask': fork['attention_mask']}
+            fork_kwargs = {
+                'prefix_cache': fork['prefix_cache'],
+                'prefill_start': fork['prefix_len'],
+                'phase_prefix': phase_prefix,
+            }
+        else:
+            # Left padding keeps every row's last token at the final position
+            original_padding_side = self.llm_tokenizer.padding_side
+            self.llm_tokenizer.padding_side = 'left'
+            try:
+                batch_inputs = self.llm_tokenizer(
+                    batch_texts,
+                    return_tensors="pt",
+                    padding=True,
+                    truncation=True,
+                )
+            finally:
+                self.llm_tokenizer.padding_side = original_padding_side
+            fork_kwargs = {}
+        
+        with self._load_model_context():
+            batch_inputs = {k: v.to(self.device) for k, v in batch_inputs.items()}
+            max_new_tokens = self._get_pt_max_new_tokens(target_duration)
+            generators = self._make_row_generators(seeds, batch_size)
+            
+            if cfg_scale > 1.0:
+                outputs = self._generate_with_cfg_custom(
+                    batch_input_ids=batch_inputs['input_ids'],
+                    batch_attention_mask=batch_inputs.get('attention_mask'),
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    cfg_scale=cfg_scale,
+                    top_k=top_k,
+                    top_p=top_p,
+                    repetition_penalty=repetition_penalty,
+                    pad_token_id=pad_token_id,
+                    streamer=None,
+                    constrained_processor=constrained_processor,
+                    generators=generators,
+                    **fork_kwargs,
+                )
+                # Keep only the conditional rows
+                outputs = outputs[:batch_size]
+            else:
+                outputs = self._generate_with_constrained_decoding(
+                    input_ids=batch_inputs['input_ids'],
+                    attention_mask=batch_inputs.get('attention_mask'),
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    repetition_penalty=repetition_penalty,
+                    pad_token_id=pad_token_id,
+                    streamer=None,
+                    constrained_processor=constrained_processor,
+                    generators=generators,
+                    **fork_kwargs,
+                )
+        
+        if fork is not None:
+            # The prefix KV came from phase 1 for every row
+            phase_prefix.note_reuse(fork['prefix_len'] * len(batch_texts))
+        
+        # Only decode the newly generated tokens, up to and including each row's EOS
+        input_length = batch_inputs['input_ids'].shape[1]
+        generated = outputs[:, input_length:].cpu()
+        output_texts = []
+        for row in generated.tolist():
+            for end, token_id in enumerate(row):
+                if token_id == eos_token_id or token_id == pad_token_id:
+                    row = row[:end + 1]
+                    break
+            output_texts.append(self.llm_tokenizer.decode(row, skip_special_tokens=False))
+        return output_texts
+
     def _run_pt(
         self,
         formatted_prompts: Union[str, List[str]],
@@ -918,54 +1387,49 @@ class LLMHandler:
         lyrics: str = "",
         cot_text: str = "",
         seeds: Optional[List[int]] = None,
+        phase_prefix: Optional[_PhasePrefix] = None,
     ) -> Union[str, List[str]]:
         """
         Unified PyTorch generation function supporting both single and batch modes.
         Accepts either a single formatted prompt (str) or a list of formatted prompts (List[str]).
         Returns a single string for single mode, or a list of strings for batch mode.
-        Note: PyTorch backend processes batch items sequentially (doesn't support true batching efficiently).
+        Batch mode runs all prompts together (see _run_pt_batch).
+        phase_prefix carries the CoT phase's sequence and KV cache into the codes phase.
         """
         # Determine if batch mode
         formatted_prompt_list, is_batch = self._normalize_batch_input(formatted_prompts)
 
-        # For batch mode, process each item sequentially with different seeds
-        if is_batch:
-            output_texts = []
-            for i, formatted_prompt in enumerate(formatted_prompt_list):
-                # Set seed for this item if provided
-                if seeds and i < len(seeds):
-                    torch.manual_seed(seeds[i])
-                    if torch.cuda.is_available():
-                        torch.cuda.manual_seed_all(seeds[i])
-                    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-                        torch.mps.manual_seed(seeds[i])
-                
-                # Generate using single-item method with batch-mode defaults
-                output_text = self._run_pt_single(
-                    formatted_prompt=formatted_prompt,
-                    temperature=temperature,
-                    cfg_scale=cfg_scale,
-                    negative_prompt=negative_prompt,
-                    top_k=top_k,
-                    top_p=top_p,
-                    repetition_penalty=repetition_penalty,
-                    use_constrained_decoding=use_constrained_decoding,
-                    constrained_decoding_debug=constrained_decoding_debug,
-                    target_duration=target_duration,
-                    user_metadata=None,
-                    stop_at_reasoning=False,
-                    skip_genres=True,
-                    skip_caption=True,
-                    skip_language=True,
-                    generation_phase=generation_phase,
-                    caption=caption,
-                    lyrics=lyrics,
-                    cot_text=cot_text,
-                )
-                
-                output_texts.append(output_text)
-            
-            return output_texts
+        # Forking from the CoT phase's KV cache goes through the batched loop
+        fork_prefix = (
+            phase_prefix is not None
+            and generation_phase == "codes"
+            and phase_prefix.kv_cache is not None
+        )
+        if is_batch or fork_prefix:
+            output_texts = self._run_pt_batch(
+                formatted_prompts=formatted_prompt_list,
+                temperature=temperature,
+                cfg_scale=cfg_scale,
+                negative_prompt=negative_prompt,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                use_constrained_decoding=use_constrained_decoding,
+                constrained_decoding_debug=constrained_decoding_debug,
+                target_duration=target_duration,
+                user_metadata=user_metadata,
+                stop_at_reasoning=stop_at_reasoning,
+                skip_genres=skip_genres,
+                skip_caption=skip_caption,
+                skip_language=skip_language,
+                generation_phase=generation_phase,
+                caption=caption,
+                lyrics=lyrics,
+                cot_text=cot_text,
+                seeds=seeds,
+                phase_prefix=phase_prefix,
+            )
+            return output_texts if is_batch else output_texts[0]
 
         # Single mode: process the formatted prompt
         formatted_prompt = formatted_prompt_list[0]
@@ -990,8 +1454,82 @@ class LLMHandler:
             caption=caption,
             lyrics=lyrics,
             cot_text=cot_text,
+            phase_prefix=phase_prefix if generation_phase == "cot" else None,
         )
 
+    def _fork_pt_inputs(
+        self,
+        batch_texts: List[str],
+        phase_prefix: _PhasePrefix,
+        pad_token_id: int,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Codes-phase inputs that start from the CoT phase's KV cache.
+
+        Every row is tokenized as a continuation of the phase-1 sequence; the
+        prefix common to all rows is taken from the recorded cache (repeated per
+        row) and only the rest is prefilled. Padding goes between that prefix and
+        each row's remainder, so the decode loop passes explicit position ids.
+
+        Returns:
+            Dict with input_ids, attention_mask, prefix_cache and prefix_len, or
+            None when nothing can be reused (the caller then tokenizes as usual).
+        """
+        kv_cache = phase_prefix.kv_cache
+        # The cache is used once; drop the reference so it can be freed after this phase
+        phase_prefix.kv_cache = None
+        if kv_cache is None or phase_prefix.kv_offset != 0:
+            # A left-padded phase-1 row has its keys at shifted positions
+            return None
+        
+        forks = [phase_prefix.fork(self.llm_tokenizer, text) for text in batch_texts]
+        prefix_len = min(shared for _, shared in forks)
+        prefix_len = min(prefix_len, kv_cache.get_seq_length())
+        # Keep at least one token per row for the prefill to produce logits from
+        prefix_len = min(prefix_len, min(len(ids) for ids, _ in forks) - 1)
+        if prefix_len <= 0:
+            return None
+        
+        suffixes = [ids[prefix_len:] for ids, _ in forks]
+        width = prefix_len + max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((len(batch_texts), width), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_texts), width), dtype=torch.long)
+        input_ids[:, :prefix_len] = torch.tensor(forks[0][0][:prefix_len], dtype=torch.long)
+        attention_mask[:, :prefix_len] = 1
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, width - len(suffix):] = torch.tensor(suffix, dtype=torch.long)
+            attention_mask[row, width - len(suffix):] = 1
+        
+        return {
+            'input_ids': input_ids,
+            'attention_mask': attention_mask,
+            'prefix_cache': self._slice_kv_cache(kv_cache, prefix_len, len(batch_texts)),
+            'prefix_len': prefix_len,
+        }
+
+    @staticmethod
+    def _slice_kv_cache(kv_cache: Any, length: int, num_rows: int) -> Any:
+        """DynamicCache holding the first `length` positions of row 0, repeated num_rows times."""
+        from transformers import DynamicCache
+        
+        # Cache internals changed across transformers releases
+        if hasattr(kv_cache, "layers"):
+            layers = [(layer.keys, layer.values) for layer in kv_cache.layers]
+        elif hasattr(kv_cache, "key_cache"):
+            layers = list(zip(kv_cache.key_cache, kv_cache.value_cache))
+        else:
+            layers = list(kv_cache)
+        
+        sliced = DynamicCache()
+        with torch.inference_mode():
+            for layer_idx, (keys, values) in enumerate(layers):
+                sliced.update(
+                    keys[:1, :, :length].expand(num_rows, -1, -1, -1).contiguous(),
+                    values[:1, :, :length].expand(num_rows, -1, -1, -1).contiguous(),
+                    layer_idx,
+                )
+        return sliced
+
     def has_all_metas(self, user_metadata: Optional[Dict[str, Optional[str]]]) -> bool:
         """Check if all required metadata are present."""
         if user_metadata is None:
@@ -1072,6 +1610,8 @@ class LLMHandler:
             Dictionary containing:
                 - metadata: Dict or List[Dict] - Generated metadata
                 - audio_codes: str or List[str] - Generated audio codes
+                - audio_code_ids: np.ndarray or List[np.ndarray] - The same codes as uint16 arrays
+                  (Phase 2 only; see acestep.audio_codes)
                 - success: bool - Whether generation succeeded
                 - error: Optional[str] - Error message if failed
                 - extra_outputs: Dict with time_costs and other info
@@ -1101,6 +1641,10 @@ class LLMHandler:
         has_all_metas = self.has_all_metas(user_metadata)
         phase1_time = 0.0
         phase2_time = 0.0
+        # Lets phase 2 continue from phase 1's sequence instead of prefilling it again
+        phase_prefix = None
+        if infer_type == "llm_dit" and self.share_cot_prefix and self.llm_backend in ("vllm", "pt"):
+            phase_prefix = _PhasePrefix()
         
         # Handle seeds for batch mode
         if is_batch:
@@ -1144,6 +1688,7 @@ class LLMHandler:
                     # Pass context for building unconditional prompt in CoT phase
                     "caption": caption,
                     "lyrics": lyrics,
+                    "phase_prefix": phase_prefix,
                 },
                 use_constrained_decoding=use_constrained_decoding,
                 constrained_decoding_debug=constrained_decoding_debug,
@@ -1243,6 +1788,7 @@ class LLMHandler:
                         lyrics=lyrics,
                         cot_text=cot_text,
                         seeds=seeds,
+                        phase_prefix=phase_prefix,
                     )
                 elif self.llm_backend == "mlx":
                     codes_outputs = self._run_mlx(
@@ -1279,6 +1825,7 @@ class LLMHandler:
                         lyrics=lyrics,
                         cot_text=cot_text,
                         seeds=seeds,
+                        phase_prefix=phase_prefix,
                     )
             except Exception as e:
                 error_msg = f"Error in batch codes generation: {str(e)}"
@@ -1299,32 +1846,38 @@ class LLMHandler:
             
             # Parse audio codes from each output
             audio_codes_list = []
+            audio_code_ids_list = []
             metadata_list = []
             for output_text in codes_outputs:
                 _, audio_codes_item = self.parse_lm_output(output_text)
                 audio_codes_list.append(audio_codes_item)
+                audio_code_ids_list.append(parse_audio_codes(audio_codes_item))
                 metadata_list.append(metadata.copy())  # Same metadata for all
             
             phase2_time = time.time() - phase2_start
             
             # Log results
-            codes_counts = [len(codes.split('<|audio_code_')) - 1 if codes else 0 for codes in audio_codes_list]
+            codes_counts = [int(codes.size) for codes in audio_code_ids_list]
             logger.info(f"Batch Phase 2 completed in {phase2_time:.2f}s. Generated codes: {codes_counts}")
+            prefix_reused_tokens, prefix_saved_time = self._log_phase_prefix_reuse(phase_prefix)
             
             total_time = phase1_time + phase2_time
             return {
                 "metadata": metadata_list,
                 "audio_codes": audio_codes_list,
+                "audio_code_ids": audio_code_ids_list,
                 "success": True,
                 "error": None,
                 "extra_outputs": {
                     "time_costs": {
                         "phase1_time": phase1_time,
                         "phase2_time": phase2_time,
+                        "phase2_prefix_saved_time": prefix_saved_time,
                         "total_time": total_time,
                     },
                     "codes_counts": codes_counts,
                     "total_codes": sum(codes_counts),
+                    "phase2_prefix_reused_tokens": prefix_reused_tokens,
                 },
             }
         else:
@@ -1347,6 +1900,7 @@ class LLMHandler:
                     "caption": caption,
                     "lyrics": lyrics,
                     "cot_text": cot_text,
+                    "phase_prefix": phase_prefix,
                 },
                 use_constrained_decoding=use_constrained_decoding,
                 constrained_decoding_debug=constrained_decoding_debug,
@@ -1373,26 +1927,42 @@ class LLMHandler:
             
             # Parse audio codes from output (metadata should be same as Phase 1)
             _, audio_codes = self.parse_lm_output(codes_output_text)
+            audio_code_ids = parse_audio_codes(audio_codes)
             
-            codes_count = len(audio_codes.split('<|audio_code_')) - 1 if audio_codes else 0
+            codes_count = int(audio_code_ids.size)
             logger.info(f"Phase 2 completed in {phase2_time:.2f}s. Generated {codes_count} audio codes")
+            prefix_reused_tokens, prefix_saved_time = self._log_phase_prefix_reuse(phase_prefix)
             
             total_time = phase1_time + phase2_time
             return {
                 "metadata": metadata,
                 "audio_codes": audio_codes,
+                "audio_code_ids": audio_code_ids,
                 "success": True,
                 "error": None,
                 "extra_outputs": {
                     "time_costs": {
                         "phase1_time": phase1_time,
                         "phase2_time": phase2_time,
+                        "phase2_prefix_saved_time": prefix_saved_time,
                         "total_time": total_time,
                     },
                     "codes_count": codes_count,
+                    "phase2_prefix_reused_tokens": prefix_reused_tokens,
                 },
             }
     
+    @staticmethod
+    def _log_phase_prefix_reuse(phase_prefix: Optional[_PhasePrefix]) -> Tuple[int, float]:
+        """Log and return (reused prefix tokens, estimated prefill seconds saved) of phase 2."""
+        if phase_prefix is None:
+            return 0, 0.0
+        logger.info(
+            f"Phase 2 reused {phase_prefix.reused_tokens} prefix tokens from phase 1 "
+            f"(~{phase_prefix.saved_seconds:.3f}s prefill saved)"
+        )
+        return phase_prefix.reused_tokens, phase_prefix.saved_seconds
+    
     def build_formatted_prompt(self, caption: str, lyrics: str = "", is_negative_prompt: bool = False, generation_phase: str = "cot", negative_prompt: str = "NO USER INPUT") -> str:
         """
         Build the chat-formatted prompt for 5Hz LM from caption/lyrics.
@@ -1599,6 +2169,8 @@ class LLMHandler:
         if not getattr(self, "llm_initialized", False):
             return {}, "❌ 5Hz LM not initialized. Please initialize it first."
         
+        # Prompts use the string form; accept uint16 code arrays too
+        audio_codes = format_audio_codes(audio_codes)
         if not audio_codes or not audio_codes.strip():
             return {}, "❌ No audio codes provided. Please paste audio codes first."
         
@@ -1612,21 +2184,7 @@ class LLMHandler:
         # Note: cfg_scale and negative_prompt are not used in understand mode
         output_text, status = self.generate_from_formatted_prompt(
             formatted_prompt=formatted_prompt,
-            cfg={
-                "temperature": temperature,
-                "top_k": top_k,
-                "top_p": top_p,
-                "repetition_penalty": repetition_penalty,
-                "target_duration": None,  # No duration constraint for understanding
-                "user_metadata": None,  # No user metadata injection
-                "skip_caption": False,  # Generate caption
-                "skip_language": False,  # Generate language
-                "skip_genres": False,  # Generate genres
-                "generation_phase": "understand",  # Understanding phase: generate CoT metadata, then free-form lyrics
-                # Context for building unconditional prompt
-                "caption": "",
-                "lyrics": "",
-            },
+            cfg=self._understand_cfg(temperature, top_k, top_p, repetition_penalty),
             use_constrained_decoding=use_constrained_decoding,
             constrained_decoding_debug=constrained_decoding_debug,
             stop_at_reasoning=False,  # Continue after </think> to generate lyrics
@@ -1635,13 +2193,7 @@ class LLMHandler:
         if not output_text:
             return {}, status
         
-        # Parse metadata and extract lyrics
-        metadata, _ = self.parse_lm_output(output_text)
-        
-        # Extract lyrics section (everything after </think>)
-        lyrics = self._extract_lyrics_from_output(output_text)
-        if lyrics:
-            metadata['lyrics'] = lyrics
+        metadata = self._parse_understand_output(output_text)
         
         logger.info(f"Understanding completed. Generated {len(metadata)} metadata fields")
         if constrained_decoding_debug:
@@ -1651,6 +2203,85 @@ class LLMHandler:
         status_msg = f"✅ Understanding completed successfully\nGenerated fields: {', '.join(metadata.keys())}"
         return metadata, status_msg
     
+    def understand_audio_from_codes_batch(
+        self,
+        audio_codes_list: List[AudioCodesLike],
+        temperature: float = 0.3,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        repetition_penalty: float = 1.0,
+        use_constrained_decoding: bool = True,
+        constrained_decoding_debug: bool = False,
+    ) -> List[Tuple[Dict[str, Any], str]]:
+        """
+        Batched understand_audio_from_codes: all prompts are submitted to the LM at once.
+        
+        With the vllm backend they join the engine's running batch, with pt they share
+        one padded forward pass per step; each row keeps its own constrained-decoding FSM.
+        
+        Returns:
+            One (metadata_dict, status_message) tuple per input, in order
+        """
+        if not getattr(self, "llm_initialized", False):
+            return [({}, "❌ 5Hz LM not initialized. Please initialize it first.")] * len(audio_codes_list)
+        
+        results: List[Tuple[Dict[str, Any], str]] = [({}, "❌ No audio codes provided.")] * len(audio_codes_list)
+        prompts, rows = [], []
+        for i, audio_codes in enumerate(audio_codes_list):
+            audio_codes = format_audio_codes(audio_codes)
+            if audio_codes and audio_codes.strip():
+                prompts.append(self.build_formatted_prompt_for_understanding(audio_codes))
+                rows.append(i)
+        if not prompts:
+            return results
+        
+        logger.info(f"Understanding {len(prompts)} audio code sequences in one batch")
+        output_texts, status = self.generate_from_formatted_prompt(
+            formatted_prompt=prompts,
+            cfg=self._understand_cfg(temperature, top_k, top_p, repetition_penalty),
+            use_constrained_decoding=use_constrained_decoding,
+            constrained_decoding_debug=constrained_decoding_debug,
+            stop_at_reasoning=False,
+        )
+        if not output_texts:
+            return [({}, status) if i in rows else results[i] for i in range(len(audio_codes_list))]
+        
+        for i, output_text in zip(rows, output_texts):
+            if not output_text:
+                results[i] = ({}, "❌ LM returned no output")
+                continue
+            metadata = self._parse_understand_output(output_text)
+            results[i] = (metadata, f"✅ Understanding completed successfully\nGenerated fields: {', '.join(metadata.keys())}")
+        return results
+    
+    @staticmethod
+    def _understand_cfg(temperature: float, top_k: Optional[int], top_p: Optional[float], repetition_penalty: float) -> Dict[str, Any]:
+        return {
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p,
+            "repetition_penalty": repetition_penalty,
+            "target_duration": None,  # No duration constraint for understanding
+            "user_metadata": None,  # No user metadata injection
+            "skip_caption": False,  # Generate caption
+            "skip_language": False,  # Generate language
+            "skip_genres": False,  # Generate genres
+            "generation_phase": "understand",  # Understanding phase: generate CoT metadata, then free-form lyrics
+            # Context for building unconditional prompt
+            "caption": "",
+            "lyrics": "",
+        }
+    
+    def _parse_understand_output(self, output_text: str) -> Dict[str, Any]:
+        # Parse metadata and extract lyrics
+        metadata, _ = self.parse_lm_output(output_text)
+        
+        # Extract lyrics section (everything after </think>)
+        lyrics = self._extract_lyrics_from_output(output_text)
+        if lyrics:
+            metadata['lyrics'] = lyrics
+        return metadata
+    
     def _extract_lyrics_from_output(self, output_text: str) -> str:
         """
         Extract lyrics section from LLM output.
@@ -2065,7 +2696,7 @@ class LLMHandler:
     
     def generate_from_formatted_prompt(
         self,
-        formatted_prompt: str,
+        formatted_prompt: Union[str, List[str]],
         cfg: Optional[Dict[str, Any]] = None,
         use_constrained_decoding: bool = True,
         constrained_decoding_debug: bool = False,
@@ -2075,7 +2706,8 @@ class LLMHandler:
         Generate raw LM text output from a pre-built formatted prompt.
 
         Args:
-            formatted_prompt: Prompt that is already formatted by `build_formatted_prompt`.
+            formatted_prompt: Prompt that is already formatted by `build_formatted_prompt`,
+                or a list of prompts generated as one batch (output_text is then a list).
             cfg: Optional dict supporting keys:
                 - temperature (float)
                 - cfg_scale (float)
@@ -2083,6 +2715,7 @@ class LLMHandler:
                 - top_k (int), top_p (float), repetition_penalty (float)
                 - target_duration (float): Target duration in seconds for codes generation
                 - generation_phase (str): "cot" or "codes" for phase-aware CFG
+                - phase_prefix (_PhasePrefix): shares the CoT phase's prefix with the codes phase
             use_constrained_decoding: Whether to use FSM-based constrained decoding
             constrained_decoding_debug: Whether to enable debug logging for constrained decoding
             stop_at_reasoning: If True, stop generation immediately after </think> tag (no audio codes)
@@ -2120,6 +2753,8 @@ class LLMHandler:
         caption = cfg.get("caption", "")
         lyrics = cfg.get("lyrics", "")
         cot_text = cfg.get("cot_text", "")
+        # CoT -> codes prefix sharing (set by generate_with_stop_condition)
+        phase_prefix = cfg.get("phase_prefix")
 
         try:
             if self.llm_backend == "vllm":
@@ -2143,6 +2778,7 @@ class LLMHandler:
                     caption=caption,
                     lyrics=lyrics,
                     cot_text=cot_text,
+                    phase_prefix=phase_prefix,
                 )
                 return output_text, f"✅ Generated successfully (vllm) | length={len(output_text)}"
 
@@ -2192,6 +2828,7 @@ class LLMHandler:
                 caption=caption,
                 lyrics=lyrics,
                 cot_text=cot_text,
+                phase_prefix=phase_prefix,
             )
             return output_text, f"✅ Generated successfully (pt) | length={len(output_text)}"
 
@@ -2208,13 +2845,9 @@ class LLMHandler:
                     reset_context()
                 except ImportError:
                     pass
-                # Also reset the LLM scheduler to release allocated KV cache blocks
-                # This prevents 'deque index out of range' errors from block leaks
-                try:
-                    if hasattr(self.llm, 'reset'):
-                        self.llm.reset()
-                except Exception:
-                    pass  # Ignore errors during cleanup
+                # NOTE: The nano-vllm engine loop releases KV cache blocks itself when a
+                # step fails. Calling self.llm.reset() here would also abort requests of
+                # other callers sharing the running batch.
             # Clear accelerator cache to release any corrupted memory
             if torch.cuda.is_available():
                 torch.cuda.empty_cache()
@@ -2239,27 +2872,37 @@ class LLMHandler:
         pad_token_id: int,
         streamer: Optional[BaseStreamer],
         constrained_processor: Optional[MetadataConstrainedLogitsProcessor] = None,
+        generators: Optional[List[torch.Generator]] = None,
+        prefix_cache: Optional[Any] = None,
+        prefill_start: int = 0,
+        phase_prefix: Optional[_PhasePrefix] = None,
     ) -> torch.Tensor:
         """
         Custom generation loop with constrained decoding support (non-CFG).
         This allows us to call update_state() after each token generation.
+        
+        Rows finish independently: once a row emits EOS it is padded with
+        pad_token_id (masked out of attention) until every row is done.
+        
+        prefix_cache holds the KV of the first prefill_start columns (see
+        _fork_pt_inputs); phase_prefix receives the final cache and the prefill
+        throughput.
         """
         model = self.llm
-        device = self.device
         
-        # Initialize generated sequences
-        generated_ids = input_ids.clone()
-        if attention_mask is not None:
-            attn_mask = attention_mask.clone()
-        else:
-            attn_mask = torch.ones_like(input_ids)
+        # Preallocated token/attention buffer (no per-token torch.cat)
+        buffer = _DecodeBuffer(input_ids, attention_mask, max_new_tokens)
         
         # Prepare model inputs
-        model_kwargs = {'attention_mask': attn_mask}
+        model_kwargs = {'attention_mask': buffer.attention_mask}
         
         # Past key values for KV cache
-        past_key_values = None
+        past_key_values = prefix_cache
         use_cache = hasattr(model, 'generation_config') and getattr(model.generation_config, 'use_cache', True)
+        use_static_cache = False
+        if use_cache and self.use_static_kv_cache and prefix_cache is None:
+            past_key_values = self._make_static_kv_cache(model, input_ids.shape[0], buffer.ids.shape[1])
+            use_static_cache = past_key_values is not None
         
         # Get EOS token ID
         eos_token_id = self.llm_tokenizer.eos_token_id
@@ -2269,10 +2912,21 @@ class LLMHandler:
         # Build logits processor for repetition penalty
         logits_processor = self._build_logits_processor(repetition_penalty)
         
+        finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        prefill_start_time = time.time()
+        
         with torch.inference_mode():
             for step in tqdm(range(max_new_tokens), desc="LLM Constrained Decoding", unit="token", disable=self.disable_tqdm):
+                generated_ids = buffer.input_ids
+                if use_static_cache:
+                    model_kwargs['cache_position'] = buffer.cache_position(prefill=step == 0)
+                if prefix_cache is not None:
+                    # Padding sits between the reused prefix and each row's prompt
+                    model_kwargs['position_ids'] = buffer.position_ids(prefill_start if step == 0 else None)
+                
                 # Forward pass
-                outputs = self._forward_pass(model, generated_ids, model_kwargs, past_key_values, use_cache)
+                outputs = self._forward_pass(model, generated_ids, model_kwargs, past_key_values, use_cache,
+                                             prefill=step == 0, prefill_start=prefill_start)
                 
                 # Get logits for the last position
                 next_token_logits = outputs.logits[:, -1, :]  # [batch_size, vocab_size]
@@ -2290,19 +2944,24 @@ class LLMHandler:
                 next_token_logits = self._apply_top_p_filter(next_token_logits, top_p)
                 
                 # Apply temperature and sample
-                next_tokens = self._sample_tokens(next_token_logits, temperature)
+                next_tokens = self._sample_tokens(next_token_logits, temperature, generators)
+                
+                # Finished rows only receive padding
+                alive = ~finished
+                next_tokens = next_tokens.masked_fill(finished, pad_token_id)
                 
                 # Update constrained processor state
                 self._update_constrained_processor_state(constrained_processor, next_tokens)
                 
-                # Check for EOS token
-                should_stop = self._check_eos_token(next_tokens, eos_token_id, pad_token_id)
+                # Check for EOS token per row; stop once every row has finished
+                finished |= self._eos_token_mask(next_tokens, eos_token_id, pad_token_id)
+                should_stop = bool(finished.all())
+                if step == 0 and phase_prefix is not None:
+                    phase_prefix.note_prefill(int(buffer.attention_mask[:, prefill_start:].sum()), time.time() - prefill_start_time)
                 
                 # Append token to sequence
-                next_tokens_unsqueezed = next_tokens.unsqueeze(1)
-                generated_ids = torch.cat([generated_ids, next_tokens_unsqueezed], dim=1)
-                attn_mask = torch.cat([attn_mask, torch.ones((input_ids.shape[0], 1), device=device, dtype=attn_mask.dtype)], dim=1)
-                model_kwargs['attention_mask'] = attn_mask
+                buffer.append(next_tokens, alive)
+                model_kwargs['attention_mask'] = buffer.attention_mask
                 
                 # Update KV cache
                 if use_cache and hasattr(outputs, 'past_key_values'):
@@ -2310,7 +2969,7 @@ class LLMHandler:
                 
                 # Update streamer
                 if streamer is not None:
-                    streamer.put(next_tokens_unsqueezed)
+                    streamer.put(next_tokens.unsqueeze(1))
                 
                 if should_stop:
                     break
@@ -2318,7 +2977,10 @@ class LLMHandler:
         if streamer is not None:
             streamer.end()
         
-        return generated_ids
+        if phase_prefix is not None and use_cache and not use_static_cache:
+            phase_prefix.kv_cache = past_key_values
+        
+        return buffer.input_ids
     
     def _generate_with_cfg_custom(
         self,
@@ -2333,6 +2995,10 @@ class LLMHandler:
         pad_token_id: int,
         streamer: Optional[BaseStreamer],
         constrained_processor: Optional[MetadataConstrainedLogitsProcessor] = None,
+        generators: Optional[List[torch.Generator]] = None,
+        prefix_cache: Optional[Any] = None,
+        prefill_start: int = 0,
+        phase_prefix: Optional[_PhasePrefix] = None,
     ) -> torch.Tensor:
         """
         Custom CFG generation loop that:
@@ -2342,29 +3008,31 @@ class LLMHandler:
         4. Applies the same sampled tokens to both conditional and unconditional sequences
         5. Optionally applies constrained decoding via FSM-based logits processor
         
-        Batch format: [cond_input, uncond_input]
+        Batch format: [cond_input, uncond_input], or [cond..., uncond...] for several
+        prompts (row i's unconditional pair is row batch_size + i). Rows finish
+        independently, and prefix_cache / phase_prefix work as in
+        _generate_with_constrained_decoding.
         """
         model = self.llm
-        device = self.device
         batch_size = batch_input_ids.shape[0] // 2  # Half are conditional, half are unconditional
         cond_start_idx = 0
         uncond_start_idx = batch_size
         
-        # Initialize generated sequences
-        generated_ids = batch_input_ids.clone()
-        if batch_attention_mask is not None:
-            attention_mask = batch_attention_mask.clone()
-        else:
-            attention_mask = torch.ones_like(batch_input_ids)
+        # Preallocated token/attention buffer (no per-token torch.cat)
+        buffer = _DecodeBuffer(batch_input_ids, batch_attention_mask, max_new_tokens)
         
         # Prepare model inputs
         model_kwargs = {}
         if batch_attention_mask is not None:
-            model_kwargs['attention_mask'] = attention_mask
+            model_kwargs['attention_mask'] = buffer.attention_mask
         
         # Past key values for KV cache (if model supports it)
-        past_key_values = None
+        past_key_values = prefix_cache
         use_cache = hasattr(model, 'generation_config') and getattr(model.generation_config, 'use_cache', True)
+        use_static_cache = False
+        if use_cache and self.use_static_kv_cache and prefix_cache is None:
+            past_key_values = self._make_static_kv_cache(model, batch_input_ids.shape[0], buffer.ids.shape[1])
+            use_static_cache = past_key_values is not None
         
         # Get EOS token ID for stopping condition
         eos_token_id = self.llm_tokenizer.eos_token_id
@@ -2374,10 +3042,21 @@ class LLMHandler:
         # Build logits processor for non-CFG operations (repetition penalty, top_k, top_p)
         logits_processor = self._build_logits_processor(repetition_penalty)
         
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=batch_input_ids.device)
+        prefill_start_time = time.time()
+        
         with torch.inference_mode():
             for step in tqdm(range(max_new_tokens), desc="LLM CFG Generation", unit="token", disable=self.disable_tqdm):
+                generated_ids = buffer.input_ids
+                if use_static_cache:
+                    model_kwargs['cache_position'] = buffer.cache_position(prefill=step == 0)
+                if prefix_cache is not None:
+                    # Padding sits between the reused prefix and each row's prompt
+                    model_kwargs['position_ids'] = buffer.position_ids(prefill_start if step == 0 else None)
+                
                 # Forward pass for the entire batch (conditional + unconditional)
-                outputs = self._forward_pass(model, generated_ids, model_kwargs, past_key_values, use_cache)
+                outputs = self._forward_pass(model, generated_ids, model_kwargs, past_key_values, use_cache,
+                                             prefill=step == 0, prefill_start=prefill_start)
                 
                 # Get logits for the last position
                 next_token_logits = outputs.logits[:, -1, :]  # [batch_size*2, vocab_size]
@@ -2406,21 +3085,26 @@ class LLMHandler:
                 cfg_logits = self._apply_top_p_filter(cfg_logits, top_p)
                 
                 # Apply temperature and sample
-                next_tokens = self._sample_tokens(cfg_logits, temperature)
+                next_tokens = self._sample_tokens(cfg_logits, temperature, generators)
+                
+                # Finished rows only receive padding
+                alive = ~finished
+                next_tokens = next_tokens.masked_fill(finished, pad_token_id)
                 
                 # Update constrained processor state AFTER sampling
                 self._update_constrained_processor_state(constrained_processor, next_tokens)
                 
-                # Check for EOS token in conditional sequences BEFORE unsqueezing
-                # Stop if any conditional sequence generates EOS token
-                # next_tokens shape: [batch_size] (only conditional tokens)
-                should_stop = self._check_eos_token(next_tokens, eos_token_id, pad_token_id)
+                # Check for EOS token in conditional sequences (next_tokens: [batch_size])
+                # Stop once every conditional sequence has generated EOS
+                finished |= self._eos_token_mask(next_tokens, eos_token_id, pad_token_id)
+                should_stop = bool(finished.all())
+                if step == 0 and phase_prefix is not None:
+                    phase_prefix.note_prefill(int(buffer.attention_mask[:, prefill_start:].sum()), time.time() - prefill_start_time)
                 
                 # Apply the same sampled tokens to both conditional and unconditional sequences
-                next_tokens_unsqueezed = next_tokens.unsqueeze(1)
-                generated_ids = torch.cat([generated_ids, next_tokens_unsqueezed.repeat(2, 1)], dim=1)
-                attention_mask = torch.cat([attention_mask, torch.ones((batch_size*2, 1), device=device, dtype=attention_mask.dtype)], dim=1)
-                model_kwargs['attention_mask'] = attention_mask
+                buffer.append(next_tokens.repeat(2), alive.repeat(2))
+                if 'attention_mask' in model_kwargs:
+                    model_kwargs['attention_mask'] = buffer.attention_mask
                 
                 # Update past_key_values for next iteration
                 if use_cache and hasattr(outputs, 'past_key_values'):
@@ -2428,7 +3112,7 @@ class LLMHandler:
                 
                 # Update streamer
                 if streamer is not None:
-                    streamer.put(next_tokens_unsqueezed)  # Stream conditional tokens
+                    streamer.put(next_tokens.unsqueeze(1))  # Stream conditional tokens
                 
                 # Stop generation if EOS token detected
                 if should_stop:
@@ -2437,9 +3121,12 @@ class LLMHandler:
         if streamer is not None:
             streamer.end()
         
+        if phase_prefix is not None and use_cache and not use_static_cache:
+            phase_prefix.kv_cache = past_key_values
+        
         # Return the full batch (both conditional and unconditional)
         # The caller will extract only the conditional output
-        return generated_ids
+        return buffer.input_ids
     
     def parse_lm_output(self, output_text: str) -> Tuple[Dict[str, Any], str]:
         """
@@ -2777,7 +3464,6 @@ class LLMHandler:
             skip_caption=True,
             skip_language=True,
             generation_phase="codes",
-            is_batch=True,
         )
 
         if constrained_processor is not None:
@@ -3103,7 +3789,6 @@ class LLMHandler:
             skip_caption=skip_caption,
             skip_language=skip_language,
             generation_phase=generation_phase,
-            is_batch=False,
         )
 
         # ---- Calculate max_new_tokens ----
@@ -3451,7 +4136,6 @@ class LLMHandler:
             skip_caption=skip_caption,
             skip_language=skip_language,
             generation_phase=generation_phase,
-            is_batch=False,
         )
 
         # Calculate max_new_tokens
@@ -3799,6 +4483,8 @@ class LLMHandler:
         Get HuggingFace model for perplexity scoring.
         
         For vllm backend, loads HuggingFace model from disk (weights are cached by transformers).
+        acestep.test_time_scaling does not need it there: it scores on the resident
+        nano-vllm weights via LLMEngine.score.
         For pt backend, returns the existing model.
         For mlx backend, loads HuggingFace model from disk (MLX model can't be used for torch scoring).
         
@@ -0,0 +1,486 @@
+"""
+Registry of LoRA adapters for the DiT decoder
+
+Adapters are loaded once into a single PEFT wrapper around the decoder and
+switched per request with set_adapter(), so the base decoder is never copied.
+Only the most recently used adapters keep their weights on the decoder's device;
+the others are parked on CPU, and past max_adapters the least recently used one
+is deleted from the decoder (and reloaded from its path on next use). A batch can
+mix adapters: every sample goes through its own adapter in the same forward pass
+via PEFT's adapter_names argument.
+
+For steady-state serving of one adapter, MergedLoRA folds its delta into the base
+linear weights instead (no per-step low-rank matmuls, works with torch.compile and
+quantized decoders) and keeps the original weights for an exact revert.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+import torch
+from loguru import logger
+
+# PEFT's adapter name for "no adapter" rows of a mixed batch
+BASE_ADAPTER = "__base__"
+
+
+class _Adapter:
+    """Bookkeeping for one registered adapter."""
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.scale = 1.0
+        # Whether the adapter is currently attached to the decoder
+        self.loaded = False
+        # Device its weights were last moved to
+        self.device: Optional[str] = None
+
+
+class LoRARegistry:
+    """
+    Named PEFT LoRA adapters attached to one decoder, with LRU weight placement.
+
+    Args:
+        max_resident: Adapters whose weights stay on the decoder's device; older
+            ones are moved to CPU until they are used again
+        max_adapters: Adapters attached to the decoder at once; older ones are
+            deleted and reloaded from their path when requested
+        search_dir: Optional directory of adapters; an unknown name is looked up
+            as ``search_dir/<name>`` before failing
+    """
+
+    def __init__(self, max_resident: int = 4, max_adapters: int = 16, search_dir: Optional[str] = None):
+        self.max_resident = max(1, max_resident)
+        self.max_adapters = max(self.max_resident, max_adapters)
+        self.search_dir = search_dir
+        # Least recently used first
+        self._adapters: "OrderedDict[str, _Adapter]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._model = None
+        self._hook_handle = None
+        # Per-row adapter names for the forward passes inside activate()
+        self._batch_adapter_names: Optional[List[str]] = None
+        # State restored after every activate(): the handler's current adapter
+        self.default_adapter: Optional[str] = None
+        self.default_enabled = False
+        self.loads = 0
+        self.evictions = 0
+        self.device_moves = 0
+
+    @property
+    def names(self) -> List[str]:
+        """Registered adapter names, least recently used first."""
+        with self._lock:
+            return list(self._adapters)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._adapters
+
+    def get_path(self, name: str) -> Optional[str]:
+        entry = self._adapters.get(name)
+        return entry.path if entry is not None else None
+
+    def get_scale(self, name: str) -> float:
+        entry = self._adapters.get(name)
+        return entry.scale if entry is not None else 1.0
+
+    def reset(self):
+        """Forget every adapter (the decoder they were attached to was replaced)."""
+        with self._lock:
+            if self._hook_handle is not None:
+                self._hook_handle.remove()
+            self._hook_handle = None
+            self._model = None
+            self._adapters.clear()
+            self._batch_adapter_names = None
+            self.default_adapter = None
+            self.default_enabled = False
+
+    def register(self, model: Any, name: str, path: str, device: Any, dtype: torch.dtype):
+        """Attach the adapter at ``path`` to ``model.decoder`` under ``name``."""
+        with self._lock:
+            entry = self._adapters.get(name)
+            if entry is not None and os.path.abspath(entry.path) != os.path.abspath(path):
+                # Same name, new weights: drop the old adapter first
+                self._remove(model, name)
+                entry = None
+            if entry is None:
+                entry = self._adapters[name] = _Adapter(name, path)
+            self._adapters.move_to_end(name)
+            if not entry.loaded:
+                self._load(model, entry, device, dtype)
+            self._make_resident([name], device, dtype)
+            self._apply_default(model)
+
+    def unregister(self, model: Any, name: Optional[str] = None):
+        """Remove one adapter, or all of them (restoring the plain decoder) when name is None."""
+        with self._lock:
+            for adapter_name in ([name] if name is not None else list(self._adapters)):
+                if adapter_name in self._adapters:
+                    self._remove(model, adapter_name)
+            if self.default_adapter not in self._adapters:
+                self.default_adapter = None
+                self.default_enabled = False
+            self._apply_default(model)
+
+    def set_default(self, model: Any, name: Optional[str], enabled: bool):
+        """Adapter used by forward passes outside activate() (e.g. the Gradio LoRA toggle)."""
+        with self._lock:
+            self.default_adapter = name
+            self.default_enabled = enabled and name is not None
+            self._apply_default(model)
+
+    def set_scale(self, model: Any, name: str, scale: float) -> int:
+        """Scale one adapter's contribution; returns the number of LoRA layers updated."""
+        with self._lock:
+            entry = self._adapters.get(name)
+            if entry is None:
+                raise KeyError(f"LoRA adapter not registered: {name}")
+            entry.scale = scale
+            return self._apply_scale(model, entry) if entry.loaded else 0
+
+    @contextmanager
+    def activate(self, model: Any, names: Sequence[Optional[str]], device: Any, dtype: torch.dtype) -> Iterator[None]:
+        """
+        Route batch row i through adapter ``names[i]`` (None = base decoder) for the
+        forward passes inside the block.
+
+        Batches that the model enlarges for CFG ([cond..., uncond...]) reuse the
+        per-row names for every block of rows.
+        """
+        with self._lock:
+            for name in names:
+                if name is not None:
+                    self._ensure_loaded(model, name, device, dtype)
+            unique = [name for name in dict.fromkeys(names) if name is not None]
+            decoder = model.decoder
+            if unique:
+                self._make_resident(unique, device, dtype)
+                if len(set(names)) == 1:
+                    decoder.set_adapter(unique[0])
+                else:
+                    self._batch_adapter_names = [name if name is not None else BASE_ADAPTER for name in names]
+                decoder.enable_adapter_layers()
+            elif self._model is not None:
+                decoder.disable_adapter_layers()
+            try:
+                yield
+            finally:
+                self._batch_adapter_names = None
+                self._apply_default(model)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_resident": self.max_resident,
+                "max_adapters": self.max_adapters,
+                "loads": self.loads,
+                "evictions": self.evictions,
+                "device_moves": self.device_moves,
+                "default_adapter": self.default_adapter if self.default_enabled else None,
+                "adapters": [
+                    {
+                        "name": entry.name,
+                        "path": entry.path,
+                        "loaded": entry.loaded,
+                        "device": entry.device,
+                        "scale": entry.scale,
+                    }
+                    for entry in self._adapters.values()
+                ],
+            }
+
+    # ------------------------------------------------------------------
+    # Internals (callers hold self._lock)
+    # ------------------------------------------------------------------
+
+    def _ensure_loaded(self, model: Any, name: str, device: Any, dtype: torch.dtype):
+        entry = self._adapters.get(name)
+        if entry is None:
+            path = self._find_in_search_dir(name)
+            if path is None:
+                raise KeyError(f"LoRA adapter not registered: {name}")
+            entry = self._adapters[name] = _Adapter(name, path)
+        self._adapters.move_to_end(name)
+        if not entry.loaded:
+            self._load(model, entry, device, dtype)
+
+    def _find_in_search_dir(self, name: str) -> Optional[str]:
+        # Names come from requests: never let them escape search_dir
+        if not self.search_dir or os.path.basename(name) != name or name in (".", ".."):
+            return None
+        path = os.path.join(self.search_dir, name)
+        if os.path.isfile(os.path.join(path, "adapter_config.json")):
+            return path
+        return None
+
+    def _load(self, model: Any, entry: _Adapter, device: Any, dtype: torch.dtype):
+        from peft import PeftModel
+
+        logger.info(f"[lora] Loading adapter '{entry.name}' from {entry.path}")
+        if self._model is model and isinstance(model.decoder, PeftModel):
+            model.decoder.load_adapter(entry.path, adapter_name=entry.name, is_trainable=False)
+        else:
+            model.decoder = PeftModel.from_pretrained(
+                model.decoder,
+                entry.path,
+                adapter_name=entry.name,
+                is_trainable=False,
+            )
+            model.decoder.eval()
+            self._model = model
+            self._hook_handle = model.decoder.register_forward_pre_hook(self._inject_adapter_names, with_kwargs=True)
+        entry.loaded = True
+        entry.device = None
+        self._move_adapter(model, entry, device, dtype)
+        if entry.scale != 1.0:
+            self._apply_scale(model, entry)
+        self.loads += 1
+
+        # Bound the number of attached adapters
+        loaded = [e for e in self._adapters.values() if e.loaded]
+        for victim in loaded[:max(0, len(loaded) - self.max_adapters)]:
+            if victim is not entry:
+                logger.info(f"[lora] Evicting adapter '{victim.name}' (max_adapters={self.max_adapters})")
+                self._detach(model, victim)
+                self.evictions += 1
+
+    def _remove(self, model: Any, name: str):
+        entry = self._adapters.pop(name)
+        if entry.loaded:
+            self._detach(model, entry)
+
+    def _detach(self, model: Any, entry: _Adapter):
+        entry.loaded = False
+        entry.device = None
+        if not any(e.loaded for e in self._adapters.values() if e is not entry):
+            # Last adapter: take the LoRA layers out instead of leaving an empty wrapper
+            if self._hook_handle is not None:
+                self._hook_handle.remove()
+            self._hook_handle = None
+            model.decoder = model.decoder.unload()
+            model.decoder.eval()
+            self._model = None
+            return
+        model.decoder.delete_adapter(entry.name)
+
+    def _make_resident(self, names: Sequence[str], device: Any, dtype: torch.dtype):
+        """Move ``names`` to the device and park the least recently used others on CPU."""
+        device_str = str(device)
+        for name in names:
+            entry = self._adapters[name]
+            self._adapters.move_to_end(name)
+            if entry.device != device_str:
+                self._move_adapter(self._model, entry, device, dtype)
+        if torch.device(device).type == "cpu":
+            return
+        resident = [e for e in self._adapters.values() if e.loaded and e.device == device_str]
+        for entry in resident[:max(0, len(resident) - self.max_resident)]:
+            if entry.name not in names:
+                self._move_adapter(self._model, entry, "cpu", dtype)
+
+    def _move_adapter(self, model: Any, entry: _Adapter, device: Any, dtype: torch.dtype):
+        from peft.tuners.tuners_utils import BaseTunerLayer
+
+        for module in model.decoder.modules():
+            if not isinstance(module, BaseTunerLayer):
+                continue
+            for attr in module.adapter_layer_names:
+                container = getattr(module, attr, None)
+                if container is None or entry.name not in container:
+                    continue
+                if isinstance(container, torch.nn.ModuleDict):
+                    container[entry.name].to(device=device, dtype=dtype)
+                elif isinstance(container, torch.nn.ParameterDict):
+                    param = container[entry.name]
+                    container[entry.name] = torch.nn.Parameter(param.data.to(device=device, dtype=dtype), requires_grad=False)
+        entry.device = str(device)
+        self.device_moves += 1
+
+    def _apply_scale(self, model: Any, entry: _Adapter) -> int:
+        modified = 0
+        for module in model.decoder.modules():
+            scaling = getattr(module, "scaling", None)
+            if not isinstance(scaling, dict) or entry.name not in scaling:
+                continue
+            # Scale relative to the adapter's own alpha / r, saved on first use
+            if not hasattr(module, "_original_scaling"):
+                module._original_scaling = {}
+            original = module._original_scaling.setdefault(entry.name, scaling[entry.name])
+            scaling[entry.name] = original * entry.scale
+            modified += 1
+        return modified
+
+    def _apply_default(self, model: Any):
+        if self._model is not model:
+            return
+        decoder = model.decoder
+        default = self._adapters.get(self.default_adapter) if self.default_adapter else None
+        if self.default_enabled and default is not None and default.loaded:
+            decoder.set_adapter(default.name)
+            decoder.enable_adapter_layers()
+        else:
+            decoder.disable_adapter_layers()
+
+    def _inject_adapter_names(self, module, args, kwargs):
+        """Forward pre-hook: pass per-row adapter names to PEFT for mixed batches."""
+        names = self._batch_adapter_names
+        if names is None:
+            return None
+        hidden_states = kwargs.get("hidden_states", args[0] if args else None)
+        batch_size = hidden_states.shape[0] if hidden_states is not None else len(names)
+        if batch_size % len(names) != 0:
+            raise ValueError(f"Decoder batch of {batch_size} rows does not match {len(names)} LoRA adapter names")
+        kwargs = dict(kwargs)
+        kwargs["adapter_names"] = names * (batch_size // len(names))
+        return args, kwargs
+
+
+# ----------------------------------------------------------------------
+# Merged-weight fast path
+# ----------------------------------------------------------------------
+
+def adapter_fingerprint(path: str) -> str:
+    """Content hash of a PEFT adapter directory (config + weight files)."""
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(path)):
+        if name != "adapter_config.json" and not name.startswith("adapter_model."):
+            continue
+        h.update(name.encode("utf-8"))
+        with open(os.path.join(path, name), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _pattern_value(patterns: Dict[str, Any], module_name: str, default):
+    # Same matching rule PEFT uses for rank_pattern / alpha_pattern keys
+    for key, value in patterns.items():
+        if re.match(rf"(.*\.)?({key})$", module_name):
+            return value
+    return default
+
+
+def load_lora_deltas(path: str, scale: float = 1.0) -> Dict[str, torch.Tensor]:
+    """
+    Read a PEFT LoRA adapter from disk and return its weight deltas.
+
+    Args:
+        path: Adapter directory (adapter_config.json + adapter_model.safetensors/.bin)
+        scale: Extra multiplier on top of lora_alpha / r (the handler's lora_scale)
+
+    Returns:
+        Mapping of decoder module path (e.g. "layers.0.self_attn.q_proj") to the
+        float32 CPU tensor ``scale * alpha / r * B @ A``, shaped like that module's weight
+    """
+    with open(os.path.join(path, "adapter_config.json"), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("use_dora"):
+        raise ValueError("Merging DoRA adapters is not supported")
+
+    weights_file = os.path.join(path, "adapter_model.safetensors")
+    if os.path.exists(weights_file):
+        from safetensors.torch import load_file
+        state_dict = load_file(weights_file, device="cpu")
+    else:
+        state_dict = torch.load(os.path.join(path, "adapter_model.bin"), map_location="cpu", weights_only=True)
+
+    r = config.get("r", 8)
+    alpha = config.get("lora_alpha", r)
+    rank_pattern = config.get("rank_pattern") or {}
+    alpha_pattern = config.get("alpha_pattern") or {}
+    deltas: Dict[str, torch.Tensor] = {}
+    for key, lora_a in state_dict.items():
+        if not key.endswith(".lora_A.weight"):
+            continue
+        module_name = key[: -len(".lora_A.weight")]
+        lora_b = state_dict.get(f"{module_name}.lora_B.weight")
+        if lora_b is None:
+            continue
+        if module_name.startswith("base_model.model."):
+            module_name = module_name[len("base_model.model."):]
+        if lora_a.dim() != 2:
+            raise ValueError(f"Merging is only supported for Linear LoRA layers (got {tuple(lora_a.shape)} for {module_name})")
+        rank = _pattern_value(rank_pattern, module_name, r)
+        module_alpha = _pattern_value(alpha_pattern, module_name, alpha)
+        scaling = module_alpha / (rank ** 0.5 if config.get("use_rslora") else rank)
+        delta = (lora_b.float() @ lora_a.float()) * (scaling * scale)
+        if config.get("fan_in_fan_out"):
+            delta = delta.T
+        deltas[module_name] = delta.contiguous()
+    if not deltas:
+        raise ValueError(f"No LoRA weights found in {path}")
+    return deltas
+
+
+def _base_linear(decoder: torch.nn.Module, module_name: str) -> torch.nn.Module:
+    """Plain linear layer at ``module_name``, looking through a PEFT wrapper if present."""
+    root = decoder.get_base_model() if hasattr(decoder, "get_base_model") else decoder
+    module = root.get_submodule(module_name)
+    if hasattr(module, "get_base_layer"):
+        module = module.get_base_layer()
+    return module
+
+
+class MergedLoRA:
+    """
+    One adapter folded into the decoder's linear weights.
+
+    apply() swaps in new weight parameters and keeps the originals (on CPU unless
+    they are quantized tensor subclasses, which some torchao versions cannot move),
+    so revert() restores the base decoder exactly, without re-subtracting deltas.
+    """
+
+    def __init__(self, name: str, path: str, key: str):
+        self.name = name
+        self.path = path
+        # Cache key: base checkpoint, adapter content, scale and quantization
+        self.key = key
+        self._originals: Dict[str, torch.Tensor] = {}
+
+    @staticmethod
+    def build(
+        decoder: torch.nn.Module,
+        deltas: Dict[str, torch.Tensor],
+        quantize_fn: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        """
+        Compute merged weights for every module in ``deltas``.
+
+        Quantized base weights are dequantized, merged in float32 and passed to
+        ``quantize_fn`` to get back a weight of the decoder's quantized type.
+        """
+        merged = {}
+        for module_name, delta in deltas.items():
+            weight = _base_linear(decoder, module_name).weight
+            quantized = type(weight.data) is not torch.Tensor
+            base = weight.dequantize() if quantized else weight.detach()
+            if tuple(base.shape) != tuple(delta.shape):
+                raise ValueError(f"LoRA delta shape {tuple(delta.shape)} does not match {module_name} weight {tuple(base.shape)}")
+            target_dtype = base.dtype
+            new_weight = (base.float() + delta.to(base.device)).to(target_dtype)
+            if quantized and quantize_fn is not None:
+                new_weight = quantize_fn(new_weight)
+            merged[module_name] = new_weight
+        return merged
+
+    def apply(self, decoder: torch.nn.Module, merged: Dict[str, torch.Tensor]):
+        for module_name, new_weight in merged.items():
+            module = _base_linear(decoder, module_name)
+            original = module.weight.data
+            quantized = type(original) is not torch.Tensor
+            self._originals[module_name] = original if quantized else original.to("cpu")
+            module.weight = torch.nn.Parameter(new_weight.to(original.device), requires_grad=False)
+
+    def revert(self, decoder: torch.nn.Module):
+        for module_name, original in self._originals.items():
+            module = _base_linear(decoder, module_name)
+            module.weight = torch.nn.Parameter(original.to(module.weight.device), requires_grad=False)
+        self._originals.clear()
@@ -0,0 +1,178 @@
+"""
+Staged pipeline executor for concurrent generation jobs
+
+A job runs LM -> DiT -> VAE decode -> save. Each stage has its own slot count and
+its own FIFO of waiting jobs, so while job A is diffusing, job B can generate LM
+codes and job C can VAE-decode/save, instead of one job holding everything.
+
+Jobs keep running on their own worker thread (the API executor); the stages are
+gates that the code in acestep.inference / AceStepHandler enters around each
+phase via ``pipeline_stage(name)``. When no executor is active the gates are
+no-ops, so the CLI and Gradio paths are unchanged.
+"""
+
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, Optional
+
+from loguru import logger
+
+PIPELINE_STAGES = ("lm", "dit", "vae", "save")
+
+
+class _StageGate:
+    """FIFO gate with a fixed number of slots plus occupancy counters."""
+
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = max(1, slots)
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._next_ticket = 0
+        self._serving_ticket = 0
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_waiting = 0
+        self._busy_since: Optional[float] = None
+        self._occupied_seconds = 0.0
+
+    def _account_occupancy(self, now: float):
+        # Time during which at least one slot was busy (stage utilization)
+        if self._busy_since is not None:
+            self._occupied_seconds += now - self._busy_since
+            self._busy_since = now if self._active > 0 else None
+
+    @contextmanager
+    def hold(self) -> Iterator[None]:
+        wait_start = time.perf_counter()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._waiting += 1
+            self.max_waiting = max(self.max_waiting, self._waiting)
+            # Strict FIFO: a job may only take a slot once every earlier arrival has
+            while ticket != self._serving_ticket or self._active >= self.slots:
+                self._cond.wait()
+            self._serving_ticket += 1
+            self._waiting -= 1
+            now = time.perf_counter()
+            self._account_occupancy(now)
+            if self._active == 0:
+                self._busy_since = now
+            self._active += 1
+            self.wait_seconds += now - wait_start
+            self._cond.notify_all()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._cond:
+                self._active -= 1
+                self.completed += 1
+                self.busy_seconds += end - start
+                self._account_occupancy(end)
+                self._cond.notify_all()
+
+    def snapshot(self, elapsed: float) -> Dict[str, Any]:
+        with self._cond:
+            occupied = self._occupied_seconds
+            if self._busy_since is not None:
+                occupied += time.perf_counter() - self._busy_since
+            completed = self.completed
+            return {
+                "slots": self.slots,
+                "active": self._active,
+                "waiting": self._waiting,
+                "max_waiting": self.max_waiting,
+                "completed": completed,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "avg_service_seconds": round(self.busy_seconds / completed, 3) if completed else 0.0,
+                "avg_wait_seconds": round(self.wait_seconds / completed, 3) if completed else 0.0,
+                # Fraction of wall time the stage had at least one job running
+                "occupancy": round(occupied / elapsed, 4) if elapsed > 0 else 0.0,
+            }
+
+
+class StagedPipelineExecutor:
+    """
+    Admission control plus per-stage gates for overlapping generation jobs.
+
+    Args:
+        stage_slots: Number of jobs allowed inside each stage at once
+            (missing stages default to 1)
+        max_in_flight: Bound on jobs admitted into the pipeline; the per-stage
+            queues can never hold more than this many jobs in total
+    """
+
+    def __init__(self, stage_slots: Optional[Dict[str, int]] = None, max_in_flight: int = 2):
+        stage_slots = stage_slots or {}
+        self.stages = {name: _StageGate(name, stage_slots.get(name, 1)) for name in PIPELINE_STAGES}
+        self.max_in_flight = max(1, max_in_flight)
+        self._admission = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._jobs_completed = 0
+        self._started_at = time.perf_counter()
+
+    @contextmanager
+    def job(self) -> Iterator[None]:
+        """Admit one job into the pipeline (blocks while the pipeline is full)."""
+        self._admission.acquire()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._jobs_completed += 1
+            self._admission.release()
+
+    def stage(self, name: str):
+        """Context manager that holds a slot of ``name`` for the enclosed phase."""
+        gate = self.stages.get(name)
+        if gate is None:
+            return nullcontext()
+        return gate.hold()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Per-stage occupancy, queue depth and timing counters."""
+        elapsed = time.perf_counter() - self._started_at
+        with self._lock:
+            in_flight = self._in_flight
+            jobs_completed = self._jobs_completed
+        return {
+            "in_flight": in_flight,
+            "max_in_flight": self.max_in_flight,
+            "jobs_completed": jobs_completed,
+            "uptime_seconds": round(elapsed, 3),
+            "stages": {name: gate.snapshot(elapsed) for name, gate in self.stages.items()},
+        }
+
+
+_active_pipeline: Optional[StagedPipelineExecutor] = None
+
+
+def set_active_pipeline(pipeline: Optional[StagedPipelineExecutor]):
+    """Install (or remove with None) the process-wide pipeline executor."""
+    global _active_pipeline
+    _active_pipeline = pipeline
+    if pipeline is not None:
+        slots = {name: gate.slots for name, gate in pipeline.stages.items()}
+        logger.info(f"[pipeline] Staged pipeline enabled: max_in_flight={pipeline.max_in_flight}, slots={slots}")
+
+
+def get_active_pipeline() -> Optional[StagedPipelineExecutor]:
+    return _active_pipeline
+
+
+def pipeline_stage(name: str):
+    """Gate for one generation phase; a no-op when no pipeline is active."""
+    pipeline = _active_pipeline
+    if pipeline is None:
+        return nullcontext()
+    return pipeline.stage(name)
@@ -4,12 +4,14 @@ Implements perplexity-based scoring for generated audio codes
 """
 import torch
 import torch.nn.functional as F
-from typing import Tuple, Optional, Dict, Any, List
+from typing import Tuple, Optional, Dict, Any, List, Callable
 from loguru import logger
 import yaml
 import math
 import re
 
+from acestep.audio_codes import AudioCodesLike, format_audio_codes, has_audio_codes
+
 
 def pmi_score(log_prob_conditional: float, log_prob_unconditional: float) -> float:
     """
@@ -75,6 +77,9 @@ def _get_logits_and_target_for_scoring(llm_handler, formatted_prompt: str,
         - target_logits: Logits used to predict the target tokens.
         - target_ids: The ground truth token IDs of the target.
     """
+    if _use_engine_scoring(llm_handler):
+        return _score_targets_with_engine(llm_handler, formatted_prompt, [target_text], [lambda l, t: (l, t)])[0]
+
     model = llm_handler.get_hf_model_for_scoring()
     tokenizer = llm_handler.llm_tokenizer
     device = llm_handler.device if llm_handler.llm_backend == "pt" else next(model.parameters()).device
@@ -112,22 +117,180 @@ def _get_logits_and_target_for_scoring(llm_handler, formatted_prompt: str,
     return target_logits, target_ids
 
 
+def _use_engine_scoring(llm_handler) -> bool:
+    """Score on the resident nano-vllm engine instead of a separate HF copy of the LM."""
+    return llm_handler.llm_backend == "vllm" and hasattr(llm_handler.llm, "score")
+
+
+def _tokenize_targets(tokenizer, formatted_prompt: str, target_texts: List[str]) -> Tuple[int, List[List[int]]]:
+    """Prompt length and prompt + target token ids, tokenized like _get_logits_and_target_for_scoring."""
+    prompt_len = tokenizer(formatted_prompt, return_tensors="pt", add_special_tokens=True)['input_ids'].shape[1]
+    sequences = [
+        tokenizer(formatted_prompt + text, padding=False, truncation=True, add_special_tokens=True)['input_ids']
+        for text in target_texts
+    ]
+    return prompt_len, sequences
+
+
+def _score_targets_with_engine(
+    llm_handler,
+    formatted_prompt: str,
+    target_texts: List[str],
+    score_fns: List[Callable[[torch.Tensor, torch.Tensor], Any]],
+) -> List[Any]:
+    """
+    Same contract as _score_targets_with_shared_prefix, for the vllm backend.
+
+    All sequences go through one teacher-forced prefill on the nano-vllm engine
+    (LLMEngine.score), so no second copy of the LM has to be loaded for scoring.
+    """
+    prompt_len, sequences = _tokenize_targets(llm_handler.llm_tokenizer, formatted_prompt, target_texts)
+    all_logits = llm_handler.llm.score(sequences, prompt_len, return_logits=True)
+    results = []
+    for ids, target_logits, fn in zip(sequences, all_logits, score_fns):
+        if len(ids) <= prompt_len:
+            empty = torch.empty(0, device=target_logits.device)
+            results.append(fn(empty, empty))
+            continue
+        target_ids = torch.tensor(ids[prompt_len:], dtype=torch.long, device=target_logits.device)
+        results.append(fn(target_logits, target_ids))
+    return results
+
+
+def _expand_prefix_cache(past_key_values, batch_size: int):
+    """Repeat a batch-1 KV cache along the batch dimension."""
+    if batch_size == 1:
+        return past_key_values
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(batch_size)
+        return past_key_values
+    # Legacy tuple-of-tuples cache
+    return tuple(
+        tuple(t.expand(batch_size, *t.shape[1:]) for t in layer)
+        for layer in past_key_values
+    )
+
+
+def _score_targets_with_shared_prefix(
+    llm_handler,
+    formatted_prompt: str,
+    target_texts: List[str],
+    score_fns: List[Callable[[torch.Tensor, torch.Tensor], Any]],
+) -> List[Any]:
+    """
+    Score several target texts that all follow the same prompt.
+
+    The token prefix shared by every prompt + target sequence is encoded once; its
+    KV cache is then repeated across the batch and all continuations run as one
+    right-padded forward. Only the decoder runs on the prefix, and the LM head is
+    applied per row to target positions only, so cost grows with the total suffix
+    length instead of (number of targets x full sequence length).
+
+    Args:
+        llm_handler: The handler containing the model and tokenizer.
+        formatted_prompt: The input context shared by all targets.
+        target_texts: Texts to score.
+        score_fns: One fn(target_logits, target_ids) per target; its return value
+            is that target's result.
+
+    Returns:
+        List of score_fn results, in target order. Targets that tokenize to nothing
+        after the prompt get score_fn(empty, empty).
+    """
+    if _use_engine_scoring(llm_handler):
+        return _score_targets_with_engine(llm_handler, formatted_prompt, target_texts, score_fns)
+
+    model = llm_handler.get_hf_model_for_scoring()
+    decoder = model.get_decoder() if hasattr(model, "get_decoder") else None
+    lm_head = model.get_output_embeddings()
+    if decoder is None or lm_head is None or len(target_texts) == 1:
+        # No decoder/head split (or nothing to share): one full forward per target
+        return [
+            fn(*_get_logits_and_target_for_scoring(llm_handler, formatted_prompt, text))
+            for text, fn in zip(target_texts, score_fns)
+        ]
+
+    tokenizer = llm_handler.llm_tokenizer
+    device = llm_handler.device if llm_handler.llm_backend == "pt" else next(model.parameters()).device
+
+    # Tokenize exactly as _get_logits_and_target_for_scoring does, so scores match
+    prompt_len, sequences = _tokenize_targets(tokenizer, formatted_prompt, target_texts)
+
+    results: List[Any] = [None] * len(target_texts)
+    rows = []
+    for i, ids in enumerate(sequences):
+        if len(ids) <= prompt_len:
+            empty = torch.empty(0, device=device)
+            results[i] = score_fns[i](empty, empty)
+        else:
+            rows.append(i)
+    if not rows:
+        return results
+
+    # Shared prefix; the token predicting the first target token (prompt_len - 1)
+    # always stays in the suffix so every target logit comes from the batched pass.
+    prefix_len = prompt_len - 1
+    first = sequences[rows[0]]
+    for i in rows[1:]:
+        ids = sequences[i]
+        n = 0
+        while n < prefix_len and ids[n] == first[n]:
+            n += 1
+        prefix_len = n
+
+    suffixes = [sequences[i][prefix_len:] for i in rows]
+    max_suffix = max(len(x) for x in suffixes)
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    suffix_ids = torch.full((len(rows), max_suffix), pad_id, dtype=torch.long)
+    suffix_mask = torch.zeros((len(rows), prefix_len + max_suffix), dtype=torch.long)
+    suffix_mask[:, :prefix_len] = 1
+    for r, ids in enumerate(suffixes):
+        suffix_ids[r, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        suffix_mask[r, prefix_len:prefix_len + len(ids)] = 1
+    suffix_ids = suffix_ids.to(device)
+    suffix_mask = suffix_mask.to(device)
+    position_ids = torch.arange(prefix_len, prefix_len + max_suffix, device=device).unsqueeze(0).expand(len(rows), -1)
+
+    with torch.no_grad():
+        with llm_handler._load_model_context():
+            past_key_values = None
+            if prefix_len > 0:
+                prefix_ids = torch.tensor([first[:prefix_len]], dtype=torch.long, device=device)
+                prefix_out = decoder(input_ids=prefix_ids, use_cache=True)
+                past_key_values = _expand_prefix_cache(prefix_out.past_key_values, len(rows))
+            # Right padding: causal attention keeps real tokens from seeing the pads
+            hidden = decoder(
+                input_ids=suffix_ids,
+                attention_mask=suffix_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=past_key_values is not None,
+            ).last_hidden_state  # [rows, max_suffix, hidden]
+
+            for r, i in enumerate(rows):
+                seq_len = len(sequences[i])
+                # Logit for token t is at position t - 1 (see _get_logits_and_target_for_scoring)
+                start = prompt_len - 1 - prefix_len
+                end = seq_len - 1 - prefix_len
+                target_logits = lm_head(hidden[r, start:end])
+                target_ids = torch.tensor(sequences[i][prompt_len:], dtype=torch.long, device=device)
+                results[i] = score_fns[i](target_logits, target_ids)
+
+    return results
+
+
 # ==============================================================================
 # Scoring Logic
 # ==============================================================================
 
 
-def _calculate_topk_recall(llm_handler,
-                           formatted_prompt: str,
-                           target_text: str,
-                           topk: int = 10) -> Tuple[float, Dict[int, float]]:
-    """
-    Calculate top-k recall for target text given prompt.
-    Checks if the ground truth token is within the top-k probabilities at each step.
-    """
-    # Use the fixed helper to get aligned logits/labels
-    pred_logits, target_ids = _get_logits_and_target_for_scoring(llm_handler, formatted_prompt, target_text)
+def _topk_recall_from_logits(pred_logits: torch.Tensor,
+                             target_ids: torch.Tensor,
+                             topk: int = 10) -> Tuple[float, Dict[int, float]]:
+    """Position-weighted top-k recall of target_ids under pred_logits.
 
+    Checks whether the ground truth token is within the top-k predictions at each step.
+    """
     if target_ids.shape[0] == 0:
         return 0.0, {}
 
@@ -171,45 +334,8 @@ def _calculate_topk_recall(llm_handler,
     return average_recall, recall_per_k
 
 
-def _calculate_metadata_recall(llm_handler,
-                               formatted_prompt: str,
-                               fields_dict: Dict[str, Any],
-                               topk: int = 10) -> Dict[str, float]:
-    """
-    Args:
-        fields_dict: Dictionary of {field_name: field_value}
-    """
-    if not fields_dict:
-        return {}
-
-    field_scores = {}
-
-    for field_name in sorted(fields_dict.keys()):
-        # Construct target text for this specific field
-        # e.g. <think>\nbpm: 120\n</think>\n
-        field_yaml = yaml.dump({field_name: fields_dict[field_name]}, allow_unicode=True, sort_keys=True).strip()
-        field_target_text = f"<think>\n{field_yaml}\n</think>\n"
-
-        # Calculate recall using the robust logic
-        avg_score, _ = _calculate_topk_recall(llm_handler, formatted_prompt, field_target_text, topk=topk)
-
-        field_scores[field_name] = avg_score
-        logger.debug(f"Recall for {field_name}: {avg_score:.4f}")
-
-    return field_scores
-
-
-def _calculate_log_prob(
-        llm_handler,
-        formatted_prompt: str,
-        target_text: str,
-        temperature: float = 1.0  # Kept for API compatibility, but ignored for scoring
-) -> float:
-    """
-    Calculate average log probability of target text given prompt.
-    """
-    pred_logits, target_ids = _get_logits_and_target_for_scoring(llm_handler, formatted_prompt, target_text)
-
+def _mean_log_prob_from_logits(pred_logits: torch.Tensor, target_ids: torch.Tensor) -> float:
+    """Average log probability of target_ids under pred_logits."""
     if target_ids.shape[0] == 0:
         return float('-inf')
 
@@ -326,7 +452,7 @@ def calculate_reward_score(
 
 def calculate_pmi_score_per_condition(
     llm_handler,
-    audio_codes: str,
+    audio_codes: AudioCodesLike,
     caption: str = "",
     lyrics: str = "",
     metadata: Optional[Dict[str, Any]] = None,
@@ -338,59 +464,73 @@ def calculate_pmi_score_per_condition(
     Calculate quality score separately for each condition.
     - Metadata: Uses Top-k Recall.
     - Caption/Lyrics: Uses PMI (Normalized).
+
+    All targets scored against the same context (codes-conditioned or unconditional)
+    share one prefix encoding and one batched forward, see
+    _score_targets_with_shared_prefix.
     """
     if not llm_handler.llm_initialized:
         return {}, 0.0, "❌ LLM not initialized"
 
-    if not audio_codes or not audio_codes.strip():
+    if not has_audio_codes(audio_codes):
         return {}, 0.0, "❌ No audio codes provided"
 
     if "caption" not in metadata:
         metadata['caption'] = caption
 
-    formatted_prompt = llm_handler.build_formatted_prompt_for_understanding(audio_codes=audio_codes, is_negative_prompt=False)
+    formatted_prompt = llm_handler.build_formatted_prompt_for_understanding(audio_codes=format_audio_codes(audio_codes), is_negative_prompt=False)
     prompt_uncond = llm_handler.build_formatted_prompt_for_understanding(audio_codes="NO USER INPUT", is_negative_prompt=False)
     try:
-        # 1. Calculate Recall for Metadata Fields
+        # Collect every (condition, target) pair first, then score per context in one pass
+        cond_targets = []  # (key, target_text, score_fn)
+        uncond_targets = []
+        recall_fn = lambda logits, ids: _topk_recall_from_logits(logits, ids, topk=topk)[0]
+
+        # 1. Recall for Metadata Fields
         if metadata and isinstance(metadata, dict):
-            scores = {}
             # Define which fields use which metric
             metadata_recall_keys = ['bpm', 'duration', 'genres', 'keyscale', 'language', 'timesignature']
             metadata_pmi_keys = ['caption']
             for key in metadata_recall_keys:
                 if key in metadata and metadata[key] is not None:
-                    recall_metadata = {key: metadata[key]}
-                    field_scores = _calculate_metadata_recall(llm_handler, formatted_prompt, recall_metadata, topk=topk)
-                    scores.update(field_scores)
+                    # e.g. <think>\nbpm: 120\n</think>\n
+                    field_yaml = yaml.dump({key: metadata[key]}, allow_unicode=True, sort_keys=True).strip()
+                    cond_targets.append((key, f"<think>\n{field_yaml}\n</think>\n", recall_fn))
 
-            # 2. Calculate PMI for Caption
+            # 2. PMI for Caption
             for key in metadata_pmi_keys:
                 if key in metadata and metadata[key] is not None:
                     cot_yaml = yaml.dump({key: metadata[key]}, allow_unicode=True, sort_keys=True).strip()
                     target_text = f"<think>\n{cot_yaml}\n</think>\n"
+                    cond_targets.append((key, target_text, _mean_log_prob_from_logits))
+                    uncond_targets.append((key, target_text, _mean_log_prob_from_logits))
 
-                    log_prob_cond = _calculate_log_prob(llm_handler, formatted_prompt, target_text)
-                    log_prob_uncond = _calculate_log_prob(llm_handler, prompt_uncond, target_text)
-
-                    pmi_normalized = pmi_to_normalized_score(log_prob_cond - log_prob_uncond, scale=score_scale)
-                    scores[key] = pmi_normalized
-
-        # 3. Calculate PMI for Lyrics
+        # 3. PMI for Lyrics
         if lyrics:
             target_text = f"<think>\n</think>\n# Lyric\n{lyrics}\n"
+            cond_targets.append(('lyrics', target_text, _mean_log_prob_from_logits))
+            uncond_targets.append(('lyrics', target_text, _mean_log_prob_from_logits))
 
-            log_prob_cond = _calculate_log_prob(llm_handler, formatted_prompt, target_text)
-
-            prompt_uncond = llm_handler.build_formatted_prompt_for_understanding(audio_codes="NO USER INPUT", is_negative_prompt=False)
-            log_prob_uncond = _calculate_log_prob(llm_handler, prompt_uncond, target_text)
-
-            scores['lyrics'] = pmi_to_normalized_score(log_prob_cond - log_prob_uncond, scale=score_scale)
-
-        if not scores:
+        if not cond_targets:
             return {}, 0.0, "❌ No conditions to evaluate"
 
+        cond_results = _score_targets_with_shared_prefix(
+            llm_handler, formatted_prompt, [t for _, t, _ in cond_targets], [fn for _, _, fn in cond_targets]
+        )
+        uncond_results = _score_targets_with_shared_prefix(
+            llm_handler, prompt_uncond, [t for _, t, _ in uncond_targets], [fn for _, _, fn in uncond_targets]
+        ) if uncond_targets else []
+        log_prob_uncond = {key: value for (key, _, _), value in zip(uncond_targets, uncond_results)}
+
+        scores = {}
+        for (key, _, _), value in zip(cond_targets, cond_results):
+            if key in log_prob_uncond:
+                scores[key] = pmi_to_normalized_score(value - log_prob_uncond[key], scale=score_scale)
+            else:
+                scores[key] = value
+                logger.debug(f"Recall for {key}: {value:.4f}")
+
         # 4. Global Score
-        global_score = sum(scores.values()) / len(scores)
         global_score, breakdown_lines = calculate_reward_score(scores)
 
         # Status Message
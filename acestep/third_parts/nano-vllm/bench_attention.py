@@ -0,0 +1,108 @@
+"""Benchmark the batched SDPA fallback against the per-sequence loop.
+
+Synthetic paged KV cache, Qwen3-0.6B-like head layout. Run without flash-attn to
+measure the path actually used on ROCm / consumer GPUs:
+
+    python bench_attention.py --batch-sizes 1 4 8 16 32 --context 1024
+"""
+import argparse
+import time
+
+import torch
+
+from nanovllm.layers.attention import (
+    _sdpa_decode_with_paged_cache,
+    _sdpa_decode_with_paged_cache_loop,
+    _sdpa_varlen_prefill,
+    _sdpa_varlen_prefill_loop,
+)
+
+
+def _sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _time(fn, device, iters):
+    fn()
+    _sync(device)
+    t = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    _sync(device)
+    return (time.perf_counter() - t) / iters * 1000
+
+
+def bench_decode(batch_size, context, args, device, dtype):
+    block_size = args.block_size
+    lens = torch.randint(context // 2, context + 1, (batch_size,))
+    max_blocks = (int(lens.max()) + block_size - 1) // block_size
+    num_blocks = batch_size * max_blocks
+    k_cache = torch.randn(num_blocks, block_size, args.num_kv_heads, args.head_dim, device=device, dtype=dtype)
+    v_cache = torch.randn_like(k_cache)
+    block_tables = torch.full((batch_size, max_blocks), -1, dtype=torch.int32)
+    perm = torch.randperm(num_blocks)
+    for i, n in enumerate(lens.tolist()):
+        used = (n + block_size - 1) // block_size
+        block_tables[i, :used] = perm[i * max_blocks:i * max_blocks + used].to(torch.int32)
+    block_tables = block_tables.to(device)
+    context_lens = lens.to(device=device, dtype=torch.int32)
+    q = torch.randn(batch_size, 1, args.num_heads, args.head_dim, device=device, dtype=dtype)
+    call_args = (q, k_cache, v_cache, context_lens, block_tables, args.head_dim ** -0.5, args.num_heads, args.num_kv_heads)
+
+    ref = _sdpa_decode_with_paged_cache_loop(*call_args)
+    out = _sdpa_decode_with_paged_cache(*call_args)
+    err = (ref.float() - out.float()).abs().max().item()
+    loop_ms = _time(lambda: _sdpa_decode_with_paged_cache_loop(*call_args), device, args.iters)
+    batched_ms = _time(lambda: _sdpa_decode_with_paged_cache(*call_args), device, args.iters)
+    return loop_ms, batched_ms, err
+
+
+def bench_prefill(batch_size, context, args, device, dtype):
+    lens = torch.randint(max(1, context // 4), context + 1, (batch_size,))
+    cu_seqlens = torch.zeros(batch_size + 1, dtype=torch.int32)
+    cu_seqlens[1:] = torch.cumsum(lens, 0)
+    total = int(cu_seqlens[-1])
+    max_len = int(lens.max())
+    cu_seqlens = cu_seqlens.to(device)
+    q = torch.randn(total, args.num_heads, args.head_dim, device=device, dtype=dtype)
+    k = torch.randn(total, args.num_kv_heads, args.head_dim, device=device, dtype=dtype)
+    v = torch.randn_like(k)
+    scale = args.head_dim ** -0.5
+
+    def loop():
+        return _sdpa_varlen_prefill_loop(q, k, v, cu_seqlens, cu_seqlens, scale, args.num_heads, args.num_kv_heads)
+
+    def batched():
+        return _sdpa_varlen_prefill(q, k, v, cu_seqlens, cu_seqlens, max_len, max_len, scale, args.num_heads, args.num_kv_heads)
+
+    err = (loop().float() - batched().float()).abs().max().item()
+    return _time(loop, device, args.iters), _time(batched, device, args.iters), err
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--context", type=int, default=1024, help="max context (decode) / prompt (prefill) length")
+    parser.add_argument("--num-heads", type=int, default=16)
+    parser.add_argument("--num-kv-heads", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    dtype = torch.bfloat16 if device.type == "cuda" else torch.float32
+
+    print(f"device={device} dtype={dtype} context={args.context} heads={args.num_heads}/{args.num_kv_heads}")
+    print(f"{'phase':<8}{'batch':>6}{'loop ms':>10}{'batched ms':>12}{'speedup':>9}{'max err':>10}")
+    for phase, fn in (("decode", bench_decode), ("prefill", bench_prefill)):
+        for batch_size in args.batch_sizes:
+            loop_ms, batched_ms, err = fn(batch_size, args.context, args, device, dtype)
+            print(f"{phase:<8}{batch_size:>6}{loop_ms:>10.3f}{batched_ms:>12.3f}{loop_ms / batched_ms:>8.2f}x{err:>10.2e}")
+
+
+if __name__ == "__main__":
+    main()
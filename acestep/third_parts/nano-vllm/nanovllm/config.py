@@ -2,6 +2,8 @@ import os
 from dataclasses import dataclass
 from transformers import AutoConfig
 
+from nanovllm.layers.quantization import KV_CACHE_DTYPES, QUANT_METHODS, read_quant_config
+
 
 @dataclass
 class Config:
@@ -16,11 +18,43 @@ class Config:
     eos: int = -1
     kvcache_block_size: int = 256
     num_kvcache_blocks: int = -1
+    # "cuda" or "cpu"; the CPU runner uses gloo, no pinned memory and no CUDA graphs
+    device: str = "cuda"
+    # Host memory reserved for the paged KV cache when device == "cpu"
+    cpu_kvcache_gb: float = 4.0
+    # Speculative decoding: draft tokens verified per decode step (0 disables it).
+    # Drafts come from n-gram lookup in each sequence's own history.
+    num_speculative_tokens: int = 0
+    speculative_max_ngram: int = 3
+    speculative_min_ngram: int = 2
+    # Weight-only quantization of the linear layers: None, "int8" (per output
+    # channel) or "int4" (groups of quantization_group_size input channels).
+    # Taken from the checkpoint when it was saved pre-quantized.
+    quantization: str | None = None
+    quantization_group_size: int = 128
+    # KV cache storage: "auto" (model dtype), "int8" or "fp8" (e4m3, CUDA needs
+    # sm89+). Quantized caches keep a float32 scale per token and kv head and fit
+    # roughly twice as many blocks in the same memory.
+    kv_cache_dtype: str = "auto"
 
     def __post_init__(self):
         assert os.path.isdir(self.model)
         assert self.kvcache_block_size % 256 == 0
         assert 1 <= self.tensor_parallel_size <= 8
+        assert self.device in ("cuda", "cpu")
+        assert self.num_speculative_tokens >= 0
+        saved_quant = read_quant_config(self.model)
+        if saved_quant is not None:
+            assert self.quantization in (None, saved_quant["method"]), (
+                f"{self.model} is pre-quantized as {saved_quant['method']}, not {self.quantization}"
+            )
+            self.quantization = saved_quant["method"]
+            self.quantization_group_size = saved_quant.get("group_size", self.quantization_group_size)
+        assert self.quantization is None or self.quantization in QUANT_METHODS
+        assert self.kv_cache_dtype == "auto" or self.kv_cache_dtype in KV_CACHE_DTYPES
+        if self.device == "cpu":
+            assert self.tensor_parallel_size == 1, "tensor parallelism requires CUDA"
+            self.enforce_eager = True
         self.hf_config = AutoConfig.from_pretrained(self.model)
         self.max_model_len = min(self.max_model_len, self.hf_config.max_position_embeddings)
         assert self.max_num_batched_tokens >= self.max_model_len
@@ -1,5 +1,5 @@
 import os
-from collections import deque
+from collections import OrderedDict
 import xxhash
 import numpy as np
 
@@ -33,14 +33,32 @@ class Block:
 
 
 class BlockManager:
+    """Paged KV block allocator with prefix caching.
+
+    Blocks with ref_count 0 live in one of two pools:
+    - free_block_ids: blocks without reusable content.
+    - evictable_block_ids: full blocks whose hash is still registered in
+      hash_to_block_id, kept in LRU order. A later sequence with the same
+      prefix (e.g. the shared instruction prompt, or a codes phase resubmitting
+      its CoT prompt) reuses them without recomputing the prefill. They are
+      only recycled, oldest first, when the free pool is empty.
+    Both pools are insertion-ordered dicts, so taking or removing a specific
+    block is O(1).
+    """
 
     def __init__(self, num_blocks: int, block_size: int):
         self.block_size = block_size
         self.blocks: list[Block] = [Block(i) for i in range(num_blocks)]
         self.hash_to_block_id: dict[int, int] = dict()
-        self.free_block_ids: deque[int] = deque(range(num_blocks))
+        self.free_block_ids: OrderedDict[int, None] = OrderedDict.fromkeys(range(num_blocks))
+        self.evictable_block_ids: OrderedDict[int, None] = OrderedDict()
         self.used_block_ids: set[int] = set()
 
+    @property
+    def num_free_blocks(self) -> int:
+        """Blocks available for allocation (free plus evictable cached blocks)."""
+        return len(self.free_block_ids) + len(self.evictable_block_ids)
+
     @classmethod
     def compute_hash(cls, token_ids: list[int], prefix: int = -1):
         h = xxhash.xxh64()
@@ -49,25 +67,56 @@ class BlockManager:
         h.update(np.array(token_ids).tobytes())
         return h.intdigest()
 
+    def _unregister_hash(self, block: Block):
+        if block.hash != -1 and self.hash_to_block_id.get(block.hash) == block.block_id:
+            del self.hash_to_block_id[block.hash]
+
+    def _take_free_block_id(self) -> int:
+        """Pick a block for new content: a clean free block, else evict the LRU cached block."""
+        if self.free_block_ids:
+            return next(iter(self.free_block_ids))
+        block_id = next(iter(self.evictable_block_ids))
+        _debug_log(f"  evicting cached block_id={block_id}")
+        self._unregister_hash(self.blocks[block_id])
+        return block_id
+
     def _allocate_block(self, block_id: int) -> Block:
         block = self.blocks[block_id]
         assert block.ref_count == 0
         block.reset()
-        self.free_block_ids.remove(block_id)
+        if self.free_block_ids.pop(block_id, False) is False:
+            del self.evictable_block_ids[block_id]
         self.used_block_ids.add(block_id)
         return self.blocks[block_id]
 
     def _deallocate_block(self, block_id: int) -> Block:
-        assert self.blocks[block_id].ref_count == 0
+        block = self.blocks[block_id]
+        assert block.ref_count == 0
         self.used_block_ids.remove(block_id)
-        self.free_block_ids.append(block_id)
+        if block.hash != -1 and self.hash_to_block_id.get(block.hash) == block_id:
+            # Keep the content reusable by later requests until memory pressure evicts it
+            self.evictable_block_ids[block_id] = None
+        else:
+            block.hash = -1
+            block.token_ids = []
+            self.free_block_ids[block_id] = None
+
+    def clear_prefix_cache(self):
+        """Forget all evictable cached blocks (e.g. after a failed step left KV contents undefined)."""
+        for block_id in self.evictable_block_ids:
+            block = self.blocks[block_id]
+            self._unregister_hash(block)
+            block.hash = -1
+            block.token_ids = []
+            self.free_block_ids[block_id] = None
+        self.evictable_block_ids.clear()
 
     def can_allocate(self, seq: Sequence) -> bool:
-        return len(self.free_block_ids) >= seq.num_blocks
+        return self.num_free_blocks >= seq.num_blocks
 
     def allocate(self, seq: Sequence):
         _debug_log(f"allocate: seq_id={seq.seq_id}, len={len(seq)}, num_blocks={seq.num_blocks}, "
-                  f"free_blocks={len(self.free_block_ids)}")
+                  f"free_blocks={len(self.free_block_ids)}, evictable_blocks={len(self.evictable_block_ids)}")
         assert not seq.block_table
         h = -1
         cache_miss = False
@@ -77,10 +126,14 @@ class BlockManager:
             block_id = self.hash_to_block_id.get(h, -1)
             if block_id == -1 or self.blocks[block_id].token_ids != token_ids:
                 cache_miss = True
+            elif i == seq.num_blocks - 1:
+                # A fully cached prompt would leave prefill with no query token to
+                # produce logits from; recompute the last block
+                cache_miss = True
             if cache_miss:
-                if len(self.free_block_ids) == 0:
+                if self.num_free_blocks == 0:
                     _debug_log(f"  ERROR: no free blocks available!")
-                block_id = self.free_block_ids[0]
+                block_id = self._take_free_block_id()
                 block = self._allocate_block(block_id)
             else:
                 seq.num_cached_tokens += self.block_size
@@ -88,41 +141,38 @@ class BlockManager:
                     block = self.blocks[block_id]
                     block.ref_count += 1
                 else:
+                    # Cached block of a finished sequence: revive it from the evictable pool
                     block = self._allocate_block(block_id)
             if h != -1:
                 block.update(h, token_ids)
                 self.hash_to_block_id[h] = block_id
             seq.block_table.append(block_id)
-        _debug_log(f"  allocated block_table: {seq.block_table}")
+        if seq.num_completion_tokens == 0:
+            seq.num_prefix_cached_tokens = seq.num_cached_tokens
+        _debug_log(f"  allocated block_table: {seq.block_table}, cached_tokens={seq.num_cached_tokens}")
 
     def deallocate(self, seq: Sequence):
         _debug_log(f"deallocate: seq_id={seq.seq_id}, block_table={seq.block_table}")
+        # Reverse order: the deepest prefix blocks become least recently used and are evicted first
         for block_id in reversed(seq.block_table):
             block = self.blocks[block_id]
             block.ref_count -= 1
             _debug_log(f"  block_id={block_id}, ref_count after decrement={block.ref_count}")
             if block.ref_count == 0:
-                # Fix: Clean up hash_to_block_id mapping to prevent stale references
-                # This prevents CUDA illegal memory access when prefix cache tries to
-                # reuse a block_id that has already been freed
-                if block.hash != -1:
-                    cached_id = self.hash_to_block_id.get(block.hash)
-                    if cached_id == block_id:
-                        del self.hash_to_block_id[block.hash]
                 self._deallocate_block(block_id)
         seq.num_cached_tokens = 0
         seq.block_table.clear()
-        _debug_log(f"  deallocated, free_blocks={len(self.free_block_ids)}")
+        _debug_log(f"  deallocated, free_blocks={len(self.free_block_ids)}, evictable_blocks={len(self.evictable_block_ids)}")
 
     def can_append(self, seq: Sequence) -> bool:
-        return len(self.free_block_ids) >= (len(seq) % self.block_size == 1)
+        return self.num_free_blocks >= (len(seq) % self.block_size == 1)
 
     def may_append(self, seq: Sequence):
         block_table = seq.block_table
         last_block = self.blocks[block_table[-1]]
         if len(seq) % self.block_size == 1:
             assert last_block.hash != -1
-            block_id = self.free_block_ids[0]
+            block_id = self._take_free_block_id()
             self._allocate_block(block_id)
             block_table.append(block_id)
         elif len(seq) % self.block_size == 0:
@@ -134,3 +184,43 @@ class BlockManager:
             self.hash_to_block_id[h] = last_block.block_id
         else:
             assert last_block.hash == -1
+
+    def num_blocks_to_reserve(self, seq: Sequence, num_draft_tokens: int) -> int:
+        """Extra blocks needed to hold num_draft_tokens tokens past len(seq)."""
+        needed = (len(seq) + num_draft_tokens + self.block_size - 1) // self.block_size
+        return max(0, needed - len(seq.block_table))
+
+    def reserve_slots(self, seq: Sequence, num_draft_tokens: int):
+        """Extend the block table (after may_append) for a speculative step's draft tokens.
+
+        Reserved blocks stay unhashed; commit_slots settles the table once the
+        accepted tokens are known.
+        """
+        for _ in range(self.num_blocks_to_reserve(seq, num_draft_tokens)):
+            block_id = self._take_free_block_id()
+            self._allocate_block(block_id)
+            seq.block_table.append(block_id)
+
+    def commit_slots(self, seq: Sequence):
+        """Settle the block table after a speculative step has appended its tokens.
+
+        Restores the invariant of the regular decode path: the table covers the
+        len(seq) - 1 tokens whose KV has been written (blocks only holding rejected
+        drafts are released) and every full block among them is hashed.
+        """
+        num_written = len(seq) - 1
+        keep = (num_written + self.block_size - 1) // self.block_size
+        while len(seq.block_table) > keep:
+            block_id = seq.block_table.pop()
+            block = self.blocks[block_id]
+            block.ref_count -= 1
+            if block.ref_count == 0:
+                self._deallocate_block(block_id)
+        prefix = -1
+        for i in range(num_written // self.block_size):
+            block = self.blocks[seq.block_table[i]]
+            if block.hash == -1:
+                token_ids = seq.block(i)
+                block.update(self.compute_hash(token_ids, prefix), token_ids)
+                self.hash_to_block_id[block.hash] = block.block_id
+            prefix = block.hash
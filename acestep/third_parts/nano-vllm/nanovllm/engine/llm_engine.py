@@ -1,9 +1,13 @@
+import asyncio
 import atexit
+import os
 import threading
+from collections import deque
 from dataclasses import fields
 from time import perf_counter
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer
+import torch
 import torch.multiprocessing as mp
 
 from nanovllm.config import Config
@@ -11,6 +15,117 @@ from nanovllm.sampling_params import SamplingParams
 from nanovllm.engine.sequence import Sequence
 from nanovllm.engine.scheduler import Scheduler
 from nanovllm.engine.model_runner import ModelRunner
+from nanovllm.engine.speculative import NgramProposer
+
+# Debug logging - enable with NANOVLLM_DEBUG=1
+_DEBUG = os.environ.get("NANOVLLM_DEBUG", "0") == "1"
+
+def _debug_log(msg: str):
+    """Print debug message if NANOVLLM_DEBUG is enabled"""
+    if _DEBUG:
+        print(f"[nanovllm engine DEBUG] {msg}", flush=True)
+
+
+class EngineAbortedError(RuntimeError):
+    """Raised on a request handle whose request was aborted or whose engine shut down."""
+
+
+class RequestHandle:
+    """Handle for a request submitted to the engine loop.
+
+    The request joins the running batch at the next engine step and leaves it as
+    soon as it finishes. Consumers can either block on result() or iterate the
+    handle asynchronously to receive newly generated token ids after every step:
+
+        handle = engine.add_request(prompt, sampling_params)
+        async for new_token_ids in handle:
+            ...
+        output = handle.result()  # {"text": ..., "token_ids": ..., "num_cached_tokens": ...}
+
+    num_cached_tokens counts the prompt tokens (of both halves of a CFG pair)
+    that were served from the prefix cache instead of being prefilled.
+    """
+
+    def __init__(self, engine: "LLMEngine", seq: Sequence):
+        self._engine = engine
+        self.seq_id = seq.seq_id
+        self._seq = seq
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._token_ids: list[int] = []
+        self._output: dict | None = None
+        self._error: BaseException | None = None
+        # (event loop, asyncio.Queue) pairs of async consumers
+        self._listeners: list[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout: float | None = None) -> dict:
+        """Block until the request finishes and return {"text", "token_ids", "num_cached_tokens"}."""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Request {self.seq_id} did not finish within {timeout}s")
+        if self._error is not None:
+            raise self._error
+        return self._output
+
+    def abort(self):
+        """Ask the engine loop to drop this request and release its KV cache blocks."""
+        self._engine.abort_request(self.seq_id)
+
+    def __aiter__(self):
+        return self._stream()
+
+    async def _stream(self):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            backlog = list(self._token_ids)
+            finished = self._done.is_set()
+            if not finished:
+                self._listeners.append((loop, queue))
+        if backlog:
+            yield backlog
+        if finished:
+            if self._error is not None:
+                raise self._error
+            return
+        while True:
+            kind, payload = await queue.get()
+            if kind == "tokens":
+                yield payload
+            elif kind == "error":
+                raise payload
+            else:
+                return
+
+    def _notify(self, kind: str, payload):
+        for loop, queue in self._listeners:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (kind, payload))
+            except RuntimeError:
+                # Consumer's event loop is closed; nothing to deliver to
+                pass
+
+    def _push_token(self, token_id: int):
+        with self._lock:
+            self._token_ids.append(token_id)
+            if self._listeners:
+                self._notify("tokens", [token_id])
+
+    def _finish(self, output: dict):
+        with self._lock:
+            self._output = output
+            self._done.set()
+            self._notify("done", None)
+            self._listeners.clear()
+
+    def _fail(self, error: BaseException):
+        with self._lock:
+            self._error = error
+            self._done.set()
+            self._notify("error", error)
+            self._listeners.clear()
 
 
 class LLMEngine:
@@ -21,15 +136,22 @@ class LLMEngine:
         config = Config(model, **config_kwargs)
         self.ps = []
         self.events = []
-        # Thread-safety lock for generate().
-        # The scheduler, block manager, model runner, and CUDA graph buffers are all
-        # shared mutable state that is NOT thread-safe. In concurrent serving scenarios
-        # (API server with ThreadPoolExecutor, multiple queue workers, Gradio with
-        # concurrent requests), multiple threads can call generate() simultaneously.
-        # Without this lock, concurrent access corrupts scheduler state, block tables,
-        # and CUDA graph input buffers, leading to intermittent CUDA device-side
-        # assertion failures (illegal memory access in KV cache).
-        self._generate_lock = threading.Lock()
+        # Continuous batching: a single background engine loop owns the scheduler,
+        # block manager, model runner and CUDA graph buffers, none of which are
+        # thread-safe. Callers (API server workers, Gradio handlers, ...) only enqueue
+        # requests; new requests join the running decode batch at the next step and
+        # finished ones leave it immediately, instead of each generate() call draining
+        # the engine to completion under a global lock.
+        # _lock guards the scheduler and every step(); _wakeup signals the loop.
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(threading.Lock())
+        self._pending: deque[tuple[RequestHandle, list[Sequence]]] = deque()
+        self._aborts: set[int] = set()
+        self._handles: dict[int, RequestHandle] = {}
+        self._loop_thread: threading.Thread | None = None
+        self._stopping = False
+        self.prefill_throughput = 0.
+        self.decode_throughput = 0.
         ctx = mp.get_context("spawn")
         for i in range(1, config.tensor_parallel_size):
             event = ctx.Event()
@@ -45,15 +167,26 @@ class LLMEngine:
             self.tokenizer = AutoTokenizer.from_pretrained(config.model, use_fast=True)
         config.eos = self.tokenizer.eos_token_id
         self.scheduler = Scheduler(config)
+        self.max_model_len = config.max_model_len
+        self.num_kvcache_blocks = config.num_kvcache_blocks
+        self.proposer = None
+        if config.num_speculative_tokens > 0:
+            self.proposer = NgramProposer(
+                config.num_speculative_tokens,
+                max_ngram=config.speculative_max_ngram,
+                min_ngram=config.speculative_min_ngram,
+                eos=config.eos,
+            )
         atexit.register(self.exit)
 
     def exit(self):
+        self._stop_loop()
         self.model_runner.call("exit")
         del self.model_runner
         for p in self.ps:
             p.join()
 
-    def add_request(self, prompt: str | list[int], sampling_params: SamplingParams, unconditional_prompt: str | list[int] | None = None):
+    def _make_sequences(self, prompt: str | list[int], sampling_params: SamplingParams, unconditional_prompt: str | list[int] | None = None) -> list[Sequence]:
         if isinstance(prompt, str):
             prompt = self.tokenizer.encode(prompt)
         # For CFG: if cfg_scale > 1.0, create both conditional and unconditional sequences
@@ -74,24 +207,272 @@ class LLMEngine:
             # Create conditional sequence with reference to unconditional
             cond_seq = Sequence(prompt, sampling_params, is_unconditional=False, conditional_seq=uncond_seq)
             uncond_seq.paired_seq = cond_seq  # Link them bidirectionally
-            # Add both sequences to scheduler
-            self.scheduler.add(cond_seq)
-            self.scheduler.add(uncond_seq)
+            return [cond_seq, uncond_seq]
+        return [Sequence(prompt, sampling_params)]
+
+    def add_request(self, prompt: str | list[int], sampling_params: SamplingParams, unconditional_prompt: str | list[int] | None = None) -> RequestHandle:
+        """Submit a request to the engine loop and return its handle.
+
+        Thread-safe and non-blocking: the sequence(s) join the running batch at the
+        next engine step. Use RequestHandle.result() to wait for the output or
+        iterate the handle asynchronously to stream token ids.
+
+        Raises:
+            ValueError: if the prompt (both prompts of a CFG pair) needs more KV
+                cache blocks than the whole cache holds, so it could never be scheduled.
+        """
+        seqs = self._make_sequences(prompt, sampling_params, unconditional_prompt)
+        blocks_needed = sum(seq.num_blocks for seq in seqs)
+        if blocks_needed > self.num_kvcache_blocks:
+            prompt_tokens = "+".join(str(len(seq)) for seq in seqs)
+            raise ValueError(
+                f"Prompt needs {blocks_needed} KV cache blocks ({prompt_tokens} tokens, block size "
+                f"{seqs[0].block_size}) but the cache only has {self.num_kvcache_blocks}. "
+                f"Shorten the prompt or raise gpu_memory_utilization."
+            )
+        handle = RequestHandle(self, seqs[0])
+        with self._wakeup:
+            if self._stopping:
+                raise EngineAbortedError("Engine is shutting down")
+            self._pending.append((handle, seqs))
+            self._ensure_loop_started()
+            self._wakeup.notify()
+        return handle
+
+    async def generate_async(
+        self,
+        prompt: str | list[int],
+        sampling_params: SamplingParams,
+        unconditional_prompt: str | list[int] | None = None,
+    ):
+        """Async iterator over a single request.
+
+        Yields lists of newly generated token ids after each engine step. The
+        request is aborted if the consumer stops iterating early.
+        """
+        handle = self.add_request(prompt, sampling_params, unconditional_prompt)
+        try:
+            async for new_token_ids in handle:
+                yield new_token_ids
+        finally:
+            if not handle.done():
+                handle.abort()
+
+    def abort_request(self, seq_id: int):
+        with self._wakeup:
+            self._aborts.add(seq_id)
+            self._wakeup.notify()
+
+    def _ensure_loop_started(self):
+        # Caller holds self._wakeup
+        if self._loop_thread is None or not self._loop_thread.is_alive():
+            self._loop_thread = threading.Thread(target=self._engine_loop, name="nanovllm-engine", daemon=True)
+            self._loop_thread.start()
+
+    def _stop_loop(self):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+            thread = self._loop_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self._fail_all(EngineAbortedError("Engine is shutting down"))
+
+    def _admit_pending(self):
+        """Move submitted requests into the scheduler and apply aborts (holds self._lock)."""
+        with self._wakeup:
+            pending = list(self._pending)
+            self._pending.clear()
+            aborts = set(self._aborts)
+            self._aborts.clear()
+        for handle, seqs in pending:
+            if handle.seq_id in aborts:
+                aborts.discard(handle.seq_id)
+                handle._fail(EngineAbortedError(f"Request {handle.seq_id} was aborted"))
+                continue
+            self._handles[handle.seq_id] = handle
+            for seq in seqs:
+                self.scheduler.add(seq)
+        aborted = False
+        for seq_id in aborts:
+            handle = self._handles.pop(seq_id, None)
+            if handle is None:
+                continue
+            self.scheduler.abort(handle._seq)
+            handle._fail(EngineAbortedError(f"Request {seq_id} was aborted"))
+            aborted = True
+        if aborted:
+            self._retain_sequence_state()
+
+    def _engine_loop(self):
+        while True:
+            with self._wakeup:
+                while not self._stopping and not self._pending and not self._aborts and self.scheduler.is_finished():
+                    self._wakeup.wait()
+                if self._stopping:
+                    return
+            with self._lock:
+                self._admit_pending()
+                if self.scheduler.is_finished():
+                    continue
+                try:
+                    t = perf_counter()
+                    seqs, token_ids, num_tokens, failed = self._step()
+                    elapsed = perf_counter() - t
+                    if num_tokens > 0:
+                        self.prefill_throughput = num_tokens / elapsed
+                    else:
+                        self.decode_throughput = -num_tokens / elapsed
+                except Exception as e:
+                    # Per-request errors (logits processors, unsamplable logits) are
+                    # handled inside the step; anything reaching here is a runner or
+                    # device failure that leaves the whole batch in an unknown state:
+                    # fail every in-flight request and release all blocks.
+                    _debug_log(f"engine step failed: {e!r}")
+                    self._reset_locked()
+                    self._fail_all(e)
+                    continue
+                for seq_id, error in failed.items():
+                    handle = self._handles.pop(seq_id, None)
+                    if handle is not None:
+                        handle._fail(error)
+                self._dispatch(seqs, token_ids)
+
+    def _dispatch(self, seqs: list[Sequence], token_ids: list[int] | list[list[int]]):
+        """Deliver sampled tokens to request handles and complete finished requests.
+
+        token_ids holds one token per sampled sequence, or a list of tokens after
+        a speculative step.
+        """
+        for seq, step_tokens in zip((s for s in seqs if not s.is_unconditional), token_ids):
+            handle = self._handles.get(seq.seq_id)
+            if handle is None:
+                continue
+            for token_id in (step_tokens if isinstance(step_tokens, list) else [step_tokens]):
+                handle._push_token(token_id)
+            if seq.is_finished:
+                del self._handles[seq.seq_id]
+                completion_token_ids = seq.completion_token_ids
+                num_cached_tokens = seq.num_prefix_cached_tokens
+                if seq.cfg_scale > 1.0 and seq.paired_seq is not None:
+                    num_cached_tokens += seq.paired_seq.num_prefix_cached_tokens
+                handle._finish({
+                    "text": self.tokenizer.decode(completion_token_ids),
+                    "token_ids": completion_token_ids,
+                    "num_cached_tokens": num_cached_tokens,
+                })
+
+    def _fail_all(self, error: BaseException):
+        with self._wakeup:
+            pending = list(self._pending)
+            self._pending.clear()
+        handles = list(self._handles.values()) + [handle for handle, _ in pending]
+        self._handles.clear()
+        for handle in handles:
+            handle._fail(error)
+
+    def _step(self):
+        """Run one engine step.
+
+        Returns (seqs, token_ids, num_tokens, failed); failed maps the seq_id of
+        each sequence whose logits processor or sampling failed to its error.
+        Those sequences (with their CFG partners) are already aborted.
+        """
+        seqs, is_prefill = self.scheduler.schedule()
+        drafts = self._propose(seqs) if not is_prefill and self.proposer is not None else None
+        if drafts is not None:
+            token_ids = self.model_runner.call("run_speculative", seqs, drafts)
+            self.scheduler.postprocess(seqs, token_ids, speculative=True)
+            num_tokens = -sum(len(tokens) for tokens in token_ids)
         else:
-            seq = Sequence(prompt, sampling_params)
-            self.scheduler.add(seq)
+            token_ids = self.model_runner.call("run", seqs, is_prefill)
+            self.scheduler.postprocess(seqs, token_ids)
+            num_tokens = sum(len(seq) for seq in seqs) if is_prefill else -len([s for s in seqs if not s.is_unconditional])
+        failed = self.model_runner.take_failed_sequences()
+        for seq in seqs:
+            if seq.seq_id in failed:
+                _debug_log(f"sequence {seq.seq_id} failed: {failed[seq.seq_id]!r}")
+                self.scheduler.abort(seq)
+        if failed or any(seq.is_finished for seq in seqs):
+            self._retain_sequence_state()
+        return seqs, token_ids, num_tokens, failed
+
+    def _retain_sequence_state(self):
+        """Release the runner's per-sequence decode state of finished and aborted sequences."""
+        self.model_runner.retain_sequence_state(
+            {s.seq_id for s in self.scheduler.running} | {s.seq_id for s in self.scheduler.waiting}
+        )
+
+    def _propose(self, seqs: list[Sequence]) -> list[list[int]] | None:
+        """Draft tokens for a decode batch, with KV slots reserved; None if nothing was drafted.
+
+        Sequences whose logits processor cannot evaluate constraints ahead of its
+        state (see MetadataConstrainedLogitsProcessor.speculation_ready) get no
+        drafts, e.g. while the CoT metadata is still being generated.
+        """
+        self.proposer.retain({s.seq_id for s in self.scheduler.running} | {s.seq_id for s in self.scheduler.waiting})
+        drafts = [[] for _ in seqs]
+        for i, seq in enumerate(seqs):
+            if seq.is_unconditional:
+                continue
+            processor = seq.logits_processor
+            if processor is not None and not (
+                hasattr(processor, "process_batch_lookahead") and processor.speculation_ready(seq.seq_id)
+            ):
+                continue
+            room = min(seq.max_tokens - seq.num_completion_tokens, self.max_model_len - len(seq)) - 1
+            if seq.cfg_scale > 1.0 and seq.paired_seq is not None:
+                paired = seq.paired_seq
+                room = min(room, paired.max_tokens - paired.num_completion_tokens - 1, self.max_model_len - len(paired) - 1)
+            drafts[i] = self.proposer.propose(seq, room)
+        if not any(drafts):
+            return None
+        drafts = self.scheduler.reserve_draft_slots(seqs, drafts)
+        return drafts if any(drafts) else None
 
     def step(self):
-        seqs, is_prefill = self.scheduler.schedule()
-        token_ids = self.model_runner.call("run", seqs, is_prefill)
-        self.scheduler.postprocess(seqs, token_ids)
+        with self._lock:
+            seqs, _, num_tokens, failed = self._step()
         # Only output conditional sequences (unconditional sequences are just for CFG computation)
-        output_seqs = [seq for seq in seqs if seq.is_finished and (seq.cfg_scale <= 1.0 or not seq.is_unconditional)]
+        output_seqs = [
+            seq for seq in seqs
+            if seq.is_finished and (seq.cfg_scale <= 1.0 or not seq.is_unconditional) and seq.seq_id not in failed
+        ]
         outputs = [(seq.seq_id, seq.completion_token_ids) for seq in output_seqs]
-        num_tokens = sum(len(seq) for seq in seqs) if is_prefill else -len([s for s in seqs if not s.is_unconditional])
         return outputs, num_tokens
 
+    def score(
+        self,
+        sequences: list[str] | list[list[int]],
+        target_starts: int | list[int] = 1,
+        return_logits: bool = False,
+    ) -> list[torch.Tensor]:
+        """Teacher-forced log-probs (or logits) for given sequences, using the resident weights.
+
+        Prefill-only: nothing is sampled and nothing is written to the KV cache. For
+        sequence i the result covers tokens [target_starts[i]:], see ModelRunner.score.
+        Runs between engine steps (under the engine lock), so it is safe to call
+        while other requests are being generated.
+        """
+        token_ids = [self.tokenizer.encode(seq) if isinstance(seq, str) else list(seq) for seq in sequences]
+        if isinstance(target_starts, int):
+            target_starts = [target_starts] * len(token_ids)
+        # Sequences without target tokens get an empty result
+        results = [torch.empty(0) for _ in token_ids]
+        rows = [i for i, (ids, start) in enumerate(zip(token_ids, target_starts)) if len(ids) > max(1, start)]
+        if rows:
+            with self._lock:
+                scored = self.model_runner.call(
+                    "score", [token_ids[i] for i in rows], [target_starts[i] for i in rows], return_logits
+                )
+            for i, value in zip(rows, scored):
+                results[i] = value
+        return results
+
     def is_finished(self):
+        with self._wakeup:
+            if self._pending:
+                return False
         return self.scheduler.is_finished()
 
     def reset(self):
@@ -99,7 +480,13 @@ class LLMEngine:
         Reset the scheduler state and release all allocated blocks.
         This should be called when an exception occurs during generation to prevent
         KV cache block leaks that can cause 'deque index out of range' errors.
+        Any request still in flight is failed with EngineAbortedError.
         """
+        with self._lock:
+            self._reset_locked()
+            self._fail_all(EngineAbortedError("Engine was reset"))
+
+    def _reset_locked(self):
         # Deallocate all running sequences
         while self.scheduler.running:
             seq = self.scheduler.running.popleft()
@@ -112,6 +499,10 @@ class LLMEngine:
             if seq.block_table:
                 self.scheduler.block_manager.deallocate(seq)
 
+        # A failed step may have left hashed blocks without their KV written
+        self.scheduler.block_manager.clear_prefix_cache()
+        self._retain_sequence_state()
+
     def generate(
         self,
         prompts: list[str] | list[list[int]],
@@ -119,60 +510,40 @@ class LLMEngine:
         use_tqdm: bool = True,
         unconditional_prompts: list[str] | list[list[int]] | None = None,
     ) -> list[str]:
-        # Serialize access to the engine to prevent concurrent corruption of
-        # scheduler state, block manager, CUDA graph buffers, and KV cache.
-        # This is the primary defense against the intermittent CUDA device-side
-        # assertion error that occurs in concurrent serving scenarios.
-        with self._generate_lock:
-            return self._generate_impl(prompts, sampling_params, use_tqdm, unconditional_prompts)
-
-    def _generate_impl(
-        self,
-        prompts: list[str] | list[list[int]],
-        sampling_params: SamplingParams | list[SamplingParams],
-        use_tqdm: bool = True,
-        unconditional_prompts: list[str] | list[list[int]] | None = None,
-    ) -> list[str]:
-        # Clean up any residual state from previous interrupted generations
-        # This prevents 'deque index out of range' errors from accumulated block leaks
-        if not self.is_finished():
-            self.reset()
-        
-        if use_tqdm:
-            pbar = tqdm(total=len(prompts), desc="Generating", dynamic_ncols=True)
+        """Blocking batch generation on top of the engine loop.
+
+        The prompts are submitted as independent requests and may share decode
+        steps with requests from other threads.
+        """
         if not isinstance(sampling_params, list):
             sampling_params = [sampling_params] * len(prompts)
         if unconditional_prompts is None:
             unconditional_prompts = [None] * len(prompts)
-        for prompt, sp, uncond_prompt in zip(prompts, sampling_params, unconditional_prompts):
-            self.add_request(prompt, sp, uncond_prompt)
-        outputs = {}
-        prefill_throughput = decode_throughput = 0.
+        handles = []
+        pbar = None
+        outputs = []
         try:
-            while not self.is_finished():
-                t = perf_counter()
-                output, num_tokens = self.step()
-                if use_tqdm:
-                    if num_tokens > 0:
-                        prefill_throughput = num_tokens / (perf_counter() - t)
-                    else:
-                        decode_throughput = -num_tokens / (perf_counter() - t)
+            # add_request raises for a prompt the KV cache can never hold; the
+            # requests submitted before it are aborted below
+            for prompt, sp, uncond_prompt in zip(prompts, sampling_params, unconditional_prompts):
+                handles.append(self.add_request(prompt, sp, uncond_prompt))
+            if use_tqdm:
+                pbar = tqdm(total=len(prompts), desc="Generating", dynamic_ncols=True)
+            for handle in handles:
+                outputs.append(handle.result())
+                if pbar is not None:
                     pbar.set_postfix({
-                        "Prefill": f"{int(prefill_throughput)}tok/s",
-                        "Decode": f"{int(decode_throughput)}tok/s",
+                        "Prefill": f"{int(self.prefill_throughput)}tok/s",
+                        "Decode": f"{int(self.decode_throughput)}tok/s",
                     })
-                for seq_id, token_ids in output:
-                    outputs[seq_id] = token_ids
-                    if use_tqdm:
-                        pbar.update(1)
-        except Exception:
-            # Clean up on exception to prevent block leaks
-            self.reset()
+                    pbar.update(1)
+        except BaseException:
+            # Don't leave the remaining requests of this batch running
+            for handle in handles:
+                if not handle.done():
+                    handle.abort()
             raise
         finally:
-            if use_tqdm:
+            if pbar is not None:
                 pbar.close()
-        
-        outputs = [outputs[seq_id] for seq_id in sorted(outputs.keys())]
-        outputs = [{"text": self.tokenizer.decode(token_ids), "token_ids": token_ids} for token_ids in outputs]
         return outputs
@@ -18,6 +18,8 @@ def _debug_log(msg: str):
         print(f"[nanovllm DEBUG] {msg}", flush=True)
 from nanovllm.engine.sequence import Sequence
 from nanovllm.models.qwen3 import Qwen3ForCausalLM
+from nanovllm.layers.linear import LinearBase
+from nanovllm.layers.quantization import KV_CACHE_DTYPES, QuantConfig, read_quant_config
 from nanovllm.layers.sampler import Sampler
 from nanovllm.utils.context import set_context, get_context, reset_context
 from nanovllm.utils.loader import load_model
@@ -64,12 +66,17 @@ class ModelRunner:
         self.world_size = config.tensor_parallel_size
         self.rank = rank
         self.event = event
+        self.use_cuda = config.device == "cuda"
+        self.device = torch.device("cuda", rank) if self.use_cuda else torch.device("cpu")
+        # Pinned host buffers only pay off for async H2D copies
+        self.pin_memory = self.use_cuda
         dist_port = find_available_port()
         print(f"[debug]dist_port: {dist_port}")
-        # Use gloo backend on Windows, nccl on Linux/other platforms
-        backend = "gloo" if sys.platform == "win32" else "nccl"
+        # Use gloo backend on Windows and for CPU execution, nccl on Linux/other platforms
+        backend = "gloo" if sys.platform == "win32" or not self.use_cuda else "nccl"
         dist.init_process_group(backend, f"tcp://127.0.0.1:{dist_port}", world_size=self.world_size, rank=rank)
-        torch.cuda.set_device(rank)
+        if self.use_cuda:
+            torch.cuda.set_device(rank)
         default_dtype = torch.get_default_dtype()
         # Use dtype instead of deprecated torch_dtype
         config_dtype = getattr(hf_config, 'dtype', getattr(hf_config, 'torch_dtype', torch.bfloat16))
@@ -95,13 +102,36 @@ class ModelRunner:
             # If not a valid floating-point torch dtype, default to bfloat16
             config_dtype = torch.bfloat16
 
+        if not self.use_cuda:
+            # Same policy as LLMHandler: float32 on CPU (bf16 matmuls are slow without AMX/AVX512-BF16)
+            config_dtype = torch.float32
+
         self.dtype = config_dtype  # Save for later use
+        self.kv_cache_dtype = KV_CACHE_DTYPES.get(config.kv_cache_dtype, config_dtype)
+        if config.kv_cache_dtype == "fp8" and self.use_cuda and torch.cuda.get_device_capability(rank) < (8, 9):
+            # The Triton kernels need native fp8 conversions
+            print("[nanovllm] fp8 KV cache needs compute capability 8.9+, using int8 instead")
+            self.kv_cache_dtype = torch.int8
+        self.kv_cache_quantized = self.kv_cache_dtype != config_dtype
         torch.set_default_dtype(config_dtype)
-        torch.set_default_device("cuda")
-        self.model = Qwen3ForCausalLM(hf_config)
+        torch.set_default_device(self.device.type)
+        quant_config = None
+        if config.quantization is not None:
+            quant_config = QuantConfig(
+                config.quantization,
+                config.quantization_group_size,
+                prequantized=read_quant_config(config.model) is not None,
+            )
+        self.model = Qwen3ForCausalLM(hf_config, quant_config)
         _t0 = debug_start("load_model", prefix="tensor.vllm")
         load_model(self.model, config.model)
         debug_end("load_model", _t0, prefix="tensor.vllm")
+        if quant_config is not None and not quant_config.prequantized:
+            _t0 = debug_start("quantize_model", prefix="tensor.vllm")
+            for module in self.model.modules():
+                if isinstance(module, LinearBase):
+                    module.quantize_weight(self.device)
+            debug_end("quantize_model", _t0, prefix="tensor.vllm")
         self.sampler = Sampler()
         
         # Pre-allocate buffers for sampling (optimization: avoid repeated tensor creation)
@@ -132,32 +162,46 @@ class ModelRunner:
         max_tokens = self.config.max_num_batched_tokens
         max_num_blocks = (self.config.max_model_len + self.block_size - 1) // self.block_size
         
-        # Pre-allocate pinned memory buffers on CPU for fast transfer
+        # Pre-allocate pinned memory buffers on CPU for fast transfer (pageable on the CPU runner)
         # Must explicitly specify device="cpu" since default device may be "cuda"
-        self._cpu_temperatures = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=True)
-        self._cpu_cfg_scales = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=True)
-        self._cpu_top_ks = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=True)
-        self._cpu_top_ps = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=True)
-        self._cpu_repetition_penalties = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=True)
+        self._cpu_temperatures = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_cfg_scales = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_top_ks = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_top_ps = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_repetition_penalties = torch.zeros(max_bs, dtype=torch.float32, device="cpu", pin_memory=self.pin_memory)
         
         # Pre-allocate decode buffers on CPU with pinned memory
-        self._cpu_input_ids = torch.zeros(max_bs, dtype=torch.int64, device="cpu", pin_memory=True)
-        self._cpu_positions = torch.zeros(max_bs, dtype=torch.int64, device="cpu", pin_memory=True)
-        self._cpu_slot_mapping = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=True)
-        self._cpu_context_lens = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=True)
+        self._cpu_input_ids = torch.zeros(max_bs, dtype=torch.int64, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_positions = torch.zeros(max_bs, dtype=torch.int64, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_slot_mapping = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_context_lens = torch.zeros(max_bs, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
         
         # Pre-allocate prefill buffers on CPU with pinned memory (optimization to avoid repeated tensor creation)
-        self._cpu_prefill_input_ids = torch.zeros(max_tokens, dtype=torch.int64, device="cpu", pin_memory=True)
-        self._cpu_prefill_positions = torch.zeros(max_tokens, dtype=torch.int64, device="cpu", pin_memory=True)
-        self._cpu_prefill_cu_seqlens = torch.zeros(max_bs + 1, dtype=torch.int32, device="cpu", pin_memory=True)
-        self._cpu_prefill_slot_mapping = torch.zeros(max_tokens, dtype=torch.int32, device="cpu", pin_memory=True)
+        self._cpu_prefill_input_ids = torch.zeros(max_tokens, dtype=torch.int64, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_prefill_positions = torch.zeros(max_tokens, dtype=torch.int64, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_prefill_cu_seqlens = torch.zeros(max_bs + 1, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
+        self._cpu_prefill_slot_mapping = torch.zeros(max_tokens, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
         
         # Pre-allocate block tables buffer (shared by both decode and prefill)
-        self._cpu_block_tables = torch.zeros(max_bs, max_num_blocks, dtype=torch.int32, device="cpu", pin_memory=True)
+        self._cpu_block_tables = torch.zeros(max_bs, max_num_blocks, dtype=torch.int32, device="cpu", pin_memory=self.pin_memory)
+        
+        # Per-sequence decode state kept on device across steps (rank 0 only):
+        # completion-token counts for repetition penalty, one row per penalized sequence,
+        # and token histories for logits processors that take HF-style input_ids.
+        # Both are updated with the sampled token each step instead of being rebuilt
+        # from the Python token lists.
+        self._token_counts: torch.Tensor | None = None  # [rows, vocab] int32
+        self._token_count_rows: dict[int, int] = {}  # seq_id -> row in _token_counts
+        self._free_token_count_rows: list[int] = []
+        self._token_histories: dict[int, list] = {}  # seq_id -> [buffer[max_model_len], length]
+        # Sequences whose logits processor raised or whose logits had no samplable
+        # token in the last step (seq_id -> error); collected by the engine, which
+        # aborts just those requests (see take_failed_sequences)
+        self._failed_seqs: dict[int, BaseException] = {}
         
         # Pre-allocate buffer for sequence token IDs (used in logits processor and sampler)
         # Max length is max_model_len since sequences can be that long
-        self._seq_token_ids_buffer = torch.zeros(max_bs, self.config.max_model_len, dtype=torch.int64, device="cpu", pin_memory=True)
+        self._seq_token_ids_buffer = torch.zeros(max_bs, self.config.max_model_len, dtype=torch.int64, device="cpu", pin_memory=self.pin_memory)
         debug_end("_allocate_sample_buffers", _t0, prefix="tensor.vllm")
 
     def exit(self):
@@ -168,7 +212,8 @@ class ModelRunner:
                 self.shm.unlink()
         if not self.enforce_eager:
             del self.graphs, self.graph_pool
-        torch.cuda.synchronize()
+        if self.use_cuda:
+            torch.cuda.synchronize()
         dist.destroy_process_group()
 
     def loop(self):
@@ -203,24 +248,33 @@ class ModelRunner:
 
     def warmup_model(self):
         _t0 = debug_start("warmup_model", prefix="tensor.vllm")
-        torch.cuda.empty_cache()
-        torch.cuda.reset_peak_memory_stats()
+        if self.use_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
         max_num_batched_tokens, max_model_len = self.config.max_num_batched_tokens, self.config.max_model_len
         num_seqs = min(max_num_batched_tokens // max_model_len, self.config.max_num_seqs)
         seqs = [Sequence([0] * max_model_len) for _ in range(num_seqs)]
         self.run(seqs, True)
-        torch.cuda.empty_cache()
+        if self.use_cuda:
+            torch.cuda.empty_cache()
         debug_end("warmup_model", _t0, prefix="tensor.vllm")
 
     def allocate_kv_cache(self):
         _t0 = debug_start("allocate_kv_cache", prefix="tensor.vllm")
         config = self.config
         hf_config = config.hf_config
-        free, total = torch.cuda.mem_get_info()
-        current = torch.cuda.memory_stats()["allocated_bytes.all.current"]
         num_kv_heads = hf_config.num_key_value_heads // self.world_size
         head_dim = getattr(hf_config, "head_dim", hf_config.hidden_size // hf_config.num_attention_heads)
-        block_bytes = 2 * hf_config.num_hidden_layers * self.block_size * num_kv_heads * head_dim * self.dtype.itemsize
+        token_bytes = head_dim * self.kv_cache_dtype.itemsize
+        if self.kv_cache_quantized:
+            token_bytes += torch.float32.itemsize  # per-head scale
+        block_bytes = 2 * hf_config.num_hidden_layers * self.block_size * num_kv_heads * token_bytes
+        if not self.use_cuda:
+            self._allocate_cpu_kv_cache(block_bytes, num_kv_heads, head_dim)
+            debug_end("allocate_kv_cache", _t0, prefix="tensor.vllm")
+            return
+        free, total = torch.cuda.mem_get_info()
+        current = torch.cuda.memory_stats()["allocated_bytes.all.current"]
         
         # Calculate available memory for KV cache
         # After warmup_model, empty_cache has been called, so current represents model memory only
@@ -246,22 +300,46 @@ class ModelRunner:
             f"[nanovllm] KV cache allocated: {config.num_kvcache_blocks} blocks × {self.block_size} tokens = "
             f"{max_tokens_capacity} tokens capacity, {kv_cache_size_gb:.2f} GB "
             f"(free: {free / 1024**3:.2f} GB, used: {current / 1024**3:.2f} GB, "
-            f"target: {target_total_usage / 1024**3:.2f} GB, block: {block_bytes / 1024**2:.2f} MB)"
+            f"target: {target_total_usage / 1024**3:.2f} GB, block: {block_bytes / 1024**2:.2f} MB, "
+            f"dtype: {str(self.kv_cache_dtype).removeprefix('torch.')})"
+        )
+        self._bind_kv_cache(num_kv_heads, head_dim)
+        debug_end("allocate_kv_cache", _t0, prefix="tensor.vllm")
+
+    def _allocate_cpu_kv_cache(self, block_bytes: int, num_kv_heads: int, head_dim: int):
+        """Size the KV cache from config.cpu_kvcache_gb, capped at what max_num_seqs full-length sequences need."""
+        config = self.config
+        blocks_per_seq = (config.max_model_len + self.block_size - 1) // self.block_size
+        budget_blocks = int(config.cpu_kvcache_gb * 1024**3) // block_bytes
+        config.num_kvcache_blocks = max(blocks_per_seq, min(budget_blocks, config.max_num_seqs * blocks_per_seq))
+        print(
+            f"[nanovllm] CPU KV cache allocated: {config.num_kvcache_blocks} blocks × {self.block_size} tokens = "
+            f"{config.num_kvcache_blocks * self.block_size} tokens capacity, "
+            f"{config.num_kvcache_blocks * block_bytes / 1024**3:.2f} GB (budget: {config.cpu_kvcache_gb:.2f} GB)"
         )
-        self.kv_cache = torch.empty(2, hf_config.num_hidden_layers, config.num_kvcache_blocks, self.block_size, num_kv_heads, head_dim)
+        self._bind_kv_cache(num_kv_heads, head_dim)
+
+    def _bind_kv_cache(self, num_kv_heads: int, head_dim: int):
+        config = self.config
+        hf_config = config.hf_config
+        shape = (2, hf_config.num_hidden_layers, config.num_kvcache_blocks, self.block_size, num_kv_heads)
+        self.kv_cache = torch.empty(*shape, head_dim, dtype=self.kv_cache_dtype)
+        self.kv_scales = torch.empty(*shape, dtype=torch.float32) if self.kv_cache_quantized else None
         layer_id = 0
         for module in self.model.modules():
             if hasattr(module, "k_cache") and hasattr(module, "v_cache"):
                 module.k_cache = self.kv_cache[0, layer_id]
                 module.v_cache = self.kv_cache[1, layer_id]
+                if self.kv_scales is not None:
+                    module.k_scale = self.kv_scales[0, layer_id]
+                    module.v_scale = self.kv_scales[1, layer_id]
                 layer_id += 1
-        debug_end("allocate_kv_cache", _t0, prefix="tensor.vllm")
 
     def prepare_block_tables(self, seqs: list[Sequence]):
         _t0 = debug_start("prepare_block_tables", prefix="tensor.vllm")
         max_len = max(len(seq.block_table) for seq in seqs)
         block_tables = [seq.block_table + [-1] * (max_len - len(seq.block_table)) for seq in seqs]
-        block_tables = torch.tensor(block_tables, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
+        block_tables = torch.tensor(block_tables, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
         debug_end("prepare_block_tables", _t0, prefix="tensor.vllm")
         return block_tables
 
@@ -296,11 +374,11 @@ class ModelRunner:
                 slot_mapping.extend(list(range(start, end)))
         if cu_seqlens_k[-1] > cu_seqlens_q[-1]:    # prefix cache
             block_tables = self.prepare_block_tables(seqs)
-        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        cu_seqlens_q = torch.tensor(cu_seqlens_q, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        cu_seqlens_k = torch.tensor(cu_seqlens_k, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        slot_mapping = torch.tensor(slot_mapping, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
+        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        cu_seqlens_q = torch.tensor(cu_seqlens_q, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        cu_seqlens_k = torch.tensor(cu_seqlens_k, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        slot_mapping = torch.tensor(slot_mapping, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
         set_context(True, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, slot_mapping, None, block_tables)
         debug_end("prepare_prefill", _t0, prefix="tensor.vllm")
         return input_ids, positions
@@ -318,24 +396,25 @@ class ModelRunner:
             self._cpu_slot_mapping[i] = seq.block_table[-1] * self.block_size + seq.last_block_num_tokens - 1
         
         # Transfer to GPU using sliced views
-        input_ids = self._cpu_input_ids[:bs].cuda(non_blocking=True)
-        positions = self._cpu_positions[:bs].cuda(non_blocking=True)
-        slot_mapping = self._cpu_slot_mapping[:bs].cuda(non_blocking=True)
-        context_lens = self._cpu_context_lens[:bs].cuda(non_blocking=True)
+        input_ids = self._cpu_input_ids[:bs].to(self.device, non_blocking=True)
+        positions = self._cpu_positions[:bs].to(self.device, non_blocking=True)
+        slot_mapping = self._cpu_slot_mapping[:bs].to(self.device, non_blocking=True)
+        context_lens = self._cpu_context_lens[:bs].to(self.device, non_blocking=True)
         block_tables = self.prepare_block_tables(seqs)
         set_context(False, slot_mapping=slot_mapping, context_lens=context_lens, block_tables=block_tables)
         debug_end("prepare_decode", _t0, prefix="tensor.vllm")
         return input_ids, positions
 
-    def prepare_sample(self, seqs: list[Sequence], is_cfg_batch: bool = False):
-        """Optimized sample preparation using pre-allocated buffers."""
+    def prepare_sample(self, seqs: list[Sequence]):
+        """Optimized sample preparation using pre-allocated buffers.
+
+        Only sampled rows are filled: plain and CFG-conditional sequences. The
+        unconditional halves of CFG pairs sit at the tail of the batch and share
+        the token sampled for their conditional partner.
+        """
         _t0 = debug_start("prepare_sample", prefix="tensor.vllm")
-        if is_cfg_batch:
-            num_seqs = len(seqs) // 2
-            target_seqs = seqs[:num_seqs]
-        else:
-            num_seqs = len(seqs)
-            target_seqs = seqs
+        target_seqs = [seq for seq in seqs if not seq.is_unconditional]
+        num_seqs = len(target_seqs)
         
         # Fill pre-allocated CPU buffers
         top_ks_is_zero = True
@@ -348,18 +427,18 @@ class ModelRunner:
             if seq.top_k is not None and seq.top_k > 0:
                 top_ks_is_zero = False
             self._cpu_top_ps[i] = seq.top_p if seq.top_p is not None else 1.0
-            if seq.top_p is not None and seq.top_p == 1.0:
+            if seq.top_p is not None and seq.top_p < 1.0:
                 top_ps_is_one = False
             self._cpu_repetition_penalties[i] = seq.repetition_penalty if seq.repetition_penalty is not None else 1.0
-            if seq.repetition_penalty is not None and seq.repetition_penalty == 1.0:
+            if seq.repetition_penalty is not None and seq.repetition_penalty != 1.0:
                 repetition_penalties_is_one = False
         
         # Transfer to GPU using sliced views (single batched transfer)
-        temperatures = self._cpu_temperatures[:num_seqs].cuda(non_blocking=True)
-        cfg_scales = self._cpu_cfg_scales[:num_seqs].cuda(non_blocking=True)
-        top_ks = self._cpu_top_ks[:num_seqs].cuda(non_blocking=True) if not top_ks_is_zero else None
-        top_ps = self._cpu_top_ps[:num_seqs].cuda(non_blocking=True) if not top_ps_is_one else None
-        repetition_penalties = self._cpu_repetition_penalties[:num_seqs].cuda(non_blocking=True) if not repetition_penalties_is_one else None
+        temperatures = self._cpu_temperatures[:num_seqs].to(self.device, non_blocking=True)
+        cfg_scales = self._cpu_cfg_scales[:num_seqs].to(self.device, non_blocking=True)
+        top_ks = self._cpu_top_ks[:num_seqs].to(self.device, non_blocking=True) if not top_ks_is_zero else None
+        top_ps = self._cpu_top_ps[:num_seqs].to(self.device, non_blocking=True) if not top_ps_is_one else None
+        repetition_penalties = self._cpu_repetition_penalties[:num_seqs].to(self.device, non_blocking=True) if not repetition_penalties_is_one else None
         
         debug_end("prepare_sample", _t0, prefix="tensor.vllm")
         return temperatures, cfg_scales, top_ks, top_ps, repetition_penalties
@@ -439,166 +518,536 @@ class ModelRunner:
             return out
 
     def run(self, seqs: list[Sequence], is_prefill: bool) -> list[int]:
-        """Run model forward and sampling. For CFG sequences, batch is structured as:
-        [cond_seq1, cond_seq2, ..., uncond_seq1, uncond_seq2, ...]
-        where uncond_seqi is the paired unconditional sequence of cond_seqi."""
+        """Run model forward and sampling.
+
+        The scheduler lays the batch out as
+        [plain_seq..., cond_seq1, cond_seq2, ..., uncond_seq1, uncond_seq2, ...]
+        where uncond_seqi is the paired unconditional sequence of cond_seqi. With
+        continuous batching a single step can mix requests with and without CFG,
+        so the split is derived from the sequences rather than from seqs[0].
+
+        Returns one token per sampled row (plain + conditional sequences); the
+        scheduler applies each conditional token to its unconditional partner.
+        """
         _debug_log(f"run: num_seqs={len(seqs)}, is_prefill={is_prefill}")
         for i, seq in enumerate(seqs):
             _debug_log(f"  seq[{i}]: len={len(seq)}, num_blocks={seq.num_blocks}, "
                       f"cfg_scale={seq.cfg_scale}, is_uncond={seq.is_unconditional}, "
                       f"block_table={seq.block_table}")
         
-        # Check if this is a CFG batch (contains paired conditional and unconditional sequences)
-        is_cfg_batch = seqs[0].cfg_scale > 1.0 and seqs[0].paired_seq is not None
-        _debug_log(f"  is_cfg_batch={is_cfg_batch}")
-        if is_cfg_batch:
-            # CFG batch: seqs = [cond_seq1, cond_seq2, ..., uncond_seq1, uncond_seq2, ...]
-            num_cond = len(seqs) // 2
-            cond_seqs = seqs[:num_cond]
-            # uncond_seqs = seqs[num_cond:]
-            
-            # Prepare inputs for both conditional and unconditional (they're already in the batch)
-            input_ids, positions = (self.prepare_prefill(seqs) if is_prefill else self.prepare_decode(seqs))
-            sample_params = self.prepare_sample(seqs, is_cfg_batch=True) if self.rank == 0 else None
-            if sample_params is not None:
-                temperatures, cfg_scales, top_ks, top_ps, repetition_penalties = sample_params
-            else:
-                temperatures = cfg_scales = top_ks = top_ps = repetition_penalties = None
-            
-            # Run model forward (processes entire batch: cond + uncond)
-            logits_all = self.run_model(input_ids, positions, is_prefill)
-            reset_context()
-            
-            if self.rank == 0:
-                # Split logits: first half is conditional, second half is unconditional
-                logits_cond = logits_all[:num_cond]
-                logits_uncond = logits_all[num_cond:]
-                
-                # Apply repetition penalty to conditional logits (before CFG)
-                if repetition_penalties is not None:
-                    for i, seq in enumerate(cond_seqs):
-                        penalty = repetition_penalties[i].item()
-                        if penalty != 1.0:
-                            # Only penalize completion tokens (not prompt tokens)
-                            completion_tokens = torch.tensor(seq.completion_token_ids, device=logits_cond.device)
-                            if len(completion_tokens) > 0:
-                                # Create token mask: mark tokens that appeared in completion
-                                token_mask = torch.zeros(logits_cond.shape[1], dtype=torch.bool, device=logits_cond.device)
-                                token_mask[completion_tokens] = True
-                                
-                                # Apply standard repetition penalty formula (matching transformers implementation):
-                                # For tokens in completion: if score < 0 then score * penalty, else score / penalty
-                                penalty_scores = torch.where(
-                                    logits_cond[i] < 0,
-                                    logits_cond[i] * penalty,
-                                    logits_cond[i] / penalty
-                                )
-                                # Only apply penalty to tokens that appeared in completion
-                                logits_cond[i] = torch.where(token_mask, penalty_scores, logits_cond[i])
-                
-                # Apply CFG formula: logits_cfg = logits_uncond + cfg_scale * (logits_cond - logits_uncond)
-                cfg_scales_tensor = cfg_scales.unsqueeze(1)  # [num_cond, 1]
-                logits_cfg = logits_uncond + cfg_scales_tensor * (logits_cond - logits_uncond)
-                
-                # Apply logits processor for constrained decoding (if any sequence has one)
-                for i, seq in enumerate(cond_seqs):
-                    if seq.logits_processor is not None:
-                        # Create input_ids tensor for this sequence
-                        seq_input_ids = torch.tensor([seq.token_ids], device=logits_cfg.device)
-                        # Apply processor to this sequence's logits
-                        logits_cfg[i:i+1] = seq.logits_processor(seq_input_ids, logits_cfg[i:i+1])
-                
-                # Prepare input_ids for sampler (for repetition penalty, though we already applied it)
-                # cond_input_ids = torch.tensor([seq.token_ids for seq in cond_seqs], device=logits_cfg.device)
-                
-                # Sample from CFG logits
-                token_ids_cfg = self.sampler(
-                    logits_cfg, 
-                    temperatures,
-                    top_ks=top_ks if top_ks is not None else None,
-                    top_ps=top_ps if top_ps is not None else None,
-                    repetition_penalties=None,  # Already applied above
-                    # input_ids=cond_input_ids,
-                ).tolist()
-                
-                # Update logits processor state after sampling
-                # NOTE: Only update for the first sequence since all sequences share the same processor
-                # Updating multiple times would cause duplicate state updates (e.g., codes_count += N instead of += 1)
-                if cond_seqs and cond_seqs[0].logits_processor_update_state is not None:
-                    cond_seqs[0].logits_processor_update_state(token_ids_cfg[0])
-                
-                # Return token_ids (will be applied to both conditional and unconditional sequences)
-                return token_ids_cfg
-            else:
-                return None
+        num_uncond = sum(1 for seq in seqs if seq.is_unconditional)
+        num_sample = len(seqs) - num_uncond
+        num_plain = num_sample - num_uncond
+        sample_seqs = seqs[:num_sample]
+        _debug_log(f"  num_plain={num_plain}, num_cfg_pairs={num_uncond}")
+        
+        # Prepare inputs for the whole batch (plain + cond + uncond)
+        input_ids, positions = (self.prepare_prefill(seqs) if is_prefill else self.prepare_decode(seqs))
+        sample_params = self.prepare_sample(seqs) if self.rank == 0 else None
+        if sample_params is not None:
+            temperatures, cfg_scales, top_ks, top_ps, repetition_penalties = sample_params
         else:
-            # Normal batch (non-CFG)
-            input_ids, positions = (self.prepare_prefill(seqs) if is_prefill 
-                                   else self.prepare_decode(seqs))
-            sample_params = self.prepare_sample(seqs, is_cfg_batch=False) if self.rank == 0 else None
-            if sample_params is not None:
-                temperatures, cfg_scales, top_ks, top_ps, repetition_penalties = sample_params
-            else:
-                temperatures = cfg_scales = top_ks = top_ps = repetition_penalties = None
-            logits = self.run_model(input_ids, positions, is_prefill)
+            temperatures = cfg_scales = top_ks = top_ps = repetition_penalties = None
+        
+        logits_all = self.run_model(input_ids, positions, is_prefill)
+        reset_context()
+        
+        if self.rank != 0:
+            return None
+        
+        # Clone logits to avoid in-place update issues in inference mode
+        logits = logits_all[:num_sample].clone()
+        
+        # Apply repetition penalty to sampled rows (before CFG for conditional rows).
+        # Standard formula (matching transformers) on tokens seen in the completion:
+        # score * penalty if score < 0 else score / penalty - one batched op for all rows.
+        penalty_rows = [i for i, seq in enumerate(sample_seqs)
+                        if seq.repetition_penalty is not None and seq.repetition_penalty != 1.0]
+        count_rows = None
+        if penalty_rows and repetition_penalties is not None:
+            count_rows = self._get_token_count_rows([sample_seqs[i] for i in penalty_rows], logits.shape[1], logits.device)
+            row_index = torch.tensor(penalty_rows, device=logits.device, dtype=torch.long)
+            seen = self._token_counts[count_rows] > 0
+            rows_logits = logits[row_index]
+            penalty = repetition_penalties[row_index].unsqueeze(1).to(rows_logits.dtype)
+            penalized = torch.where(rows_logits < 0, rows_logits * penalty, rows_logits / penalty)
+            logits[row_index] = torch.where(seen, penalized, rows_logits)
+        
+        # Apply CFG formula to the conditional rows:
+        # logits_cfg = logits_uncond + cfg_scale * (logits_cond - logits_uncond)
+        if num_uncond > 0:
+            logits_cond = logits[num_plain:]
+            logits_uncond = logits_all[num_sample:]
+            cfg_scales_tensor = cfg_scales[num_plain:].unsqueeze(1)  # [num_cond, 1]
+            logits[num_plain:] = logits_uncond + cfg_scales_tensor * (logits_cond - logits_uncond)
+        
+        # Apply logits processor for constrained decoding (if any sequence has one).
+        # Processors that implement the batched protocol (process_batch/update_state_batch)
+        # keep FSM state per seq_id and are applied once to all of their rows; other
+        # processors are applied row by row.
+        # A processor that raises only fails its own sequences (the engine aborts them);
+        # their rows are sampled unconstrained so the rest of the batch can proceed.
+        batch_processors = {}  # id(processor) -> (processor, row indices)
+        failed = {}
+        for i, seq in enumerate(sample_seqs):
+            processor = seq.logits_processor
+            if processor is None:
+                continue
+            if hasattr(processor, "process_batch") and hasattr(processor, "update_state_batch"):
+                batch_processors.setdefault(id(processor), (processor, []))[1].append(i)
+                continue
+            try:
+                # HF-style processors get a [1, seq_len] view of the on-device history
+                seq_input_ids = self._get_token_history(seq, logits.device)
+                # Apply processor to this sequence's logits (clone to avoid inference mode issues)
+                processed = processor(seq_input_ids, logits[i:i+1].clone())
+                logits[i] = processed[0]
+            except Exception as e:
+                failed[seq.seq_id] = e
+        for processor, rows in batch_processors.values():
+            row_index = torch.tensor(rows, device=logits.device, dtype=torch.long)
+            try:
+                logits[row_index] = processor.process_batch(
+                    [sample_seqs[i].seq_id for i in rows],
+                    [sample_seqs[i].token_ids for i in rows],
+                    logits[row_index],
+                )
+            except Exception as e:
+                for i in rows:
+                    failed[sample_seqs[i].seq_id] = e
+        unsamplable = self._mask_unsamplable_rows(logits)
+        
+        sampled = self.sampler(
+            logits,
+            temperatures,
+            top_ks=top_ks if top_ks is not None else None,
+            top_ps=top_ps if top_ps is not None else None,
+            repetition_penalties=None,  # Already applied above
+        )
+        if count_rows is not None:
+            # Incremental update: count the sampled token for each penalized sequence
+            self._token_counts.index_put_(
+                (count_rows, sampled[row_index]),
+                torch.ones_like(count_rows, dtype=self._token_counts.dtype),
+                accumulate=True,
+            )
+        token_ids = sampled.tolist()
+        self._record_failures(sample_seqs, unsamplable, failed)
+        
+        # Update logits processor state after sampling.
+        # Batched processors advance every sequence's own FSM. For legacy processors,
+        # sequences submitted together with a single SamplingParams share one
+        # processor, so each distinct processor is advanced exactly once (with the
+        # token of its first sequence). Updating it once per sequence would cause
+        # duplicate state updates (e.g., codes_count += N instead of += 1), while
+        # independent requests in the same continuous batch each get their own update.
+        for processor, rows in batch_processors.values():
+            rows = [i for i in rows if sample_seqs[i].seq_id not in self._failed_seqs]
+            if rows:
+                self._update_processor_state(
+                    processor.update_state_batch,
+                    [sample_seqs[i] for i in rows],
+                    [sample_seqs[i].seq_id for i in rows],
+                    [token_ids[i] for i in rows],
+                )
+        updated_processors = set(batch_processors)
+        for seq, token_id in zip(sample_seqs, token_ids):
+            update_state = seq.logits_processor_update_state
+            if update_state is None or seq.seq_id in self._failed_seqs:
+                continue
+            key = id(getattr(update_state, "__self__", update_state))
+            if key in updated_processors:
+                continue
+            updated_processors.add(key)
+            self._update_processor_state(update_state, [seq], token_id)
+        
+        return token_ids
+
+    def prepare_verify(self, seqs: list[Sequence], drafts: list[list[int]]):
+        """Inputs of a speculative decode step: [last_token, *drafts] per sequence.
+
+        Laid out as a prefix-cached prefill, so every query token attends to the
+        paged KV of the sequence plus the preceding drafts. The drafts' KV goes
+        into the slots reserved by Scheduler.reserve_draft_slots.
+        """
+        _t0 = debug_start("prepare_verify", prefix="tensor.vllm")
+        input_ids = []
+        positions = []
+        cu_seqlens_q = [0]
+        cu_seqlens_k = [0]
+        slot_mapping = []
+        for seq, seq_drafts in zip(seqs, drafts):
+            first = len(seq) - 1
+            num_query = 1 + len(seq_drafts)
+            input_ids.append(seq.last_token)
+            input_ids.extend(seq_drafts)
+            positions.extend(range(first, first + num_query))
+            cu_seqlens_q.append(cu_seqlens_q[-1] + num_query)
+            cu_seqlens_k.append(cu_seqlens_k[-1] + first + num_query)
+            for pos in range(first, first + num_query):
+                slot_mapping.append(seq.block_table[pos // self.block_size] * self.block_size + pos % self.block_size)
+        max_seqlen_q = max(1 + len(d) for d in drafts)
+        max_seqlen_k = max(len(seq) + len(d) for seq, d in zip(seqs, drafts))
+        block_tables = self.prepare_block_tables(seqs)
+        query_starts = cu_seqlens_q[:-1]
+        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        cu_seqlens_q = torch.tensor(cu_seqlens_q, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        cu_seqlens_k = torch.tensor(cu_seqlens_k, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        slot_mapping = torch.tensor(slot_mapping, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        # Logits for every query token, not only the last one of each sequence
+        logits_indices = torch.arange(input_ids.size(0), device=self.device)
+        set_context(True, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, slot_mapping, None, block_tables, logits_indices)
+        debug_end("prepare_verify", _t0, prefix="tensor.vllm")
+        return input_ids, positions, query_starts
+
+    @torch.inference_mode()
+    def run_speculative(self, seqs: list[Sequence], drafts: list[list[int]]) -> list[list[int]] | None:
+        """Decode step that verifies speculative draft tokens in one target forward.
+
+        drafts holds one (possibly empty) list per sequence; an unconditional CFG
+        row carries the drafts of its conditional partner. For every position of
+        [last_token, *drafts] the target distribution is built exactly as run()
+        builds it (repetition penalty over the history including the preceding
+        drafts, CFG against the unconditional row at the same position, the
+        logits processor at that lookahead, temperature/top-k/top-p). Draft token
+        d_j is accepted with probability p_j(d_j); at the first rejection a token
+        is sampled from p_j with d_j removed, and after all acceptances a bonus
+        token is sampled from the last position. With a deterministic proposer
+        this is standard speculative sampling, so the output distribution equals
+        token-by-token decoding.
+
+        Returns, per plain/conditional sequence, the accepted drafts followed by
+        the sampled token.
+        """
+        num_uncond = sum(1 for seq in seqs if seq.is_unconditional)
+        num_sample = len(seqs) - num_uncond
+        num_plain = num_sample - num_uncond
+        sample_seqs = seqs[:num_sample]
+
+        input_ids, positions, query_starts = self.prepare_verify(seqs, drafts)
+        sample_params = self.prepare_sample(seqs) if self.rank == 0 else None
+        logits_all = self.run_model(input_ids, positions, True)
+        reset_context()
+
+        if self.rank != 0:
+            return None
+        temperatures, cfg_scales, top_ks, top_ps, repetition_penalties = sample_params
+
+        # One expanded row per (sampled sequence, position j): j drafts assumed accepted
+        row_seq = []
+        row_depth = []
+        cond_index = []
+        uncond_index = []
+        for i in range(num_sample):
+            for j in range(len(drafts[i]) + 1):
+                row_seq.append(i)
+                row_depth.append(j)
+                cond_index.append(query_starts[i] + j)
+                if i >= num_plain:
+                    uncond_index.append(query_starts[num_sample + i - num_plain] + j)
+        device = logits_all.device
+        row_seq_t = torch.tensor(row_seq, dtype=torch.long, device=device)
+        logits = logits_all[torch.tensor(cond_index, dtype=torch.long, device=device)].clone()
+
+        # Repetition penalty: completion counts plus the drafts before each position
+        penalty_seqs = [i for i, seq in enumerate(sample_seqs)
+                        if seq.repetition_penalty is not None and seq.repetition_penalty != 1.0]
+        count_rows = None
+        if penalty_seqs and repetition_penalties is not None:
+            count_rows = self._get_token_count_rows([sample_seqs[i] for i in penalty_seqs], logits.shape[1], device)
+            count_row_of = dict(zip(penalty_seqs, count_rows.tolist()))
+            rows = [r for r, i in enumerate(row_seq) if i in count_row_of]
+            row_index = torch.tensor(rows, dtype=torch.long, device=device)
+            seen = self._token_counts[torch.tensor([count_row_of[row_seq[r]] for r in rows], dtype=torch.long, device=device)] > 0
+            draft_rows, draft_tokens = [], []
+            for n, r in enumerate(rows):
+                for token_id in drafts[row_seq[r]][:row_depth[r]]:
+                    draft_rows.append(n)
+                    draft_tokens.append(token_id)
+            if draft_rows:
+                seen[torch.tensor(draft_rows, device=device), torch.tensor(draft_tokens, device=device)] = True
+            rows_logits = logits[row_index]
+            penalty = repetition_penalties[row_seq_t[row_index]].unsqueeze(1).to(rows_logits.dtype)
+            penalized = torch.where(rows_logits < 0, rows_logits * penalty, rows_logits / penalty)
+            logits[row_index] = torch.where(seen, penalized, rows_logits)
+
+        # CFG: conditional rows are the tail of the expanded batch, in the same order as uncond_index
+        if num_uncond > 0:
+            first_cfg = len(row_seq) - len(uncond_index)
+            logits_uncond = logits_all[torch.tensor(uncond_index, dtype=torch.long, device=device)]
+            cfg = cfg_scales[row_seq_t[first_cfg:]].unsqueeze(1)
+            logits[first_cfg:] = logits_uncond + cfg * (logits[first_cfg:] - logits_uncond)
+
+        # Logits processors. Sequences with drafts only have processors that support
+        # lookahead (checked when drafting); rows without drafts are processed as in run().
+        batch_processors = {}
+        failed = {}
+        for r, i in enumerate(row_seq):
+            seq = sample_seqs[i]
+            processor = seq.logits_processor
+            if processor is None:
+                continue
+            if hasattr(processor, "process_batch") and hasattr(processor, "update_state_batch"):
+                batch_processors.setdefault(id(processor), (processor, []))[1].append(r)
+                continue
+            try:
+                seq_input_ids = self._get_token_history(seq, device)
+                logits[r] = processor(seq_input_ids, logits[r:r+1].clone())[0]
+            except Exception as e:
+                failed[seq.seq_id] = e
+        for processor, rows in batch_processors.values():
+            plain_rows = [r for r in rows if not drafts[row_seq[r]]]
+            lookahead_rows = [r for r in rows if drafts[row_seq[r]]]
+            try:
+                if plain_rows:
+                    row_index = torch.tensor(plain_rows, device=device, dtype=torch.long)
+                    logits[row_index] = processor.process_batch(
+                        [sample_seqs[row_seq[r]].seq_id for r in plain_rows],
+                        [sample_seqs[row_seq[r]].token_ids for r in plain_rows],
+                        logits[row_index],
+                    )
+                if lookahead_rows:
+                    row_index = torch.tensor(lookahead_rows, device=device, dtype=torch.long)
+                    logits[row_index] = processor.process_batch_lookahead(
+                        [sample_seqs[row_seq[r]].seq_id for r in lookahead_rows],
+                        logits[row_index],
+                        [row_depth[r] for r in lookahead_rows],
+                    )
+            except Exception as e:
+                for r in rows:
+                    failed[sample_seqs[row_seq[r]].seq_id] = e
+        unsamplable = self._mask_unsamplable_rows(logits)
+
+        probs = self.sampler.probs(
+            logits,
+            temperatures[row_seq_t],
+            top_ks[row_seq_t] if top_ks is not None else None,
+            top_ps[row_seq_t] if top_ps is not None else None,
+        )
+
+        # Accept/reject: one gather and one uniform draw per draft token
+        verify_rows = [r for r, (i, j) in enumerate(zip(row_seq, row_depth)) if j < len(drafts[i])]
+        verify_tokens = [drafts[row_seq[r]][row_depth[r]] for r in verify_rows]
+        if verify_rows:
+            p_draft = probs[torch.tensor(verify_rows, device=device), torch.tensor(verify_tokens, device=device)].tolist()
+            uniforms = torch.rand(len(verify_rows), device=device).tolist()
+        outputs = []
+        final_rows = []
+        rejected_tokens = []
+        row = 0
+        k = 0
+        for i in range(num_sample):
+            num_drafts = len(drafts[i])
+            accepted = 0
+            while accepted < num_drafts and uniforms[k + accepted] < p_draft[k + accepted]:
+                accepted += 1
+            k += num_drafts
+            outputs.append(list(drafts[i][:accepted]))
+            final_rows.append(row + accepted)
+            rejected_tokens.append(drafts[i][accepted] if accepted < num_drafts else -1)
+            row += num_drafts + 1
+        final_probs = probs[torch.tensor(final_rows, device=device)]
+        residual_rows = [n for n, t in enumerate(rejected_tokens) if t >= 0]
+        if residual_rows:
+            # Residual distribution after rejecting d: p with d removed (renormalized by multinomial)
+            index = torch.tensor(residual_rows, device=device)
+            residual = final_probs[index]
+            residual[torch.arange(len(residual_rows), device=device), torch.tensor([rejected_tokens[n] for n in residual_rows], device=device)] = 0
+            # Guard against numerically empty residuals
+            empty = residual.sum(dim=-1) <= 0
+            final_probs[index] = torch.where(empty.unsqueeze(1), final_probs[index], residual)
+        sampled = torch.multinomial(final_probs, 1).squeeze(1).tolist()
+        for out, token_id in zip(outputs, sampled):
+            out.append(token_id)
+        # Expanded rows -> sequences: a sequence fails if any of its rows had no samplable token
+        unsamplable_seqs = [False] * num_sample
+        for i, bad in zip(row_seq, unsamplable.tolist()):
+            unsamplable_seqs[i] = unsamplable_seqs[i] or bad
+        self._record_failures(sample_seqs, unsamplable_seqs, failed)
+
+        if count_rows is not None:
+            index_rows, index_tokens = [], []
+            for row_id, i in zip(count_rows.tolist(), penalty_seqs):
+                index_rows.extend([row_id] * len(outputs[i]))
+                index_tokens.extend(outputs[i])
+            self._token_counts.index_put_(
+                (torch.tensor(index_rows, dtype=torch.long, device=device), torch.tensor(index_tokens, dtype=torch.long, device=device)),
+                torch.ones(len(index_rows), dtype=self._token_counts.dtype, device=device),
+                accumulate=True,
+            )
+
+        # Advance processor state token by token (see run() for the legacy processor rule)
+        for step in range(max(len(out) for out in outputs)):
+            for processor, rows in batch_processors.values():
+                seq_rows = sorted({
+                    row_seq[r] for r in rows
+                    if len(outputs[row_seq[r]]) > step and sample_seqs[row_seq[r]].seq_id not in self._failed_seqs
+                })
+                if seq_rows:
+                    self._update_processor_state(
+                        processor.update_state_batch,
+                        [sample_seqs[i] for i in seq_rows],
+                        [sample_seqs[i].seq_id for i in seq_rows],
+                        [outputs[i][step] for i in seq_rows],
+                    )
+        updated_processors = set(batch_processors)
+        for seq, out in zip(sample_seqs, outputs):
+            update_state = seq.logits_processor_update_state
+            if update_state is None or seq.seq_id in self._failed_seqs:
+                continue
+            key = id(getattr(update_state, "__self__", update_state))
+            if key in updated_processors:
+                continue
+            updated_processors.add(key)
+            self._update_processor_state(update_state, [seq], out[0])
+
+        return outputs
+
+    @torch.inference_mode()
+    def score(self, token_ids: list[list[int]], target_starts: list[int], return_logits: bool = False) -> list[torch.Tensor] | None:
+        """Teacher-forced scoring: prefill-only forward, no KV cache writes, no sampling.
+
+        For sequence i, returns the model's predictions for token_ids[i][target_starts[i]:]:
+        the logits ([n, vocab], model dtype, on device) if return_logits, else the
+        float32 log-probs of the actual tokens ([n], on CPU). Sequences are packed
+        into varlen prefill batches of at most max_num_batched_tokens tokens, and
+        the LM head only runs on the target positions.
+        """
+        results = []
+        budget = self.config.max_num_batched_tokens
+        chunk: list[int] = []
+        chunk_tokens = 0
+        for i, ids in enumerate(token_ids):
+            if chunk and chunk_tokens + len(ids) > budget:
+                results.extend(self._score_chunk([token_ids[j] for j in chunk], [target_starts[j] for j in chunk], return_logits))
+                chunk, chunk_tokens = [], 0
+            chunk.append(i)
+            chunk_tokens += len(ids)
+        if chunk:
+            results.extend(self._score_chunk([token_ids[j] for j in chunk], [target_starts[j] for j in chunk], return_logits))
+        return results if self.rank == 0 else None
+
+    def _score_chunk(self, token_ids: list[list[int]], target_starts: list[int], return_logits: bool) -> list[torch.Tensor]:
+        input_ids = []
+        positions = []
+        cu_seqlens = [0]
+        logits_indices = []
+        num_targets = []
+        for ids, start in zip(token_ids, target_starts):
+            offset = cu_seqlens[-1]
+            start = max(1, start)
+            input_ids.extend(ids)
+            positions.extend(range(len(ids)))
+            cu_seqlens.append(offset + len(ids))
+            # Token t is predicted by the hidden state at t - 1
+            logits_indices.extend(range(offset + start - 1, offset + len(ids) - 1))
+            num_targets.append(max(0, len(ids) - start))
+        max_seqlen = max(len(ids) for ids in token_ids)
+        targets = torch.tensor([t for ids, start in zip(token_ids, target_starts) for t in ids[max(1, start):]], dtype=torch.int64).to(self.device)
+        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        cu_seqlens = torch.tensor(cu_seqlens, dtype=torch.int32, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        logits_indices = torch.tensor(logits_indices, dtype=torch.int64, pin_memory=self.pin_memory).to(self.device, non_blocking=True)
+        # Slot -1 everywhere: store_kvcache skips these rows, the paged cache is untouched
+        slot_mapping = torch.full((input_ids.size(0),), -1, dtype=torch.int32, device=self.device)
+        set_context(True, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen, slot_mapping, None, None, logits_indices)
+        try:
+            logits = self.model.compute_logits(self.model(input_ids, positions))
+        finally:
             reset_context()
-            
-            if self.rank == 0:
-                # Apply repetition penalty to logits
-                if repetition_penalties is not None:
-                    for i, seq in enumerate(seqs):
-                        penalty = repetition_penalties[i].item()
-                        if penalty != 1.0:
-                            # Only penalize completion tokens (not prompt tokens)
-                            completion_tokens = torch.tensor(seq.completion_token_ids, device=logits.device)
-                            if len(completion_tokens) > 0:
-                                # Create token mask: mark tokens that appeared in completion
-                                token_mask = torch.zeros(logits.shape[1], dtype=torch.bool, device=logits.device)
-                                token_mask[completion_tokens] = True
-                                
-                                # Apply standard repetition penalty formula (matching transformers implementation):
-                                # For tokens in completion: if score < 0 then score * penalty, else score / penalty
-                                penalty_scores = torch.where(
-                                    logits[i] < 0,
-                                    logits[i] * penalty,
-                                    logits[i] / penalty
-                                )
-                                # Only apply penalty to tokens that appeared in completion
-                                logits[i] = torch.where(token_mask, penalty_scores, logits[i])
-                
-                # Apply logits processor for constrained decoding (if any sequence has one)
-                # Clone logits to avoid in-place update issues in inference mode
-                logits = logits.clone()
-                for i, seq in enumerate(seqs):
-                    if seq.logits_processor is not None:
-                        # Create input_ids tensor for this sequence
-                        seq_input_ids = torch.tensor([seq.token_ids], device=logits.device)
-                        # Apply processor to this sequence's logits (clone to avoid inference mode issues)
-                        processed = seq.logits_processor(seq_input_ids, logits[i:i+1].clone())
-                        logits[i] = processed[0]
-                
-                # Prepare input_ids for sampler
-                # seq_input_ids = torch.tensor([seq.token_ids for seq in seqs], device=logits.device)
-                
-                token_ids = self.sampler(
-                    logits, 
-                    temperatures,
-                    top_ks=top_ks if top_ks is not None else None,
-                    top_ps=top_ps if top_ps is not None else None,
-                    repetition_penalties=None,  # Already applied above
-                    # input_ids=seq_input_ids,
-                ).tolist()
-                
-                # Update logits processor state after sampling
-                # NOTE: Only update for the first sequence since all sequences may share the same processor
-                # (when using a single SamplingParams for batch generation)
-                # Updating multiple times would cause duplicate state updates (e.g., codes_count += N instead of += 1)
-                if seqs and seqs[0].logits_processor_update_state is not None:
-                    seqs[0].logits_processor_update_state(token_ids[0])
-                
-                return token_ids
-            else:
-                return None
+        if self.rank != 0:
+            return []
+        if return_logits:
+            return list(logits.split(num_targets))
+        log_probs = torch.log_softmax(logits.float(), dim=-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+        return list(log_probs.cpu().split(num_targets))
+
+    @staticmethod
+    def _mask_unsamplable_rows(logits: torch.Tensor) -> torch.Tensor:
+        """Rows with NaN/+inf logits or no finite logit, zeroed in place so sampling can't fail.
+
+        Returns the [rows] bool mask; it is read after sampling, so no extra sync.
+        """
+        unsamplable = (
+            torch.isnan(logits).any(dim=-1)
+            | torch.isposinf(logits).any(dim=-1)
+            | ~torch.isfinite(logits).any(dim=-1)
+        )
+        logits.masked_fill_(unsamplable.unsqueeze(1), 0.0)
+        return unsamplable
+
+    def _record_failures(self, sample_seqs: list[Sequence], unsamplable, failed: dict[int, BaseException]):
+        if not isinstance(unsamplable, list):
+            unsamplable = unsamplable.tolist()
+        for seq, bad in zip(sample_seqs, unsamplable):
+            if bad and seq.seq_id not in failed:
+                failed[seq.seq_id] = RuntimeError(
+                    f"Sequence {seq.seq_id}: no token can be sampled (logits are NaN or all masked)"
+                )
+        self._failed_seqs.update(failed)
+
+    def _update_processor_state(self, update, seqs: list[Sequence], *args):
+        """Advance a logits processor; if it raises, only its sequences fail."""
+        try:
+            update(*args)
+        except Exception as e:
+            for seq in seqs:
+                self._failed_seqs.setdefault(seq.seq_id, e)
+
+    def take_failed_sequences(self) -> dict[int, BaseException]:
+        """Sequences (plain or CFG-conditional seq_id) that failed since the last call, with their errors."""
+        failed, self._failed_seqs = self._failed_seqs, {}
+        return failed
+
+    def _get_token_count_rows(self, seqs: list[Sequence], vocab_size: int, device: torch.device) -> torch.Tensor:
+        """Rows of _token_counts for seqs; new (or preempted and resumed) sequences are seeded once from their completion."""
+        if self._token_counts is None or self._token_counts.shape[1] != vocab_size:
+            self._token_counts = torch.zeros(max(8, len(seqs)), vocab_size, dtype=torch.int32, device=device)
+            self._token_count_rows.clear()
+            self._free_token_count_rows = list(range(self._token_counts.shape[0]))
+        rows = []
+        for seq in seqs:
+            row = self._token_count_rows.get(seq.seq_id)
+            if row is None:
+                if not self._free_token_count_rows:
+                    old_rows = self._token_counts.shape[0]
+                    grown = torch.zeros(old_rows * 2, vocab_size, dtype=torch.int32, device=device)
+                    grown[:old_rows] = self._token_counts
+                    self._token_counts = grown
+                    self._free_token_count_rows = list(range(old_rows, old_rows * 2))
+                row = self._free_token_count_rows.pop()
+                self._token_count_rows[seq.seq_id] = row
+                self._token_counts[row].zero_()
+                completion = seq.completion_token_ids
+                if completion:
+                    tokens = torch.tensor(completion, dtype=torch.long, device=device)
+                    self._token_counts[row].index_add_(0, tokens, torch.ones_like(tokens, dtype=torch.int32))
+            rows.append(row)
+        return torch.tensor(rows, dtype=torch.long, device=device)
+
+    def _get_token_history(self, seq: Sequence, device: torch.device) -> torch.Tensor:
+        """[1, len(seq)] view of seq.token_ids on device, appending only tokens added since the last step."""
+        entry = self._token_histories.get(seq.seq_id)
+        if entry is None or entry[1] > len(seq):
+            buffer = torch.empty(max(self.config.max_model_len, len(seq)), dtype=torch.long, device=device)
+            entry = self._token_histories[seq.seq_id] = [buffer, 0]
+        buffer, length = entry
+        if length < len(seq):
+            buffer[length:len(seq)] = torch.tensor(seq.token_ids[length:], dtype=torch.long)
+            entry[1] = len(seq)
+        return buffer[:len(seq)].unsqueeze(0)
+
+    def retain_sequence_state(self, active_seq_ids: set[int]):
+        """Drop per-sequence decode state of sequences not in active_seq_ids (finished or aborted).
+
+        The engine passes every running and waiting sequence, so the state of
+        sequences left out of a batch or preempted survives until they resume.
+        """
+        for seq_id in [sid for sid in self._token_count_rows if sid not in active_seq_ids]:
+            self._free_token_count_rows.append(self._token_count_rows.pop(seq_id))
+        for seq_id in [sid for sid in self._token_histories if sid not in active_seq_ids]:
+            del self._token_histories[seq_id]
 
     @torch.inference_mode()
     def capture_cudagraph(self):
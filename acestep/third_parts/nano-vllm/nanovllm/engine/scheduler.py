@@ -32,7 +32,7 @@ class Scheduler:
 
     def schedule(self) -> tuple[list[Sequence], bool]:
         _debug_log(f"schedule: waiting={len(self.waiting)}, running={len(self.running)}, "
-                  f"free_blocks={len(self.block_manager.free_block_ids)}")
+                  f"free_blocks={self.block_manager.num_free_blocks}")
         
         # prefill
         scheduled_seqs = []
@@ -43,6 +43,11 @@ class Scheduler:
         while self.waiting and num_seqs < self.max_num_seqs:
             seq = self.waiting[0]
             
+            # An unconditional sequence at the head of the queue is scheduled through
+            # its conditional partner so that the pair is always prefilled together.
+            if seq.is_unconditional and seq.paired_seq is not None and seq.paired_seq.status == SequenceStatus.WAITING:
+                seq = seq.paired_seq
+            
             # For CFG sequences, ensure conditional and unconditional are scheduled together
             if seq.cfg_scale > 1.0 and seq.paired_seq is not None and not seq.is_unconditional:
                 # This is a conditional sequence, need to schedule its paired unconditional sequence too
@@ -58,7 +63,7 @@ class Scheduler:
                 # The old check was wrong: it checked each sequence independently,
                 # but didn't account for the total blocks needed by both
                 total_blocks_needed = seq.num_blocks + paired_seq.num_blocks
-                can_allocate_both = len(self.block_manager.free_block_ids) >= total_blocks_needed
+                can_allocate_both = self.block_manager.num_free_blocks >= total_blocks_needed
                 
                 if num_batched_tokens + total_tokens > self.max_num_batched_tokens or not can_allocate_both:
                     break
@@ -107,6 +112,16 @@ class Scheduler:
         while temp_running and num_seqs < self.max_num_seqs:
             seq = temp_running.pop(0)
             
+            # Reached the unconditional half of a CFG pair first: schedule the pair
+            # through its conditional sequence (put the unconditional one back so the
+            # pair logic below can find it).
+            if seq.is_unconditional and seq.paired_seq is not None and seq.seq_id not in processed_seqs:
+                if seq.paired_seq not in temp_running:
+                    continue
+                temp_running.remove(seq.paired_seq)
+                temp_running.insert(0, seq)
+                seq = seq.paired_seq
+            
             # For CFG sequences, ensure conditional and unconditional are scheduled together
             if seq.cfg_scale > 1.0 and seq.paired_seq is not None and not seq.is_unconditional:
                 paired_seq = seq.paired_seq
@@ -123,7 +138,7 @@ class Scheduler:
                 blocks_needed_seq = 1 if len(seq) % block_size == 1 else 0
                 blocks_needed_paired = 1 if len(paired_seq) % block_size == 1 else 0
                 total_blocks_needed = blocks_needed_seq + blocks_needed_paired
-                can_append_both = len(self.block_manager.free_block_ids) >= total_blocks_needed
+                can_append_both = self.block_manager.num_free_blocks >= total_blocks_needed
                 
                 if not can_append_both:
                     # Try preempting other sequences
@@ -131,9 +146,9 @@ class Scheduler:
                     while not can_append_both and temp_running:
                         other_seq = temp_running.pop(0)
                         if other_seq != seq and other_seq != paired_seq:
-                            self.preempt(other_seq)
+                            self._preempt_with_pair(other_seq, temp_running)
                             # Recalculate with the same correct logic
-                            can_append_both = len(self.block_manager.free_block_ids) >= total_blocks_needed
+                            can_append_both = self.block_manager.num_free_blocks >= total_blocks_needed
                             preempted = True
                         else:
                             temp_running.append(other_seq)
@@ -163,7 +178,7 @@ class Scheduler:
                     if temp_running:
                         other_seq = temp_running.pop(0)
                         if other_seq != seq:
-                            self.preempt(other_seq)
+                            self._preempt_with_pair(other_seq, temp_running)
                         else:
                             temp_running.append(other_seq)
                             break
@@ -183,7 +198,7 @@ class Scheduler:
             # No sequences could be scheduled - provide informative error
             waiting_count = len(self.waiting)
             running_count = len(self.running)
-            free_blocks = len(self.block_manager.free_block_ids)
+            free_blocks = self.block_manager.num_free_blocks
             total_blocks = len(self.block_manager.blocks)
 
             if waiting_count > 0:
@@ -220,53 +235,106 @@ class Scheduler:
         self.block_manager.deallocate(seq)
         self.waiting.appendleft(seq)
 
-    def postprocess(self, seqs: list[Sequence], token_ids: list[int]) -> list[bool]:
+    def _preempt_with_pair(self, seq: Sequence, temp_running: list[Sequence]):
+        """Preempt a sequence together with its CFG partner (if any).
+
+        With several requests sharing the running batch, preempting only one half
+        of a CFG pair would leave the other half running without its partner and
+        block the pair from being rescheduled. The unconditional half is pushed
+        first so the conditional one ends up at the head of the waiting queue.
+        """
+        paired_seq = seq.paired_seq if seq.cfg_scale > 1.0 else None
+        if paired_seq is None or paired_seq.status != SequenceStatus.RUNNING:
+            self.preempt(seq)
+            if seq in self.running:
+                self.running.remove(seq)
+            return
+        if paired_seq in temp_running:
+            temp_running.remove(paired_seq)
+        cond_seq, uncond_seq = (paired_seq, seq) if seq.is_unconditional else (seq, paired_seq)
+        for s in (uncond_seq, cond_seq):
+            self.preempt(s)
+            if s in self.running:
+                self.running.remove(s)
+
+    def abort(self, seq: Sequence):
+        """Remove a sequence (and its CFG partner) from the scheduler and free its blocks."""
+        for s in (seq, seq.paired_seq):
+            if s is None or s.is_finished:
+                continue
+            if s in self.waiting:
+                self.waiting.remove(s)
+            if s in self.running:
+                self.running.remove(s)
+            if s.block_table:
+                self.block_manager.deallocate(s)
+            s.status = SequenceStatus.FINISHED
+
+    def reserve_draft_slots(self, seqs: list[Sequence], drafts: list[list[int]]) -> list[list[int]]:
+        """Reserve KV slots for the draft tokens of a decode batch (see ModelRunner.run_speculative).
+
+        drafts holds one list per sequence; the unconditional half of a CFG pair
+        carries the same drafts as its conditional partner. Drafts of a sequence
+        (or pair) that does not fit into the free blocks are dropped.
+        """
+        drafts = list(drafts)
+        position = {seq.seq_id: i for i, seq in enumerate(seqs)}
+        for i, seq in enumerate(seqs):
+            if seq.is_unconditional or not drafts[i]:
+                continue
+            group = [i]
+            if seq.cfg_scale > 1.0 and seq.paired_seq is not None and seq.paired_seq.seq_id in position:
+                group.append(position[seq.paired_seq.seq_id])
+            needed = sum(self.block_manager.num_blocks_to_reserve(seqs[j], len(drafts[i])) for j in group)
+            if needed > self.block_manager.num_free_blocks:
+                for j in group:
+                    drafts[j] = []
+                continue
+            for j in group:
+                drafts[j] = drafts[i]
+                self.block_manager.reserve_slots(seqs[j], len(drafts[i]))
+        return drafts
+
+    def postprocess(self, seqs: list[Sequence], token_ids: list[int] | list[list[int]], speculative: bool = False) -> list[bool]:
+        """Append sampled tokens and retire finished sequences.
+
+        The batch layout matches ModelRunner.run: [plain..., cfg_cond..., cfg_uncond...].
+        token_ids holds one token per plain/conditional sequence; each conditional
+        token is also appended to the paired unconditional sequence.
+
+        With speculative=True every entry is a list of tokens (accepted drafts plus
+        one sampled token). Tokens after a sequence finishes are dropped from that
+        list in place, and the block tables of unfinished sequences are settled.
+        """
         _debug_log(f"postprocess: num_seqs={len(seqs)}, num_token_ids={len(token_ids) if token_ids else 0}")
         if token_ids:
             _debug_log(f"  token_ids: {token_ids[:10]}..." if len(token_ids) > 10 else f"  token_ids: {token_ids}")
         
-        # Check if this is a CFG batch
-        is_cfg_batch = False
-        if len(seqs) > 0 and seqs[0].cfg_scale > 1.0 and seqs[0].paired_seq is not None:
-            num_cond = len(seqs) // 2
-            is_cfg_batch = (num_cond > 0 and 
-                           not seqs[0].is_unconditional and 
-                           seqs[num_cond].is_unconditional)
-        _debug_log(f"  is_cfg_batch={is_cfg_batch}")
-        
-        if is_cfg_batch:
-            # CFG batch: seqs = [cond_seq1, cond_seq2, ..., uncond_seq1, uncond_seq2, ...]
-            # token_ids correspond to conditional sequences only (sampled from CFG logits)
-            num_cond = len(seqs) // 2
-            cond_seqs = seqs[:num_cond]
-            uncond_seqs = seqs[num_cond:]
-            
-            # Apply the same sampled token to both conditional and unconditional sequences
-            for i, (cond_seq, uncond_seq, token_id) in enumerate(zip(cond_seqs, uncond_seqs, token_ids)):
-                cond_seq.append_token(token_id)
-                uncond_seq.append_token(token_id)  # Same token for unconditional
-                
-                # Check if either sequence is finished
-                cond_finished = ((not cond_seq.ignore_eos and token_id == self.eos) or 
-                                cond_seq.num_completion_tokens == cond_seq.max_tokens)
-                uncond_finished = ((not uncond_seq.ignore_eos and token_id == self.eos) or 
-                                  uncond_seq.num_completion_tokens == uncond_seq.max_tokens)
-                
-                if cond_finished or uncond_finished:
-                    # Mark both as finished
-                    cond_seq.status = SequenceStatus.FINISHED
-                    uncond_seq.status = SequenceStatus.FINISHED
-                    self.block_manager.deallocate(cond_seq)
-                    self.block_manager.deallocate(uncond_seq)
-                    if cond_seq in self.running:
-                        self.running.remove(cond_seq)
-                    if uncond_seq in self.running:
-                        self.running.remove(uncond_seq)
-        else:
-            # Normal batch
-            for seq, token_id in zip(seqs, token_ids):
+        num_sample = len(seqs) - sum(1 for seq in seqs if seq.is_unconditional)
+        for seq, step_tokens in zip(seqs[:num_sample], token_ids):
+            uncond_seq = seq.paired_seq if seq.cfg_scale > 1.0 else None
+            finished = False
+            for n, token_id in enumerate(step_tokens if speculative else [step_tokens]):
                 seq.append_token(token_id)
-                if (not seq.ignore_eos and token_id == self.eos) or seq.num_completion_tokens == seq.max_tokens:
-                    seq.status = SequenceStatus.FINISHED
-                    self.block_manager.deallocate(seq)
-                    self.running.remove(seq)
+                finished = (not seq.ignore_eos and token_id == self.eos) or seq.num_completion_tokens == seq.max_tokens
+                if uncond_seq is not None:
+                    uncond_seq.append_token(token_id)  # Same token for unconditional
+                    finished = finished or uncond_seq.num_completion_tokens == uncond_seq.max_tokens
+                if finished:
+                    if speculative:
+                        del step_tokens[n + 1:]
+                    break
+            if not finished:
+                if speculative:
+                    for s in (seq, uncond_seq):
+                        if s is not None:
+                            self.block_manager.commit_slots(s)
+                continue
+            # Mark both halves of a CFG pair as finished together
+            for s in (seq, uncond_seq):
+                if s is None:
+                    continue
+                s.status = SequenceStatus.FINISHED
+                self.block_manager.deallocate(s)
+                if s in self.running:
+                    self.running.remove(s)
@@ -0,0 +1,61 @@
+from nanovllm.engine.sequence import Sequence
+
+
+class NgramProposer:
+    """Self-drafting proposer for speculative decoding (prompt lookup).
+
+    Finds the most recent earlier occurrence of the sequence's last n tokens
+    (longest n first, down to min_ngram) in its own prompt + completion and
+    proposes the tokens that followed it. Audio codes repeat with the music's
+    structure (repeated bars, choruses), so these drafts are often accepted.
+
+    The n-gram index of each sequence is updated incrementally, so proposing
+    costs O(new tokens) per step rather than a scan of the whole history.
+    Proposals never include eos; verification in ModelRunner.run_speculative
+    keeps the output distribution exact whatever the drafts are.
+    """
+
+    def __init__(self, num_speculative_tokens: int, max_ngram: int = 3, min_ngram: int = 2, eos: int = -1):
+        assert num_speculative_tokens > 0
+        assert 1 <= min_ngram <= max_ngram
+        self.num_speculative_tokens = num_speculative_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        self.eos = eos
+        # seq_id -> [ngram index {tuple: position after its latest occurrence}, tokens indexed]
+        self._states: dict[int, list] = {}
+
+    def propose(self, seq: Sequence, max_tokens: int) -> list[int]:
+        """Up to max_tokens draft tokens to follow seq (may be empty)."""
+        num_tokens = min(max_tokens, self.num_speculative_tokens)
+        if num_tokens <= 0:
+            return []
+        token_ids = seq.token_ids
+        state = self._states.get(seq.seq_id)
+        if state is None or state[1] > len(token_ids):
+            state = self._states[seq.seq_id] = [{}, 0]
+        index, indexed = state
+        # Index n-grams ending before the last token; the suffix itself is the query
+        end = len(token_ids) - 1
+        for i in range(indexed, end):
+            for n in range(self.min_ngram, self.max_ngram + 1):
+                if i + 1 >= n:
+                    index[tuple(token_ids[i + 1 - n:i + 1])] = i + 1
+        state[1] = max(indexed, end)
+
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if len(token_ids) < n:
+                continue
+            start = index.get(tuple(token_ids[-n:]))
+            if start is None:
+                continue
+            draft = token_ids[start:start + num_tokens]
+            if self.eos in draft:
+                draft = draft[:draft.index(self.eos)]
+            return list(draft)
+        return []
+
+    def retain(self, seq_ids: set[int]):
+        """Drop the index of every sequence not in seq_ids."""
+        for seq_id in [sid for sid in self._states if sid not in seq_ids]:
+            del self._states[seq_id]
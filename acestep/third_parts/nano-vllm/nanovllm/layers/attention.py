@@ -3,10 +3,13 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
+from nanovllm.layers.quantization import dequantize_kv, kv_qmax, quantize_kv
 from nanovllm.utils.context import get_context
 
 # Debug logging - enable with NANOVLLM_DEBUG=1
 _DEBUG = os.environ.get("NANOVLLM_DEBUG", "0") == "1"
+# Per-sequence SDPA loops instead of the batched SDPA paths - enable with NANOVLLM_SDPA_LOOP=1
+_SDPA_LOOP = os.environ.get("NANOVLLM_SDPA_LOOP", "0") == "1"
 
 def _debug_log(msg: str):
     """Print debug message if NANOVLLM_DEBUG is enabled"""
@@ -58,6 +61,100 @@ if _HAS_TRITON:
         tl.store(k_cache_ptr + cache_offsets, key)
         tl.store(v_cache_ptr + cache_offsets, value)
 
+    @triton.jit
+    def store_kvcache_quantized_kernel(
+        key_ptr,
+        key_stride,
+        value_ptr,
+        value_stride,
+        k_cache_ptr,
+        v_cache_ptr,
+        k_scale_ptr,
+        v_scale_ptr,
+        slot_mapping_ptr,
+        NUM_KV_HEADS: tl.constexpr,
+        HEAD_DIM: tl.constexpr,
+        QMAX: tl.constexpr,
+        IS_INT8: tl.constexpr,
+    ):
+        # One program per (token, kv head): the scale is that head's absmax / QMAX
+        idx = tl.program_id(0)
+        head = tl.program_id(1)
+        slot = tl.load(slot_mapping_ptr + idx)
+        if slot == -1: return
+        d = tl.arange(0, HEAD_DIM)
+        key = tl.load(key_ptr + idx * key_stride + head * HEAD_DIM + d).to(tl.float32)
+        value = tl.load(value_ptr + idx * value_stride + head * HEAD_DIM + d).to(tl.float32)
+        k_scale = tl.maximum(tl.max(tl.abs(key), 0) / QMAX, 1e-8)
+        v_scale = tl.maximum(tl.max(tl.abs(value), 0) / QMAX, 1e-8)
+        key = key / k_scale
+        value = value / v_scale
+        if IS_INT8:
+            key = tl.floor(key + 0.5)
+            value = tl.floor(value + 0.5)
+        scale_offset = slot.to(tl.int64) * NUM_KV_HEADS + head
+        cache_offsets = scale_offset * HEAD_DIM + d
+        tl.store(k_cache_ptr + cache_offsets, key.to(k_cache_ptr.dtype.element_ty))
+        tl.store(v_cache_ptr + cache_offsets, value.to(v_cache_ptr.dtype.element_ty))
+        tl.store(k_scale_ptr + scale_offset, k_scale)
+        tl.store(v_scale_ptr + scale_offset, v_scale)
+
+    @triton.jit
+    def paged_decode_quantized_kernel(
+        q_ptr,
+        k_cache_ptr,
+        v_cache_ptr,
+        k_scale_ptr,
+        v_scale_ptr,
+        block_tables_ptr,
+        context_lens_ptr,
+        out_ptr,
+        sm_scale,
+        q_stride_b,
+        q_stride_h,
+        block_tables_stride,
+        out_stride_b,
+        out_stride_h,
+        NUM_KV_HEADS: tl.constexpr,
+        GROUP_SIZE: tl.constexpr,
+        BLOCK_SIZE: tl.constexpr,
+        HEAD_DIM: tl.constexpr,
+        BLOCK_N: tl.constexpr,
+    ):
+        # One program per (sequence, query head); online softmax over the context
+        # in tiles of BLOCK_N tokens, dequantizing K/V in registers
+        b = tl.program_id(0)
+        h = tl.program_id(1)
+        kv_head = h // GROUP_SIZE
+        ctx_len = tl.load(context_lens_ptr + b)
+        d = tl.arange(0, HEAD_DIM)
+        q = tl.load(q_ptr + b * q_stride_b + h * q_stride_h + d).to(tl.float32) * sm_scale
+
+        m_i = tl.zeros([1], dtype=tl.float32) - float("inf")
+        l_i = tl.zeros([1], dtype=tl.float32)
+        acc = tl.zeros([HEAD_DIM], dtype=tl.float32)
+        for start in range(0, ctx_len, BLOCK_N):
+            n = start + tl.arange(0, BLOCK_N)
+            mask = n < ctx_len
+            block = tl.load(block_tables_ptr + b * block_tables_stride + n // BLOCK_SIZE, mask=mask, other=0)
+            scale_offset = (block.to(tl.int64) * BLOCK_SIZE + n % BLOCK_SIZE) * NUM_KV_HEADS + kv_head
+            cache_offsets = scale_offset[:, None] * HEAD_DIM + d[None, :]
+            k = tl.load(k_cache_ptr + cache_offsets, mask=mask[:, None], other=0).to(tl.float32)
+            k_scale = tl.load(k_scale_ptr + scale_offset, mask=mask, other=0)
+            s = tl.sum(k * q[None, :], axis=1) * k_scale
+            s = tl.where(mask, s, float("-inf"))
+            m_new = tl.maximum(m_i, tl.max(s, 0))
+            alpha = tl.exp(m_i - m_new)
+            p = tl.exp(s - m_new)
+            v = tl.load(v_cache_ptr + cache_offsets, mask=mask[:, None], other=0).to(tl.float32)
+            v_scale = tl.load(v_scale_ptr + scale_offset, mask=mask, other=0)
+            acc = acc * alpha + tl.sum((p * v_scale)[:, None] * v, axis=0)
+            l_i = l_i * alpha + tl.sum(p, 0)
+            m_i = m_new
+        # Padded batch rows (ctx_len == 0) produce zeros instead of NaN
+        out = acc / tl.where(l_i > 0, l_i, 1.0)
+        tl.store(out_ptr + b * out_stride_b + h * out_stride_h + d, out.to(out_ptr.dtype.element_ty))
+
 
 # ============================================================
 # Pure PyTorch KV cache store (fallback when Triton unavailable)
@@ -97,14 +194,63 @@ def _store_kvcache_pytorch(
     v_flat[valid_slots] = value_flat[valid_mask]
 
 
+def _store_kvcache_quantized_pytorch(
+    key: torch.Tensor,
+    value: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    k_scale: torch.Tensor,
+    v_scale: torch.Tensor,
+    slot_mapping: torch.Tensor,
+):
+    """Quantize key/value per (token, kv head) and store them with their scales.
+
+    Args:
+        key: [N, num_kv_heads, head_dim]
+        value: [N, num_kv_heads, head_dim]
+        k_cache: [num_blocks, block_size, num_kv_heads, head_dim] int8 / fp8
+        v_cache: [num_blocks, block_size, num_kv_heads, head_dim] int8 / fp8
+        k_scale: [num_blocks, block_size, num_kv_heads] float32
+        v_scale: [num_blocks, block_size, num_kv_heads] float32
+        slot_mapping: [N] - flat slot indices into cache
+    """
+    valid_mask = slot_mapping != -1
+    valid_slots = slot_mapping[valid_mask]
+    for x, cache, scale in ((key, k_cache, k_scale), (value, v_cache, v_scale)):
+        q, s = quantize_kv(x[valid_mask], cache.dtype)
+        # Indexed writes go through uint8 views: fp8 index_put is not available everywhere
+        cache.view(torch.uint8).reshape(-1, *cache.shape[2:])[valid_slots] = q.view(torch.uint8)
+        scale.reshape(-1, scale.shape[-1])[valid_slots] = s
+
+
 def store_kvcache(
     key: torch.Tensor,
     value: torch.Tensor,
     k_cache: torch.Tensor,
     v_cache: torch.Tensor,
     slot_mapping: torch.Tensor,
+    k_scale: torch.Tensor | None = None,
+    v_scale: torch.Tensor | None = None,
 ):
-    """Store key/value into paged KV cache. Uses Triton kernel when available."""
+    """Store key/value into paged KV cache. Uses Triton kernel when available.
+
+    With k_scale/v_scale the cache is quantized (int8 / fp8) and each token's
+    heads are quantized on store.
+    """
+    if k_scale is not None:
+        if _HAS_TRITON and key.is_cuda:
+            N, num_kv_heads, head_dim = key.shape
+            assert key.stride(-1) == 1 and value.stride(-1) == 1
+            assert key.stride(1) == head_dim and value.stride(1) == head_dim
+            assert slot_mapping.numel() == N
+            store_kvcache_quantized_kernel[(N, num_kv_heads)](
+                key, key.stride(0), value, value.stride(0),
+                k_cache, v_cache, k_scale, v_scale, slot_mapping,
+                num_kv_heads, head_dim, kv_qmax(k_cache.dtype), k_cache.dtype == torch.int8,
+            )
+        else:
+            _store_kvcache_quantized_pytorch(key, value, k_cache, v_cache, k_scale, v_scale, slot_mapping)
+        return
     if _HAS_TRITON:
         N, num_heads, head_dim = key.shape
         D = num_heads * head_dim
@@ -117,11 +263,87 @@ def store_kvcache(
         _store_kvcache_pytorch(key, value, k_cache, v_cache, slot_mapping)
 
 
+# ============================================================
+# Reading a quantized KV cache
+# ============================================================
+
+def _gather_blocks(
+    cache: torch.Tensor,
+    scale: torch.Tensor | None,
+    block_indices: torch.Tensor,
+    dtype: torch.dtype,
+) -> torch.Tensor:
+    """cache[block_indices], dequantized to dtype when the cache is quantized."""
+    if scale is None:
+        return cache[block_indices]
+    blocks = cache.view(torch.uint8)[block_indices].view(cache.dtype)
+    return dequantize_kv(blocks, scale[block_indices], dtype)
+
+
+def _dequantize_paged_cache(
+    cache: torch.Tensor,
+    scale: torch.Tensor,
+    block_tables: torch.Tensor,
+    dtype: torch.dtype,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Dense dtype copy of the blocks in block_tables, for paged kernels that only read the model dtype.
+
+    Returns:
+        cache: [num_seqs * max_blocks, block_size, num_kv_heads, head_dim]
+        block_tables: [num_seqs, max_blocks], entry (i, j) = i * max_blocks + j
+    """
+    num_seqs, max_blocks = block_tables.shape
+    dense = _gather_blocks(cache, scale, block_tables.clamp(min=0).flatten(), dtype)
+    table = torch.arange(num_seqs * max_blocks, dtype=block_tables.dtype, device=block_tables.device)
+    return dense, table.view(num_seqs, max_blocks)
+
+
+def paged_decode_quantized(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    k_scale: torch.Tensor,
+    v_scale: torch.Tensor,
+    context_lens: torch.Tensor,
+    block_tables: torch.Tensor,
+    scale: float,
+) -> torch.Tensor:
+    """Decode attention straight from an int8 / fp8 paged cache (Triton).
+
+    Dequantizing in registers keeps the cache's memory savings at decode time,
+    where a dequantized copy of every sequence's blocks would not fit at large
+    CUDA graph batch sizes.
+
+    Args:
+        q: [batch, num_heads, head_dim]
+        k_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        v_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        k_scale: [num_blocks, block_size, num_kv_heads]
+        v_scale: [num_blocks, block_size, num_kv_heads]
+        context_lens: [batch]
+        block_tables: [batch, max_blocks_per_seq], padded with -1
+        scale: attention scale factor
+
+    Returns:
+        output: [batch, 1, num_heads, head_dim]
+    """
+    batch, num_heads, head_dim = q.shape
+    _, block_size, num_kv_heads, _ = k_cache.shape
+    q = q.contiguous()
+    out = torch.empty_like(q)
+    paged_decode_quantized_kernel[(batch, num_heads)](
+        q, k_cache, v_cache, k_scale, v_scale, block_tables, context_lens, out, scale,
+        q.stride(0), q.stride(1), block_tables.stride(0), out.stride(0), out.stride(1),
+        num_kv_heads, num_heads // num_kv_heads, block_size, head_dim, 64,
+    )
+    return out.unsqueeze(1)
+
+
 # ============================================================
 # SDPA-based attention (fallback when Flash Attention unavailable)
 # ============================================================
 
-def _sdpa_varlen_prefill(
+def _sdpa_varlen_prefill_loop(
     q: torch.Tensor,
     k: torch.Tensor,
     v: torch.Tensor,
@@ -131,7 +353,7 @@ def _sdpa_varlen_prefill(
     num_heads: int,
     num_kv_heads: int,
 ) -> torch.Tensor:
-    """SDPA replacement for flash_attn_varlen_func during prefill.
+    """Per-sequence reference for _sdpa_varlen_prefill.
 
     Splits packed sequences, runs SDPA per sequence with causal masking,
     then re-packs. Handles GQA via enable_gqa when heads differ.
@@ -174,7 +396,7 @@ def _sdpa_varlen_prefill(
     return torch.cat(outputs, dim=0)
 
 
-def _sdpa_prefill_with_paged_cache(
+def _sdpa_prefill_with_paged_cache_loop(
     q: torch.Tensor,
     k_cache: torch.Tensor,
     v_cache: torch.Tensor,
@@ -184,8 +406,10 @@ def _sdpa_prefill_with_paged_cache(
     scale: float,
     num_heads: int,
     num_kv_heads: int,
+    k_scale: torch.Tensor | None = None,
+    v_scale: torch.Tensor | None = None,
 ) -> torch.Tensor:
-    """SDPA prefill with paged KV cache (prefix caching case).
+    """Per-sequence reference for _sdpa_prefill_with_paged_cache.
 
     Args:
         q: [total_q_tokens, num_heads, head_dim]
@@ -197,6 +421,7 @@ def _sdpa_prefill_with_paged_cache(
         scale: attention scale factor
         num_heads: number of query heads
         num_kv_heads: number of KV heads
+        k_scale, v_scale: [num_blocks, block_size, num_kv_heads] for a quantized cache
 
     Returns:
         output: [total_q_tokens, num_heads, head_dim]
@@ -214,8 +439,8 @@ def _sdpa_prefill_with_paged_cache(
         # Gather k/v from paged cache
         num_blocks_needed = (k_len + block_size - 1) // block_size
         block_indices = block_tables[i, :num_blocks_needed]
-        ki = k_cache[block_indices].reshape(-1, num_kv_heads, k_cache.shape[-1])[:k_len]
-        vi = v_cache[block_indices].reshape(-1, num_kv_heads, v_cache.shape[-1])[:k_len]
+        ki = _gather_blocks(k_cache, k_scale, block_indices, q.dtype).reshape(-1, num_kv_heads, k_cache.shape[-1])[:k_len]
+        vi = _gather_blocks(v_cache, v_scale, block_indices, q.dtype).reshape(-1, num_kv_heads, v_cache.shape[-1])[:k_len]
 
         # [seq, heads, dim] -> [1, heads, seq, dim]
         qi = q[q_start:q_end].unsqueeze(0).transpose(1, 2)
@@ -230,7 +455,7 @@ def _sdpa_prefill_with_paged_cache(
     return torch.cat(outputs, dim=0)
 
 
-def _sdpa_decode_with_paged_cache(
+def _sdpa_decode_with_paged_cache_loop(
     q: torch.Tensor,
     k_cache: torch.Tensor,
     v_cache: torch.Tensor,
@@ -239,8 +464,10 @@ def _sdpa_decode_with_paged_cache(
     scale: float,
     num_heads: int,
     num_kv_heads: int,
+    k_scale: torch.Tensor | None = None,
+    v_scale: torch.Tensor | None = None,
 ) -> torch.Tensor:
-    """SDPA replacement for flash_attn_with_kvcache during decode.
+    """Per-sequence reference for _sdpa_decode_with_paged_cache.
 
     For each sequence, gathers KV from paged cache and runs SDPA
     for the single new query token against the full context.
@@ -254,6 +481,7 @@ def _sdpa_decode_with_paged_cache(
         scale: attention scale factor
         num_heads: number of query heads
         num_kv_heads: number of KV heads
+        k_scale, v_scale: [num_blocks, block_size, num_kv_heads] for a quantized cache
 
     Returns:
         output: [batch, 1, num_heads, head_dim]
@@ -269,8 +497,8 @@ def _sdpa_decode_with_paged_cache(
         block_indices = block_tables[i, :num_blocks_needed]
 
         # Gather and trim KV: [ctx_len, num_kv_heads, head_dim]
-        ki = k_cache[block_indices].reshape(-1, num_kv_heads, k_cache.shape[-1])[:ctx_len]
-        vi = v_cache[block_indices].reshape(-1, num_kv_heads, v_cache.shape[-1])[:ctx_len]
+        ki = _gather_blocks(k_cache, k_scale, block_indices, q.dtype).reshape(-1, num_kv_heads, k_cache.shape[-1])[:ctx_len]
+        vi = _gather_blocks(v_cache, v_scale, block_indices, q.dtype).reshape(-1, num_kv_heads, v_cache.shape[-1])[:ctx_len]
 
         # q[i]: [1, num_heads, head_dim] -> [1, num_heads, 1, head_dim]
         qi = q[i].unsqueeze(0).transpose(1, 2)     # [1, num_heads, 1, head_dim]
@@ -285,6 +513,211 @@ def _sdpa_decode_with_paged_cache(
     return torch.stack(outputs, dim=0)  # [batch, 1, num_heads, head_dim]
 
 
+# ============================================================
+# Batched SDPA over padded sequences
+# ============================================================
+#
+# The per-sequence loops above call .item() on cu_seqlens / context_lens for
+# every sequence (one device sync each) and launch one SDPA per sequence. The
+# batched versions below build padded [num_seqs, heads, L, head_dim] views with
+# pure tensor indexing plus a boolean length/causal mask, so a whole batch is a
+# single SDPA call with no host syncs.
+
+def _padded_positions(cu_seqlens: torch.Tensor, max_len: int, total: int):
+    """Gather indices for a packed varlen batch padded to max_len.
+
+    Returns:
+        index: [num_seqs, max_len] packed-token index of each padded slot
+            (clamped to a valid token; padding slots are masked out later)
+        lens: [num_seqs] sequence lengths
+    """
+    cu_seqlens = cu_seqlens.long()
+    starts = cu_seqlens[:-1]
+    lens = cu_seqlens[1:] - starts
+    pos = torch.arange(max_len, device=cu_seqlens.device)
+    index = (starts.unsqueeze(1) + pos.unsqueeze(0)).clamp(max=total - 1)
+    return index, lens
+
+
+def _causal_length_mask(lens_q: torch.Tensor, lens_k: torch.Tensor, max_q: int, max_k: int) -> torch.Tensor:
+    """Boolean [num_seqs, 1, max_q, max_k] mask: causal (bottom-right aligned) and within length.
+
+    Query i of a sequence sits at absolute position i + (len_k - len_q), matching
+    flash_attn's causal convention when cached prefix tokens precede the queries.
+    """
+    device = lens_q.device
+    q_pos = torch.arange(max_q, device=device).view(1, max_q, 1)
+    k_pos = torch.arange(max_k, device=device).view(1, 1, max_k)
+    offset = (lens_k - lens_q).view(-1, 1, 1)
+    mask = (k_pos <= q_pos + offset) & (k_pos < lens_k.view(-1, 1, 1))
+    # Padded query rows would otherwise be fully masked (NaN softmax); key 0 is
+    # always visible to real rows, so unmasking it is a no-op for them.
+    mask[:, :, 0] = True
+    return mask.unsqueeze(1)
+
+
+def _unpad_output(o: torch.Tensor, cu_seqlens_q: torch.Tensor, total_q: int) -> torch.Tensor:
+    """[num_seqs, max_q, heads, dim] padded output -> [total_q, heads, dim] packed output."""
+    cu_seqlens_q = cu_seqlens_q.long()
+    token = torch.arange(total_q, device=cu_seqlens_q.device)
+    seq_ids = torch.searchsorted(cu_seqlens_q[1:], token, right=True)
+    return o[seq_ids, token - cu_seqlens_q[seq_ids]]
+
+
+def _gather_paged_kv(
+    cache: torch.Tensor,
+    block_tables: torch.Tensor,
+    scale: torch.Tensor | None = None,
+    dtype: torch.dtype | None = None,
+) -> torch.Tensor:
+    """Gather paged cache blocks into [num_seqs, heads, num_blocks * block_size, dim].
+
+    A quantized cache (scale given) is dequantized to dtype on the way.
+    """
+    num_seqs, max_blocks = block_tables.shape
+    _, block_size, num_kv_heads, head_dim = cache.shape
+    # -1 padding entries gather block 0; those slots are masked out by length
+    blocks = _gather_blocks(cache, scale, block_tables.clamp(min=0), dtype)
+    return blocks.view(num_seqs, max_blocks * block_size, num_kv_heads, head_dim).transpose(1, 2)
+
+
+def _sdpa_varlen_prefill(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    cu_seqlens_q: torch.Tensor,
+    cu_seqlens_k: torch.Tensor,
+    max_seqlen_q: int,
+    max_seqlen_k: int,
+    scale: float,
+    num_heads: int,
+    num_kv_heads: int,
+) -> torch.Tensor:
+    """SDPA replacement for flash_attn_varlen_func during prefill.
+
+    Pads the packed sequences to [num_seqs, heads, max_seqlen, head_dim] and runs
+    one masked SDPA call for the whole batch.
+
+    Args:
+        q: [total_q_tokens, num_heads, head_dim]
+        k: [total_k_tokens, num_kv_heads, head_dim]
+        v: [total_k_tokens, num_kv_heads, head_dim]
+        cu_seqlens_q: [num_seqs + 1] cumulative sequence lengths for queries
+        cu_seqlens_k: [num_seqs + 1] cumulative sequence lengths for keys
+        max_seqlen_q: longest query sequence (host int from the context)
+        max_seqlen_k: longest key sequence (host int from the context)
+        scale: attention scale factor
+        num_heads: number of query heads
+        num_kv_heads: number of KV heads
+
+    Returns:
+        output: [total_q_tokens, num_heads, head_dim]
+    """
+    q_index, lens_q = _padded_positions(cu_seqlens_q, max_seqlen_q, q.shape[0])
+    k_index, lens_k = _padded_positions(cu_seqlens_k, max_seqlen_k, k.shape[0])
+
+    # [num_seqs, L, heads, dim] -> [num_seqs, heads, L, dim]
+    qp = q[q_index].transpose(1, 2)
+    kp = k[k_index].transpose(1, 2)
+    vp = v[k_index].transpose(1, 2)
+    mask = _causal_length_mask(lens_q, lens_k, max_seqlen_q, max_seqlen_k)
+
+    o = F.scaled_dot_product_attention(
+        qp, kp, vp, attn_mask=mask, scale=scale, enable_gqa=num_heads != num_kv_heads
+    )
+    return _unpad_output(o.transpose(1, 2), cu_seqlens_q, q.shape[0])
+
+
+def _sdpa_prefill_with_paged_cache(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    cu_seqlens_q: torch.Tensor,
+    cu_seqlens_k: torch.Tensor,
+    max_seqlen_q: int,
+    block_tables: torch.Tensor,
+    scale: float,
+    num_heads: int,
+    num_kv_heads: int,
+    k_scale: torch.Tensor | None = None,
+    v_scale: torch.Tensor | None = None,
+) -> torch.Tensor:
+    """SDPA prefill with paged KV cache (prefix caching case), batched.
+
+    Args:
+        q: [total_q_tokens, num_heads, head_dim]
+        k_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        v_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        cu_seqlens_q: [num_seqs + 1]
+        cu_seqlens_k: [num_seqs + 1]
+        max_seqlen_q: longest query sequence (host int from the context)
+        block_tables: [num_seqs, max_blocks_per_seq], padded with -1
+        scale: attention scale factor
+        num_heads: number of query heads
+        num_kv_heads: number of KV heads
+        k_scale, v_scale: [num_blocks, block_size, num_kv_heads] for a quantized cache
+
+    Returns:
+        output: [total_q_tokens, num_heads, head_dim]
+    """
+    q_index, lens_q = _padded_positions(cu_seqlens_q, max_seqlen_q, q.shape[0])
+    lens_k = cu_seqlens_k[1:] - cu_seqlens_k[:-1]
+
+    qp = q[q_index].transpose(1, 2)
+    kp = _gather_paged_kv(k_cache, block_tables, k_scale, q.dtype)
+    vp = _gather_paged_kv(v_cache, block_tables, v_scale, q.dtype)
+    mask = _causal_length_mask(lens_q, lens_k, max_seqlen_q, kp.shape[2])
+
+    o = F.scaled_dot_product_attention(
+        qp, kp, vp, attn_mask=mask, scale=scale, enable_gqa=num_heads != num_kv_heads
+    )
+    return _unpad_output(o.transpose(1, 2), cu_seqlens_q, q.shape[0])
+
+
+def _sdpa_decode_with_paged_cache(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    context_lens: torch.Tensor,
+    block_tables: torch.Tensor,
+    scale: float,
+    num_heads: int,
+    num_kv_heads: int,
+    k_scale: torch.Tensor | None = None,
+    v_scale: torch.Tensor | None = None,
+) -> torch.Tensor:
+    """SDPA replacement for flash_attn_with_kvcache during decode.
+
+    Gathers every sequence's blocks into one padded [batch, kv_heads, Lmax, head_dim]
+    view (Lmax = block_tables width * block_size) and runs a single SDPA call with
+    a context-length mask.
+
+    Args:
+        q: [batch, 1, num_heads, head_dim] (already unsqueezed)
+        k_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        v_cache: [num_blocks, block_size, num_kv_heads, head_dim]
+        context_lens: [batch] - number of tokens in context for each sequence
+        block_tables: [batch, max_blocks_per_seq], padded with -1
+        scale: attention scale factor
+        num_heads: number of query heads
+        num_kv_heads: number of KV heads
+        k_scale, v_scale: [num_blocks, block_size, num_kv_heads] for a quantized cache
+
+    Returns:
+        output: [batch, 1, num_heads, head_dim]
+    """
+    kp = _gather_paged_kv(k_cache, block_tables, k_scale, q.dtype)
+    vp = _gather_paged_kv(v_cache, block_tables, v_scale, q.dtype)
+    max_len = kp.shape[2]
+    mask = torch.arange(max_len, device=q.device).unsqueeze(0) < context_lens.unsqueeze(1)
+
+    o = F.scaled_dot_product_attention(
+        q.transpose(1, 2), kp, vp,
+        attn_mask=mask.view(-1, 1, 1, max_len), scale=scale, enable_gqa=num_heads != num_kv_heads,
+    )
+    return o.transpose(1, 2)  # [batch, 1, num_heads, head_dim]
+
+
 # ============================================================
 # Attention module
 # ============================================================
@@ -304,6 +737,8 @@ class Attention(nn.Module):
         self.scale = scale
         self.num_kv_heads = num_kv_heads
         self.k_cache = self.v_cache = torch.tensor([])
+        # Per (slot, kv head) scales, bound only when the cache is int8 / fp8
+        self.k_scale = self.v_scale = None
 
     def forward(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
         context = get_context()
@@ -322,7 +757,7 @@ class Attention(nn.Module):
                 _debug_log(f"  context_lens={context.context_lens.tolist()}")
 
         if k_cache.numel() and v_cache.numel():
-            store_kvcache(k, v, k_cache, v_cache, context.slot_mapping)
+            store_kvcache(k, v, k_cache, v_cache, context.slot_mapping, self.k_scale, self.v_scale)
 
         if _HAS_FLASH_ATTN:
             return self._forward_flash_attn(q, k, v, k_cache, v_cache, context)
@@ -332,8 +767,12 @@ class Attention(nn.Module):
     def _forward_flash_attn(self, q, k, v, k_cache, v_cache, context):
         """Original flash attention path."""
         if context.is_prefill:
-            if context.block_tables is not None:  # prefix cache
+            block_tables = context.block_tables
+            if block_tables is not None:  # prefix cache
                 k, v = k_cache, v_cache
+                if self.k_scale is not None:
+                    k, _ = _dequantize_paged_cache(k_cache, self.k_scale, block_tables, q.dtype)
+                    v, block_tables = _dequantize_paged_cache(v_cache, self.v_scale, block_tables, q.dtype)
             _debug_log(f"  calling flash_attn_varlen_func")
             o = flash_attn_varlen_func(
                 q, k, v,
@@ -343,14 +782,24 @@ class Attention(nn.Module):
                 cu_seqlens_k=context.cu_seqlens_k,
                 softmax_scale=self.scale,
                 causal=True,
-                block_table=context.block_tables,
+                block_table=block_tables,
+            )
+        elif self.k_scale is not None and _HAS_TRITON:
+            _debug_log(f"  calling paged_decode_quantized")
+            o = paged_decode_quantized(
+                q, k_cache, v_cache, self.k_scale, self.v_scale,
+                context.context_lens, context.block_tables, self.scale,
             )
         else:  # decode
+            block_tables = context.block_tables
+            if self.k_scale is not None:
+                k_cache, _ = _dequantize_paged_cache(k_cache, self.k_scale, block_tables, q.dtype)
+                v_cache, block_tables = _dequantize_paged_cache(v_cache, self.v_scale, block_tables, q.dtype)
             _debug_log(f"  calling flash_attn_with_kvcache")
             o = flash_attn_with_kvcache(
                 q.unsqueeze(1), k_cache, v_cache,
                 cache_seqlens=context.context_lens,
-                block_table=context.block_tables,
+                block_table=block_tables,
                 softmax_scale=self.scale,
                 causal=True,
             )
@@ -358,6 +807,8 @@ class Attention(nn.Module):
 
     def _forward_sdpa(self, q, k, v, k_cache, v_cache, context):
         """SDPA fallback path (no flash_attn dependency)."""
+        if _SDPA_LOOP:
+            return self._forward_sdpa_loop(q, k, v, k_cache, v_cache, context)
         if context.is_prefill:
             if context.block_tables is not None:
                 # Prefix cache: gather from paged cache
@@ -365,8 +816,9 @@ class Attention(nn.Module):
                 o = _sdpa_prefill_with_paged_cache(
                     q, k_cache, v_cache,
                     context.cu_seqlens_q, context.cu_seqlens_k,
-                    context.block_tables,
+                    context.max_seqlen_q, context.block_tables,
                     self.scale, self.num_heads, self.num_kv_heads,
+                    self.k_scale, self.v_scale,
                 )
             else:
                 # Standard prefill: k, v are packed tokens
@@ -374,6 +826,7 @@ class Attention(nn.Module):
                 o = _sdpa_varlen_prefill(
                     q, k, v,
                     context.cu_seqlens_q, context.cu_seqlens_k,
+                    context.max_seqlen_q, context.max_seqlen_k,
                     self.scale, self.num_heads, self.num_kv_heads,
                 )
         else:
@@ -383,5 +836,32 @@ class Attention(nn.Module):
                 q.unsqueeze(1), k_cache, v_cache,
                 context.context_lens, context.block_tables,
                 self.scale, self.num_heads, self.num_kv_heads,
+                self.k_scale, self.v_scale,
+            )
+        return o
+
+    def _forward_sdpa_loop(self, q, k, v, k_cache, v_cache, context):
+        """Per-sequence SDPA path (NANOVLLM_SDPA_LOOP=1), kept as a reference."""
+        if context.is_prefill:
+            if context.block_tables is not None:
+                o = _sdpa_prefill_with_paged_cache_loop(
+                    q, k_cache, v_cache,
+                    context.cu_seqlens_q, context.cu_seqlens_k,
+                    context.block_tables,
+                    self.scale, self.num_heads, self.num_kv_heads,
+                    self.k_scale, self.v_scale,
+                )
+            else:
+                o = _sdpa_varlen_prefill_loop(
+                    q, k, v,
+                    context.cu_seqlens_q, context.cu_seqlens_k,
+                    self.scale, self.num_heads, self.num_kv_heads,
+                )
+        else:
+            o = _sdpa_decode_with_paged_cache_loop(
+                q.unsqueeze(1), k_cache, v_cache,
+                context.context_lens, context.block_tables,
+                self.scale, self.num_heads, self.num_kv_heads,
+                self.k_scale, self.v_scale,
             )
         return o
@@ -3,6 +3,8 @@ from torch import nn
 import torch.nn.functional as F
 import torch.distributed as dist
 
+from nanovllm.layers.quantization import QuantConfig
+
 
 def divide(numerator, denominator):
     assert numerator % denominator == 0
@@ -17,19 +19,52 @@ class LinearBase(nn.Module):
         output_size: int,
         bias: bool = False,
         tp_dim: int | None = None,
+        quant_config: QuantConfig | None = None,
     ):
         super().__init__()
         self.tp_dim = tp_dim
         self.tp_rank = dist.get_rank()
         self.tp_size = dist.get_world_size()
-        self.weight = nn.Parameter(torch.empty(output_size, input_size))
-        self.weight.weight_loader = self.weight_loader
+        self.quant_config = quant_config
+        if quant_config is not None and quant_config.prequantized:
+            # The weight loaders shard along tp_dim generically, so they fill
+            # qweight/scales/zeros the same way as a float weight
+            dtype = torch.get_default_dtype()
+            for name, tensor in quant_config.create_weights(output_size, input_size, dtype).items():
+                param = nn.Parameter(tensor, requires_grad=False)
+                param.weight_loader = self.weight_loader
+                self.register_parameter(name, param)
+        else:
+            # Loaded on the host when it is quantized afterwards (see quantize_weight)
+            device = "cpu" if quant_config is not None else None
+            self.weight = nn.Parameter(
+                torch.empty(output_size, input_size, device=device),
+                requires_grad=quant_config is None,
+            )
+            self.weight.weight_loader = self.weight_loader
         if bias:
             self.bias = nn.Parameter(torch.empty(output_size))
             self.bias.weight_loader = self.weight_loader
         else:
             self.register_parameter("bias", None)
 
+    def quantize_weight(self, device: torch.device):
+        """Replace the float weight loaded from the checkpoint with its quantized form on device."""
+        if self.quant_config is None or self.quant_config.prequantized:
+            return
+        quantized = self.quant_config.quantize(self.weight.data.to(device))
+        del self.weight
+        for name, tensor in quantized.items():
+            param = nn.Parameter(tensor, requires_grad=False)
+            param.weight_loader = self.weight_loader
+            self.register_parameter(name, param)
+
+    def linear(self, x: torch.Tensor, bias: torch.Tensor | None) -> torch.Tensor:
+        if self.quant_config is None:
+            return F.linear(x, self.weight, bias)
+        y = self.quant_config.apply(x, self._parameters)
+        return y + bias if bias is not None else y
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         raise NotImplementedError
 
@@ -41,14 +76,15 @@ class ReplicatedLinear(LinearBase):
         input_size: int,
         output_size: int,
         bias: bool = False,
+        quant_config: QuantConfig | None = None,
     ):
-        super().__init__(input_size, output_size, bias)
+        super().__init__(input_size, output_size, bias, quant_config=quant_config)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor):
         param.data.copy_(loaded_weight)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return F.linear(x, self.weight, self.bias)
+        return self.linear(x, self.bias)
 
 
 class ColumnParallelLinear(LinearBase):
@@ -58,9 +94,10 @@ class ColumnParallelLinear(LinearBase):
         input_size: int,
         output_size: int,
         bias: bool = False,
+        quant_config: QuantConfig | None = None,
     ):
         tp_size = dist.get_world_size()
-        super().__init__(input_size, divide(output_size, tp_size), bias, 0)
+        super().__init__(input_size, divide(output_size, tp_size), bias, 0, quant_config)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor):
         param_data = param.data
@@ -70,7 +107,7 @@ class ColumnParallelLinear(LinearBase):
         param_data.copy_(loaded_weight)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return F.linear(x, self.weight, self.bias)
+        return self.linear(x, self.bias)
 
 
 class MergedColumnParallelLinear(ColumnParallelLinear):
@@ -80,9 +117,10 @@ class MergedColumnParallelLinear(ColumnParallelLinear):
         input_size: int,
         output_sizes: list[int],
         bias: bool = False,
+        quant_config: QuantConfig | None = None,
     ):
         self.output_sizes = output_sizes
-        super().__init__(input_size, sum(output_sizes), bias)
+        super().__init__(input_size, sum(output_sizes), bias, quant_config)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor, loaded_shard_id: int):
         param_data = param.data
@@ -102,6 +140,7 @@ class QKVParallelLinear(ColumnParallelLinear):
         total_num_heads: int,
         total_num_kv_heads: int | None = None,
         bias: bool = False,
+        quant_config: QuantConfig | None = None,
     ):
         tp_size = dist.get_world_size()
         total_num_kv_heads = total_num_kv_heads or total_num_heads
@@ -109,7 +148,7 @@ class QKVParallelLinear(ColumnParallelLinear):
         self.num_heads = divide(total_num_heads, tp_size)
         self.num_kv_heads = divide(total_num_kv_heads, tp_size)
         output_size = (total_num_heads + 2 * total_num_kv_heads) * self.head_size
-        super().__init__(hidden_size, output_size, bias)
+        super().__init__(hidden_size, output_size, bias, quant_config)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor, loaded_shard_id: str):
         param_data = param.data
@@ -135,19 +174,24 @@ class RowParallelLinear(LinearBase):
         input_size: int,
         output_size: int,
         bias: bool = False,
+        quant_config: QuantConfig | None = None,
     ):
         tp_size = dist.get_world_size()
-        super().__init__(divide(input_size, tp_size), output_size, bias, 1)
+        super().__init__(divide(input_size, tp_size), output_size, bias, 1, quant_config)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor):
         param_data = param.data
+        if loaded_weight.shape == param_data.shape:
+            # Not split across ranks (e.g. int8 per-output-channel scales)
+            param_data.copy_(loaded_weight)
+            return
         shard_size = param_data.size(self.tp_dim)
         start_idx = self.tp_rank * shard_size
         loaded_weight = loaded_weight.narrow(self.tp_dim, start_idx, shard_size)
         param_data.copy_(loaded_weight)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        y = F.linear(x, self.weight, self.bias if self.tp_rank == 0 else None)
+        y = self.linear(x, self.bias if self.tp_rank == 0 else None)
         if self.tp_size > 1:
             dist.all_reduce(y)
         return y
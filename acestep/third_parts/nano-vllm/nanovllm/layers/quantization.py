@@ -0,0 +1,185 @@
+import json
+import os
+from dataclasses import dataclass
+
+import torch
+import torch.nn.functional as F
+
+# Written next to config.json by utils.quantize.quantize_checkpoint
+QUANT_CONFIG_FILENAME = "nanovllm_quant.json"
+QUANT_METHODS = ("int8", "int4")
+
+# Up to this many rows the matmul is bound by reading the weight. Written as a
+# broadcast-multiply + reduction, inductor fuses the dequantization into it, so
+# only the packed weight is read from memory.
+_SMALL_BATCH = 16
+
+
+def quantize_int8(weight: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric per-output-channel int8: weight ~= qweight * scales[:, None]."""
+    w = weight.float()
+    scales = (w.abs().amax(dim=1) / 127).clamp(min=1e-8)
+    qweight = torch.round(w / scales[:, None]).clamp(-128, 127).to(torch.int8)
+    return qweight, scales.to(weight.dtype)
+
+
+def dequantize_int8(qweight: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    return qweight.to(scales.dtype) * scales[:, None]
+
+
+def quantize_int4(weight: torch.Tensor, group_size: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Asymmetric int4 over groups of group_size input channels.
+
+    weight[:, g] ~= q * scales[:, g] + zeros[:, g] with q in [0, 15]; two values
+    are packed per uint8 along the input dimension (low nibble first).
+    """
+    out_features, in_features = weight.shape
+    assert in_features % group_size == 0 and group_size % 2 == 0
+    w = weight.float().view(out_features, in_features // group_size, group_size)
+    w_min = w.amin(dim=-1)
+    scales = ((w.amax(dim=-1) - w_min) / 15).clamp(min=1e-8)
+    q = torch.round((w - w_min[..., None]) / scales[..., None]).clamp(0, 15).to(torch.uint8)
+    q = q.view(out_features, in_features)
+    qweight = q[:, 0::2] | (q[:, 1::2] << 4)
+    return qweight, scales.to(weight.dtype), w_min.to(weight.dtype)
+
+
+def dequantize_int4(qweight: torch.Tensor, scales: torch.Tensor, zeros: torch.Tensor) -> torch.Tensor:
+    out_features = qweight.size(0)
+    q = torch.stack([qweight & 0xF, qweight >> 4], dim=-1).view(out_features, scales.size(1), -1)
+    w = q.to(scales.dtype) * scales[..., None] + zeros[..., None]
+    return w.view(out_features, -1)
+
+
+def int8_linear_reference(x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    """Reference kernel (any device): dequantize, then a dense matmul."""
+    return F.linear(x, dequantize_int8(qweight, scales.to(x.dtype)))
+
+
+def int4_linear_reference(
+    x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor, zeros: torch.Tensor
+) -> torch.Tensor:
+    """Reference kernel (any device): dequantize, then a dense matmul."""
+    return F.linear(x, dequantize_int4(qweight, scales.to(x.dtype), zeros.to(x.dtype)))
+
+
+@torch.compile(dynamic=True)
+def _int8_linear_fused(x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    if x.size(0) <= _SMALL_BATCH:
+        y = (x.unsqueeze(1) * qweight.to(x.dtype)).sum(dim=-1)
+    else:
+        y = F.linear(x, qweight.to(x.dtype))
+    return y * scales
+
+
+@torch.compile(dynamic=True)
+def _int4_linear_fused(
+    x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor, zeros: torch.Tensor
+) -> torch.Tensor:
+    w = dequantize_int4(qweight, scales, zeros)
+    if x.size(0) <= _SMALL_BATCH:
+        return (x.unsqueeze(1) * w).sum(dim=-1)
+    return F.linear(x, w)
+
+
+@dataclass
+class QuantConfig:
+    """Weight-only quantization of the model's linear layers.
+
+    The embeddings and the LM head stay in the model dtype: they are lookups or a
+    single matmul, and the head decides every sampled token.
+    """
+    method: str
+    group_size: int = 128
+    # The checkpoint holds qweight/scales(/zeros) tensors. Otherwise float weights
+    # are loaded on the host and quantized layer by layer after loading, so the
+    # full-precision model never has to fit on the device.
+    prequantized: bool = False
+
+    def __post_init__(self):
+        assert self.method in QUANT_METHODS, f"Unsupported quantization: {self.method}"
+        assert self.group_size > 0 and self.group_size % 2 == 0
+
+    def create_weights(self, output_size: int, input_size: int, dtype: torch.dtype) -> dict[str, torch.Tensor]:
+        """Empty quantized tensors for a (output_size, input_size) weight."""
+        if self.method == "int8":
+            return {
+                "qweight": torch.empty(output_size, input_size, dtype=torch.int8),
+                "scales": torch.empty(output_size, dtype=dtype),
+            }
+        assert input_size % self.group_size == 0, (
+            f"input size {input_size} is not a multiple of the int4 group size {self.group_size}"
+        )
+        num_groups = input_size // self.group_size
+        return {
+            "qweight": torch.empty(output_size, input_size // 2, dtype=torch.uint8),
+            "scales": torch.empty(output_size, num_groups, dtype=dtype),
+            "zeros": torch.empty(output_size, num_groups, dtype=dtype),
+        }
+
+    def quantize(self, weight: torch.Tensor) -> dict[str, torch.Tensor]:
+        if self.method == "int8":
+            qweight, scales = quantize_int8(weight)
+            return {"qweight": qweight, "scales": scales}
+        qweight, scales, zeros = quantize_int4(weight, self.group_size)
+        return {"qweight": qweight, "scales": scales, "zeros": zeros}
+
+    def apply(self, x: torch.Tensor, weights: dict[str, torch.Tensor]) -> torch.Tensor:
+        shape = x.shape
+        x = x.reshape(-1, shape[-1])
+        fused = x.is_cuda
+        if self.method == "int8":
+            kernel = _int8_linear_fused if fused else int8_linear_reference
+            y = kernel(x, weights["qweight"], weights["scales"])
+        else:
+            kernel = _int4_linear_fused if fused else int4_linear_reference
+            y = kernel(x, weights["qweight"], weights["scales"], weights["zeros"])
+        return y.view(*shape[:-1], y.size(-1))
+
+
+def read_quant_config(model_path: str) -> dict | None:
+    """Quantization settings saved with a pre-quantized checkpoint, if any."""
+    path = os.path.join(model_path, QUANT_CONFIG_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_quant_config(model_path: str, method: str, group_size: int):
+    with open(os.path.join(model_path, QUANT_CONFIG_FILENAME), "w", encoding="utf-8") as f:
+        json.dump({"method": method, "group_size": group_size}, f, indent=2)
+
+
+# ============================================================
+# Quantized paged KV cache
+# ============================================================
+#
+# Keys and values are stored as int8 or fp8 (e4m3) with one float32 scale per
+# (slot, kv head), kept in a paged tensor of the same block layout as the cache.
+# A scale per token rather than per block lets a block be filled one decode
+# step at a time without rescaling what it already holds.
+
+KV_CACHE_DTYPES = {
+    "int8": torch.int8,
+    "fp8": torch.float8_e4m3fn,
+}
+
+
+def kv_qmax(dtype: torch.dtype) -> float:
+    """Largest magnitude stored in a quantized cache of this dtype."""
+    return 127.0 if dtype == torch.int8 else torch.finfo(dtype).max
+
+
+def quantize_kv(x: torch.Tensor, dtype: torch.dtype) -> tuple[torch.Tensor, torch.Tensor]:
+    """[..., head_dim] -> (values in dtype, float32 scales [...])."""
+    x = x.float()
+    scales = (x.abs().amax(dim=-1) / kv_qmax(dtype)).clamp(min=1e-8)
+    q = x / scales.unsqueeze(-1)
+    if dtype == torch.int8:
+        q = torch.round(q)
+    return q.to(dtype), scales
+
+
+def dequantize_kv(q: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    return q.to(dtype) * scales.unsqueeze(-1).to(dtype)
@@ -111,4 +111,20 @@ class Sampler(nn.Module):
         )
         probs = torch.softmax(logits, dim=-1)
         sample_tokens = probs.div_(torch.empty_like(probs).exponential_(1).clamp_min_(1e-10)).argmax(dim=-1)
-        return sample_tokens
\ No newline at end of file
+        return sample_tokens
+
+    @torch.inference_mode()
+    def probs(
+        self,
+        logits: torch.Tensor,
+        temperatures: torch.Tensor,
+        top_ks: Optional[torch.Tensor] = None,
+        top_ps: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """The distribution forward() samples from, as float32 probabilities.
+
+        Used by speculative decoding to accept or reject draft tokens.
+        """
+        logits = logits.float().div_(temperatures.unsqueeze(dim=1))
+        logits = apply_top_k_top_p(logits, top_ks, top_ps)
+        return torch.softmax(logits, dim=-1)
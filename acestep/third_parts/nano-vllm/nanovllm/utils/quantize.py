@@ -0,0 +1,49 @@
+import os
+import shutil
+from glob import glob
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from nanovllm.layers.quantization import QuantConfig, write_quant_config
+
+# Checkpoint (HuggingFace) names of the weights nano-vllm loads into linear layers
+QUANTIZED_PROJECTIONS = ("q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj")
+
+
+def quantize_checkpoint(model_path: str, output_path: str, method: str = "int8", group_size: int = 128) -> str:
+    """Write a pre-quantized copy of a Qwen3 checkpoint for nano-vllm.
+
+    Linear weights are stored as <name>.qweight / .scales (/ .zeros for int4)
+    under their original names, so the engine's packed-module mapping loads
+    them like float weights; all other tensors and files are copied as-is.
+    Quantization runs on the host, so no GPU is needed.
+
+    Returns:
+        output_path
+    """
+    quant_config = QuantConfig(method, group_size)
+    safetensor_files = glob(os.path.join(model_path, "*.safetensors"))
+    if not safetensor_files:
+        raise FileNotFoundError(f"No .safetensors files found in {model_path}")
+    os.makedirs(output_path, exist_ok=True)
+
+    for name in os.listdir(model_path):
+        src = os.path.join(model_path, name)
+        if os.path.isfile(src) and not name.endswith(".safetensors") and not name.endswith(".safetensors.index.json"):
+            shutil.copy2(src, os.path.join(output_path, name))
+
+    tensors = {}
+    for file in safetensor_files:
+        with safe_open(file, "pt", "cpu") as f:
+            for weight_name in f.keys():
+                tensor = f.get_tensor(weight_name)
+                module_name, _, param = weight_name.rpartition(".")
+                if param == "weight" and module_name.rsplit(".", 1)[-1] in QUANTIZED_PROJECTIONS:
+                    for suffix, quantized in quant_config.quantize(tensor).items():
+                        tensors[f"{module_name}.{suffix}"] = quantized.contiguous()
+                else:
+                    tensors[weight_name] = tensor
+    save_file(tensors, os.path.join(output_path, "model.safetensors"), metadata={"format": "pt"})
+    write_quant_config(output_path, method, group_size)
+    return output_path
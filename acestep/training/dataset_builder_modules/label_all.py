@@ -1,4 +1,9 @@
-from typing import List, Tuple
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
 
 from .models import AudioSample
 
@@ -15,43 +20,115 @@ class LabelAllMixin:
         skip_metas: bool = False,
         only_unlabeled: bool = False,
         progress_callback=None,
+        batch_size: int = 8,
+        num_workers: int = 4,
+        save_path: Optional[str] = None,
     ) -> Tuple[List[AudioSample], str]:
-        """Label all samples in the dataset."""
+        """Label all samples in the dataset.
+
+        Samples are processed in batches: audio files are decoded by a thread pool
+        (one batch ahead of the GPU), VAE-encoded (batched where their lengths match,
+        see encode_audios_to_code_ids), and their understanding prompts are submitted
+        to the LM as one batch.
+
+        With save_path, the dataset JSON is rewritten after every batch. If a run is
+        interrupted, the next call with the same save_path restores the samples that
+        run had finished instead of labeling them again.
+        """
         if not self.samples:
             return [], "❌ No samples to label. Please scan a directory first."
 
+        resumed = self._restore_label_progress(save_path) if save_path else set()
+
         if only_unlabeled:
             samples_to_label = [
                 (i, s) for i, s in enumerate(self.samples) if not s.labeled or not s.caption
             ]
         else:
             samples_to_label = [(i, s) for i, s in enumerate(self.samples)]
+        samples_to_label = [(i, s) for i, s in samples_to_label if s.audio_path not in resumed]
 
         if not samples_to_label:
+            if save_path:
+                self._finish_label_progress(save_path)
             return self.samples, "✅ All samples already labeled"
 
         success_count = 0
         fail_count = 0
         total = len(samples_to_label)
+        done = 0
+        batch_size = max(1, batch_size)
 
-        for idx, (i, sample) in enumerate(samples_to_label):
-            if progress_callback:
-                progress_callback(f"Labeling {idx+1}/{total}: {sample.filename}")
+        # Samples whose lyrics get formatted by the LM don't need audio codes
+        format_items = [
+            (i, s) for i, s in samples_to_label
+            if format_lyrics and s.has_raw_lyrics() and not s.is_instrumental
+        ]
+        format_ids = {i for i, _ in format_items}
+        # Sorting by length puts equal-length audios in the same batch, where they share VAE encodes
+        encode_items = sorted(
+            [(i, s) for i, s in samples_to_label if i not in format_ids],
+            key=lambda item: item[1].duration or 0,
+        )
+        batches = [encode_items[k:k + batch_size] for k in range(0, len(encode_items), batch_size)]
 
+        for i, sample in format_items:
+            done += 1
+            if progress_callback:
+                progress_callback(f"Labeling {done}/{total}: {sample.filename}")
             _, status = self.label_sample(
-                i,
-                dit_handler,
-                llm_handler,
-                format_lyrics,
-                transcribe_lyrics,
-                skip_metas,
-                progress_callback,
+                i, dit_handler, llm_handler, format_lyrics, transcribe_lyrics, skip_metas, progress_callback,
             )
-
             if "✅" in status:
                 success_count += 1
+                resumed.add(sample.audio_path)
             else:
                 fail_count += 1
+            if save_path and done % batch_size == 0:
+                self._save_label_progress(save_path, resumed)
+
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+
+            def _load(batch):
+                return [pool.submit(dit_handler.process_src_audio, s.audio_path) for _, s in batch]
+
+            pending = _load(batches[0]) if batches else []
+            for batch_idx, batch in enumerate(batches):
+                futures = pending
+                # Decode the next batch while this one is on the GPU
+                pending = _load(batches[batch_idx + 1]) if batch_idx + 1 < len(batches) else []
+
+                if progress_callback:
+                    progress_callback(
+                        f"Labeling {done + 1}-{done + len(batch)}/{total}: "
+                        f"{', '.join(s.filename for _, s in batch)}"
+                    )
+
+                audios = {}
+                for (i, sample), future in zip(batch, futures):
+                    try:
+                        audio = future.result()
+                    except Exception:
+                        logger.exception(f"Error loading audio {sample.audio_path}")
+                        audio = None
+                    if audio is not None:
+                        audios[i] = audio
+
+                statuses = self._label_batch(batch, audios, dit_handler, llm_handler, transcribe_lyrics, skip_metas)
+                for (i, sample), status in zip(batch, statuses):
+                    if "✅" in status:
+                        success_count += 1
+                        resumed.add(sample.audio_path)
+                    else:
+                        fail_count += 1
+                        logger.warning(status)
+                done += len(batch)
+
+                if save_path:
+                    self._save_label_progress(save_path, resumed)
+
+        if save_path:
+            self._finish_label_progress(save_path)
 
         status_msg = f"✅ Labeled {success_count}/{total} samples"
         if fail_count > 0:
@@ -60,3 +137,108 @@ class LabelAllMixin:
             status_msg += f" (unlabeled only, {len(self.samples)} total)"
 
         return self.samples, status_msg
+
+    def _label_batch(
+        self,
+        batch: List[Tuple[int, AudioSample]],
+        audios: Dict[int, object],
+        dit_handler,
+        llm_handler,
+        transcribe_lyrics: bool,
+        skip_metas: bool,
+    ) -> List[str]:
+        """Encode and understand one batch of samples; returns a status per sample."""
+        statuses = {i: f"❌ Failed to encode audio: {s.filename}" for i, s in batch}
+        try:
+            encoded = dit_handler.encode_audios_to_code_ids(list(audios.values())) if audios else []
+        except Exception as e:
+            logger.exception("Error encoding audio batch")
+            return [f"❌ Error: {str(e)}"] * len(batch)
+
+        codes = {}
+        for i, result in zip(audios.keys(), encoded):
+            if isinstance(result, str):
+                logger.warning(f"Failed to convert audio to codes: {result}")
+            elif result.size > 0:
+                codes[i] = result
+
+        if codes:
+            understood = llm_handler.understand_audio_from_codes_batch(
+                list(codes.values()),
+                temperature=0.7,
+                use_constrained_decoding=True,
+            )
+            by_index = dict(zip(codes.keys(), understood))
+            for i, sample in batch:
+                if i not in by_index:
+                    continue
+                metadata, status = by_index[i]
+                if not metadata:
+                    statuses[i] = f"❌ LLM labeling failed: {status}"
+                    continue
+                suffix = self._apply_understanding(sample, metadata, transcribe_lyrics, skip_metas)
+                self.samples[i] = sample
+                statuses[i] = self._labeled_status(sample, skip_metas, suffix)
+
+        return [statuses[i] for i, _ in batch]
+
+    # ------------------------------------------------------------------
+    # Resumable progress: the dataset JSON is saved after every batch, and a
+    # small "<save_path>.labeling" marker lists the samples finished by the
+    # current run. The marker only exists while a run is in progress, so its
+    # presence at start means the previous run was interrupted.
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _label_marker_path(save_path: str) -> str:
+        return f"{save_path}.labeling"
+
+    def _save_label_progress(self, save_path: str, finished: Set[str]):
+        marker = self._label_marker_path(save_path)
+        try:
+            status = self.save_dataset(save_path)
+            if not status.startswith("✅"):
+                logger.warning(f"Could not save labeling progress: {status}")
+                return
+            tmp_path = f"{marker}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(finished), f, ensure_ascii=False)
+            os.replace(tmp_path, marker)
+        except OSError as e:
+            logger.warning(f"Could not save labeling progress to {save_path}: {e}")
+
+    def _restore_label_progress(self, save_path: str) -> Set[str]:
+        """Copy labels finished by an interrupted run back into self.samples."""
+        marker = self._label_marker_path(save_path)
+        if not (os.path.exists(marker) and os.path.exists(save_path)):
+            return set()
+        try:
+            with open(marker, "r", encoding="utf-8") as f:
+                finished = set(json.load(f))
+            with open(save_path, "r", encoding="utf-8") as f:
+                saved = {
+                    d.get("audio_path"): d for d in json.load(f).get("samples", [])
+                    if d.get("audio_path") in finished
+                }
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable labeling progress in {save_path}: {e}")
+            return set()
+
+        restored = set()
+        for idx, sample in enumerate(self.samples):
+            data = saved.get(sample.audio_path)
+            if data is not None and data.get("labeled"):
+                restored_sample = AudioSample.from_dict(data)
+                restored_sample.id = sample.id
+                self.samples[idx] = restored_sample
+                restored.add(sample.audio_path)
+        if restored:
+            logger.info(f"Resuming labeling: restored {len(restored)} samples from {save_path}")
+        return restored
+
+    def _finish_label_progress(self, save_path: str):
+        self._save_label_progress(save_path, set())
+        try:
+            os.remove(self._label_marker_path(save_path))
+        except OSError:
+            pass
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 from loguru import logger
 
@@ -26,8 +26,6 @@ class LabelSingleMixin:
         sample = self.samples[sample_idx]
 
         has_preloaded_lyrics = sample.has_raw_lyrics() and not sample.is_instrumental
-        has_csv_bpm = sample.bpm is not None
-        has_csv_key = bool(sample.keyscale)
 
         try:
             if progress_callback:
@@ -56,18 +54,7 @@ class LabelSingleMixin:
                 if not result.success:
                     return sample, f"❌ LLM format failed: {result.error}"
 
-                sample.caption = result.caption or ""
-                if not skip_metas:
-                    if not has_csv_bpm:
-                        sample.bpm = result.bpm
-                    if not has_csv_key:
-                        sample.keyscale = result.keyscale or ""
-                    sample.timesignature = result.timesignature or ""
-                sample.language = result.language or "unknown"
-                sample.formatted_lyrics = result.lyrics or ""
-                sample.lyrics = sample.formatted_lyrics if sample.formatted_lyrics else sample.raw_lyrics
-
-                status_suffix = "(lyrics formatted by LM)"
+                status_suffix = self._apply_format_result(sample, result, skip_metas)
 
             else:
                 metadata, status = llm_handler.understand_audio_from_codes(
@@ -79,49 +66,82 @@ class LabelSingleMixin:
                 if not metadata:
                     return sample, f"❌ LLM labeling failed: {status}"
 
-                sample.caption = metadata.get("caption", "")
-                sample.genre = metadata.get("genres", "")
-
-                if not skip_metas:
-                    if not has_csv_bpm:
-                        sample.bpm = parse_int(metadata.get("bpm"))
-                    if not has_csv_key:
-                        sample.keyscale = metadata.get("keyscale", "")
-                    sample.timesignature = metadata.get("timesignature", "")
-
-                sample.language = metadata.get("vocal_language", "unknown")
-
-                llm_lyrics = metadata.get("lyrics", "")
-
-                if sample.is_instrumental:
-                    sample.lyrics = "[Instrumental]"
-                    sample.language = "unknown"
-                    sample.formatted_lyrics = ""
-                    status_suffix = "(instrumental)"
-                elif transcribe_lyrics:
-                    sample.formatted_lyrics = llm_lyrics
-                    sample.lyrics = llm_lyrics
-                    status_suffix = "(lyrics transcribed by LM)"
-                elif has_preloaded_lyrics:
-                    sample.lyrics = sample.raw_lyrics
-                    sample.formatted_lyrics = ""
-                    status_suffix = "(using raw lyrics)"
-                else:
-                    sample.lyrics = llm_lyrics
-                    sample.formatted_lyrics = llm_lyrics
-                    status_suffix = ""
-
-            sample.labeled = True
-            self.samples[sample_idx] = sample
-
-            status_msg = f"✅ Labeled: {sample.filename}"
-            if skip_metas:
-                status_msg += " (skip metas)"
-            if status_suffix:
-                status_msg += f" {status_suffix}"
+                status_suffix = self._apply_understanding(sample, metadata, transcribe_lyrics, skip_metas)
 
-            return sample, status_msg
+            self.samples[sample_idx] = sample
+            return sample, self._labeled_status(sample, skip_metas, status_suffix)
 
         except Exception as e:
             logger.exception(f"Error labeling sample {sample.filename}")
             return sample, f"❌ Error: {str(e)}"
+
+    @staticmethod
+    def _apply_format_result(sample: AudioSample, result: Any, skip_metas: bool) -> str:
+        """Copy a format_sample() result into the sample; returns the status suffix."""
+        sample.caption = result.caption or ""
+        if not skip_metas:
+            if sample.bpm is None:
+                sample.bpm = result.bpm
+            if not sample.keyscale:
+                sample.keyscale = result.keyscale or ""
+            sample.timesignature = result.timesignature or ""
+        sample.language = result.language or "unknown"
+        sample.formatted_lyrics = result.lyrics or ""
+        sample.lyrics = sample.formatted_lyrics if sample.formatted_lyrics else sample.raw_lyrics
+        sample.labeled = True
+        return "(lyrics formatted by LM)"
+
+    @staticmethod
+    def _apply_understanding(
+        sample: AudioSample,
+        metadata: Dict[str, Any],
+        transcribe_lyrics: bool,
+        skip_metas: bool,
+    ) -> str:
+        """Copy understand_audio_from_codes() metadata into the sample; returns the status suffix."""
+        has_preloaded_lyrics = sample.has_raw_lyrics() and not sample.is_instrumental
+
+        sample.caption = metadata.get("caption", "")
+        sample.genre = metadata.get("genres", "")
+
+        if not skip_metas:
+            # BPM / key from the CSV take precedence over the LM's guess
+            if sample.bpm is None:
+                sample.bpm = parse_int(metadata.get("bpm"))
+            if not sample.keyscale:
+                sample.keyscale = metadata.get("keyscale", "")
+            sample.timesignature = metadata.get("timesignature", "")
+
+        sample.language = metadata.get("vocal_language", "unknown")
+
+        llm_lyrics = metadata.get("lyrics", "")
+
+        if sample.is_instrumental:
+            sample.lyrics = "[Instrumental]"
+            sample.language = "unknown"
+            sample.formatted_lyrics = ""
+            status_suffix = "(instrumental)"
+        elif transcribe_lyrics:
+            sample.formatted_lyrics = llm_lyrics
+            sample.lyrics = llm_lyrics
+            status_suffix = "(lyrics transcribed by LM)"
+        elif has_preloaded_lyrics:
+            sample.lyrics = sample.raw_lyrics
+            sample.formatted_lyrics = ""
+            status_suffix = "(using raw lyrics)"
+        else:
+            sample.lyrics = llm_lyrics
+            sample.formatted_lyrics = llm_lyrics
+            status_suffix = ""
+
+        sample.labeled = True
+        return status_suffix
+
+    @staticmethod
+    def _labeled_status(sample: AudioSample, skip_metas: bool, status_suffix: Optional[str]) -> str:
+        status_msg = f"✅ Labeled: {sample.filename}"
+        if skip_metas:
+            status_msg += " (skip metas)"
+        if status_suffix:
+            status_msg += f" {status_suffix}"
+        return status_msg
@@ -1,87 +1,176 @@
 import os
-from typing import List, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
 
 from loguru import logger
 
 from .audio_io import get_audio_duration, load_lyrics_file
 from .csv_metadata import load_csv_metadata
 from .models import AudioSample, SUPPORTED_AUDIO_FORMATS
+from .scan_index import ScanIndex, file_stat
 
 
 class ScanMixin:
     """Directory scanning helpers."""
 
-    def scan_directory(self, directory: str) -> Tuple[List[AudioSample], str]:
+    def scan_directory(
+        self,
+        directory: str,
+        num_workers: int = 16,
+        use_index: bool = True,
+    ) -> Tuple[List[AudioSample], str]:
         """Scan a directory for audio files."""
+        samples, status = [], ""
+        for samples, status in self.iter_scan_directory(directory, num_workers=num_workers, use_index=use_index):
+            pass
+        return samples, status
+
+    def iter_scan_directory(
+        self,
+        directory: str,
+        num_workers: int = 16,
+        use_index: bool = True,
+        chunk_size: int = 200,
+    ) -> Iterator[Tuple[List[AudioSample], str]]:
+        """Scan a directory for audio files, yielding (samples, status) as they are found.
+
+        Durations and lyrics files are probed by a thread pool while the tree is still
+        being walked. With use_index, probed durations are cached in the directory's
+        scan index so rescans only probe new or modified files. A partial result is
+        yielded every chunk_size samples; the last yield is the final, sorted result.
+        """
         if not os.path.exists(directory):
-            return [], f"❌ Directory not found: {directory}"
+            yield [], f"❌ Directory not found: {directory}"
+            return
 
         if not os.path.isdir(directory):
-            return [], f"❌ Not a directory: {directory}"
+            yield [], f"❌ Not a directory: {directory}"
+            return
 
         self._current_dir = directory
         self.samples = []
 
-        audio_files = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                ext = os.path.splitext(file)[1].lower()
-                if ext in SUPPORTED_AUDIO_FORMATS:
-                    audio_files.append(os.path.join(root, file))
-
-        if not audio_files:
-            return [], (
-                f"❌ No audio files found in {directory}\n"
-                f"Supported formats: {', '.join(SUPPORTED_AUDIO_FORMATS)}"
-            )
-
-        audio_files.sort()
-
         csv_metadata = load_csv_metadata(directory)
-        csv_count = 0
-        lyrics_count = 0
+        index = ScanIndex(directory) if use_index else None
+        counts = {"csv": 0, "lyrics": 0, "cached": 0}
+        found = 0
+        max_pending = max(1, num_workers) * 4
 
-        for audio_path in audio_files:
+        def _collect(future):
             try:
-                duration = get_audio_duration(audio_path)
-                lyrics_content, has_lyrics_file = load_lyrics_file(audio_path)
-
-                is_instrumental = self.metadata.all_instrumental
-                if has_lyrics_file:
-                    is_instrumental = False
-                    lyrics_count += 1
-
-                sample = AudioSample(
-                    audio_path=audio_path,
-                    filename=os.path.basename(audio_path),
-                    duration=duration,
-                    is_instrumental=is_instrumental,
-                    custom_tag=self.metadata.custom_tag,
-                    lyrics=lyrics_content if has_lyrics_file else "[Instrumental]",
-                    raw_lyrics=lyrics_content if has_lyrics_file else "",
-                )
-
-                if csv_metadata and sample.filename in csv_metadata:
-                    meta = csv_metadata[sample.filename]
-                    if meta.get("bpm"):
-                        sample.bpm = meta["bpm"]
-                    if meta.get("key"):
-                        sample.keyscale = meta["key"]
-                    if meta.get("caption"):
-                        sample.caption = meta["caption"]
-                        sample.labeled = True
-                    csv_count += 1
-
-                self.samples.append(sample)
+                sample, cached = future.result()
             except Exception as e:
-                logger.warning(f"Failed to process {audio_path}: {e}")
+                logger.warning(f"Failed to process audio file: {e}")
+                return
+            if sample is None:
+                return
+            counts["cached"] += cached
+            if sample.raw_lyrics:
+                counts["lyrics"] += 1
+            if csv_metadata and sample.filename in csv_metadata:
+                meta = csv_metadata[sample.filename]
+                if meta.get("bpm"):
+                    sample.bpm = meta["bpm"]
+                if meta.get("key"):
+                    sample.keyscale = meta["key"]
+                if meta.get("caption"):
+                    sample.caption = meta["caption"]
+                    sample.labeled = True
+                counts["csv"] += 1
+            self.samples.append(sample)
+
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+            pending = deque()
+            last_yield = 0
+            for audio_path, has_lyrics_file in self._walk_audio_files(directory):
+                found += 1
+                pending.append(pool.submit(self._probe_audio_file, audio_path, has_lyrics_file, index))
+                # Keep results in discovery order; bound the backlog on huge trees
+                while pending and (pending[0].done() or len(pending) > max_pending):
+                    _collect(pending.popleft())
+                if len(self.samples) - last_yield >= chunk_size:
+                    last_yield = len(self.samples)
+                    yield self.samples, f"🔍 Scanning {directory}... {last_yield} audio files found"
+            while pending:
+                _collect(pending.popleft())
+
+        if index is not None:
+            index.save()
+
+        if not found:
+            yield [], (
+                f"❌ No audio files found in {directory}\n"
+                f"Supported formats: {', '.join(SUPPORTED_AUDIO_FORMATS)}"
+            )
+            return
 
+        self.samples.sort(key=lambda s: s.audio_path)
         self.metadata.num_samples = len(self.samples)
 
         status = f"✅ Found {len(self.samples)} audio files in {directory}"
-        if lyrics_count > 0:
-            status += f"\n   📝 {lyrics_count} files have accompanying lyrics (.txt)"
-        if csv_count > 0:
-            status += f"\n   📊 {csv_count} files have metadata from CSV"
-
-        return self.samples, status
+        if counts["lyrics"] > 0:
+            status += f"\n   📝 {counts['lyrics']} files have accompanying lyrics (.txt)"
+        if counts["csv"] > 0:
+            status += f"\n   📊 {counts['csv']} files have metadata from CSV"
+        if counts["cached"] > 0:
+            status += f"\n   ⚡ {counts['cached']} durations reused from the scan index"
+
+        yield self.samples, status
+
+    @staticmethod
+    def _walk_audio_files(directory: str) -> Iterator[Tuple[str, bool]]:
+        """Yield (audio_path, has_lyrics_file) in sorted walk order.
+
+        Lyrics presence comes from the directory listing, so files without a .txt
+        never need an extra stat.
+        """
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            names = set(files)
+            for file in sorted(files):
+                base, ext = os.path.splitext(file)
+                if ext.lower() in SUPPORTED_AUDIO_FORMATS:
+                    yield os.path.join(root, file), base + ".txt" in names
+
+    def _probe_audio_file(
+        self, audio_path: str, has_lyrics_file: bool, index: Optional[ScanIndex]
+    ) -> Tuple[Optional[AudioSample], bool]:
+        """Build the AudioSample for one file; returns (sample, duration_was_cached)."""
+        lyrics_stat = None
+        entry = None
+        audio_stat = None
+        if index is not None:
+            audio_stat = file_stat(audio_path)
+            if audio_stat is None:
+                return None, False
+            if has_lyrics_file:
+                lyrics_stat = file_stat(os.path.splitext(audio_path)[0] + ".txt")
+            entry = index.lookup(audio_path, audio_stat, lyrics_stat)
+
+        if entry is not None:
+            duration = entry["duration"]
+            lyrics_content, has_lyrics = "", entry["has_lyrics"]
+            if has_lyrics:
+                lyrics_content, has_lyrics = load_lyrics_file(audio_path)
+        else:
+            duration = get_audio_duration(audio_path)
+            lyrics_content, has_lyrics = load_lyrics_file(audio_path) if has_lyrics_file else ("", False)
+            # A failed probe (duration 0) may be transient, so don't cache it
+            if index is not None and duration > 0:
+                index.update(audio_path, audio_stat, lyrics_stat, duration, has_lyrics)
+
+        is_instrumental = self.metadata.all_instrumental
+        if has_lyrics:
+            is_instrumental = False
+
+        sample = AudioSample(
+            audio_path=audio_path,
+            filename=os.path.basename(audio_path),
+            duration=duration,
+            is_instrumental=is_instrumental,
+            custom_tag=self.metadata.custom_tag,
+            lyrics=lyrics_content if has_lyrics else "[Instrumental]",
+            raw_lyrics=lyrics_content if has_lyrics else "",
+        )
+        return sample, entry is not None
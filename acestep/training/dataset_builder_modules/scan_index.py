@@ -0,0 +1,102 @@
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+SCAN_INDEX_FILENAME = ".acestep_scan_index.json"
+SCAN_INDEX_VERSION = 1
+
+FileStat = Tuple[int, int]  # (size, mtime_ns)
+
+
+def file_stat(path: str) -> Optional[FileStat]:
+    """(size, mtime_ns) of a file, or None if it cannot be stat'ed."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class ScanIndex:
+    """Persistent per-directory cache of audio metadata probed during scans.
+
+    Entries are keyed by path relative to the scanned directory and hold the
+    audio file's (size, mtime_ns), its duration and the stat of the matching
+    lyrics .txt, so a rescan only probes files that were added or changed.
+    The index lives in ``.acestep_scan_index.json`` inside the directory.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, SCAN_INDEX_FILENAME)
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._seen = set()
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == SCAN_INDEX_VERSION:
+                self._entries = data.get("files", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable scan index {self.path}: {e}")
+
+    def _key(self, audio_path: str) -> str:
+        return os.path.relpath(audio_path, self.directory).replace(os.sep, "/")
+
+    def lookup(
+        self, audio_path: str, audio_stat: FileStat, lyrics_stat: Optional[FileStat]
+    ) -> Optional[Dict[str, Any]]:
+        """Cached entry for audio_path if neither the audio nor its lyrics changed."""
+        key = self._key(audio_path)
+        self._seen.add(key)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if tuple(entry.get("stat") or ()) != tuple(audio_stat):
+            return None
+        cached_lyrics = entry.get("lyrics_stat")
+        if (tuple(cached_lyrics) if cached_lyrics else None) != (tuple(lyrics_stat) if lyrics_stat else None):
+            return None
+        return entry
+
+    def update(
+        self,
+        audio_path: str,
+        audio_stat: FileStat,
+        lyrics_stat: Optional[FileStat],
+        duration: int,
+        has_lyrics: bool,
+    ):
+        key = self._key(audio_path)
+        self._seen.add(key)
+        self._entries[key] = {
+            "stat": list(audio_stat),
+            "lyrics_stat": list(lyrics_stat) if lyrics_stat else None,
+            "duration": duration,
+            "has_lyrics": has_lyrics,
+        }
+        self._dirty = True
+
+    def save(self):
+        """Write the index, dropping entries for files not seen in this scan."""
+        stale = set(self._entries) - self._seen
+        if not self._dirty and not stale:
+            return
+        for key in stale:
+            del self._entries[key]
+
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": SCAN_INDEX_VERSION, "files": self._entries}, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"Failed to save scan index {self.path}: {e}")
@@ -30,8 +30,12 @@ class SerializationMixin:
         try:
             os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else ".", exist_ok=True)
 
-            with open(output_path, "w", encoding="utf-8") as f:
+            # Write to a temp file and swap it in, so an interrupted save never
+            # truncates the dataset already at output_path
+            tmp_path = f"{output_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
                 json.dump(dataset, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, output_path)
 
             return f"✅ Dataset saved to {output_path}\n{len(self.samples)} samples, tag: '{self.metadata.custom_tag}'"
         except Exception as e:
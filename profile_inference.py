@@ -11,6 +11,7 @@ Modes:
     understand      - Profile the understand_music() API (audio codes -> metadata)
     create_sample   - Profile the create_sample() API (inspiration/simple mode)
     format_sample   - Profile the format_sample() API (caption+lyrics -> metadata)
+    lm_decode       - Micro-benchmark the PyTorch LM decode loop (tokens/s)
 
 Usage:
     # Profile text2music with default settings
@@ -30,6 +31,9 @@ Usage:
 
     # Full profiling with cProfile
     python profile_inference.py --detailed --llm-debug
+
+    # PyTorch LM decode loop: torch.cat growth vs preallocated buffer
+    python profile_inference.py --mode lm_decode --lm-backend pt --lm-decode-tokens 1500
 """
 
 import time
@@ -139,7 +143,7 @@ class PreciseTimer:
             torch.cuda.synchronize()
         elif self.device == "mps" and hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
             if hasattr(torch, "mps"):
-            torch.mps.synchronize()
+                torch.mps.synchronize()
         elif self.device.startswith("xpu") and hasattr(torch, "xpu"):
             torch.xpu.synchronize()
     
@@ -247,10 +251,10 @@ def print_time_costs_breakdown(
     time_costs: Dict[str, float], total_wall_time: float
 ):
     """Print a detailed timing breakdown from result.extra_outputs['time_costs']."""
-        print("\n" + "=" * 100)
+    print("\n" + "=" * 100)
     print("PROFILING RESULTS")
-        print("=" * 100)
-        
+    print("=" * 100)
+
     if not time_costs:
         print("\n  (No time_costs data available from the pipeline)")
         print(f"\n  Total wall time: {total_wall_time:.3f}s")
@@ -341,10 +345,10 @@ def print_time_costs_breakdown(
     print(f"\n{'TOTAL WALL TIME':<50} {total_wall_time:<12.3f} {'100.0%':>6}")
 
     # Performance insights
-        print("\n" + "=" * 100)
+    print("\n" + "=" * 100)
     print("PERFORMANCE INSIGHTS")
-        print("=" * 100)
-        
+    print("=" * 100)
+
     if lm_total > 0 and dit_total > 0:
         if lm_total > dit_total * 2:
             print(
@@ -394,7 +398,7 @@ def print_result_summary(result: GenerationResult, mode: str = "profile"):
         if silent_count:
             print(f" ({silent_count} silent)", end="")
         print()
-        else:
+    else:
         print(f"\n  FAILED: {result.error}")
 
 
@@ -763,7 +767,7 @@ def run_create_sample_mode(
     print(f"\n  Query: {query}")
     print(f"  Instrumental: {args.instrumental}")
 
-        timer.sync()
+    timer.sync()
     t0 = time.perf_counter()
 
     result = create_sample(
@@ -826,7 +830,7 @@ def run_format_sample_mode(
     print(f"\n  Caption: {caption[:80]}...")
     print(f"  Lyrics: {lyrics[:80]}...")
 
-        timer.sync()
+    timer.sync()
     t0 = time.perf_counter()
 
     result = format_sample(
@@ -857,6 +861,118 @@ def run_format_sample_mode(
     return result, wall_time
 
 
+# =============================================================================
+# Mode: lm_decode (PyTorch decode-loop micro-benchmark)
+# =============================================================================
+
+
+def _decode_with_cat_growth(llm_handler, input_ids, max_new_tokens: int) -> int:
+    """Reference decode loop that grows ids/mask with torch.cat every token.
+
+    This is how the PyTorch backend decode loops worked before they switched to
+    a preallocated buffer; kept here only as the benchmark baseline.
+    """
+    model = llm_handler.llm
+    eos_token_id = llm_handler.llm_tokenizer.eos_token_id
+    generated_ids = input_ids.clone()
+    attn_mask = torch.ones_like(input_ids)
+    past_key_values = None
+    with torch.inference_mode():
+        for _ in range(max_new_tokens):
+            outputs = llm_handler._forward_pass(
+                model, generated_ids, {"attention_mask": attn_mask},
+                past_key_values, True,
+            )
+            next_tokens = torch.argmax(outputs.logits[:, -1, :], dim=-1)
+            generated_ids = torch.cat([generated_ids, next_tokens.unsqueeze(1)], dim=1)
+            attn_mask = torch.cat(
+                [attn_mask, torch.ones((attn_mask.shape[0], 1), device=attn_mask.device, dtype=attn_mask.dtype)],
+                dim=1,
+            )
+            past_key_values = outputs.past_key_values
+            if eos_token_id is not None and bool((next_tokens == eos_token_id).any()):
+                break
+    return generated_ids.shape[1] - input_ids.shape[1]
+
+
+def run_lm_decode_mode(dit_handler, llm_handler, args, timer: PreciseTimer):
+    """Compare tokens/s of the PyTorch decode loop: torch.cat growth vs preallocated buffer."""
+    if not llm_handler.llm_initialized or llm_handler.llm_backend != "pt":
+        print("\n  lm_decode mode requires the LLM on the PyTorch backend.")
+        print("  Re-run with --lm-backend pt.")
+        sys.exit(1)
+
+    prompt = llm_handler.build_formatted_prompt(
+        "an upbeat synth-pop song with bright female vocals", "[Instrumental]"
+    )
+    max_new_tokens = args.lm_decode_tokens
+    pad_token_id = (
+        llm_handler.llm_tokenizer.pad_token_id
+        or llm_handler.llm_tokenizer.eos_token_id
+    )
+
+    def run_buffer(static_kv: bool) -> int:
+        previous = llm_handler.use_static_kv_cache
+        llm_handler.use_static_kv_cache = static_kv
+        try:
+            outputs = llm_handler._generate_with_constrained_decoding(
+                input_ids=input_ids,
+                attention_mask=None,
+                max_new_tokens=max_new_tokens,
+                temperature=0.0,
+                top_k=None,
+                top_p=None,
+                repetition_penalty=1.0,
+                pad_token_id=pad_token_id,
+                streamer=None,
+                constrained_processor=None,
+            )
+        finally:
+            llm_handler.use_static_kv_cache = previous
+        return outputs.shape[1] - input_ids.shape[1]
+
+    variants = [
+        ("torch.cat growth (before)", lambda: _decode_with_cat_growth(llm_handler, input_ids, max_new_tokens)),
+        ("preallocated buffer (after)", lambda: run_buffer(False)),
+        ("preallocated buffer + static KV", lambda: run_buffer(True)),
+    ]
+
+    results = []
+    with llm_handler._load_model_context():
+        input_ids = llm_handler.llm_tokenizer(prompt, return_tensors="pt")["input_ids"].to(llm_handler.device)
+        print(f"\n  Prompt tokens: {input_ids.shape[1]}, max new tokens: {max_new_tokens} (greedy)")
+
+        if not args.no_warmup:
+            # Short run per variant to exclude kernel selection / allocator warmup
+            saved = max_new_tokens
+            max_new_tokens = 16
+            for _, fn in variants:
+                fn()
+            max_new_tokens = saved
+
+        for name, fn in variants:
+            timer.sync()
+            t0 = time.perf_counter()
+            n_tokens = fn()
+            timer.sync()
+            elapsed = time.perf_counter() - t0
+            tps = n_tokens / elapsed if elapsed > 0 else 0.0
+            results.append({"variant": name, "tokens": n_tokens, "time": elapsed, "tokens_per_s": tps})
+            print(f"    {name:<36} {n_tokens:>6} tokens  {elapsed:>8.2f}s  {tps:>8.1f} tok/s")
+
+    baseline = results[0]["tokens_per_s"]
+    if baseline > 0:
+        for entry in results[1:]:
+            print(f"  Speedup of {entry['variant']}: {entry['tokens_per_s'] / baseline:.2f}x")
+
+    if args.benchmark_output:
+        with open(args.benchmark_output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n  Benchmark results saved to: {args.benchmark_output}")
+
+    return results
+
+
 # =============================================================================
 # cProfile helper
 # =============================================================================
@@ -864,23 +980,23 @@ def run_format_sample_mode(
 
 def _print_cprofile(prof):
     """Print cProfile results and save to file."""
-            import pstats
-            import io
-            
-            output_file = "profile_cprofile_detailed.txt"
+    import pstats
+    import io
+
+    output_file = "profile_cprofile_detailed.txt"
     with open(output_file, "w") as f:
-                ps = pstats.Stats(prof, stream=f)
+        ps = pstats.Stats(prof, stream=f)
         ps.sort_stats("cumulative")
-                ps.print_stats(100)
-            
-            print("\n" + "=" * 100)
+        ps.print_stats(100)
+
+    print("\n" + "=" * 100)
     print("TOP 20 FUNCTIONS BY CUMULATIVE TIME (cProfile)")
-            print("=" * 100)
-            s = io.StringIO()
-            ps = pstats.Stats(prof, stream=s)
+    print("=" * 100)
+    s = io.StringIO()
+    ps = pstats.Stats(prof, stream=s)
     ps.sort_stats("cumulative")
-            ps.print_stats(20)
-            print(s.getvalue())
+    ps.print_stats(20)
+    print(s.getvalue())
     print(f"Full report saved to: {output_file}")
 
 
@@ -938,7 +1054,7 @@ def initialize_handlers(
         or args.use_cot_metas
         or args.use_cot_caption
         or args.use_cot_language
-        or args.mode in ("understand", "create_sample", "format_sample")
+        or args.mode in ("understand", "create_sample", "format_sample", "lm_decode")
     )
 
     if need_llm:
@@ -955,7 +1071,7 @@ def initialize_handlers(
             print(f"  LLM ready (backend={llm_handler.llm_backend})")
         else:
             print(f"  LLM initialization failed: {status_llm}")
-            if args.mode in ("understand", "create_sample", "format_sample"):
+            if args.mode in ("understand", "create_sample", "format_sample", "lm_decode"):
                 sys.exit(1)
     else:
         print(
@@ -1001,6 +1117,7 @@ Examples:
             "understand",
             "create_sample",
             "format_sample",
+            "lm_decode",
         ],
         help="Profiling mode (default: profile)",
     )
@@ -1202,6 +1319,12 @@ Examples:
         default=None,
         help="Save benchmark results to JSON file",
     )
+    parser.add_argument(
+        "--lm-decode-tokens",
+        type=int,
+        default=1200,
+        help="Tokens to decode per variant in lm_decode mode (default: 1200)",
+    )
 
     # create_sample / understand options
     parser.add_argument(
@@ -1307,6 +1430,8 @@ def main():
         run_create_sample_mode(dit_handler, llm_handler, args, timer)
     elif args.mode == "format_sample":
         run_format_sample_mode(dit_handler, llm_handler, args, timer)
+    elif args.mode == "lm_decode":
+        run_lm_decode_mode(dit_handler, llm_handler, args, timer)
 
     print("\n" + "=" * 100)
     print("DONE")